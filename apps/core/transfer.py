@@ -0,0 +1,141 @@
+"""
+大文件传输
+下载在Django中完成鉴权后交给nginx发送（X-Accel-Redirect），上传可由nginx将请求体落盘后只把临时文件路径转发给Django
+"""
+import os
+import re
+import logging
+from typing import Optional
+from urllib.parse import quote
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+
+logger = logging.getLogger(__name__)
+
+# 单次读取的块大小
+BLOCK_SIZE = 1024 * 1024
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def _accel_path(path: str) -> Optional[str]:
+    """将文件路径映射为nginx内部location下的URI，不在映射目录中时返回None"""
+    if not getattr(settings, 'NGINX_ACCEL_REDIRECT', False):
+        return None
+    real_path = os.path.realpath(path)
+    for root, location in getattr(settings, 'NGINX_ACCEL_LOCATIONS', {}).items():
+        root = os.path.realpath(root)
+        if os.path.commonpath([root, real_path]) == root:
+            relative = os.path.relpath(real_path, root)
+            return location.rstrip('/') + '/' + quote(relative)
+    return None
+
+
+def _parse_range(header: str, size: int):
+    """
+    解析单个字节范围
+
+    Returns:
+        （起始，结束）闭区间；不是字节范围或包含多个范围时返回None，范围无法满足时抛出ValueError
+    """
+    match = RANGE_RE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    start, end = match.groups()
+    if start:
+        start = int(start)
+        end = min(int(end), size - 1) if end else size - 1
+    else:
+        # bytes=-N 表示最后N个字节
+        start = max(size - int(end), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise ValueError(header)
+    return start, end
+
+
+def _iter_range(path: str, start: int, length: int):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            data = f.read(min(BLOCK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def file_download_response(request, path: str, filename: Optional[str] = None):
+    """
+    生成文件下载响应
+
+    启用 NGINX_ACCEL_REDIRECT 且文件位于 NGINX_ACCEL_LOCATIONS 映射的目录中时，
+    只返回 X-Accel-Redirect 头，由nginx发送文件并处理Range请求；否则由Django发送，
+    支持单个字节范围的断点续传。
+
+    Args:
+        request: 请求对象
+        path: 文件路径，调用方需已完成鉴权
+        filename: 下载文件名，默认为文件本身的名称
+
+    Returns:
+        HttpResponse
+    """
+    filename = filename or os.path.basename(path)
+    disposition = f"attachment; filename*=UTF-8''{quote(filename)}"
+
+    accel_path = _accel_path(path)
+    if accel_path:
+        response = HttpResponse(content_type='application/octet-stream')
+        response['X-Accel-Redirect'] = accel_path
+        response['Content-Disposition'] = disposition
+        logger.info(f"下载交由nginx发送: {path} -> {accel_path}")
+        return response
+
+    size = os.path.getsize(path)
+    range_header = request.headers.get('Range')
+    try:
+        byte_range = _parse_range(range_header, size) if range_header else None
+    except ValueError:
+        response = HttpResponse(status=416)
+        response['Content-Range'] = f'bytes */{size}'
+        return response
+
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _iter_range(path, start, end - start + 1),
+            status=206, content_type='application/octet-stream'
+        )
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        response['Content-Length'] = str(end - start + 1)
+    else:
+        response = FileResponse(open(path, 'rb'), content_type='application/octet-stream')
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = disposition
+    return response
+
+
+def get_body_file(request) -> Optional[str]:
+    """
+    获取nginx落盘的请求体文件路径
+
+    nginx在 client_body_in_file_only 模式下将请求体写入 NGINX_UPLOAD_DIR，并通过
+    X-Upload-File 头传递路径。未配置 NGINX_UPLOAD_DIR 或路径不在该目录中时忽略此头，
+    防止客户端直接访问后端时伪造路径。
+
+    Returns:
+        请求体文件路径，未使用落盘模式时返回None
+    """
+    upload_dir = getattr(settings, 'NGINX_UPLOAD_DIR', '')
+    path = request.headers.get('X-Upload-File')
+    if not upload_dir or not path:
+        return None
+    upload_dir = os.path.realpath(upload_dir)
+    real_path = os.path.realpath(path)
+    if real_path == upload_dir or os.path.commonpath([upload_dir, real_path]) != upload_dir:
+        logger.warning(f"忽略上传目录之外的请求体文件: {path}")
+        return None
+    if not os.path.isfile(real_path):
+        return None
+    return real_path
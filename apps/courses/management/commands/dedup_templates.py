@@ -0,0 +1,35 @@
+"""
+将已有模板文件存入内容寻址存储
+"""
+import os
+from django.core.management.base import BaseCommand
+
+from apps.courses.models import VirtualMachineTemplate
+from apps.courses.store import ingest_file
+
+
+class Command(BaseCommand):
+    help = '计算未入库模板的SHA-256并存入模板存储，内容相同的文件合并为一个'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='只计算摘要，不修改文件')
+
+    def handle(self, *args, **options):
+        templates = VirtualMachineTemplate.objects.filter(blob__isnull=True)
+        saved = 0
+        for template in templates:
+            if not os.path.exists(template.file_path):
+                self.stderr.write(f"模板 {template.name} 的文件不存在: {template.file_path}")
+                continue
+            if options['dry_run']:
+                self.stdout.write(f"{template.name}: {template.file_path}")
+                continue
+            size = os.path.getsize(template.file_path)
+            # 已有虚拟机以原路径作为后备文件，原路径保留为指向存储文件的硬链接
+            blob = ingest_file(template.file_path, keep_source=True)
+            if blob.templates.exists():
+                saved += size
+            template.blob = blob
+            template.save()
+            self.stdout.write(f"{template.name}: {blob.sha256}")
+        self.stdout.write(f"去重释放 {saved} 字节")
@@ -0,0 +1,37 @@
+"""
+模板页缓存预热
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.courses.models import VirtualMachineTemplate
+from apps.courses.pagecache import prewarm_template, template_residency
+
+
+class Command(BaseCommand):
+    help = '将模板整条后备链读入页缓存，或只报告缓存驻留情况（可在上课前由cron调用）'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--template', action='append', default=[], help='模板ID，可重复指定')
+        parser.add_argument('--course', action='append', default=[], help='课程ID，预热课程的全部模板')
+        parser.add_argument('--method', choices=['fadvise', 'read'], default='fadvise',
+                            help='fadvise 异步预读；read 同步读取，完成后返回')
+        parser.add_argument('--report', action='store_true', help='只报告缓存驻留，不预热')
+
+    def handle(self, *args, **options):
+        if not options['template'] and not options['course']:
+            raise CommandError('请指定 --template 或 --course')
+        templates = VirtualMachineTemplate.objects.filter(id__in=options['template']) | \
+            VirtualMachineTemplate.objects.filter(course_id__in=options['course'])
+
+        for template in templates.distinct():
+            if not options['report']:
+                result = prewarm_template(template, options['method'])
+                self.stdout.write(f"{template.name}: 预热 {len(result['files'])} 个文件, {result['bytes']} 字节")
+            residency = template_residency(template)
+            if residency is None:
+                self.stderr.write('当前平台不支持统计页缓存驻留')
+                continue
+            self.stdout.write(
+                f"{template.name}: 驻留 {residency['resident_bytes']}/{residency['size']} 字节"
+                f"（{residency['percent']}%）"
+            )
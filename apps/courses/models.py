@@ -1,14 +1,28 @@
 from django.db import models
 from django.conf import settings
+from datetime import timedelta
+import uuid
 
 class Course(models.Model):
     """
     课程模型
     """
+    IDLE_POLICY_CHOICES = [
+        ('none', '不处理'),
+        ('pause', '暂停'),
+        ('managed_save', '休眠到磁盘'),
+        ('shutdown', '关机'),
+    ]
+
     name = models.CharField(max_length=255, verbose_name="课程名称")
     description = models.TextField(blank=True, null=True, verbose_name="课程描述")
     teachers = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="teaching_courses", verbose_name="授课教师")
     students = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="enrolled_courses", blank=True, verbose_name="选课学生")
+    idle_policy = models.CharField(max_length=20, choices=IDLE_POLICY_CHOICES, default='none', verbose_name="空闲虚拟机处理策略")
+    idle_timeout_minutes = models.IntegerField(default=120, verbose_name="空闲判定时长 (分钟)")
+    admission_weight = models.PositiveIntegerField(default=1, verbose_name="开机调度权重")
+    cpu_policy = models.CharField(max_length=50, blank=True, default='', verbose_name="CPU调度策略")
+    preemption_priority = models.PositiveIntegerField(default=0, verbose_name="抢占优先级")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
 
@@ -19,21 +33,204 @@ class Course(models.Model):
         verbose_name = "课程"
         verbose_name_plural = verbose_name
 
+class TemplateBlob(models.Model):
+    """
+    按内容寻址存储的模板镜像文件
+
+    文件以SHA-256命名保存在模板存储目录中，内容相同的模板共用一个文件，
+    引用计数为指向该文件的模板与模板版本数，归零时删除文件。
+    """
+    sha256 = models.CharField(max_length=64, unique=True, verbose_name="文件SHA-256")
+    file_path = models.CharField(max_length=1024, verbose_name="文件路径")
+    size = models.BigIntegerField(verbose_name="文件大小 (字节)")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    def __str__(self):
+        return self.sha256
+
+    @property
+    def ref_count(self) -> int:
+        return self.templates.count() + self.versions.count()
+
+    class Meta:
+        verbose_name = "模板镜像文件"
+        verbose_name_plural = verbose_name
+
+
 class VirtualMachineTemplate(models.Model):
     """
     虚拟机模板模型
+
+    镜像头信息在模板创建时读取并保存，元数据一致性检查在后台执行，
+    创建虚拟机时直接使用保存的结果，不再读取镜像文件。
     """
+    VALIDATION_STATUS_CHOICES = [
+        ('pending', '待检查'),
+        ('checking', '检查中'),
+        ('valid', '可用'),
+        ('invalid', '不可用'),
+    ]
+
     name = models.CharField(max_length=255, verbose_name="模板名称")
     description = models.TextField(blank=True, null=True, verbose_name="模板描述")
     file_path = models.CharField(max_length=1024, verbose_name="qcow2文件路径")
+    blob = models.ForeignKey(TemplateBlob, on_delete=models.PROTECT, null=True, blank=True, related_name="templates", verbose_name="镜像文件")
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="上传者")
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name="vm_templates", verbose_name="模板所属课程")
     is_public = models.BooleanField(default=False, verbose_name="是否公开")
+    hardware_profile = models.CharField(max_length=50, default='default', verbose_name="硬件性能配置")
+    sha256 = models.CharField(max_length=64, blank=True, default='', verbose_name="文件SHA-256")
+    format_version = models.IntegerField(default=0, verbose_name="qcow2版本")
+    virtual_size = models.BigIntegerField(default=0, verbose_name="虚拟大小 (字节)")
+    cluster_size = models.IntegerField(default=0, verbose_name="簇大小 (字节)")
+    backing_file = models.CharField(max_length=1024, blank=True, default='', verbose_name="后备文件")
+    is_compressed = models.BooleanField(default=False, verbose_name="包含压缩簇")
+    is_encrypted = models.BooleanField(default=False, verbose_name="是否加密")
+    validation_status = models.CharField(max_length=20, choices=VALIDATION_STATUS_CHOICES, default='pending', verbose_name="检查状态")
+    validation_error = models.TextField(blank=True, default='', verbose_name="检查错误")
+    validated_at = models.DateTimeField(null=True, blank=True, verbose_name="检查时间")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        # 存储中的模板路径由镜像文件决定
+        if self.blob_id:
+            self.file_path = self.blob.file_path
+            self.sha256 = self.blob.sha256
+        super().save(*args, **kwargs)
+
+    @property
+    def min_disk_gb(self) -> int:
+        """基于该模板创建的磁盘的最小大小（GB），尚未读取镜像头时为0"""
+        return -(-self.virtual_size // 1024 ** 3)
+
     class Meta:
         verbose_name = "虚拟机模板"
         verbose_name_plural = verbose_name
+
+
+class TemplateVersion(models.Model):
+    """
+    模板版本
+
+    每个版本是一个qcow2层：基础版本是完整镜像，之后的版本只保存相对父版本的差异，
+    以父版本文件为后备文件。模板的 blob 始终指向最新版本，新建虚拟机在其上创建覆盖层。
+    """
+    template = models.ForeignKey(VirtualMachineTemplate, on_delete=models.CASCADE, related_name="versions", verbose_name="模板")
+    version = models.PositiveIntegerField(verbose_name="版本号")
+    parent = models.ForeignKey('self', on_delete=models.RESTRICT, null=True, blank=True, related_name="children", verbose_name="父版本")
+    blob = models.ForeignKey(TemplateBlob, on_delete=models.PROTECT, null=True, blank=True, related_name="versions", verbose_name="镜像文件")
+    file_path = models.CharField(max_length=1024, verbose_name="文件路径")
+    depth = models.PositiveIntegerField(default=0, verbose_name="后备链深度")
+    size = models.BigIntegerField(default=0, verbose_name="本层文件大小 (字节)")
+    description = models.TextField(blank=True, default='', verbose_name="版本说明")
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="发布者")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    def __str__(self):
+        return f"{self.template.name} v{self.version}"
+
+    def save(self, *args, **kwargs):
+        if self.blob_id:
+            self.file_path = self.blob.file_path
+            self.size = self.blob.size
+        super().save(*args, **kwargs)
+
+    class Meta:
+        verbose_name = "模板版本"
+        verbose_name_plural = verbose_name
+        ordering = ['-version']
+        unique_together = ('template', 'version')
+
+
+class TemplateUpload(models.Model):
+    """
+    分块上传中的模板文件
+
+    分块按偏移顺序直接写入模板存储目录中的临时文件，SHA-256 随分块增量计算；
+    连接中断后客户端查询 offset 从断点继续，全部写完后提交生成模板。
+    """
+    STATUS_CHOICES = [
+        ('uploading', '上传中'),
+        ('committed', '已提交'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="上传者")
+    name = models.CharField(max_length=255, verbose_name="模板名称")
+    description = models.TextField(blank=True, null=True, verbose_name="模板描述")
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, verbose_name="模板所属课程")
+    is_public = models.BooleanField(default=False, verbose_name="是否公开")
+    hardware_profile = models.CharField(max_length=50, default='default', verbose_name="硬件性能配置")
+    size = models.BigIntegerField(verbose_name="文件总大小 (字节)")
+    offset = models.BigIntegerField(default=0, verbose_name="已接收字节数")
+    file_path = models.CharField(max_length=1024, verbose_name="临时文件路径")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='uploading', verbose_name="上传状态")
+    template = models.ForeignKey(VirtualMachineTemplate, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="生成的模板")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    def __str__(self):
+        return f"{self.name} ({self.offset}/{self.size})"
+
+    class Meta:
+        verbose_name = "模板上传"
+        verbose_name_plural = verbose_name
+
+
+class LabSession(models.Model):
+    """
+    课程上机时段
+
+    调度守护进程在开始前 prestart_minutes 分钟起分批启动选课学生的虚拟机（指定了模板时
+    为还没有虚拟机的学生创建），结束 grace_minutes 分钟后按 end_action 关机或休眠。
+    """
+    STATUS_CHOICES = [
+        ('scheduled', '未开始'),
+        ('starting', '预启动中'),
+        ('running', '进行中'),
+        ('finished', '已结束'),
+        ('cancelled', '已取消'),
+    ]
+    END_ACTION_CHOICES = [
+        ('none', '不处理'),
+        ('managed_save', '休眠到磁盘'),
+        ('shutdown', '关机'),
+    ]
+
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name="lab_sessions", verbose_name="课程")
+    title = models.CharField(max_length=255, blank=True, default='', verbose_name="标题")
+    starts_at = models.DateTimeField(verbose_name="开始时间")
+    ends_at = models.DateTimeField(verbose_name="结束时间")
+    template = models.ForeignKey(VirtualMachineTemplate, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="预创建虚拟机使用的模板")
+    vm_cpu_cores = models.IntegerField(default=1, verbose_name="预创建虚拟机CPU核心数")
+    vm_memory_mb = models.IntegerField(default=1024, verbose_name="预创建虚拟机内存 (MB)")
+    vm_disk_gb = models.IntegerField(default=20, verbose_name="预创建虚拟机磁盘 (GB)")
+    prestart_minutes = models.IntegerField(default=10, verbose_name="提前启动 (分钟)")
+    grace_minutes = models.IntegerField(default=15, verbose_name="结束后保留 (分钟)")
+    end_action = models.CharField(max_length=20, choices=END_ACTION_CHOICES, default='managed_save', verbose_name="结束后处理")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='scheduled', verbose_name="状态")
+    last_wave_at = models.DateTimeField(null=True, blank=True, verbose_name="上一批启动时间")
+    started_count = models.IntegerField(default=0, verbose_name="已启动虚拟机数")
+    created_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="创建者")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    def __str__(self):
+        return f"{self.course.name} {self.title or self.starts_at.strftime('%Y-%m-%d %H:%M')}"
+
+    @property
+    def prestart_at(self):
+        """开始预启动的时间"""
+        return self.starts_at - timedelta(minutes=self.prestart_minutes)
+
+    @property
+    def stop_at(self):
+        """执行结束处理的时间"""
+        return self.ends_at + timedelta(minutes=self.grace_minutes)
+
+    class Meta:
+        verbose_name = "上机时段"
+        verbose_name_plural = verbose_name
+        ordering = ['starts_at']
@@ -0,0 +1,193 @@
+"""
+模板页缓存预热
+
+批量开机时大量虚拟机同时读取同一模板的后备文件，冷缓存下全部落到磁盘。上课前将模板
+整条后备链中已分配的区段读入操作系统页缓存（posix_fadvise WILLNEED 或逐页读取），
+开机风暴即可由内存满足；驻留比例通过 mincore 统计。
+"""
+import ctypes
+import ctypes.util
+import logging
+import mmap
+import os
+import threading
+from typing import Dict, List, Optional
+
+from apps.vms.diskcopy import DiskCopier
+from .models import VirtualMachineTemplate
+from .qcow2 import Qcow2Error, read_header
+
+logger = logging.getLogger(__name__)
+
+PAGE_SIZE = mmap.PAGESIZE
+# 统计驻留时每次映射的窗口大小，避免大文件一次占用过多地址空间
+RESIDENCY_WINDOW = 1024 ** 3
+# 逐页读取时单次读取的字节数
+READ_BLOCK = 4 * 1024 * 1024
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.mmap.restype = ctypes.c_void_p
+        libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_int, ctypes.c_int,
+                              ctypes.c_int, ctypes.c_long]
+        libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+        libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t, ctypes.c_char_p]
+        _libc = libc
+    return _libc
+
+
+def mincore_supported() -> bool:
+    """当前平台能否统计页缓存驻留"""
+    try:
+        _get_libc()
+    except (OSError, AttributeError, TypeError):
+        return False
+    return True
+
+
+def backing_chain(path: str) -> List[str]:
+    """
+    返回镜像及其全部后备文件的路径（顶层在前）
+
+    非qcow2文件或无法读取的镜像头视为链的末端。
+    """
+    chain = []
+    while path and path not in chain:
+        chain.append(path)
+        try:
+            backing = read_header(path)['backing_file']
+        except (Qcow2Error, OSError):
+            break
+        if backing and not os.path.isabs(backing):
+            backing = os.path.join(os.path.dirname(path), backing)
+        path = backing
+    return chain
+
+
+def prewarm_file(path: str, method: str = 'fadvise') -> int:
+    """
+    将文件已分配的区段读入页缓存
+
+    Args:
+        path: 文件路径
+        method: fadvise 发起异步预读后立即返回；read 同步逐块读取，返回时已全部进入缓存
+
+    Returns:
+        预热的字节数
+    """
+    warmed = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        for start, length in DiskCopier.iter_data_extents(fd, size):
+            end = start + length
+            if method == 'read':
+                offset = start
+                while offset < end:
+                    data = os.pread(fd, min(READ_BLOCK, end - offset), offset)
+                    if not data:
+                        break
+                    offset += len(data)
+            else:
+                os.posix_fadvise(fd, start, length, os.POSIX_FADV_WILLNEED)
+            warmed += length
+    finally:
+        os.close(fd)
+    return warmed
+
+
+def residency(path: str) -> Dict:
+    """
+    统计文件在页缓存中的驻留情况（mincore）
+
+    Returns:
+        {'size': 文件大小, 'resident_bytes': 驻留字节数, 'percent': 驻留百分比}
+    """
+    libc = _get_libc()
+    resident_pages = 0
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        offset = 0
+        while offset < size:
+            length = min(RESIDENCY_WINDOW, size - offset)
+            addr = libc.mmap(None, length, mmap.PROT_READ, mmap.MAP_SHARED, fd, offset)
+            if addr in (None, ctypes.c_void_p(-1).value):
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), path)
+            try:
+                pages = (length + PAGE_SIZE - 1) // PAGE_SIZE
+                vec = ctypes.create_string_buffer(pages)
+                if libc.mincore(addr, length, vec) != 0:
+                    err = ctypes.get_errno()
+                    raise OSError(err, os.strerror(err), path)
+                resident_pages += sum(b & 1 for b in vec.raw)
+            finally:
+                libc.munmap(addr, length)
+            offset += length
+    finally:
+        os.close(fd)
+    resident = min(resident_pages * PAGE_SIZE, size)
+    return {
+        'size': size,
+        'resident_bytes': resident,
+        'percent': round(resident * 100 / size, 1) if size else 100.0,
+    }
+
+
+def prewarm_template(template: VirtualMachineTemplate, method: str = 'fadvise') -> Dict:
+    """
+    预热模板整条后备链
+
+    Returns:
+        {'files': [{'path', 'bytes'}], 'bytes': 预热总字节数}
+    """
+    files = []
+    for path in backing_chain(template.file_path):
+        try:
+            warmed = prewarm_file(path, method)
+        except OSError as e:
+            logger.warning(f"预热模板文件 {path} 失败: {e}")
+            continue
+        files.append({'path': path, 'bytes': warmed})
+    total = sum(f['bytes'] for f in files)
+    logger.info(f"预热模板 {template.name}: {len(files)} 个文件, {total} 字节")
+    return {'files': files, 'bytes': total}
+
+
+def prewarm_template_async(template: VirtualMachineTemplate, method: str = 'fadvise'):
+    """在后台线程中预热模板"""
+    thread = threading.Thread(target=prewarm_template, args=(template, method))
+    thread.daemon = True
+    thread.start()
+
+
+def template_residency(template: VirtualMachineTemplate) -> Optional[Dict]:
+    """
+    统计模板整条后备链在页缓存中的驻留情况
+
+    Returns:
+        {'files': [{'path', 'size', 'resident_bytes', 'percent'}], 'size', 'resident_bytes', 'percent'}，
+        平台不支持 mincore 时返回 None
+    """
+    if not mincore_supported():
+        return None
+    files = []
+    for path in backing_chain(template.file_path):
+        try:
+            files.append({'path': path, **residency(path)})
+        except OSError as e:
+            logger.warning(f"统计模板文件 {path} 缓存驻留失败: {e}")
+    size = sum(f['size'] for f in files)
+    resident = sum(f['resident_bytes'] for f in files)
+    return {
+        'files': files,
+        'size': size,
+        'resident_bytes': resident,
+        'percent': round(resident * 100 / size, 1) if size else 100.0,
+    }
@@ -0,0 +1,331 @@
+"""
+qcow2镜像头解析与一致性检查
+
+只依赖标准库，按 qcow2 格式规范（docs/interop/qcow2.txt）直接读取镜像文件，
+不调用 qemu-img。
+"""
+import os
+import struct
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+QCOW2_MAGIC = b'QFI\xfb'
+
+# 版本2的头长度；版本3由 header_length 字段给出
+V2_HEADER_LENGTH = 72
+
+# 头扩展类型
+EXT_END = 0x00000000
+EXT_BACKING_FORMAT = 0xe2792aca
+EXT_FEATURE_TABLE = 0x6803f857
+EXT_CRYPTO = 0x0537be77
+EXT_DATA_FILE = 0x44415441
+
+# 不兼容特性位
+INCOMPAT_DIRTY = 1 << 0
+INCOMPAT_CORRUPT = 1 << 1
+INCOMPAT_DATA_FILE = 1 << 2
+INCOMPAT_COMPRESSION = 1 << 3
+INCOMPAT_EXTL2 = 1 << 4
+KNOWN_INCOMPAT = INCOMPAT_DIRTY | INCOMPAT_CORRUPT | INCOMPAT_DATA_FILE | INCOMPAT_COMPRESSION | INCOMPAT_EXTL2
+
+CRYPT_METHODS = {0: None, 1: 'aes', 2: 'luks'}
+COMPRESSION_TYPES = {0: 'zlib', 1: 'zstd'}
+
+# L1/L2/引用计数表项中的偏移掩码
+L1E_OFFSET_MASK = 0x00fffffffffffe00
+L2E_OFFSET_MASK = 0x00fffffffffffe00
+REFT_OFFSET_MASK = 0xfffffffffffffe00
+L1E_RESERVED_MASK = 0x7f000000000001ff
+QCOW_OFLAG_COMPRESSED = 1 << 62
+
+
+class Qcow2Error(Exception):
+    """不是有效的qcow2镜像"""
+    pass
+
+
+def _read_at(f, offset: int, length: int) -> bytes:
+    f.seek(offset)
+    data = f.read(length)
+    if len(data) != length:
+        raise Qcow2Error(f"偏移 {offset} 处数据不完整")
+    return data
+
+
+def read_header(path: str) -> Dict:
+    """
+    读取qcow2镜像头
+
+    只读取头部与头扩展（通常位于第一个簇内），不扫描数据。
+
+    Args:
+        path: 镜像文件路径
+
+    Returns:
+        包含 version、virtual_size、cluster_size、backing_file、backing_format、
+        encrypted、encryption、compression_type、dirty、corrupt、nb_snapshots
+        以及检查所需表位置的字典
+
+    Raises:
+        Qcow2Error: 文件不是qcow2镜像或头部损坏
+    """
+    with open(path, 'rb') as f:
+        data = f.read(V2_HEADER_LENGTH)
+        if len(data) < V2_HEADER_LENGTH or data[:4] != QCOW2_MAGIC:
+            raise Qcow2Error("文件不是qcow2格式")
+
+        (version, backing_file_offset, backing_file_size, cluster_bits, size,
+         crypt_method, l1_size, l1_table_offset, refcount_table_offset,
+         refcount_table_clusters, nb_snapshots, snapshots_offset) = struct.unpack('>IQIIQIIQQIIQ', data[4:72])
+
+        if version not in (2, 3):
+            raise Qcow2Error(f"不支持的qcow2版本: {version}")
+        if not 9 <= cluster_bits <= 21:
+            raise Qcow2Error(f"簇大小无效: 2^{cluster_bits}")
+
+        header_length = V2_HEADER_LENGTH
+        incompatible = compatible = autoclear = 0
+        refcount_order = 4
+        compression_type = 0
+        if version == 3:
+            incompatible, compatible, autoclear, refcount_order, header_length = \
+                struct.unpack('>QQQII', _read_at(f, 72, 32))
+            if header_length < 104:
+                raise Qcow2Error(f"头长度无效: {header_length}")
+            if header_length > 104 and incompatible & INCOMPAT_COMPRESSION:
+                compression_type = _read_at(f, 104, 1)[0]
+            if refcount_order > 6:
+                raise Qcow2Error(f"引用计数宽度无效: 2^{refcount_order}")
+        unknown = incompatible & ~KNOWN_INCOMPAT
+        if unknown:
+            raise Qcow2Error(f"包含未知的不兼容特性: {unknown:#x}")
+
+        cluster_size = 1 << cluster_bits
+        header = {
+            'version': version,
+            'virtual_size': size,
+            'cluster_size': cluster_size,
+            'cluster_bits': cluster_bits,
+            'backing_file': '',
+            'backing_format': '',
+            'encrypted': crypt_method != 0,
+            'encryption': CRYPT_METHODS.get(crypt_method, str(crypt_method)),
+            'compression_type': COMPRESSION_TYPES.get(compression_type, str(compression_type)),
+            'dirty': bool(incompatible & INCOMPAT_DIRTY),
+            'corrupt': bool(incompatible & INCOMPAT_CORRUPT),
+            'external_data_file': bool(incompatible & INCOMPAT_DATA_FILE),
+            'extended_l2': bool(incompatible & INCOMPAT_EXTL2),
+            'refcount_bits': 1 << refcount_order,
+            'header_length': header_length,
+            'l1_size': l1_size,
+            'l1_table_offset': l1_table_offset,
+            'refcount_table_offset': refcount_table_offset,
+            'refcount_table_clusters': refcount_table_clusters,
+            'nb_snapshots': nb_snapshots,
+            'snapshots_offset': snapshots_offset,
+            'crypto_offset': 0,
+            'crypto_length': 0,
+        }
+
+        if backing_file_offset:
+            if backing_file_size > 1023 or backing_file_offset + backing_file_size > cluster_size:
+                raise Qcow2Error("后备文件名位置无效")
+            header['backing_file'] = _read_at(f, backing_file_offset, backing_file_size).decode('utf-8', 'replace')
+
+        # 头扩展紧跟在头之后，各自按8字节对齐
+        offset = header_length
+        end = backing_file_offset or cluster_size
+        while offset + 8 <= end:
+            ext_type, ext_length = struct.unpack('>II', _read_at(f, offset, 8))
+            if ext_type == EXT_END:
+                break
+            if offset + 8 + ext_length > end:
+                raise Qcow2Error("头扩展超出第一个簇")
+            ext_data = _read_at(f, offset + 8, ext_length)
+            if ext_type == EXT_BACKING_FORMAT:
+                header['backing_format'] = ext_data.decode('utf-8', 'replace')
+            elif ext_type == EXT_CRYPTO and ext_length >= 16:
+                header['crypto_offset'], header['crypto_length'] = struct.unpack('>QQ', ext_data[:16])
+            offset += 8 + (ext_length + 7) // 8 * 8
+
+    return header
+
+
+def _read_table(f, offset: int, count: int) -> Tuple[int, ...]:
+    """读取大端64位表项数组"""
+    return struct.unpack(f'>{count}Q', _read_at(f, offset, count * 8))
+
+
+def _iter_refcounts(block: bytes, refcount_bits: int) -> Iterator[int]:
+    """解码一个引用计数块"""
+    if refcount_bits >= 8:
+        width = refcount_bits // 8
+        fmt = {1: 'B', 2: 'H', 4: 'I', 8: 'Q'}[width]
+        yield from struct.unpack(f'>{len(block) // width}{fmt}', block)
+    else:
+        # 宽度小于一字节时低位在前
+        mask = (1 << refcount_bits) - 1
+        for byte in block:
+            for shift in range(0, 8, refcount_bits):
+                yield (byte >> shift) & mask
+
+
+def _snapshot_l1_tables(f, header: Dict) -> Tuple[List[Tuple[int, int]], int]:
+    """读取快照表，返回各快照的（L1表偏移，L1表项数）列表与快照表长度"""
+    tables = []
+    offset = header['snapshots_offset']
+    for _ in range(header['nb_snapshots']):
+        (l1_offset, l1_size, id_size, name_size, _, _, _, _,
+         extra_size) = struct.unpack('>QIHHIIQII', _read_at(f, offset, 40))
+        tables.append((l1_offset, l1_size))
+        length = 40 + extra_size + id_size + name_size
+        offset += (length + 7) // 8 * 8
+    return tables, offset - header['snapshots_offset']
+
+
+def check_image(path: str, header: Optional[Dict] = None) -> Dict:
+    """
+    检查qcow2镜像的元数据一致性（L1/L2表与引用计数）
+
+    遍历当前L1表与各快照的L1表，统计每个主机簇被引用的次数，与引用计数表比对：
+    引用计数小于引用次数、表项越界或未对齐视为错误；引用计数大于引用次数的簇为泄漏，
+    只影响空间占用。同时统计压缩簇与已分配簇数量。
+
+    Args:
+        path: 镜像文件路径
+        header: read_header 的结果，为空时重新读取
+
+    Returns:
+        包含 errors（错误描述列表）、leaked_clusters、allocated_clusters、
+        compressed_clusters、compressed 的字典
+
+    Raises:
+        Qcow2Error: 头部损坏
+    """
+    header = header or read_header(path)
+    cluster_size = header['cluster_size']
+    cluster_bits = header['cluster_bits']
+    file_size = os.path.getsize(path)
+    errors: List[str] = []
+    references: Counter = Counter()
+    allocated = compressed = 0
+
+    def is_valid_offset(offset: int, what: str) -> bool:
+        if offset % cluster_size:
+            errors.append(f"{what}偏移 {offset:#x} 未按簇对齐")
+            return False
+        if offset >= file_size:
+            errors.append(f"{what}偏移 {offset:#x} 超出文件末尾")
+            return False
+        return True
+
+    def reference(offset: int, length: int):
+        for cluster in range(offset >> cluster_bits, ((offset + length - 1) >> cluster_bits) + 1):
+            references[cluster] += 1
+
+    if header['dirty']:
+        errors.append("镜像带有dirty标志，可能未正常关闭")
+    if header['corrupt']:
+        errors.append("镜像已被qemu标记为损坏")
+    if header['external_data_file']:
+        errors.append("不支持外部数据文件")
+        return _check_result(errors, 0, 0, 0)
+
+    l2_entry_size = 16 if header['extended_l2'] else 8
+    l2_entries = cluster_size // l2_entry_size
+    # 压缩簇描述符：低 x 位为主机偏移，其上为额外的512字节扇区数
+    compressed_shift = 62 - (cluster_bits - 8)
+    compressed_offset_mask = (1 << compressed_shift) - 1
+    compressed_sectors_mask = (1 << (cluster_bits - 8)) - 1
+
+    # 头部、后备文件名与头扩展所在的簇
+    reference(0, header['header_length'])
+    if header['crypto_length']:
+        reference(header['crypto_offset'], header['crypto_length'])
+
+    required_l1 = -(-header['virtual_size'] // (cluster_size * l2_entries))
+    if header['l1_size'] < required_l1:
+        errors.append(f"L1表项数 {header['l1_size']} 小于虚拟大小所需的 {required_l1}")
+
+    with open(path, 'rb') as f:
+        l1_tables = [(header['l1_table_offset'], header['l1_size'])]
+        if header['nb_snapshots']:
+            if is_valid_offset(header['snapshots_offset'], "快照表"):
+                snapshot_tables, length = _snapshot_l1_tables(f, header)
+                l1_tables += snapshot_tables
+                reference(header['snapshots_offset'], length)
+
+        seen_l2 = set()
+        for index, (l1_offset, l1_size) in enumerate(l1_tables):
+            what = "L1表" if index == 0 else f"快照{index}的L1表"
+            if not l1_size:
+                continue
+            if not is_valid_offset(l1_offset, what):
+                continue
+            reference(l1_offset, l1_size * 8)
+            for l1_entry in _read_table(f, l1_offset, l1_size):
+                if l1_entry & L1E_RESERVED_MASK:
+                    errors.append(f"{what}表项 {l1_entry:#x} 保留位非零")
+                l2_offset = l1_entry & L1E_OFFSET_MASK
+                if not l2_offset or not is_valid_offset(l2_offset, "L2表"):
+                    continue
+                references[l2_offset >> cluster_bits] += 1
+                # 快照之间共享的L2表只需扫描一次，引用次数仍逐个累计
+                if l2_offset in seen_l2:
+                    continue
+                seen_l2.add(l2_offset)
+                entries = _read_table(f, l2_offset, cluster_size // 8)[::l2_entry_size // 8]
+                for l2_entry in entries:
+                    if l2_entry & QCOW_OFLAG_COMPRESSED:
+                        offset = l2_entry & compressed_offset_mask
+                        sectors = ((l2_entry >> compressed_shift) & compressed_sectors_mask) + 1
+                        if offset >= file_size:
+                            errors.append(f"压缩簇偏移 {offset:#x} 超出文件末尾")
+                            continue
+                        reference(offset & ~511, sectors * 512)
+                        compressed += 1
+                        allocated += 1
+                    else:
+                        offset = l2_entry & L2E_OFFSET_MASK
+                        if offset and is_valid_offset(offset, "数据簇"):
+                            references[offset >> cluster_bits] += 1
+                            allocated += 1
+
+        # 引用计数表及其指向的引用计数块
+        refcount_bits = header['refcount_bits']
+        refcount_table_size = header['refcount_table_clusters'] * cluster_size // 8
+        refcounts: Dict[int, int] = {}
+        if is_valid_offset(header['refcount_table_offset'], "引用计数表"):
+            reference(header['refcount_table_offset'], refcount_table_size * 8)
+            entries_per_block = cluster_size * 8 // refcount_bits
+            refcount_table = _read_table(f, header['refcount_table_offset'], refcount_table_size)
+            for index, entry in enumerate(refcount_table):
+                block_offset = entry & REFT_OFFSET_MASK
+                if not block_offset or not is_valid_offset(block_offset, "引用计数块"):
+                    continue
+                references[block_offset >> cluster_bits] += 1
+                block = _read_at(f, block_offset, cluster_size)
+                first = index * entries_per_block
+                for cluster, count in enumerate(_iter_refcounts(block, refcount_bits), first):
+                    if count:
+                        refcounts[cluster] = count
+
+    for cluster, count in references.items():
+        refcount = refcounts.get(cluster, 0)
+        if refcount < count:
+            errors.append(f"簇 {cluster} 引用计数为 {refcount}，实际被引用 {count} 次")
+    leaked = sum(1 for cluster in refcounts if cluster not in references)
+    return _check_result(errors, leaked, allocated, compressed)
+
+
+def _check_result(errors: List[str], leaked: int, allocated: int, compressed: int) -> Dict:
+    # 错误可能逐簇重复出现，只保留前若干条
+    return {
+        'errors': errors[:20],
+        'error_count': len(errors),
+        'leaked_clusters': leaked,
+        'allocated_clusters': allocated,
+        'compressed_clusters': compressed,
+        'compressed': compressed > 0,
+    }
@@ -1,9 +1,47 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Course, VirtualMachineTemplate
+from django.conf import settings
+from .models import Course, VirtualMachineTemplate, TemplateUpload, TemplateVersion, LabSession
+from apps.vms.profiles import available_profiles
+from apps.vms.cputune import available_cpu_policies
 
 User = get_user_model()
 
+
+def validate_admission_weight(serializer, value):
+    """开机调度权重只能由管理员调整"""
+    if value < 1:
+        raise serializers.ValidationError("开机调度权重至少为1")
+    current = serializer.instance.admission_weight if serializer.instance else 1
+    user = serializer.context['request'].user
+    user_role = getattr(user, 'role', None)
+    role_name = getattr(user_role, 'name', None) if user_role else None
+    if value != current and not (user.is_staff or role_name == 'admin'):
+        raise serializers.ValidationError("只有管理员可以调整开机调度权重")
+    return value
+
+def validate_cpu_policy(serializer, value):
+    """CPU调度策略只能由管理员调整"""
+    if value and value not in available_cpu_policies():
+        raise serializers.ValidationError(f"CPU调度策略 {value} 不存在")
+    current = serializer.instance.cpu_policy if serializer.instance else ''
+    user = serializer.context['request'].user
+    user_role = getattr(user, 'role', None)
+    role_name = getattr(user_role, 'name', None) if user_role else None
+    if value != current and not (user.is_staff or role_name == 'admin'):
+        raise serializers.ValidationError("只有管理员可以调整CPU调度策略")
+    return value
+
+def validate_preemption_priority(serializer, value):
+    """抢占优先级只能由管理员调整"""
+    current = serializer.instance.preemption_priority if serializer.instance else 0
+    user = serializer.context['request'].user
+    user_role = getattr(user, 'role', None)
+    role_name = getattr(user_role, 'name', None) if user_role else None
+    if value != current and not (user.is_staff or role_name == 'admin'):
+        raise serializers.ValidationError("只有管理员可以调整抢占优先级")
+    return value
+
 class CourseSerializer(serializers.ModelSerializer):
     """
     课程序列化器
@@ -19,10 +57,20 @@ class CourseSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'name', 'description', 'teachers', 'students',
             'teachers_count', 'students_count', 'vm_templates_count',
-            'created_at', 'updated_at'
+            'idle_policy', 'idle_timeout_minutes', 'admission_weight', 'cpu_policy',
+            'preemption_priority', 'created_at', 'updated_at'
         ]
         read_only_fields = ['created_at', 'updated_at']
 
+    def validate_admission_weight(self, value):
+        return validate_admission_weight(self, value)
+
+    def validate_cpu_policy(self, value):
+        return validate_cpu_policy(self, value)
+
+    def validate_preemption_priority(self, value):
+        return validate_preemption_priority(self, value)
+
     def get_teachers_count(self, obj):
         return obj.teachers.count()
 
@@ -51,7 +99,16 @@ class CourseCreateSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Course
-        fields = ['name', 'description', 'teacher_ids', 'student_ids']
+        fields = ['name', 'description', 'idle_policy', 'idle_timeout_minutes', 'admission_weight', 'cpu_policy', 'preemption_priority', 'teacher_ids', 'student_ids']
+
+    def validate_admission_weight(self, value):
+        return validate_admission_weight(self, value)
+
+    def validate_cpu_policy(self, value):
+        return validate_cpu_policy(self, value)
+
+    def validate_preemption_priority(self, value):
+        return validate_preemption_priority(self, value)
 
     def create(self, validated_data):
         teacher_ids = validated_data.pop('teacher_ids', [])
@@ -82,14 +139,99 @@ class VirtualMachineTemplateSerializer(serializers.ModelSerializer):
         model = VirtualMachineTemplate
         fields = [
             'id', 'name', 'description', 'file_path', 'owner',
-            'course', 'course_name', 'is_public', 'created_at'
+            'course', 'course_name', 'is_public', 'hardware_profile', 'sha256',
+            'format_version', 'virtual_size', 'cluster_size', 'backing_file',
+            'is_compressed', 'is_encrypted', 'validation_status', 'validation_error',
+            'validated_at', 'created_at'
         ]
-        read_only_fields = ['created_at', 'owner']
+        read_only_fields = [
+            'created_at', 'owner', 'sha256', 'format_version', 'virtual_size', 'cluster_size',
+            'backing_file', 'is_compressed', 'is_encrypted', 'validation_status',
+            'validation_error', 'validated_at'
+        ]
+
+    def validate_hardware_profile(self, value):
+        if value not in available_profiles():
+            raise serializers.ValidationError(f"硬件配置 {value} 不存在")
+        return value
 
     def create(self, validated_data):
         validated_data['owner'] = self.context['request'].user
         return super().create(validated_data)
 
+class TemplateVersionSerializer(serializers.ModelSerializer):
+    """
+    模板版本序列化器
+    """
+    parent_version = serializers.IntegerField(source='parent.version', read_only=True, default=None)
+    sha256 = serializers.CharField(source='blob.sha256', read_only=True, default=None)
+    created_by = serializers.StringRelatedField(read_only=True)
+    vm_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = TemplateVersion
+        fields = [
+            'id', 'version', 'parent_version', 'depth', 'size', 'sha256',
+            'description', 'created_by', 'vm_count', 'created_at'
+        ]
+        read_only_fields = fields
+
+    def get_vm_count(self, obj):
+        return obj.vms.count()
+
+class TemplateUploadSerializer(serializers.ModelSerializer):
+    """
+    模板分块上传序列化器
+    """
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = TemplateUpload
+        fields = [
+            'id', 'name', 'description', 'course', 'is_public', 'hardware_profile',
+            'size', 'offset', 'chunk_size', 'status', 'template', 'created_at', 'updated_at'
+        ]
+        read_only_fields = ['id', 'offset', 'status', 'template', 'created_at', 'updated_at']
+
+    def get_chunk_size(self, obj):
+        """客户端每个分块的大小，与nginx的请求体上限保持一致"""
+        return settings.TEMPLATE_UPLOAD_CHUNK_SIZE
+
+    def validate_size(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("文件大小必须大于0")
+        return value
+
+    def validate_hardware_profile(self, value):
+        if value not in available_profiles():
+            raise serializers.ValidationError(f"硬件配置 {value} 不存在")
+        return value
+
+class LabSessionSerializer(serializers.ModelSerializer):
+    """
+    上机时段序列化器
+    """
+    course_name = serializers.CharField(source='course.name', read_only=True)
+
+    class Meta:
+        model = LabSession
+        fields = [
+            'id', 'course', 'course_name', 'title', 'starts_at', 'ends_at', 'template',
+            'vm_cpu_cores', 'vm_memory_mb', 'vm_disk_gb', 'prestart_minutes', 'grace_minutes',
+            'end_action', 'status', 'started_count', 'created_at'
+        ]
+        read_only_fields = ['status', 'started_count', 'created_at']
+
+    def validate(self, attrs):
+        starts_at = attrs.get('starts_at', getattr(self.instance, 'starts_at', None))
+        ends_at = attrs.get('ends_at', getattr(self.instance, 'ends_at', None))
+        if starts_at and ends_at and ends_at <= starts_at:
+            raise serializers.ValidationError("结束时间必须晚于开始时间")
+        for field in ('prestart_minutes', 'grace_minutes'):
+            if attrs.get(field, 0) < 0:
+                raise serializers.ValidationError({field: "不能为负数"})
+        return attrs
+
 class UserBasicSerializer(serializers.ModelSerializer):
     """
     用户基本信息序列化器（用于课程成员管理）
@@ -0,0 +1,198 @@
+"""
+按内容寻址的模板存储
+
+模板文件以 sha256-<摘要>.qcow2 命名保存在模板存储池目录中，内容相同的上传或转换结果
+合并为同一个文件（TemplateBlob），模板与模板版本通过外键引用，最后一个引用释放时删除文件。
+"""
+import errno
+import hashlib
+import logging
+import os
+import stat
+import uuid
+from typing import Iterable, Optional
+from django.db import transaction
+
+from apps.vms.diskcopy import copy_disk
+from .models import TemplateBlob, VirtualMachineTemplate
+
+logger = logging.getLogger(__name__)
+
+# 计算摘要时单次读取的字节数
+BLOCK_SIZE = 4 * 1024 * 1024
+
+
+class TemplateInUse(Exception):
+    """模板仍被虚拟机使用"""
+    pass
+
+
+def get_store_dir() -> str:
+    """模板存储目录，即 templates 用途的存储池目录"""
+    from apps.vms.libvirt_manager import libvirt_manager
+    return libvirt_manager.storage.get_pool_path('templates')
+
+
+def blob_path(sha256: str, store_dir: Optional[str] = None) -> str:
+    """返回摘要对应的文件路径"""
+    return os.path.join(store_dir or get_store_dir(), f"sha256-{sha256}.qcow2")
+
+
+def temp_path(store_dir: Optional[str] = None) -> str:
+    """返回存储目录中的临时文件路径，写完后通过 ingest_file 入库"""
+    return os.path.join(store_dir or get_store_dir(), f".{uuid.uuid4().hex}.part")
+
+
+def hash_file(path: str) -> str:
+    """流式计算文件的SHA-256"""
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str):
+    """同一文件系统上创建硬链接，否则复制"""
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        copy_disk(src, dst)
+
+
+def ingest_file(path: str, sha256: Optional[str] = None, keep_source: bool = False) -> TemplateBlob:
+    """
+    将文件存入模板存储
+
+    存储中已有相同内容时丢弃该文件（keep_source 时改为指向已有文件的硬链接），
+    否则将其移动到以摘要命名的位置并设为只读。
+
+    Args:
+        path: 文件路径
+        sha256: 已知的SHA-256（如上传时增量计算的结果），为空时读取文件计算
+        keep_source: 保留原路径（已有虚拟机以原路径作为后备文件时使用）
+
+    Returns:
+        对应的镜像文件记录
+    """
+    sha256 = sha256 or hash_file(path)
+    store_dir = get_store_dir()
+    target = blob_path(sha256, store_dir)
+
+    with transaction.atomic():
+        blob = TemplateBlob.objects.select_for_update().filter(sha256=sha256).first()
+        if blob is not None and os.path.exists(blob.file_path):
+            if os.path.realpath(path) != os.path.realpath(blob.file_path):
+                if keep_source:
+                    # 原路径换成指向已有文件的硬链接，释放重复占用的空间
+                    tmp = temp_path(os.path.dirname(path))
+                    _link_or_copy(blob.file_path, tmp)
+                    os.replace(tmp, path)
+                else:
+                    os.remove(path)
+            logger.info(f"模板文件 {path} 与已有文件 {blob.file_path} 内容相同，已去重")
+            return blob
+
+        if os.path.realpath(path) != os.path.realpath(target):
+            if keep_source:
+                _link_or_copy(path, target)
+            else:
+                try:
+                    os.replace(path, target)
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise
+                    copy_disk(path, target)
+                    os.remove(path)
+        # 共享文件不允许被改写
+        os.chmod(target, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+
+        size = os.path.getsize(target)
+        if blob is None:
+            blob = TemplateBlob.objects.create(sha256=sha256, file_path=target, size=size)
+        else:
+            # 记录存在但文件丢失，用新文件恢复
+            blob.file_path, blob.size = target, size
+            blob.save()
+    logger.info(f"模板文件存入存储: {target}, {size} 字节")
+    return blob
+
+
+def ingest_chunks(chunks: Iterable[bytes]) -> TemplateBlob:
+    """
+    将数据流写入存储，边写边计算SHA-256
+
+    Args:
+        chunks: 数据块迭代器（如 UploadedFile.chunks()）
+
+    Returns:
+        对应的镜像文件记录
+    """
+    path = temp_path()
+    hasher = hashlib.sha256()
+    try:
+        with open(path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                hasher.update(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+        return ingest_file(path, sha256=hasher.hexdigest())
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def release_blob(blob: TemplateBlob) -> bool:
+    """
+    释放镜像文件，没有模板和模板版本引用时删除文件与记录
+
+    Returns:
+        是否已删除
+    """
+    with transaction.atomic():
+        blob = TemplateBlob.objects.select_for_update().get(pk=blob.pk)
+        if blob.templates.exists() or blob.versions.exists():
+            return False
+        try:
+            os.remove(blob.file_path)
+        except FileNotFoundError:
+            pass
+        blob.delete()
+    logger.info(f"删除不再引用的模板文件: {blob.file_path}")
+    return True
+
+
+def delete_template(template: VirtualMachineTemplate):
+    """
+    删除模板及其全部版本并释放镜像文件
+
+    虚拟机磁盘以模板文件为后备文件，仍有虚拟机基于该模板时拒绝删除。
+    未存入存储的旧模板直接删除其文件。
+
+    Raises:
+        TemplateInUse: 仍有虚拟机使用该模板
+    """
+    from apps.vms.models import VirtualMachine
+
+    vm_count = VirtualMachine.objects.filter(template=template).count()
+    if vm_count:
+        raise TemplateInUse(f"仍有 {vm_count} 台虚拟机基于此模板，无法删除")
+
+    blobs = {template.blob} | {version.blob for version in template.versions.select_related('blob')}
+    blobs.discard(None)
+    file_path = template.file_path
+    template.delete()
+    if blobs:
+        for blob in blobs:
+            release_blob(blob)
+    else:
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
@@ -0,0 +1,248 @@
+"""
+模板文件分块上传
+"""
+import errno
+import hashlib
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+from django.utils import timezone
+
+from apps.vms.diskcopy import copy_disk
+from .models import TemplateUpload, VirtualMachineTemplate
+from .store import get_store_dir, ingest_file
+from .validation import validate_template_async
+
+logger = logging.getLogger(__name__)
+
+# 单次读写的块大小
+BLOCK_SIZE = 4 * 1024 * 1024
+
+# 进程内缓存的增量哈希状态，键: 上传ID, 值: (已计入哈希的字节数, 哈希对象)
+# 多个工作进程各自缓存；某个进程缺失的区段在下次处理时从文件补读，每个字节每个进程最多补读一次
+_hashers: Dict[str, Tuple[int, 'hashlib._Hash']] = {}
+_hashers_lock = threading.Lock()
+
+
+class UploadError(Exception):
+    """上传请求无效"""
+    pass
+
+
+class UploadConflict(UploadError):
+    """分块偏移与服务端已接收的字节数不一致，客户端应从 offset 处续传"""
+
+    def __init__(self, offset: int):
+        super().__init__(f"偏移不一致，服务端已接收 {offset} 字节")
+        self.offset = offset
+
+
+def get_upload_dir() -> str:
+    """上传文件直接写入模板存储目录，提交时只需重命名"""
+    return get_store_dir()
+
+
+def start_upload(owner, size: int, **fields) -> TemplateUpload:
+    """
+    创建上传会话并在模板存储目录中创建空的临时文件
+
+    Args:
+        owner: 上传者
+        size: 文件总大小（字节）
+        **fields: 模板信息（name、description、course、is_public、hardware_profile）
+
+    Returns:
+        上传会话
+    """
+    upload = TemplateUpload(owner=owner, size=size, **fields)
+    upload.file_path = os.path.join(get_upload_dir(), f"{upload.id.hex}.part")
+    with open(upload.file_path, 'wb'):
+        pass
+    upload.save()
+    logger.info(f"开始上传模板 {upload.name}: {upload.file_path}, {size} 字节")
+    return upload
+
+
+def _hasher_at(upload: TemplateUpload, offset: int):
+    """返回已计入前 offset 字节的哈希对象副本，缓存不足时从文件补读"""
+    with _hashers_lock:
+        position, hasher = _hashers.get(str(upload.id), (0, None))
+    if hasher is None or position > offset:
+        position, hasher = 0, hashlib.sha256()
+    else:
+        hasher = hasher.copy()
+
+    if position < offset:
+        with open(upload.file_path, 'rb') as f:
+            f.seek(position)
+            while position < offset:
+                data = f.read(min(BLOCK_SIZE, offset - position))
+                if not data:
+                    raise UploadError("临时文件长度小于已接收字节数")
+                hasher.update(data)
+                position += len(data)
+    return hasher
+
+
+def write_chunk(upload: TemplateUpload, offset: int, stream, length: int) -> int:
+    """
+    写入一个分块
+
+    Args:
+        upload: 上传会话
+        offset: 分块在文件中的起始偏移，必须等于已接收字节数
+        stream: 分块数据流（请求体）
+        length: 分块长度
+
+    Returns:
+        写入后的已接收字节数；连接中断时只记录实际收到的部分
+
+    Raises:
+        UploadConflict: 偏移与服务端记录不一致
+        UploadError: 上传已提交或分块超出文件大小
+    """
+    if upload.status != 'uploading':
+        raise UploadError("上传已提交")
+    if offset != upload.offset:
+        raise UploadConflict(upload.offset)
+    if offset + length > upload.size:
+        raise UploadError("分块超出文件大小")
+
+    hasher = _hasher_at(upload, offset)
+    position = offset
+    fd = os.open(upload.file_path, os.O_WRONLY)
+    try:
+        while position < offset + length:
+            data = stream.read(min(BLOCK_SIZE, offset + length - position))
+            if not data:
+                break
+            os.pwrite(fd, data, position)
+            hasher.update(data)
+            position += len(data)
+        # 记录的偏移必须已落盘，续传才不会产生空洞
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+    # 以偏移做比较并交换，并发写入同一会话时只有一个请求生效
+    updated = TemplateUpload.objects.filter(
+        id=upload.id, offset=offset, status='uploading'
+    ).update(offset=position, updated_at=timezone.now())
+    if not updated:
+        upload.refresh_from_db()
+        raise UploadConflict(upload.offset)
+
+    with _hashers_lock:
+        _hashers[str(upload.id)] = (position, hasher)
+    upload.offset = position
+    return position
+
+
+def attach_body_file(upload: TemplateUpload, body_path: str) -> int:
+    """
+    以nginx落盘的完整请求体作为上传内容
+
+    请求体文件与模板存储目录位于同一文件系统时直接重命名，Django不读写文件内容；
+    SHA-256 在提交时计算。
+
+    Args:
+        upload: 上传会话，尚未接收任何分块
+        body_path: nginx写入的请求体文件路径
+
+    Returns:
+        已接收字节数
+
+    Raises:
+        UploadConflict: 会话已接收过分块
+        UploadError: 上传已提交或文件大小与会话不一致
+    """
+    if upload.status != 'uploading':
+        raise UploadError("上传已提交")
+    if upload.offset != 0:
+        raise UploadConflict(upload.offset)
+    size = os.path.getsize(body_path)
+    if size != upload.size:
+        os.remove(body_path)
+        raise UploadError(f"文件大小不一致: 收到 {size} 字节，应为 {upload.size} 字节")
+
+    try:
+        os.replace(body_path, upload.file_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # 请求体临时目录与存储池不在同一文件系统
+        copy_disk(body_path, upload.file_path)
+        os.remove(body_path)
+
+    updated = TemplateUpload.objects.filter(
+        id=upload.id, offset=0, status='uploading'
+    ).update(offset=size, updated_at=timezone.now())
+    if not updated:
+        upload.refresh_from_db()
+        raise UploadConflict(upload.offset)
+
+    with _hashers_lock:
+        _hashers.pop(str(upload.id), None)
+    upload.offset = size
+    logger.info(f"模板 {upload.name} 请求体已由nginx落盘: {body_path} -> {upload.file_path}")
+    return size
+
+
+def commit_upload(upload: TemplateUpload, sha256: Optional[str] = None) -> VirtualMachineTemplate:
+    """
+    提交上传，生成模板
+
+    Args:
+        upload: 上传会话
+        sha256: 客户端计算的SHA-256，提供时与服务端结果比对
+
+    Returns:
+        生成的模板
+
+    Raises:
+        UploadError: 文件未传完或校验失败
+    """
+    if upload.status != 'uploading':
+        raise UploadError("上传已提交")
+    if upload.offset != upload.size:
+        raise UploadError(f"文件未上传完成，已接收 {upload.offset}/{upload.size} 字节")
+
+    digest = _hasher_at(upload, upload.size).hexdigest()
+    if sha256 and sha256.lower() != digest:
+        raise UploadError(f"SHA-256 校验失败，服务端计算结果为 {digest}")
+
+    # 按摘要存入存储，与已有模板内容相同时复用已有文件
+    blob = ingest_file(upload.file_path, sha256=digest)
+
+    template = VirtualMachineTemplate.objects.create(
+        name=upload.name,
+        description=upload.description,
+        blob=blob,
+        owner=upload.owner,
+        course=upload.course,
+        is_public=upload.is_public,
+        hardware_profile=upload.hardware_profile,
+    )
+    upload.status = 'committed'
+    upload.file_path = blob.file_path
+    upload.template = template
+    upload.save()
+
+    with _hashers_lock:
+        _hashers.pop(str(upload.id), None)
+    logger.info(f"模板 {template.name} 上传完成: {blob.file_path}, sha256={digest}")
+    validate_template_async(template)
+    return template
+
+
+def abort_upload(upload: TemplateUpload):
+    """放弃上传，删除临时文件与会话"""
+    if upload.status == 'uploading':
+        try:
+            os.remove(upload.file_path)
+        except FileNotFoundError:
+            pass
+    with _hashers_lock:
+        _hashers.pop(str(upload.id), None)
+    upload.delete()
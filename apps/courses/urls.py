@@ -1,11 +1,13 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 from . import views
-from .views import CourseViewSet, VirtualMachineTemplateViewSet
+from .views import CourseViewSet, VirtualMachineTemplateViewSet, TemplateUploadViewSet, LabSessionViewSet
 
 router = DefaultRouter()
 router.register(r'courses', CourseViewSet, basename='course')
 router.register(r'templates', VirtualMachineTemplateViewSet, basename='template')
+router.register(r'template-uploads', TemplateUploadViewSet, basename='template-upload')
+router.register(r'lab-sessions', LabSessionViewSet, basename='lab-session')
 
 app_name = 'courses'
 
@@ -0,0 +1,159 @@
+"""
+模板镜像检查
+"""
+import logging
+import os
+import threading
+from django.utils import timezone
+
+from .models import VirtualMachineTemplate
+from .qcow2 import Qcow2Error, check_image, read_header
+
+logger = logging.getLogger(__name__)
+
+
+def _mark_invalid(template: VirtualMachineTemplate, error: str):
+    template.validation_status = 'invalid'
+    template.validation_error = error
+    template.validated_at = timezone.now()
+    template.save()
+    logger.warning(f"模板 {template.name} 不可用: {error}")
+
+
+def _backing_error(template: VirtualMachineTemplate, backing_file: str) -> str:
+    """
+    校验模板镜像的后备文件，返回错误信息，可用时为空
+
+    学生虚拟机的覆盖层以模板为后备文件，模板不能再依赖宿主机上的任意文件；
+    只有模板新版本的差异层可以以本模板的其他版本为后备文件。
+    """
+    # 相对路径相对于镜像所在目录
+    path = os.path.realpath(os.path.join(os.path.dirname(template.file_path), backing_file))
+    versions = {os.path.realpath(file_path) for file_path in template.versions.values_list('file_path', flat=True)}
+    versions.discard(os.path.realpath(template.file_path))
+    if path not in versions:
+        return f"模板镜像依赖后备文件 {backing_file}，请上传完整镜像"
+    if not os.path.exists(path):
+        return f"模板镜像的后备文件不存在: {backing_file}"
+    return ''
+
+
+def inspect_template(template: VirtualMachineTemplate) -> bool:
+    """
+    读取模板镜像头并保存到模板
+
+    只读取头部，耗时与镜像大小无关。头部有效时状态置为 checking，等待一致性检查。
+
+    Args:
+        template: 模板
+
+    Returns:
+        镜像头是否有效
+    """
+    try:
+        header = read_header(template.file_path)
+    except FileNotFoundError:
+        _mark_invalid(template, '模板文件不存在')
+        return False
+    except (Qcow2Error, OSError) as e:
+        _mark_invalid(template, str(e))
+        return False
+
+    template.format_version = header['version']
+    template.virtual_size = header['virtual_size']
+    template.cluster_size = header['cluster_size']
+    template.backing_file = header['backing_file']
+    template.is_encrypted = header['encrypted']
+    if header['encrypted']:
+        _mark_invalid(template, f"不支持加密镜像（{header['encryption']}）")
+        return False
+    if header['backing_file']:
+        error = _backing_error(template, header['backing_file'])
+        if error:
+            _mark_invalid(template, error)
+            return False
+    template.validation_status = 'checking'
+    template.validation_error = ''
+    template.save()
+    return True
+
+
+def check_template(template_id) -> bool:
+    """
+    对模板镜像做完整检查（镜像头与L1/L2、引用计数表），结果保存到模板
+
+    Args:
+        template_id: 模板ID
+
+    Returns:
+        模板是否可用
+    """
+    try:
+        template = VirtualMachineTemplate.objects.get(id=template_id)
+    except VirtualMachineTemplate.DoesNotExist:
+        return False
+    if not inspect_template(template):
+        return False
+
+    try:
+        result = check_image(template.file_path)
+    except (Qcow2Error, OSError) as e:
+        _mark_invalid(template, str(e))
+        return False
+
+    template.is_compressed = result['compressed']
+    if result['error_count']:
+        _mark_invalid(template, '\n'.join(result['errors']))
+        return False
+    template.validation_status = 'valid'
+    template.validation_error = ''
+    template.validated_at = timezone.now()
+    template.save()
+    if result['leaked_clusters']:
+        logger.info(f"模板 {template.name} 有 {result['leaked_clusters']} 个泄漏簇")
+    logger.info(f"模板 {template.name} 检查通过: {template.virtual_size} 字节, "
+                f"{result['allocated_clusters']} 个已分配簇")
+    return True
+
+
+def copy_validation(template: VirtualMachineTemplate) -> bool:
+    """
+    共用同一镜像文件的模板已检查过时直接复用结果
+
+    Returns:
+        是否已复用
+    """
+    if not template.blob_id:
+        return False
+    source = VirtualMachineTemplate.objects.filter(
+        blob_id=template.blob_id, validation_status__in=('valid', 'invalid')
+    ).exclude(id=template.id).first()
+    if source is None:
+        return False
+    for field in ('format_version', 'virtual_size', 'cluster_size', 'backing_file',
+                  'is_compressed', 'is_encrypted', 'validation_status',
+                  'validation_error', 'validated_at'):
+        setattr(template, field, getattr(source, field))
+    template.save()
+    return True
+
+
+def validate_template_async(template: VirtualMachineTemplate, reuse: bool = True) -> bool:
+    """
+    读取镜像头后在后台线程中做一致性检查
+
+    Args:
+        template: 模板
+        reuse: 是否复用共用同一镜像文件的模板的检查结果
+
+    Returns:
+        镜像头是否有效；无效时模板已标记为不可用
+    """
+    if reuse and copy_validation(template):
+        return template.validation_status != 'invalid'
+    if not inspect_template(template):
+        return False
+    thread = threading.Thread(target=check_template, args=(template.id,))
+    thread.daemon = True
+    thread.start()
+    return True
@@ -0,0 +1,186 @@
+"""
+分层模板版本
+
+基础版本是完整镜像，之后每个版本只保存相对父版本的差异层（以父版本文件为后备文件），
+发布新版本只占用差异的大小。后备链超过 TEMPLATE_MAX_CHAIN_DEPTH 层后在后台合并为
+独立镜像，旧版本在没有虚拟机和子版本引用后释放。
+"""
+import logging
+import os
+import threading
+from typing import Optional
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from . import store
+from .models import TemplateBlob, TemplateVersion, VirtualMachineTemplate
+from .validation import check_template
+
+logger = logging.getLogger(__name__)
+
+# 正在合并的模板ID，避免同一模板并发合并
+_flattening = set()
+_flattening_lock = threading.Lock()
+
+
+def ensure_base_version(template: VirtualMachineTemplate) -> TemplateVersion:
+    """
+    返回模板的最新版本，尚无版本记录时以当前镜像建立版本1
+
+    建立版本1时，该模板已有的虚拟机都以当前镜像为后备文件，一并关联到版本1。
+    """
+    from apps.vms.models import VirtualMachine
+
+    with transaction.atomic():
+        template = VirtualMachineTemplate.objects.select_for_update().get(pk=template.pk)
+        latest = template.versions.first()
+        if latest is not None:
+            return latest
+        latest = TemplateVersion.objects.create(
+            template=template,
+            version=1,
+            blob=template.blob,
+            file_path=template.file_path,
+            depth=0,
+            created_by=template.owner,
+            description=template.description or '',
+        )
+        VirtualMachine.objects.filter(
+            template=template, template_version__isnull=True
+        ).update(template_version=latest)
+    return latest
+
+
+def add_version(template: VirtualMachineTemplate, blob: TemplateBlob,
+                parent: Optional[TemplateVersion], user=None,
+                description: str = '') -> TemplateVersion:
+    """
+    以已入库的镜像文件作为模板的新版本，并将模板指向它
+
+    Args:
+        template: 模板
+        blob: 新版本的镜像文件
+        parent: 父版本，为空表示独立镜像
+        user: 发布者
+        description: 版本说明
+
+    Returns:
+        新版本
+    """
+    with transaction.atomic():
+        template = VirtualMachineTemplate.objects.select_for_update().get(pk=template.pk)
+        number = template.versions.aggregate(n=Max('version'))['n'] or 0
+        version = TemplateVersion.objects.create(
+            template=template,
+            version=number + 1,
+            parent=parent,
+            blob=blob,
+            depth=parent.depth + 1 if parent else 0,
+            created_by=user,
+            description=description,
+        )
+        template.blob = blob
+        template.save()
+    logger.info(f"模板 {template.name} 发布版本 {version.version}，后备链深度 {version.depth}")
+    return version
+
+
+def latest_version(template: VirtualMachineTemplate) -> Optional[TemplateVersion]:
+    """模板的最新版本，尚无版本记录时返回 None"""
+    return template.versions.first()
+
+
+def needs_flatten(version: TemplateVersion) -> bool:
+    """版本的后备链是否超过上限"""
+    return version.depth > settings.TEMPLATE_MAX_CHAIN_DEPTH
+
+
+def flatten_template(template_id) -> Optional[TemplateVersion]:
+    """
+    将模板最新版本的后备链合并为独立镜像，作为新版本发布（在后台线程中执行）
+
+    合并结果内容与最新版本一致，已有虚拟机仍以原版本为后备文件，新建虚拟机使用合并后的版本。
+
+    Args:
+        template_id: 模板ID
+
+    Returns:
+        合并后的版本，无需合并或失败时返回 None
+    """
+    from apps.vms.libvirt_manager import libvirt_manager
+
+    with _flattening_lock:
+        if template_id in _flattening:
+            return None
+        _flattening.add(template_id)
+
+    dest = None
+    try:
+        template = VirtualMachineTemplate.objects.get(id=template_id)
+        latest = latest_version(template)
+        if latest is None or latest.depth == 0:
+            return None
+
+        dest = store.temp_path()
+        libvirt_manager.convert_disk(latest.file_path, dest)
+        blob = store.ingest_file(dest)
+        version = add_version(template, blob, parent=None, user=latest.created_by,
+                              description=f"由版本 {latest.version} 合并")
+        check_template(template.id)
+        prune_versions(template)
+        return version
+    except Exception as e:
+        logger.error(f"合并模板 {template_id} 后备链失败: {e}")
+        if dest and os.path.exists(dest):
+            os.remove(dest)
+        return None
+    finally:
+        with _flattening_lock:
+            _flattening.discard(template_id)
+
+
+def flatten_template_async(template: VirtualMachineTemplate):
+    """在后台线程中合并模板后备链"""
+    thread = threading.Thread(target=flatten_template, args=(template.id,))
+    thread.daemon = True
+    thread.start()
+
+
+def prune_versions(template: VirtualMachineTemplate) -> int:
+    """
+    删除不再需要的旧版本并释放其镜像文件
+
+    可删除的版本：不是最新版本，没有子版本，也没有虚拟机以其为后备文件。
+    仍有未关联版本的虚拟机时不删除任何版本。
+
+    Returns:
+        删除的版本数
+    """
+    from apps.vms.models import VirtualMachine
+
+    if VirtualMachine.objects.filter(template=template, template_version__isnull=True).exists():
+        return 0
+
+    latest = latest_version(template)
+    if latest is None:
+        return 0
+
+    removed = 0
+    while True:
+        candidates = list(
+            template.versions.exclude(pk=latest.pk)
+            .filter(children__isnull=True, vms__isnull=True)
+            .select_related('blob')
+        )
+        if not candidates:
+            break
+        for version in candidates:
+            blob = version.blob
+            version.delete()
+            if blob is not None:
+                store.release_blob(blob)
+            removed += 1
+    if removed:
+        logger.info(f"模板 {template.name} 删除 {removed} 个旧版本")
+    return removed
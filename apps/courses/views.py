@@ -1,14 +1,27 @@
 from django.http import HttpResponse
-from rest_framework import viewsets, permissions, status
+from rest_framework import viewsets, permissions, status, mixins
 from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied
 from rest_framework.response import Response
 from django.contrib.auth import get_user_model
+from django.conf import settings
 from django.db.models import Q
+import os
 
-from .models import Course, VirtualMachineTemplate
+from apps.core.transfer import file_download_response, get_body_file
+from .models import Course, VirtualMachineTemplate, TemplateUpload, LabSession
 from .serializers import (
     CourseSerializer, CourseCreateSerializer, CourseDetailSerializer,
-    VirtualMachineTemplateSerializer, UserBasicSerializer
+    VirtualMachineTemplateSerializer, TemplateUploadSerializer, TemplateVersionSerializer,
+    LabSessionSerializer, UserBasicSerializer
+)
+from .store import TemplateInUse, delete_template
+from .pagecache import prewarm_template_async, template_residency
+from .validation import validate_template_async
+from .versions import ensure_base_version
+from .uploads import (
+    UploadError, UploadConflict, start_upload, write_chunk, attach_body_file,
+    commit_upload, abort_upload
 )
 
 User = get_user_model()
@@ -228,22 +241,246 @@ class VirtualMachineTemplateViewSet(viewsets.ModelViewSet):
                 Q(is_public=True) | Q(course__in=user_courses)
             ).order_by('-created_at')
 
+    def perform_create(self, serializer):
+        template = serializer.save()
+        validate_template_async(template)
+
+    def perform_update(self, serializer):
+        file_path = serializer.instance.file_path
+        template = serializer.save()
+        # 镜像文件变化时重新检查
+        if template.file_path != file_path:
+            validate_template_async(template)
+
+    def destroy(self, request, *args, **kwargs):
+        """删除模板，镜像文件在最后一个引用释放时删除"""
+        template = self.get_object()
+        try:
+            delete_template(template)
+        except TemplateInUse as e:
+            return Response({'error': str(e)}, status=status.HTTP_409_CONFLICT)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
     @action(detail=True, methods=['post'])
     def validate(self, request, pk=None):
         """
-        验证模板文件
+        重新检查模板文件：同步读取qcow2镜像头，一致性检查在后台执行
         """
         template = self.get_object()
-        # 这里可以添加文件验证逻辑
-        # 例如检查文件是否存在、是否为有效的qcow2格式等
-        import os
-        
-        if os.path.exists(template.file_path):
-            # 简单检查文件扩展名
-            if template.file_path.endswith('.qcow2'):
-                return Response({'valid': True, 'message': '模板文件验证通过'})
-            else:
-                return Response({'valid': False, 'message': '文件格式不正确，需要qcow2格式'})
-        else:
+        if not os.path.exists(template.file_path):
             return Response({'valid': False, 'message': '模板文件不存在'}, 
                           status=status.HTTP_404_NOT_FOUND)
+        if validate_template_async(template, reuse=False):
+            message = '镜像头检查通过，正在后台检查元数据一致性'
+        else:
+            message = template.validation_error
+        template.refresh_from_db()
+        return Response({
+            'valid': template.validation_status != 'invalid',
+            'message': message,
+            'template': VirtualMachineTemplateSerializer(template).data,
+        })
+
+    @action(detail=True, methods=['get'])
+    def download(self, request, pk=None):
+        """
+        下载模板文件，鉴权后由nginx发送（X-Accel-Redirect），支持Range断点续传
+        """
+        template = self.get_object()
+        if not os.path.exists(template.file_path):
+            return Response({'error': '模板文件不存在'}, status=status.HTTP_404_NOT_FOUND)
+        return file_download_response(request, template.file_path, f"{template.name}.qcow2")
+
+    @action(detail=True, methods=['get', 'post'])
+    def prewarm(self, request, pk=None):
+        """
+        GET 查询模板后备链在页缓存中的驻留情况；POST 在后台将其读入页缓存
+        """
+        template = self.get_object()
+        if not os.path.exists(template.file_path):
+            return Response({'error': '模板文件不存在'}, status=status.HTTP_404_NOT_FOUND)
+        if request.method == 'POST':
+            method = request.data.get('method', 'fadvise')
+            if method not in ('fadvise', 'read'):
+                return Response({'error': 'method 只能为 fadvise 或 read'}, status=status.HTTP_400_BAD_REQUEST)
+            prewarm_template_async(template, method)
+            return Response({'message': '模板预热已启动'}, status=status.HTTP_202_ACCEPTED)
+        residency = template_residency(template)
+        if residency is None:
+            return Response({'error': '当前平台不支持统计页缓存驻留'}, status=status.HTTP_501_NOT_IMPLEMENTED)
+        return Response(residency)
+
+    @action(detail=True, methods=['get'])
+    def versions(self, request, pk=None):
+        """
+        获取模板版本列表（新版本在前）
+        """
+        template = self.get_object()
+        ensure_base_version(template)
+        versions = template.versions.select_related('parent', 'blob', 'created_by')
+        return Response(TemplateVersionSerializer(versions, many=True).data)
+
+    @action(detail=True, methods=['get'], url_path=r'versions/(?P<version>\d+)/download')
+    def download_version(self, request, pk=None, version=None):
+        """
+        下载某个版本的镜像层，差异版本只包含相对父版本的变化
+        """
+        template = self.get_object()
+        layer = template.versions.filter(version=version).first()
+        if layer is None:
+            return Response({'error': '版本不存在'}, status=status.HTTP_404_NOT_FOUND)
+        if not os.path.exists(layer.file_path):
+            return Response({'error': '模板文件不存在'}, status=status.HTTP_404_NOT_FOUND)
+        return file_download_response(request, layer.file_path, f"{template.name}-v{layer.version}.qcow2")
+
+
+class TemplateUploadViewSet(mixins.CreateModelMixin,
+                            mixins.RetrieveModelMixin,
+                            mixins.DestroyModelMixin,
+                            viewsets.GenericViewSet):
+    """
+    模板分块上传视图集
+
+    POST 创建上传会话，PUT chunk 按偏移写入分块，GET 查询已接收字节数以便续传，
+    POST commit 校验并生成模板，DELETE 放弃上传。
+    """
+    serializer_class = TemplateUploadSerializer
+    permission_classes = [IsTeacherOrAdmin]
+
+    def get_queryset(self):
+        """管理员可以看到所有上传，其他用户只能看到自己的上传"""
+        user = self.request.user
+        if user.is_staff:
+            return TemplateUpload.objects.all()
+        return TemplateUpload.objects.filter(owner=user)
+
+    def perform_create(self, serializer):
+        data = serializer.validated_data
+        serializer.instance = start_upload(self.request.user, **data)
+
+    def perform_destroy(self, instance):
+        abort_upload(instance)
+
+    @action(detail=True, methods=['put'])
+    def chunk(self, request, pk=None):
+        """
+        写入分块：请求体为原始字节，偏移由查询参数 offset 或请求头 Upload-Offset 指定
+        """
+        upload = self.get_object()
+        try:
+            offset = int(request.query_params.get('offset', request.headers.get('Upload-Offset', '')))
+            length = int(request.headers.get('Content-Length', ''))
+        except ValueError:
+            return Response({'error': '缺少有效的 offset 或 Content-Length'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if length > settings.TEMPLATE_UPLOAD_CHUNK_SIZE:
+            return Response({'error': f'分块大小不能超过 {settings.TEMPLATE_UPLOAD_CHUNK_SIZE} 字节',
+                             'chunk_size': settings.TEMPLATE_UPLOAD_CHUNK_SIZE},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        try:
+            # 直接读取原始请求流，不经过Django的上传文件处理
+            new_offset = write_chunk(upload, offset, request._request, length)
+        except UploadConflict as e:
+            return Response({'error': str(e), 'offset': e.offset}, status=status.HTTP_409_CONFLICT)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({'offset': new_offset, 'size': upload.size})
+
+    @action(detail=True, methods=['put'])
+    def body(self, request, pk=None):
+        """
+        一次上传完整文件
+
+        nginx配置了请求体落盘时只转发临时文件路径（X-Upload-File），Django直接将其移入
+        模板存储目录；否则按从偏移0开始的单个分块处理。
+        """
+        upload = self.get_object()
+        body_path = get_body_file(request)
+        try:
+            if body_path:
+                new_offset = attach_body_file(upload, body_path)
+            else:
+                length = int(request.headers.get('Content-Length', ''))
+                new_offset = write_chunk(upload, 0, request._request, length)
+        except ValueError:
+            return Response({'error': '缺少有效的 Content-Length'}, status=status.HTTP_400_BAD_REQUEST)
+        except UploadConflict as e:
+            return Response({'error': str(e), 'offset': e.offset}, status=status.HTTP_409_CONFLICT)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        finally:
+            # nginx在 client_body_in_file_only on 模式下不会删除请求体文件
+            if body_path and os.path.exists(body_path):
+                os.remove(body_path)
+
+        return Response({'offset': new_offset, 'size': upload.size})
+
+    @action(detail=True, methods=['post'])
+    def commit(self, request, pk=None):
+        """
+        提交上传并生成模板，可选传入 sha256 进行校验
+        """
+        upload = self.get_object()
+        try:
+            template = commit_upload(upload, sha256=request.data.get('sha256'))
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(VirtualMachineTemplateSerializer(template).data, status=status.HTTP_201_CREATED)
+
+
+class LabSessionViewSet(viewsets.ModelViewSet):
+    """
+    上机时段视图集
+
+    教师管理自己课程的时段，学生只能查看所选课程的时段；可通过 ?course=<课程ID> 过滤。
+    预启动与结束处理由 run_lab_scheduler 守护进程执行。
+    """
+    serializer_class = LabSessionSerializer
+    permission_classes = [IsTeacherOrAdmin]
+
+    def get_queryset(self):
+        user = self.request.user
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+
+        sessions = LabSession.objects.select_related('course')
+        if not (user.is_staff or role_name == 'admin'):
+            sessions = sessions.filter(Q(course__teachers=user) | Q(course__students=user)).distinct()
+        course_id = self.request.query_params.get('course')
+        if course_id:
+            sessions = sessions.filter(course_id=course_id)
+        return sessions
+
+    def _check_course(self, course):
+        user = self.request.user
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+        if not (user.is_staff or role_name == 'admin' or course.teachers.filter(id=user.id).exists()):
+            raise PermissionDenied('只有课程教师可以管理上机时段')
+
+    def perform_create(self, serializer):
+        self._check_course(serializer.validated_data['course'])
+        serializer.save(created_by=self.request.user)
+
+    def perform_update(self, serializer):
+        self._check_course(serializer.validated_data.get('course', serializer.instance.course))
+        serializer.save()
+
+    def perform_destroy(self, instance):
+        self._check_course(instance.course)
+        instance.delete()
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """
+        取消尚未结束的时段，已启动的虚拟机不受影响
+        """
+        session = self.get_object()
+        self._check_course(session.course)
+        if session.status in ('finished', 'cancelled'):
+            return Response({'error': '时段已结束'}, status=status.HTTP_400_BAD_REQUEST)
+        session.status = 'cancelled'
+        session.save(update_fields=['status'])
+        return Response(LabSessionSerializer(session).data)
@@ -36,6 +36,7 @@ class Quota(models.Model):
     memory_mb = models.IntegerField(default=4096, verbose_name="内存配额 (MB)")
     disk_gb = models.IntegerField(default=100, verbose_name="磁盘空间配额 (GB)")
     vm_limit = models.IntegerField(default=5, verbose_name="虚拟机数量限制")
+    snapshot_limit = models.IntegerField(default=10, verbose_name="快照数量限制")
 
     def __str__(self):
         return f"{self.user.username} 的配额"
@@ -15,9 +15,16 @@ class QuotaSerializer(serializers.ModelSerializer):
     """
     配额序列化器
     """
+    usage = serializers.SerializerMethodField()
+
     class Meta:
         model = Quota
-        fields = ['cpu_cores', 'memory_mb', 'disk_gb', 'vm_limit']
+        fields = ['cpu_cores', 'memory_mb', 'disk_gb', 'vm_limit', 'snapshot_limit', 'usage']
+
+    def get_usage(self, obj):
+        """已占用资源，磁盘同时给出虚拟大小与实际占用"""
+        from apps.vms.quota import QuotaLedger
+        return QuotaLedger(obj.user, quota=obj).usage()
 
 class UserSerializer(serializers.ModelSerializer):
     """
@@ -0,0 +1,453 @@
+"""
+开机准入调度
+
+大量创建、启动请求同时到达时逐个调用 domain.create() 会让宿主机磁盘与CPU饱和。
+所有开机类操作先在宿主机队列中排队，按并发上限与每分钟速率放行；放行的虚拟机在
+检测到开机完成（获得IP或客户机代理响应）前一直占用名额，开机越慢放行越慢。
+
+放行顺序不是先到先得：用户直接发起的单台操作（interactive）整体优先于上机时段预启动等
+批量任务（batch）；同一优先级内按课程、用户两级加权公平排队，一位教师批量排队的大量请求
+不会让其他课程学生的单台请求一直等待。
+
+放行前还需在宿主机容量账本（apps.vms.capacity）中预留vCPU与内存，容量不足时按
+HOST_CAPACITY_EXCEEDED_ACTION 拒绝请求或留在队列中等待其他虚拟机关机；拒绝或排队前先尝试
+抢占同一宿主机上长时间空闲的虚拟机腾出容量（apps.vms.preemption），请求在后台线程休眠
+被抢占的虚拟机期间保持排队，休眠完成后的下一轮放行。
+"""
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from datetime import timedelta
+from typing import Dict, List, Optional
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Prefetch, Q
+from django.utils import timezone
+
+from apps.vms.capacity import CapacityExceeded, capacity
+from apps.vms.libvirt_manager import libvirt_manager
+from apps.vms.models import AdmissionTicket, VirtualMachine
+from apps.vms.preemption import preemptor
+
+logger = logging.getLogger(__name__)
+
+# 占用开机名额的状态
+ACTIVE_STATUSES = ('admitted', 'booting')
+# 优先级由高到低
+PRIORITY_ORDER = ('interactive', 'batch')
+
+
+def prefetch_admission(queryset):
+    """预取虚拟机进行中的开机准入记录（VirtualMachine.admission）"""
+    return queryset.prefetch_related(Prefetch(
+        'admission_tickets', to_attr='active_admissions',
+        queryset=AdmissionTicket.objects.filter(status__in=('queued',) + ACTIVE_STATUSES),
+    ))
+
+
+class AdmissionScheduler:
+    """
+    宿主机开机准入调度器
+
+    队列保存在数据库中（AdmissionTicket），有排队请求时由后台线程轮询放行。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._dispatcher = None
+        # 键: 准入记录ID, 值: 是否仍在休眠被抢占的虚拟机；每个请求只抢占一次
+        self._preempting: Dict[str, bool] = {}
+
+    @property
+    def host(self) -> str:
+        """默认连接的宿主机标识"""
+        return libvirt_manager.uri
+
+    def host_for(self, vm: VirtualMachine) -> str:
+        """虚拟机所在宿主机的队列标识：宿主机名称，未分配宿主机时为默认连接URI"""
+        return vm.host.name if vm.host_id else self.host
+
+    def submit(self, vm: VirtualMachine, operation: str, priority: str = 'interactive') -> AdmissionTicket:
+        """
+        为虚拟机操作排队
+
+        同一虚拟机已有相同操作在排队时返回已有记录；用户再次直接发起时批量请求提升为交互优先级。
+
+        Args:
+            vm: 虚拟机
+            operation: create、start 或 restart
+            priority: interactive（用户直接发起）或 batch（批量任务）
+
+        Returns:
+            准入记录；状态为 admitted 时调用方应立即通过 run() 执行，queued 时由后台线程执行
+        """
+        ticket = vm.admission_tickets.filter(operation=operation, status='queued').first()
+        if ticket is None:
+            ticket = AdmissionTicket.objects.create(
+                vm=vm, operation=operation, priority=priority, host=self.host_for(vm)
+            )
+        elif priority == 'interactive' and ticket.priority != 'interactive':
+            ticket.priority = priority
+            ticket.save(update_fields=['priority'])
+        for admitted in self.admit():
+            if admitted.id == ticket.id:
+                ticket = admitted
+            else:
+                self._run_in_thread(admitted)
+        if ticket.status == 'queued':
+            # 容量不足时可能已被拒绝
+            ticket.refresh_from_db()
+        if ticket.status == 'queued':
+            logger.info(f"虚拟机 {vm.name} {ticket.get_operation_display()}请求排队，位置 {ticket.position}")
+            self._ensure_dispatcher()
+        return ticket
+
+    def check_boots(self, now=None):
+        """检查各宿主机上开机中的虚拟机，开机完成或超时后释放名额"""
+        from apps.vms.services import vm_service
+
+        now = now or timezone.now()
+        timeout = timedelta(seconds=settings.ADMISSION_BOOT_TIMEOUT)
+        booting = AdmissionTicket.objects.filter(status='booting').select_related('vm', 'vm__host')
+        for ticket in booting:
+            try:
+                completed = vm_service.manager_for(ticket.vm).boot_completed(ticket.vm.name)
+            except Exception as e:
+                logger.warning(f"检测虚拟机 {ticket.vm.name} 开机状态失败: {e}")
+                completed = False
+            if completed:
+                ticket.booted_at = now
+            elif now - ticket.admitted_at < timeout:
+                continue
+            else:
+                ticket.error = '开机检测超时'
+            ticket.status = 'done'
+            ticket.finished_at = now
+            ticket.save(update_fields=['status', 'booted_at', 'error', 'finished_at'])
+            if ticket.booted_at:
+                logger.info(f"虚拟机 {ticket.vm.name} 开机完成，耗时 {ticket.boot_seconds:.1f} 秒")
+
+    def free_slots(self, now=None, host: Optional[str] = None) -> int:
+        """宿主机当前可放行的数量，host 为空时为默认连接"""
+        now = now or timezone.now()
+        host = host or self.host
+        slots = []
+        if settings.ADMISSION_MAX_CONCURRENT_BOOTS:
+            active = AdmissionTicket.objects.filter(host=host, status__in=ACTIVE_STATUSES).count()
+            slots.append(settings.ADMISSION_MAX_CONCURRENT_BOOTS - active)
+        if settings.ADMISSION_BOOTS_PER_MINUTE:
+            recent = AdmissionTicket.objects.filter(
+                host=host, admitted_at__gte=now - timedelta(minutes=1)
+            ).count()
+            slots.append(settings.ADMISSION_BOOTS_PER_MINUTE - recent)
+        if not slots:
+            return AdmissionTicket.objects.filter(host=host, status='queued').count()
+        return max(min(slots), 0)
+
+    def _served_counts(self, now, host: str):
+        """公平排队窗口内各课程、各（课程，用户）已放行的次数"""
+        window_start = now - timedelta(seconds=settings.ADMISSION_FAIR_SHARE_WINDOW)
+        course_served = defaultdict(int)
+        user_served = defaultdict(int)
+        recent = AdmissionTicket.objects.filter(
+            host=host, admitted_at__gte=window_start
+        ).values_list('vm__course_id', 'vm__owner_id')
+        for course_id, owner_id in recent:
+            course_served[course_id] += 1
+            user_served[(course_id, owner_id)] += 1
+        return course_served, user_served
+
+    def ordered_queue(self, now=None, host: Optional[str] = None) -> List[AdmissionTicket]:
+        """
+        按放行顺序返回宿主机上排队中的请求，host 为空时为默认连接
+
+        交互请求整体排在批量请求之前。同一优先级内先选近期放行次数除以课程权重最小的课程，
+        再在课程内选近期放行次数最少的用户，取该用户最早的请求；近期指
+        ADMISSION_FAIR_SHARE_WINDOW 秒内，每选出一个请求即计入其课程与用户。
+        不属于任何课程的虚拟机视为权重为1的同一课程。
+        """
+        now = now or timezone.now()
+        host = host or self.host
+        queued = list(AdmissionTicket.objects.filter(
+            host=host, status='queued'
+        ).select_related('vm', 'vm__course', 'vm__host'))
+        if len(queued) <= 1:
+            return queued
+
+        course_served, user_served = self._served_counts(now, host)
+        ordered = []
+        for priority in PRIORITY_ORDER:
+            # 课程 -> 用户 -> 按排队时间排列的请求
+            flows = {}
+            weights = {}
+            for ticket in queued:
+                if ticket.priority != priority:
+                    continue
+                course_id = ticket.vm.course_id
+                flows.setdefault(course_id, {}).setdefault(ticket.vm.owner_id, deque()).append(ticket)
+                weights[course_id] = ticket.vm.course.admission_weight if ticket.vm.course else 1
+
+            while flows:
+                course_id = min(flows, key=lambda c: (
+                    course_served[c] / max(weights[c], 1),
+                    min(q[0].created_at for q in flows[c].values()),
+                ))
+                users = flows[course_id]
+                owner_id = min(users, key=lambda u: (user_served[(course_id, u)], users[u][0].created_at))
+                ordered.append(users[owner_id].popleft())
+                course_served[course_id] += 1
+                user_served[(course_id, owner_id)] += 1
+                if not users[owner_id]:
+                    del users[owner_id]
+                if not users:
+                    del flows[course_id]
+        return ordered
+
+    def positions(self, tickets) -> Dict:
+        """
+        批量计算排队请求的位置，每台宿主机只排序一次队列
+
+        Args:
+            tickets: 准入记录，只用到其中排队中记录的宿主机
+
+        Returns:
+            {准入记录ID: 位置}，包含这些宿主机上的全部排队请求
+        """
+        hosts = {ticket.host for ticket in tickets if ticket.status == 'queued'}
+        positions = {}
+        now = timezone.now()
+        for host in hosts:
+            for index, queued in enumerate(self.ordered_queue(now, host=host)):
+                positions[queued.id] = index + 1
+        return positions
+
+    def position(self, ticket: AdmissionTicket) -> int:
+        """排队请求按当前放行顺序的位置（从1开始），不在队列中时为0"""
+        for index, queued in enumerate(self.ordered_queue(host=ticket.host)):
+            if queued.id == ticket.id:
+                return index + 1
+        return 0
+
+    def tenant_metrics(self, now=None) -> List[Dict]:
+        """
+        按课程、用户统计队列深度与等待时间
+
+        Returns:
+            每个租户一项：queued、interactive、batch 为当前排队数，oldest_wait_seconds 为
+            最早排队请求已等待的时间；admitted、avg_wait_seconds、max_wait_seconds 为公平排队
+            窗口内已放行请求从排队到放行的等待时间
+        """
+        now = now or timezone.now()
+        window_start = now - timedelta(seconds=settings.ADMISSION_FAIR_SHARE_WINDOW)
+        tickets = AdmissionTicket.objects.filter(
+            Q(status='queued') | Q(admitted_at__gte=window_start)
+        ).select_related('vm', 'vm__course', 'vm__owner')
+
+        tenants = {}
+        for ticket in tickets:
+            vm = ticket.vm
+            key = (vm.course_id, vm.owner_id)
+            tenant = tenants.get(key)
+            if tenant is None:
+                tenant = tenants[key] = {
+                    'course': vm.course_id,
+                    'course_name': vm.course.name if vm.course else None,
+                    'user': vm.owner_id,
+                    'username': vm.owner.username,
+                    'queued': 0, 'interactive': 0, 'batch': 0, 'oldest_wait_seconds': 0.0,
+                    'admitted': 0, 'avg_wait_seconds': None, 'max_wait_seconds': None,
+                    '_waits': [],
+                }
+            if ticket.status == 'queued':
+                tenant['queued'] += 1
+                tenant[ticket.priority] += 1
+                waited = (now - ticket.created_at).total_seconds()
+                tenant['oldest_wait_seconds'] = max(tenant['oldest_wait_seconds'], round(waited, 1))
+            else:
+                tenant['admitted'] += 1
+                tenant['_waits'].append((ticket.admitted_at - ticket.created_at).total_seconds())
+
+        result = []
+        for tenant in tenants.values():
+            waits = tenant.pop('_waits')
+            if waits:
+                tenant['avg_wait_seconds'] = round(sum(waits) / len(waits), 1)
+                tenant['max_wait_seconds'] = round(max(waits), 1)
+            result.append(tenant)
+        result.sort(key=lambda t: (-t['queued'], -t['oldest_wait_seconds']))
+        return result
+
+    def admit(self, now=None) -> List[AdmissionTicket]:
+        """
+        按公平排队顺序放行，放行前预留宿主机容量
+
+        容量不足的请求按 HOST_CAPACITY_EXCEEDED_ACTION 处理：reject 时标记为失败，
+        queue 时留在队列中，名额让给后面容量足够的请求。
+
+        Returns:
+            本次放行的准入记录
+        """
+        now = now or timezone.now()
+        admitted = []
+        preemptions = []
+        with self._lock:
+            self.check_boots(now)
+            hosts = set(AdmissionTicket.objects.filter(status='queued').values_list('host', flat=True))
+            for host in sorted(hosts):
+                admitted.extend(self._admit_host(host, now, preemptions))
+        # 休眠耗时数秒，在锁外执行，不阻塞其他请求的排队与放行
+        for ticket, victims in preemptions:
+            self._preempt_in_thread(ticket, victims, now)
+        return admitted
+
+    def _reserve(self, ticket: AdmissionTicket, now, preemptions: list) -> bool:
+        """
+        为放行的请求预留宿主机容量
+
+        容量不足时规划抢占空闲虚拟机，计划加入 preemptions 由调用方在锁外执行，
+        请求保持排队，休眠完成后的下一轮重新预留。
+
+        Returns:
+            是否预留成功，False 表示请求等待抢占完成
+
+        Raises:
+            CapacityExceeded: 容量不足且无法（或已经）抢占
+        """
+        key = str(ticket.id)
+        if self._preempting.get(key):
+            return False
+        try:
+            capacity.reserve(ticket.vm, include_disk=ticket.operation == 'create')
+            return True
+        except CapacityExceeded:
+            # 重启的虚拟机已持有预留，只有创建与启动抢占
+            if ticket.operation == 'restart' or key in self._preempting:
+                raise
+            victims = preemptor.plan_room(ticket.vm, now)
+            if not victims:
+                raise
+            self._preempting[key] = True
+            preemptions.append((ticket, victims))
+            logger.info(f"虚拟机 {ticket.vm.name} {ticket.get_operation_display()}请求等待抢占 "
+                        f"{len(victims)} 台空闲虚拟机")
+            return False
+
+    def _preempt(self, ticket: AdmissionTicket, victims: list, now):
+        """休眠被抢占的虚拟机，完成后唤醒放行线程"""
+        try:
+            preemptor.preempt(ticket.vm, victims, now)
+        finally:
+            with self._lock:
+                self._preempting[str(ticket.id)] = False
+        self._ensure_dispatcher()
+
+    def _preempt_in_thread(self, ticket: AdmissionTicket, victims: list, now):
+        def _run():
+            try:
+                self._preempt(ticket, victims, now)
+            except Exception as e:
+                logger.error(f"为虚拟机 {ticket.vm.name} 抢占空闲虚拟机失败: {e}")
+            finally:
+                close_old_connections()
+
+        thread = threading.Thread(target=_run)
+        thread.daemon = True
+        thread.start()
+
+    def _admit_host(self, host: str, now, preemptions: list) -> List[AdmissionTicket]:
+        """放行单台宿主机队列中的请求"""
+        free = self.free_slots(now, host)
+        if free <= 0:
+            return []
+        admitted = []
+        for ticket in self.ordered_queue(now, host):
+            if len(admitted) >= free:
+                break
+            try:
+                if not self._reserve(ticket, now, preemptions):
+                    continue
+            except CapacityExceeded as e:
+                if settings.HOST_CAPACITY_EXCEEDED_ACTION == 'reject':
+                    AdmissionTicket.objects.filter(id=ticket.id, status='queued').update(
+                        status='failed', error=str(e), finished_at=now)
+                    self._preempting.pop(str(ticket.id), None)
+                    logger.warning(f"虚拟机 {ticket.vm.name} {ticket.get_operation_display()}请求被拒绝: {e}")
+                continue
+            self._preempting.pop(str(ticket.id), None)
+            # 条件更新，多个进程同时放行时只有一个成功
+            if AdmissionTicket.objects.filter(id=ticket.id, status='queued').update(
+                    status='admitted', admitted_at=now):
+                ticket.status, ticket.admitted_at = 'admitted', now
+                admitted.append(ticket)
+        return admitted
+
+    def run(self, ticket: AdmissionTicket) -> Dict:
+        """
+        执行已放行的操作，成功后进入开机检测
+
+        Returns:
+            操作结果
+        """
+        from apps.vms.services import vm_service
+
+        handlers = {
+            'create': vm_service.create_vm_sync,
+            'start': vm_service.start_vm_now,
+            'restart': vm_service.restart_vm_now,
+        }
+        try:
+            result = handlers[ticket.operation](str(ticket.vm_id))
+        except Exception as e:
+            result = {'success': False, 'error': str(e)}
+        if result['success']:
+            ticket.status = 'booting'
+        else:
+            ticket.status = 'failed'
+            ticket.error = result['error']
+            ticket.finished_at = timezone.now()
+            if ticket.operation != 'restart':
+                capacity.release(ticket.vm)
+        ticket.save(update_fields=['status', 'error', 'finished_at'])
+        return result
+
+    def _run_in_thread(self, ticket: AdmissionTicket):
+        def _run():
+            try:
+                self.run(ticket)
+            finally:
+                close_old_connections()
+
+        thread = threading.Thread(target=_run)
+        thread.daemon = True
+        thread.start()
+
+    def _ensure_dispatcher(self):
+        """有排队请求时启动后台放行线程，队列清空后线程退出"""
+        with self._lock:
+            if self._dispatcher is not None:
+                return
+            self._dispatcher = threading.Thread(target=self._dispatch_loop)
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+
+    def _dispatch_loop(self):
+        try:
+            while True:
+                # 与 _ensure_dispatcher 互斥，避免退出的同时有新请求排队
+                with self._lock:
+                    if not AdmissionTicket.objects.filter(status='queued').exists():
+                        self._dispatcher = None
+                        return
+                for ticket in self.admit():
+                    self._run_in_thread(ticket)
+                time.sleep(settings.ADMISSION_POLL_INTERVAL)
+        except Exception as e:
+            logger.error(f"开机准入调度线程异常退出: {e}")
+            with self._lock:
+                self._dispatcher = None
+        finally:
+            close_old_connections()
+
+
+admission = AdmissionScheduler()
@@ -0,0 +1,162 @@
+"""
+内存气球与KSM密度管理
+
+宿主机内存紧张时，通过内存气球回收空闲虚拟机来宾中未使用的内存，并在宿主机容量账本中
+同步调低预留，让同一宿主机能开更多虚拟机；虚拟机重新活动或来宾内存吃紧时恢复到配置的内存。
+同一模板的虚拟机内存页高度相似，KSM合并的效果按模板汇总报告。
+"""
+import logging
+from datetime import timedelta
+from typing import Dict, Optional
+from django.conf import settings
+from django.utils import timezone
+
+from apps.vms.capacity import CapacityExceeded, capacity
+from apps.vms.libvirt_manager import KSM_PAGE_SIZE, get_manager, libvirt_manager
+from apps.vms.models import Host, VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+# 气球调整的最小幅度(MB)，避免反复微调
+BALLOON_MIN_STEP_MB = 64
+
+
+class MemoryManager:
+    """
+    内存气球管理器
+
+    依赖 IdleReaper 写入的 last_activity_at，应在每轮采样后执行。气球只作用于运行中的域，
+    虚拟机重启后恢复定义中的内存。
+    """
+
+    @staticmethod
+    def under_pressure(info: Optional[Dict]) -> bool:
+        """宿主机可用内存是否低于物理内存的 BALLOON_HOST_FREE_PERCENT"""
+        if info is None or not settings.BALLOON_HOST_FREE_PERCENT:
+            return False
+        return info['available_mb'] < info['memory_mb'] * settings.BALLOON_HOST_FREE_PERCENT / 100
+
+    def shrink_target(self, vm: VirtualMachine, stats: Dict) -> int:
+        """气球回收后的内存(MB)：来宾已用内存加余量，不低于配置内存的 BALLOON_MIN_PERCENT"""
+        used_mb = (stats['available'] - stats['usable']) // 1024
+        floor_mb = vm.memory_mb * settings.BALLOON_MIN_PERCENT // 100
+        return min(max(used_mb + settings.BALLOON_HEADROOM_MB, floor_mb), vm.memory_mb)
+
+    def shrink(self, vm: VirtualMachine, memory_mb: int):
+        """放大气球，将虚拟机内存回收到 memory_mb 并调低容量预留"""
+        from apps.vms.services import vm_service
+
+        vm_service.manager_for(vm).set_balloon(vm.name, memory_mb)
+        capacity.shrink(vm, memory_mb)
+        vm.memory_current_mb = memory_mb
+        vm.save(update_fields=['memory_current_mb'])
+
+    def grow(self, vm: VirtualMachine):
+        """
+        收回气球，恢复到配置的内存
+
+        Raises:
+            CapacityExceeded: 宿主机容量不足，保持当前大小
+        """
+        from apps.vms.services import vm_service
+
+        capacity.reserve(vm, memory_mb=vm.memory_mb)
+        vm_service.manager_for(vm).set_balloon(vm.name, vm.memory_mb)
+        vm.memory_current_mb = None
+        vm.save(update_fields=['memory_current_mb'])
+
+    def run_once(self, now=None) -> Dict:
+        """
+        执行一轮气球调整
+
+        Returns:
+            {'checked', 'shrunk', 'grown', 'reclaimed_mb'}，reclaimed_mb 为本轮回收的内存
+        """
+        from apps.vms.services import vm_service
+
+        now = now or timezone.now()
+        result = {'checked': 0, 'shrunk': 0, 'grown': 0, 'reclaimed_mb': 0}
+        # 关机或休眠后气球随重启复位
+        VirtualMachine.objects.filter(memory_current_mb__isnull=False).exclude(
+            status__in=('running', 'paused')
+        ).update(memory_current_mb=None)
+
+        idle_before = now - timedelta(minutes=settings.BALLOON_IDLE_MINUTES)
+        hosts: Dict[Optional[int], list] = {}
+        for vm in VirtualMachine.objects.filter(status='running').select_related('host'):
+            hosts.setdefault(vm.host_id, []).append(vm)
+        for vms in hosts.values():
+            pressure = self.under_pressure(capacity.host_info(vms[0].host))
+            for vm in vms:
+                result['checked'] += 1
+                manager = vm_service.manager_for(vm)
+                stats = manager.get_memory_stats(vm.name)
+                if not stats:
+                    continue
+                if 'usable' not in stats or 'available' not in stats:
+                    # 启用气球统计之前定义的虚拟机，下一轮才有数据
+                    manager.enable_memory_stats(vm.name, settings.BALLOON_STATS_PERIOD)
+                    continue
+                current_mb = stats.get('actual', vm.memory_mb * 1024) // 1024
+                idle = vm.last_activity_at is not None and vm.last_activity_at < idle_before
+                try:
+                    if current_mb < vm.memory_mb - BALLOON_MIN_STEP_MB:
+                        tight = stats['usable'] // 1024 < settings.BALLOON_HEADROOM_MB
+                        if not idle or tight:
+                            self.grow(vm)
+                            result['grown'] += 1
+                            logger.info(f"虚拟机 {vm.name} 内存恢复到 {vm.memory_mb}MB")
+                    elif pressure and idle:
+                        target = self.shrink_target(vm, stats)
+                        if target <= current_mb - BALLOON_MIN_STEP_MB:
+                            self.shrink(vm, target)
+                            result['shrunk'] += 1
+                            result['reclaimed_mb'] += current_mb - target
+                            logger.info(f"空闲虚拟机 {vm.name} 内存从 {current_mb}MB 回收到 {target}MB")
+                except CapacityExceeded as e:
+                    logger.warning(f"虚拟机 {vm.name} 暂不能恢复内存: {e}")
+                except Exception as e:
+                    logger.error(f"调整虚拟机 {vm.name} 内存气球失败: {e}")
+        return result
+
+    def report(self, host: Optional[Host] = None) -> Dict:
+        """
+        宿主机内存密度报告
+
+        Returns:
+            {'host', 'ksm', 'ballooned', 'reclaimed_mb', 'templates'}：ksm 为宿主机KSM统计，
+            ballooned 为气球回收中的虚拟机，templates 按模板汇总运行中虚拟机的内存与KSM合并量
+            （ksm_merging_mb 只在本机可读取进程信息时给出）
+        """
+        manager = libvirt_manager if host is None else get_manager(host)
+        vms = VirtualMachine.objects.filter(host=host, status='running').select_related('template')
+        ballooned = [
+            {'id': str(vm.id), 'name': vm.name, 'memory_mb': vm.memory_mb,
+             'memory_current_mb': vm.memory_current_mb}
+            for vm in vms if vm.memory_current_mb is not None
+        ]
+        templates = {}
+        for vm in vms:
+            entry = templates.setdefault(vm.template_id, {
+                'template_id': vm.template_id,
+                'template': vm.template.name if vm.template else None,
+                'vms': 0, 'memory_mb': 0, 'ksm_merging_mb': None,
+            })
+            entry['vms'] += 1
+            entry['memory_mb'] += vm.memory_current_mb or vm.memory_mb
+            pages = manager.get_ksm_merging_pages(vm.name)
+            if pages is not None:
+                entry['ksm_merging_mb'] = (entry['ksm_merging_mb'] or 0) + pages * KSM_PAGE_SIZE / (1024 * 1024)
+        for entry in templates.values():
+            if entry['ksm_merging_mb'] is not None:
+                entry['ksm_merging_mb'] = round(entry['ksm_merging_mb'], 1)
+        return {
+            'host': capacity.host_key(host),
+            'ksm': manager.get_ksm_stats(),
+            'ballooned': ballooned,
+            'reclaimed_mb': sum(vm['memory_mb'] - vm['memory_current_mb'] for vm in ballooned),
+            'templates': sorted(templates.values(), key=lambda t: -t['vms']),
+        }
+
+
+memory_manager = MemoryManager()
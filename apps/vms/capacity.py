@@ -0,0 +1,258 @@
+"""
+宿主机容量账本
+
+用户配额只限制单个用户，所有用户的虚拟机同时开机仍可能超出宿主机内存。开机、创建与在线
+调整配置前按虚拟机的vCPU与内存预留宿主机容量，已预留总量不超过物理容量乘以超分比例；
+磁盘按全部虚拟机的虚拟大小与磁盘存储池容量比较。每台宿主机（apps.vms.models.Host）单独记账，
+未分配宿主机的虚拟机计入默认连接。
+"""
+import logging
+import threading
+from datetime import timedelta
+from typing import Dict, Optional
+from django.conf import settings
+from django.db import models, transaction
+from django.utils import timezone
+
+from apps.vms.libvirt_manager import get_manager, libvirt_manager
+from apps.vms.models import CapacityReservation, Host, VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+# 占用宿主机CPU与内存的虚拟机状态
+ACTIVE_VM_STATUSES = ('creating', 'running', 'paused')
+
+
+class CapacityExceeded(Exception):
+    """宿主机容量不足"""
+    pass
+
+
+class HostCapacity:
+    """
+    宿主机容量账本
+
+    预留记录保存在数据库中（CapacityReservation），预留在进程锁与数据库事务中完成。
+    无法获取宿主机信息时，宿主机上已有运行中的虚拟机则拒绝预留，否则不限制。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @property
+    def host(self) -> str:
+        """默认连接的宿主机标识"""
+        return libvirt_manager.uri
+
+    def host_key(self, host: Optional[Host]) -> str:
+        """预留记录中的宿主机标识：宿主机名称，默认连接为其URI"""
+        return host.name if host is not None else self.host
+
+    def host_info(self, host: Optional[Host] = None) -> Optional[Dict]:
+        """宿主机物理容量，获取失败时返回None"""
+        try:
+            manager = libvirt_manager if host is None else get_manager(host)
+            return manager.get_host_capacity()
+        except Exception as e:
+            logger.error(f"获取宿主机 {self.host_key(host)} 容量失败: {e}")
+            return None
+
+    def _require_info(self, host: Optional[Host], vm: VirtualMachine) -> Optional[Dict]:
+        """
+        校验容量所需的宿主机信息
+
+        宿主机配置错误（如缺少 disks 存储池）时容量读取失败，不能因此关闭容量限制；
+        宿主机上还没有运行中的虚拟机时（如尚未部署libvirt的开发环境）不限制。
+
+        Returns:
+            宿主机信息，不限制时返回None
+
+        Raises:
+            CapacityExceeded: 无法获取宿主机信息且宿主机上有运行中的虚拟机
+        """
+        info = self.host_info(host)
+        if info is None:
+            active = VirtualMachine.objects.filter(host=host, status__in=ACTIVE_VM_STATUSES).exclude(id=vm.id)
+            if active.exists():
+                raise CapacityExceeded(f"无法获取宿主机 {self.host_key(host)} 容量，暂不能分配")
+            logger.error(f"无法获取宿主机 {self.host_key(host)} 容量，宿主机上没有运行中的虚拟机，不限制")
+        return info
+
+    @staticmethod
+    def limits(info: Dict) -> Dict:
+        """按超分比例计算可分配上限"""
+        return {
+            'cpu_cores': int(info['cpus'] * settings.HOST_CPU_OVERCOMMIT),
+            'memory_mb': int(max(info['memory_mb'] - settings.HOST_RESERVED_MEMORY_MB, 0)
+                             * settings.HOST_MEMORY_OVERCOMMIT),
+            'disk_gb': int(info['disk_capacity_gb'] * settings.HOST_DISK_OVERCOMMIT),
+        }
+
+    def reconcile(self, host: Optional[Host] = None, now=None):
+        """清理已关机但未经服务层释放的预留（如客户机内关机），开机中的预留保留到开机超时"""
+        now = now or timezone.now()
+        stale = now - timedelta(seconds=settings.ADMISSION_BOOT_TIMEOUT)
+        CapacityReservation.objects.filter(host=self.host_key(host), updated_at__lt=stale).exclude(
+            vm__status__in=ACTIVE_VM_STATUSES
+        ).delete()
+
+    def committed(self, host: Optional[Host] = None,
+                  exclude_vm: Optional[VirtualMachine] = None) -> Dict:
+        """
+        宿主机已分配的容量
+
+        Args:
+            host: 宿主机，为空时统计默认连接
+            exclude_vm: 不计入统计的虚拟机（调整配置时排除自身）
+        """
+        reservations = CapacityReservation.objects.filter(host=self.host_key(host))
+        vms = VirtualMachine.objects.filter(host=host).exclude(status='deleting')
+        if exclude_vm is not None:
+            reservations = reservations.exclude(vm=exclude_vm)
+            vms = vms.exclude(id=exclude_vm.id)
+        totals = reservations.aggregate(
+            cpu_cores=models.Sum('cpu_cores'),
+            memory_mb=models.Sum('memory_mb'),
+        )
+        # 启用容量账本前已在运行、没有预留记录的虚拟机按其配置计入
+        unreserved = vms.filter(
+            status__in=ACTIVE_VM_STATUSES, capacity_reservation__isnull=True
+        ).aggregate(cpu_cores=models.Sum('cpu_cores'), memory_mb=models.Sum('memory_mb'))
+        return {
+            'cpu_cores': (totals['cpu_cores'] or 0) + (unreserved['cpu_cores'] or 0),
+            'memory_mb': (totals['memory_mb'] or 0) + (unreserved['memory_mb'] or 0),
+            # 磁盘为精简置备，按全部虚拟机的虚拟大小计算
+            'disk_gb': vms.aggregate(disk_gb=models.Sum('disk_gb'))['disk_gb'] or 0,
+        }
+
+    def usage(self, host: Optional[Host] = None) -> Dict:
+        """宿主机容量、上限与已分配情况"""
+        info = self.host_info(host)
+        return {
+            'host': self.host_key(host),
+            'info': info,
+            'overcommit': {
+                'cpu': settings.HOST_CPU_OVERCOMMIT,
+                'memory': settings.HOST_MEMORY_OVERCOMMIT,
+                'disk': settings.HOST_DISK_OVERCOMMIT,
+            },
+            'limits': self.limits(info) if info else None,
+            'committed': self.committed(host),
+            'reservations': CapacityReservation.objects.filter(host=self.host_key(host)).count(),
+        }
+
+    def _check(self, info: Dict, committed: Dict, cpu_cores: int, memory_mb: int,
+               memory_growth: int, disk_gb: Optional[int]):
+        limits = self.limits(info)
+        if committed['cpu_cores'] + cpu_cores > limits['cpu_cores']:
+            raise CapacityExceeded(
+                f"宿主机CPU容量不足：已分配 {committed['cpu_cores']} 核，"
+                f"上限 {limits['cpu_cores']} 核，申请 {cpu_cores} 核"
+            )
+        if committed['memory_mb'] + memory_mb > limits['memory_mb']:
+            raise CapacityExceeded(
+                f"宿主机内存容量不足：已分配 {committed['memory_mb']}MB，"
+                f"上限 {limits['memory_mb']}MB，申请 {memory_mb}MB"
+            )
+        # 允许内存超分时以实际可用内存兜底，避免触发OOM
+        if settings.HOST_MEMORY_OVERCOMMIT > 1 and \
+                info['available_mb'] - settings.HOST_RESERVED_MEMORY_MB < memory_growth:
+            raise CapacityExceeded(
+                f"宿主机可用内存不足：可用 {info['available_mb']}MB，"
+                f"保留 {settings.HOST_RESERVED_MEMORY_MB}MB，申请 {memory_growth}MB"
+            )
+        if disk_gb is not None and committed['disk_gb'] + disk_gb > limits['disk_gb']:
+            raise CapacityExceeded(
+                f"宿主机磁盘容量不足：已分配 {committed['disk_gb']}GB，"
+                f"上限 {limits['disk_gb']}GB，申请 {disk_gb}GB"
+            )
+
+    def check_fit(self, vm: VirtualMachine, host: Optional[Host] = None,
+                  info: Optional[Dict] = None, include_disk: bool = True):
+        """
+        校验虚拟机能否放到宿主机上（不预留），用于放置调度
+
+        Raises:
+            CapacityExceeded: 容量不足
+        """
+        info = info or self._require_info(host, vm)
+        if info is None:
+            return
+        self._check(info, self.committed(host, exclude_vm=vm), vm.cpu_cores, vm.memory_mb,
+                    vm.memory_mb, vm.disk_gb if include_disk else None)
+
+    def reserve(self, vm: VirtualMachine, cpu_cores: Optional[int] = None,
+                memory_mb: Optional[int] = None, include_disk: bool = False) -> Optional[CapacityReservation]:
+        """
+        在虚拟机所在宿主机上预留容量，已有预留时按新配置更新
+
+        Args:
+            vm: 虚拟机
+            cpu_cores: 预留的CPU核心数，默认取虚拟机配置
+            memory_mb: 预留的内存大小(MB)，默认取虚拟机配置
+            include_disk: 是否同时校验虚拟机磁盘（创建时）
+
+        Returns:
+            预留记录，宿主机上没有运行中的虚拟机且无法获取宿主机信息时不限制并返回None
+
+        Raises:
+            CapacityExceeded: 容量不足，或无法获取有运行中虚拟机的宿主机的信息
+        """
+        cpu_cores = cpu_cores or vm.cpu_cores
+        memory_mb = memory_mb or vm.memory_mb
+        host = vm.host if vm.host_id else None
+        info = self._require_info(host, vm)
+        if info is None:
+            return None
+        with self._lock, transaction.atomic():
+            self.reconcile(host)
+            committed = self.committed(host, exclude_vm=vm)
+            # 已预留的虚拟机（运行中调整配置、重启）只需新增部分的可用内存
+            existing = CapacityReservation.objects.filter(vm=vm).first()
+            growth = memory_mb - existing.memory_mb if existing else memory_mb
+            self._check(info, committed, cpu_cores, memory_mb, growth,
+                        vm.disk_gb if include_disk else None)
+            reservation, _ = CapacityReservation.objects.update_or_create(
+                vm=vm, defaults={'host': self.host_key(host), 'cpu_cores': cpu_cores, 'memory_mb': memory_mb}
+            )
+        logger.info(f"虚拟机 {vm.name} 在宿主机 {reservation.host} 预留容量 {cpu_cores} 核 / {memory_mb}MB")
+        return reservation
+
+    def shrink(self, vm: VirtualMachine, memory_mb: int):
+        """
+        将运行中虚拟机的内存预留调低到气球回收后的大小，回收的内存可供其他虚拟机开机
+
+        气球放大时通过 reserve 重新预留。
+        """
+        host = vm.host if vm.host_id else None
+        with self._lock:
+            CapacityReservation.objects.update_or_create(
+                vm=vm, defaults={'host': self.host_key(host), 'cpu_cores': vm.cpu_cores, 'memory_mb': memory_mb}
+            )
+        logger.info(f"虚拟机 {vm.name} 内存预留调低到 {memory_mb}MB")
+
+    def check_disk(self, vm: VirtualMachine, disk_gb: int):
+        """
+        校验磁盘扩容后的宿主机磁盘容量
+
+        Raises:
+            CapacityExceeded: 容量不足
+        """
+        host = vm.host if vm.host_id else None
+        info = self._require_info(host, vm)
+        if info is None:
+            return
+        limit = self.limits(info)['disk_gb']
+        committed = self.committed(host, exclude_vm=vm)['disk_gb']
+        if committed + disk_gb > limit:
+            raise CapacityExceeded(
+                f"宿主机磁盘容量不足：已分配 {committed}GB，上限 {limit}GB，申请 {disk_gb}GB"
+            )
+
+    def release(self, vm: VirtualMachine):
+        """释放虚拟机的容量预留"""
+        if CapacityReservation.objects.filter(vm=vm).delete()[0]:
+            logger.info(f"虚拟机 {vm.name} 释放宿主机容量预留")
+
+
+capacity = HostCapacity()
@@ -0,0 +1,157 @@
+"""
+虚拟机CPU调度策略与限流
+
+域定义中的 cputune 按课程与所有者角色的策略生成（见 settings.VM_CPU_POLICIES），
+避免单台虚拟机占满宿主机CPU。宿主机CPU紧张时，限流器临时压低持续高负载虚拟机的配额。
+"""
+import logging
+from datetime import timedelta
+from typing import Dict, Optional
+from django.conf import settings
+from django.utils import timezone
+
+from apps.vms.capacity import capacity
+from apps.vms.models import VirtualMachine
+from apps.vms.profiles import merge_policies
+
+logger = logging.getLogger(__name__)
+
+# 所有策略项及其默认值，0 表示使用虚拟化层默认值（不写入 cputune）
+DEFAULT_CPU_POLICY: Dict = {
+    # 相对权重，宿主机CPU紧张时按权重分配
+    'shares': 0,
+    # 配额周期（微秒）
+    'period': 0,
+    # 每个vCPU每个周期可运行的时间（微秒），0 表示不限制
+    'quota': 0,
+}
+
+# 未设置周期时内核的默认周期（微秒）
+DEFAULT_CPU_PERIOD = 100000
+
+
+def available_cpu_policies() -> list:
+    """返回可用的CPU调度策略名称"""
+    return sorted(set(getattr(settings, 'VM_CPU_POLICIES', {})) | {'default'})
+
+
+def resolve_cpu_policy(vm: VirtualMachine) -> Dict:
+    """
+    解析虚拟机的CPU调度策略
+
+    依次合并 default、课程策略（Course.cpu_policy）与所有者角色策略（settings.VM_CPU_ROLE_POLICIES），
+    后者覆盖前者设置的项。
+
+    Args:
+        vm: 虚拟机
+
+    Returns:
+        {'shares', 'period', 'quota'}
+    """
+    return merge_policies(
+        DEFAULT_CPU_POLICY, getattr(settings, 'VM_CPU_POLICIES', {}),
+        getattr(settings, 'VM_CPU_ROLE_POLICIES', {}), vm.owner,
+        policy=vm.course.cpu_policy if vm.course_id else None, label='CPU调度策略',
+    )
+
+
+class CpuThrottler:
+    """
+    CPU限流器
+
+    依赖 IdleReaper 写入的 cpu_usage_percent 采样，应在每轮采样后执行。限流只作用于运行中的域
+    （不写入持久化定义），到期后恢复策略配额，虚拟机重启也会解除。
+    """
+
+    def __init__(self):
+        # 键: 虚拟机ID, 值: CPU使用率持续超过阈值的起始时间
+        self._high_since: Dict[str, object] = {}
+
+    @staticmethod
+    def contended(vms, host=None) -> bool:
+        """宿主机上运行中虚拟机的CPU使用量之和是否达到物理CPU的 CPU_THROTTLE_HOST_PERCENT"""
+        info = capacity.host_info(host)
+        if info is None:
+            return False
+        demand = sum(vm.cpu_cores * vm.cpu_usage_percent / 100 for vm in vms
+                     if vm.cpu_usage_percent is not None)
+        return demand >= info['cpus'] * settings.CPU_THROTTLE_HOST_PERCENT / 100
+
+    def throttle(self, vm: VirtualMachine, now):
+        """将虚拟机每个vCPU的配额压低到 CPU_THROTTLE_QUOTA_PERCENT"""
+        from apps.vms.services import vm_service
+
+        policy = resolve_cpu_policy(vm)
+        period = policy['period'] or DEFAULT_CPU_PERIOD
+        quota = int(period * settings.CPU_THROTTLE_QUOTA_PERCENT / 100)
+        if policy['quota']:
+            quota = min(quota, policy['quota'])
+        vm_service.manager_for(vm).set_cpu_tune(vm.name, period=period, quota=quota, persistent=False)
+        vm.cpu_throttled_until = now + timedelta(seconds=settings.CPU_THROTTLE_DURATION)
+        vm.save(update_fields=['cpu_throttled_until'])
+        logger.info(f"虚拟机 {vm.name} CPU持续 {vm.cpu_usage_percent}%，限流到每vCPU {quota}/{period}微秒")
+
+    def release(self, vm: VirtualMachine):
+        """恢复虚拟机的策略配额"""
+        from apps.vms.services import vm_service
+
+        if vm.status == 'running':
+            policy = resolve_cpu_policy(vm)
+            vm_service.manager_for(vm).set_cpu_tune(vm.name, period=policy['period'] or DEFAULT_CPU_PERIOD,
+                                           quota=policy['quota'], persistent=False)
+            logger.info(f"虚拟机 {vm.name} 解除CPU限流")
+        vm.cpu_throttled_until = None
+        vm.save(update_fields=['cpu_throttled_until'])
+
+    def run_once(self, now=None) -> Dict:
+        """
+        执行一轮限流检查
+
+        Returns:
+            {'checked', 'throttled', 'released'}
+        """
+        now = now or timezone.now()
+        result = {'checked': 0, 'throttled': 0, 'released': 0}
+        if not settings.CPU_THROTTLE_VM_PERCENT:
+            return result
+
+        # 到期或已关机的限流
+        expired = VirtualMachine.objects.filter(cpu_throttled_until__isnull=False).exclude(
+            status='running', cpu_throttled_until__gt=now
+        ).select_related('host', 'course', 'owner__role')
+        for vm in expired:
+            try:
+                self.release(vm)
+                result['released'] += 1
+            except Exception as e:
+                logger.error(f"解除虚拟机 {vm.name} CPU限流失败: {e}")
+
+        hosts: Dict[Optional[int], list] = {}
+        for vm in VirtualMachine.objects.filter(status='running').select_related('host', 'course', 'owner__role'):
+            hosts.setdefault(vm.host_id, []).append(vm)
+        running = set()
+        for vms in hosts.values():
+            contended = self.contended(vms, vms[0].host)
+            for vm in vms:
+                result['checked'] += 1
+                key = str(vm.id)
+                running.add(key)
+                # 限流中的虚拟机解除后重新计算持续时间
+                if vm.cpu_throttled_until is not None or vm.cpu_usage_percent is None or \
+                        vm.cpu_usage_percent < settings.CPU_THROTTLE_VM_PERCENT:
+                    self._high_since.pop(key, None)
+                    continue
+                since = self._high_since.setdefault(key, now)
+                if not contended:
+                    continue
+                if now - since < timedelta(seconds=settings.CPU_THROTTLE_SUSTAIN_SECONDS):
+                    continue
+                try:
+                    self.throttle(vm, now)
+                    self._high_since.pop(key, None)
+                    result['throttled'] += 1
+                except Exception as e:
+                    logger.error(f"限流虚拟机 {vm.name} 失败: {e}")
+        for key in set(self._high_since) - running:
+            del self._high_since[key]
+        return result
@@ -0,0 +1,170 @@
+"""
+磁盘镜像复制引擎
+"""
+import errno
+import fcntl
+import logging
+import os
+import shutil
+import time
+from typing import Callable, Dict, Iterator, Optional, Tuple
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# linux/fs.h: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# 文件系统不支持reflink或源与目标不在同一文件系统时返回的错误码
+REFLINK_UNSUPPORTED = {errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS}
+
+# copy_file_range 不可用时改用 pread/pwrite 的错误码
+COPY_RANGE_UNSUPPORTED = {errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL}
+
+
+class DiskCopier:
+    """
+    磁盘镜像复制器
+
+    优先使用reflink（FICLONE）克隆，XFS/btrfs 上几乎不耗时；不支持时按
+    SEEK_DATA/SEEK_HOLE 只复制已分配的区段（copy_file_range，内核内完成），
+    目标文件保持稀疏。支持进度回调与限速。
+    """
+
+    def __init__(self, bytes_per_sec: Optional[int] = None,
+                 progress: Optional[Callable[[int, int], None]] = None,
+                 chunk_size: int = 16 * 1024 * 1024):
+        """
+        初始化复制器
+
+        Args:
+            bytes_per_sec: 限速（字节/秒），为空时使用 settings.DISK_COPY_BYTES_PER_SEC，0 表示不限速
+            progress: 进度回调，参数为（已复制字节，需复制的总字节）
+            chunk_size: 单次复制的最大字节数，决定进度与限速的粒度
+        """
+        if bytes_per_sec is None:
+            bytes_per_sec = getattr(settings, 'DISK_COPY_BYTES_PER_SEC', 0)
+        self.bytes_per_sec = bytes_per_sec
+        self.progress = progress
+        self.chunk_size = chunk_size
+
+    def copy(self, src: str, dst: str) -> Dict:
+        """
+        复制磁盘镜像
+
+        Args:
+            src: 源文件路径
+            dst: 目标文件路径，已存在时被覆盖
+
+        Returns:
+            包含 method（reflink / copy_file_range / pread）、bytes_copied、elapsed 的字典
+        """
+        started_at = time.monotonic()
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+            size = os.fstat(src_fd).st_size
+
+            if self._reflink(src_fd, dst_fd):
+                method, copied = 'reflink', size
+                self._report(size, size)
+            else:
+                # 先设定目标大小，未写入的区段保持为空洞
+                os.ftruncate(dst_fd, size)
+                method, copied = self._copy_extents(src_fd, dst_fd, size)
+            os.fsync(dst_fd)
+        shutil.copystat(src, dst)
+
+        elapsed = time.monotonic() - started_at
+        logger.info(f"复制磁盘 {src} -> {dst}: {method}, {copied} 字节, 耗时 {elapsed:.3f}s")
+        return {'method': method, 'bytes_copied': copied, 'elapsed': elapsed}
+
+    def _reflink(self, src_fd: int, dst_fd: int) -> bool:
+        """尝试reflink克隆，文件系统不支持时返回False"""
+        try:
+            fcntl.ioctl(dst_fd, FICLONE, src_fd)
+            return True
+        except OSError as e:
+            if e.errno in REFLINK_UNSUPPORTED:
+                return False
+            raise
+
+    @staticmethod
+    def iter_data_extents(fd: int, size: int) -> Iterator[Tuple[int, int]]:
+        """
+        枚举文件中已分配的数据区段
+
+        Args:
+            fd: 文件描述符
+            size: 文件大小
+
+        Yields:
+            （偏移，长度）；文件系统不支持 SEEK_DATA 时整个文件作为一个区段
+        """
+        if not hasattr(os, 'SEEK_DATA'):
+            if size:
+                yield 0, size
+            return
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # 之后只剩空洞
+                    return
+                if e.errno == errno.EINVAL:
+                    yield offset, size - offset
+                    return
+                raise
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+            yield start, end - start
+            offset = end
+
+    def _copy_extents(self, src_fd: int, dst_fd: int, size: int) -> Tuple[str, int]:
+        """只复制已分配的区段"""
+        extents = list(self.iter_data_extents(src_fd, size))
+        total = sum(length for _, length in extents)
+        method = 'copy_file_range' if hasattr(os, 'copy_file_range') else 'pread'
+        copied = 0
+        started_at = time.monotonic()
+
+        for offset, length in extents:
+            end = offset + length
+            while offset < end:
+                count = min(self.chunk_size, end - offset)
+                if method == 'copy_file_range':
+                    try:
+                        written = os.copy_file_range(src_fd, dst_fd, count, offset, offset)
+                    except OSError as e:
+                        if e.errno not in COPY_RANGE_UNSUPPORTED:
+                            raise
+                        method = 'pread'
+                        continue
+                else:
+                    written = os.pwrite(dst_fd, os.pread(src_fd, count, offset), offset)
+                if written == 0:
+                    # 源文件在复制过程中被截断
+                    raise Exception(f"复制在偏移 {offset} 处提前结束")
+                offset += written
+                copied += written
+                self._report(copied, total)
+                self._throttle(copied, started_at)
+
+        return method, copied
+
+    def _throttle(self, copied: int, started_at: float):
+        """按限速休眠，使平均速率不超过 bytes_per_sec"""
+        if not self.bytes_per_sec:
+            return
+        delay = copied / self.bytes_per_sec - (time.monotonic() - started_at)
+        if delay > 0:
+            time.sleep(delay)
+
+    def _report(self, copied: int, total: int):
+        if self.progress:
+            self.progress(copied, total)
+
+
+def copy_disk(src: str, dst: str, **kwargs) -> Dict:
+    """使用默认配置复制磁盘镜像，参数见 DiskCopier"""
+    return DiskCopier(**kwargs).copy(src, dst)
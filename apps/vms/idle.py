@@ -0,0 +1,154 @@
+"""
+空闲虚拟机检测与回收
+"""
+import logging
+import time
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
+from django.conf import settings
+from django.utils import timezone
+
+from apps.vms.models import VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+# /proc/net/tcp 中 ESTABLISHED 状态的编码
+TCP_ESTABLISHED = '01'
+
+
+def has_console_session(port: Optional[int]) -> bool:
+    """
+    检查是否有已建立的控制台（websockify）连接
+
+    Args:
+        port: websockify 监听端口
+
+    Returns:
+        是否存在已建立的连接
+    """
+    if not port:
+        return False
+    for table in ('/proc/net/tcp', '/proc/net/tcp6'):
+        try:
+            with open(table) as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    local_port = int(fields[1].rsplit(':', 1)[1], 16)
+                    if local_port == port and fields[3] == TCP_ESTABLISHED:
+                        return True
+        except OSError:
+            continue
+    return False
+
+
+class ActivitySampler:
+    """
+    虚拟机活动采样器
+
+    libvirt 只提供累计计数器，采样器保存上一次的读数，以两次采样的差值计算CPU使用率与网络速率。
+    """
+
+    def __init__(self):
+        # 键: 虚拟机名称, 值: (采样时间, cpu_time, net_bytes)
+        self._last: Dict[str, Tuple[float, int, int]] = {}
+
+    def sample(self, vm: VirtualMachine) -> Optional[Dict]:
+        """
+        采样一台虚拟机
+
+        Args:
+            vm: 虚拟机
+
+        Returns:
+            包含 cpu_percent、net_rate、console、disk_allocation 的字典；首次采样或虚拟机未运行时返回None
+        """
+        from apps.vms.services import vm_service
+
+        counters = vm_service.manager_for(vm).get_activity_counters(vm.name)
+        if counters is None:
+            self._last.pop(vm.name, None)
+            return None
+
+        now = time.monotonic()
+        previous = self._last.get(vm.name)
+        self._last[vm.name] = (now, counters['cpu_time'], counters['net_bytes'])
+        if previous is None:
+            return None
+
+        elapsed = now - previous[0]
+        if elapsed <= 0:
+            return None
+        cpu_delta = max(counters['cpu_time'] - previous[1], 0)
+        net_delta = max(counters['net_bytes'] - previous[2], 0)
+        vcpus = max(counters['vcpus'], 1)
+
+        return {
+            'cpu_percent': cpu_delta / (elapsed * 1e9 * vcpus) * 100,
+            'net_rate': net_delta / elapsed,
+            'console': has_console_session(vm.websockify_port),
+            'disk_allocation': counters['disk_allocation'],
+        }
+
+    @staticmethod
+    def is_active(sample: Dict) -> bool:
+        """根据采样结果判断虚拟机是否活跃"""
+        return (sample['cpu_percent'] >= settings.IDLE_CPU_PERCENT or
+                sample['net_rate'] >= settings.IDLE_NET_BYTES_PER_SEC or
+                sample['console'])
+
+
+class IdleReaper:
+    """
+    空闲虚拟机回收器
+
+    按课程的 idle_policy 处理超过 idle_timeout_minutes 未活动的虚拟机：
+    暂停（pause）、休眠到磁盘（managed_save）或关机（shutdown）。
+    被处理的虚拟机下次 start 时会被透明恢复。
+    """
+
+    def __init__(self, sampler: Optional[ActivitySampler] = None):
+        self.sampler = sampler or ActivitySampler()
+
+    def run_once(self) -> Dict:
+        """
+        执行一轮采样与回收
+
+        Returns:
+            本轮统计结果
+        """
+        # 避免循环导入：services 依赖 libvirt_manager，与本模块同级
+        from apps.vms.services import vm_service
+
+        now = timezone.now()
+        reclaimed = 0
+        vms = VirtualMachine.objects.filter(status='running').select_related('course')
+
+        for vm in vms:
+            sample = self.sampler.sample(vm)
+            if sample is not None:
+                vm.cpu_usage_percent = round(sample['cpu_percent'], 2)
+                if self.sampler.is_active(sample) or vm.last_activity_at is None:
+                    vm.last_activity_at = now
+                if sample.get('disk_allocation') is not None:
+                    # 运行中的磁盘持续增长，顺带刷新实际占用供配额账本统计
+                    vm.disk_allocated_bytes = sample['disk_allocation']
+                vm.save(update_fields=['cpu_usage_percent', 'last_activity_at', 'disk_allocated_bytes'])
+
+            course = vm.course
+            if not course or course.idle_policy == 'none' or vm.last_activity_at is None:
+                continue
+            if now - vm.last_activity_at < timedelta(minutes=course.idle_timeout_minutes):
+                continue
+
+            logger.info(f"虚拟机 {vm.name} 空闲超过 {course.idle_timeout_minutes} 分钟，执行策略 {course.idle_policy}")
+            if course.idle_policy == 'pause':
+                result = vm_service.pause_vm(str(vm.id))
+            elif course.idle_policy == 'managed_save':
+                result = vm_service.hibernate_vm(str(vm.id))
+            else:
+                result = vm_service.stop_vm(str(vm.id))
+            if result['success']:
+                reclaimed += 1
+
+        return {'success': True, 'checked': len(vms), 'reclaimed': reclaimed}
@@ -0,0 +1,55 @@
+"""
+虚拟机磁盘与网络I/O限速策略
+
+域定义中系统盘的 iotune 与网卡的 bandwidth 按模板硬件配置与所有者角色的策略生成
+（见 settings.VM_IO_POLICIES），避免磁盘拷贝或个别虚拟机拖慢整台宿主机的I/O。
+"""
+from typing import Dict
+from django.conf import settings
+
+from apps.vms.models import VirtualMachine
+from apps.vms.profiles import merge_policies, resolve_profile
+
+# 系统盘 iotune 项，名称与libvirt一致；bytes 单位为字节/秒，iops 为次/秒，
+# *_max 为突发上限，*_max_length 为突发持续秒数
+DISK_IOTUNE_KEYS = (
+    'total_bytes_sec', 'read_bytes_sec', 'write_bytes_sec',
+    'total_iops_sec', 'read_iops_sec', 'write_iops_sec',
+    'total_bytes_sec_max', 'total_iops_sec_max',
+    'total_bytes_sec_max_length', 'total_iops_sec_max_length',
+)
+
+# 网卡 bandwidth 项，inbound 为进入虚拟机的方向；average、peak 单位为KiB/s，burst 为KiB
+NET_BANDWIDTH_KEYS = (
+    'inbound_average', 'inbound_peak', 'inbound_burst',
+    'outbound_average', 'outbound_peak', 'outbound_burst',
+)
+
+# 所有策略项，0 表示不限制
+DEFAULT_IO_LIMITS: Dict = {key: 0 for key in DISK_IOTUNE_KEYS + NET_BANDWIDTH_KEYS}
+
+
+def available_io_policies() -> list:
+    """返回可用的I/O限速策略名称"""
+    return sorted(set(getattr(settings, 'VM_IO_POLICIES', {})) | {'default'})
+
+
+def resolve_io_limits(vm: VirtualMachine) -> Dict:
+    """
+    解析虚拟机的I/O限速
+
+    依次合并 default、模板硬件配置的 io_policy 与所有者角色策略（settings.VM_IO_ROLE_POLICIES），
+    后者覆盖前者设置的项。
+
+    Args:
+        vm: 虚拟机
+
+    Returns:
+        DISK_IOTUNE_KEYS 与 NET_BANDWIDTH_KEYS 各项的值
+    """
+    profile = resolve_profile(vm.template.hardware_profile if vm.template_id else None)
+    return merge_policies(
+        DEFAULT_IO_LIMITS, getattr(settings, 'VM_IO_POLICIES', {}),
+        getattr(settings, 'VM_IO_ROLE_POLICIES', {}), vm.owner,
+        policy=profile['io_policy'], label='I/O限速策略',
+    )
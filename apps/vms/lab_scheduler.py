@@ -0,0 +1,227 @@
+"""
+上机时段调度
+
+开始前分批启动（或预创建）选课学生的虚拟机，使开机负载在预启动窗口内均匀分布；
+结束并经过保留时间后关机或休眠，释放课后资源。
+"""
+import logging
+from datetime import timedelta
+from typing import Dict, List, Optional
+from django.conf import settings
+from django.utils import timezone
+
+from apps.courses.models import LabSession
+from apps.courses.pagecache import prewarm_template_async
+from apps.users.models import Quota
+from apps.vms.libvirt_manager import get_manager, libvirt_manager
+from apps.vms.models import Host, VirtualMachine
+from apps.vms.quota import QuotaLedger, QuotaExceeded
+
+logger = logging.getLogger(__name__)
+
+# 可由调度器启动的虚拟机状态
+STARTABLE_STATUSES = ('stopped', 'saved', 'paused')
+
+
+class LabScheduler:
+    """
+    上机时段调度器
+
+    每轮检查：进入预启动窗口的时段每隔 LAB_SESSION_WAVE_INTERVAL 秒启动一批（最多
+    LAB_SESSION_WAVE_SIZE 台、不超过宿主机空闲内存减去 LAB_SESSION_HOST_RESERVE_MB）；
+    超过结束时间加保留时间的时段按 end_action 处理仍在运行的学生虚拟机。
+    """
+
+    def run_once(self, now=None) -> Dict:
+        """
+        执行一轮调度
+
+        Args:
+            now: 当前时间，默认取系统时间
+
+        Returns:
+            本轮统计结果
+        """
+        now = now or timezone.now()
+        started = 0
+        stopped = 0
+
+        sessions = LabSession.objects.filter(
+            status__in=('scheduled', 'starting', 'running')
+        ).select_related('course', 'template')
+        for session in sessions:
+            if now >= session.stop_at:
+                stopped += self.finish_session(session, now)
+            elif session.status != 'running' and now >= session.prestart_at:
+                started += self.start_wave(session, now)
+        return {'started': started, 'stopped': stopped}
+
+    def _student_vms(self, session: LabSession):
+        return VirtualMachine.objects.filter(
+            course=session.course, owner__in=session.course.students.all()
+        )
+
+    def _pending_vms(self, session: LabSession) -> List[VirtualMachine]:
+        """预启动中仍需启动的虚拟机，每个学生取最近创建的一台"""
+        pending = []
+        seen = set()
+        for vm in self._student_vms(session).exclude(status='deleting').order_by('owner_id', '-created_at'):
+            if vm.owner_id in seen:
+                continue
+            seen.add(vm.owner_id)
+            if vm.status in STARTABLE_STATUSES:
+                pending.append(vm)
+        return pending
+
+    def _students_without_vm(self, session: LabSession):
+        if session.template is None:
+            return session.course.students.none()
+        return session.course.students.exclude(
+            id__in=self._student_vms(session).values('owner_id')
+        ).order_by('id')
+
+    def _memory_budget(self) -> Optional[int]:
+        """本批可用的内存（MB），为各启用宿主机空闲内存减去保留量之和，无法获取宿主机信息时不限制"""
+        hosts = Host.objects.filter(enabled=True)
+        managers = [get_manager(host) for host in hosts] or [libvirt_manager]
+        budget = None
+        for manager in managers:
+            memory = manager.get_host_memory()
+            if memory is None:
+                continue
+            budget = (budget or 0) + memory['free_mb'] - settings.LAB_SESSION_HOST_RESERVE_MB
+        return budget
+
+    def start_wave(self, session: LabSession, now) -> int:
+        """
+        为时段启动一批虚拟机
+
+        Returns:
+            本批启动或创建的虚拟机数
+        """
+        from apps.vms.services import vm_service
+
+        if session.status == 'scheduled':
+            session.status = 'starting'
+            session.save(update_fields=['status'])
+            self._prewarm(session)
+            logger.info(f"上机时段 {session} 开始预启动")
+
+        if session.last_wave_at and \
+                now - session.last_wave_at < timedelta(seconds=settings.LAB_SESSION_WAVE_INTERVAL):
+            return 0
+
+        pending = self._pending_vms(session)
+        missing = list(self._students_without_vm(session))
+        if not pending and not missing:
+            if now >= session.starts_at:
+                session.status = 'running'
+                session.save(update_fields=['status'])
+                logger.info(f"上机时段 {session} 预启动完成，共 {session.started_count} 台")
+            return 0
+
+        budget = self._memory_budget()
+        count = 0
+        for vm in pending:
+            if count >= settings.LAB_SESSION_WAVE_SIZE:
+                break
+            if budget is not None and vm.memory_mb > budget:
+                logger.info(f"宿主机空闲内存不足，上机时段 {session} 本批停止在 {count} 台")
+                break
+            result = vm_service.start_vm(str(vm.id), priority='batch')
+            if not result['success']:
+                logger.warning(f"预启动虚拟机 {vm.name} 失败: {result['error']}")
+                continue
+            count += 1
+            if budget is not None:
+                budget -= vm.memory_mb
+
+        for student in missing:
+            if count >= settings.LAB_SESSION_WAVE_SIZE:
+                break
+            if budget is not None and session.vm_memory_mb > budget:
+                break
+            vm = self._provision(session, student)
+            if vm is None:
+                continue
+            count += 1
+            if budget is not None:
+                budget -= session.vm_memory_mb
+
+        session.last_wave_at = now
+        session.started_count += count
+        session.save(update_fields=['last_wave_at', 'started_count'])
+        logger.info(f"上机时段 {session} 启动一批 {count} 台虚拟机")
+        return count
+
+    def _prewarm(self, session: LabSession):
+        """预启动开始时预热时段用到的模板"""
+        templates = {vm.template for vm in self._student_vms(session).select_related('template')
+                     if vm.template is not None}
+        if session.template is not None:
+            templates.add(session.template)
+        for template in templates:
+            prewarm_template_async(template)
+
+    def _provision(self, session: LabSession, student) -> Optional[VirtualMachine]:
+        """为还没有虚拟机的学生创建虚拟机，配额不足时跳过"""
+        from apps.vms.services import vm_service
+
+        template = session.template
+        if template.validation_status == 'invalid':
+            return None
+        disk_gb = max(session.vm_disk_gb, template.min_disk_gb)
+        try:
+            QuotaLedger(student).check_vm(session.vm_cpu_cores, session.vm_memory_mb, disk_gb)
+        except (QuotaExceeded, Quota.DoesNotExist) as e:
+            logger.warning(f"学生 {student.username} 配额不足，跳过预创建: {e}")
+            return None
+
+        vm = VirtualMachine.objects.create(
+            name=f"{student.username}-{session.course_id}-{session.id}",
+            owner=student,
+            course=session.course,
+            template=template,
+            cpu_cores=session.vm_cpu_cores,
+            memory_mb=session.vm_memory_mb,
+            disk_gb=disk_gb,
+        )
+        # 经开机准入以批量优先级排队创建，不挤占学生自己发起的操作
+        result = vm_service.create_vm_async(str(vm.id), priority='batch')
+        if not result['success']:
+            logger.warning(f"预创建虚拟机 {vm.name} 失败: {result['error']}")
+            return None
+        return vm
+
+    def finish_session(self, session: LabSession, now) -> int:
+        """
+        结束时段，按 end_action 处理仍在运行的学生虚拟机
+
+        同一课程紧接着还有时段（已进入其预启动窗口）时不处理虚拟机。
+
+        Returns:
+            处理的虚拟机数
+        """
+        from apps.vms.services import vm_service
+
+        count = 0
+        others = LabSession.objects.filter(
+            course=session.course, status__in=('scheduled', 'starting', 'running'), ends_at__gt=now
+        ).exclude(id=session.id)
+        overlapping = any(other.prestart_at <= now for other in others)
+
+        if session.end_action != 'none' and not overlapping:
+            for vm in self._student_vms(session).filter(status__in=('running', 'paused')):
+                if session.end_action == 'managed_save':
+                    result = vm_service.hibernate_vm(str(vm.id))
+                else:
+                    result = vm_service.stop_vm(str(vm.id))
+                if result['success']:
+                    count += 1
+                else:
+                    logger.warning(f"上机时段结束处理虚拟机 {vm.name} 失败: {result['error']}")
+
+        session.status = 'finished'
+        session.save(update_fields=['status'])
+        logger.info(f"上机时段 {session} 结束，{session.get_end_action_display()} {count} 台虚拟机")
+        return count
@@ -8,11 +8,23 @@ import string
 import logging
 import time
 import os
-from typing import Any, Dict, List, Optional, Tuple
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from django.conf import settings
 
+from apps.vms.iotune import DISK_IOTUNE_KEYS, NET_BANDWIDTH_KEYS
+from apps.vms.profiles import resolve_profile
+from apps.vms.storage import StorageManager
+from apps.vms.diskcopy import copy_disk
+
 logger = logging.getLogger(__name__)
 
+# KSM按基本页合并
+KSM_PAGE_SIZE = 4096
+# libvirt 保存QEMU进程号的目录
+QEMU_PID_DIR = '/run/libvirt/qemu'
+
+
 class LibvirtManager:
     """
     Libvirt虚拟机管理器
@@ -29,6 +41,7 @@ class LibvirtManager:
         """
         self.uri = uri
         self.conn = None
+        self.storage = StorageManager(self)
         if not os.environ.get('DOCKER_BUILDING'):
             self._connect()
     
@@ -50,9 +63,12 @@ class LibvirtManager:
     
     def _generate_vm_xml(self, name: str, uuid: str, memory_mb: int, 
                         cpu_cores: int, disk_path: str, vnc_port: int,
-                        mac_address: str, vnc_password: str) -> str:
+                        mac_address: str, vnc_password: str,
+                        profile: Optional[Dict] = None,
+                        cputune: Optional[Dict] = None,
+                        io_limits: Optional[Dict] = None) -> str:
         """
-        生成虚拟机XML配置
+        根据硬件配置生成虚拟机XML配置
         
         Args:
             name: 虚拟机名称
@@ -62,55 +78,129 @@ class LibvirtManager:
             disk_path: 磁盘文件路径
             vnc_port: VNC端口
             mac_address: MAC地址
+            vnc_password: VNC密码
+            profile: 硬件配置（见 apps.vms.profiles），为空时使用默认配置
+            cputune: CPU调度策略（见 apps.vms.cputune），为空或各项为0时不写入
+            io_limits: 磁盘与网络I/O限速（见 apps.vms.iotune），为0的项不限制
             
         Returns:
             XML配置字符串
         """
-        xml_template = f"""
-<domain type='kvm'>
-  <name>{name}</name>
-  <uuid>{uuid}</uuid>
-  <memory unit='MiB'>{memory_mb}</memory>
-  <currentMemory unit='MiB'>{memory_mb}</currentMemory>
-  <vcpu>{cpu_cores}</vcpu>
-  <os>
-    <type arch='x86_64'>hvm</type>
-    <boot dev='hd'/>
-  </os>
-  <features>
-    <acpi/>
-    <apic/>
-    <pae/>
-  </features>
-  <clock offset='utc'/>
-  <devices>
-    <disk type='file' device='disk'>
-      <driver name='qemu' type='qcow2'/>
-      <source file='{disk_path}'/>
-      <target dev='vda' bus='virtio'/>
-    </disk>
-    <interface type='network'>
-      <source network='default'/>
-      <mac address='{mac_address}'/>
-      <model type='virtio'/>
-    </interface>
-    <graphics type='vnc' port='{vnc_port}' autoport='no' listen='0.0.0.0'>
-      <listen type='address' address='0.0.0.0'/>
-      <passwd>{vnc_password}</passwd>
-    </graphics>
-    <video>
-      <model type='cirrus'/>
-    </video>
-    <console type='pty'>
-      <target type='virtio' port='0'/>
-    </console>
-    <serial type='pty'>
-      <target port='0'/>
-    </serial>
-  </devices>
-</domain>
-        """.strip()
-        return xml_template
+        if profile is None:
+            profile = resolve_profile()
+        
+        # libvirt 测试驱动（test:///default）只接受 test 类型的域
+        domain = ET.Element('domain', type='test' if self.uri.startswith('test:') else 'kvm')
+        ET.SubElement(domain, 'name').text = name
+        ET.SubElement(domain, 'uuid').text = uuid
+        # memory 为上限，currentMemory 为实际分配，差值留给在线扩容
+        max_memory_mb = max(profile['max_memory_mb'], memory_mb)
+        ET.SubElement(domain, 'memory', unit='MiB').text = str(max_memory_mb)
+        ET.SubElement(domain, 'currentMemory', unit='MiB').text = str(memory_mb)
+        if profile['hugepages']:
+            memory_backing = ET.SubElement(domain, 'memoryBacking')
+            ET.SubElement(memory_backing, 'hugepages')
+        max_vcpus = max(profile['max_vcpus'], cpu_cores)
+        vcpu = ET.SubElement(domain, 'vcpu', placement='static')
+        vcpu.text = str(max_vcpus)
+        if max_vcpus > cpu_cores:
+            vcpu.set('current', str(cpu_cores))
+        if profile['iothreads']:
+            ET.SubElement(domain, 'iothreads').text = str(profile['iothreads'])
+        if cputune and any(cputune.get(key) for key in ('shares', 'period', 'quota')):
+            tune = ET.SubElement(domain, 'cputune')
+            for key in ('shares', 'period', 'quota'):
+                if cputune.get(key):
+                    ET.SubElement(tune, key).text = str(cputune[key])
+        
+        os_elem = ET.SubElement(domain, 'os')
+        ET.SubElement(os_elem, 'type', arch='x86_64').text = 'hvm'
+        ET.SubElement(os_elem, 'boot', dev='hd')
+        
+        features = ET.SubElement(domain, 'features')
+        for feature in ('acpi', 'apic', 'pae'):
+            ET.SubElement(features, feature)
+        if profile['cpu_mode']:
+            ET.SubElement(domain, 'cpu', mode=profile['cpu_mode'], check='none')
+        ET.SubElement(domain, 'clock', offset='utc')
+        
+        devices = ET.SubElement(domain, 'devices')
+        
+        # 系统盘
+        disk = ET.SubElement(devices, 'disk', type='file', device='disk')
+        driver = ET.SubElement(disk, 'driver', name='qemu', type='qcow2')
+        for attr, key in (('cache', 'disk_cache'), ('io', 'disk_io'), ('discard', 'discard')):
+            if profile[key]:
+                driver.set(attr, profile[key])
+        ET.SubElement(disk, 'source', file=disk_path)
+        if io_limits and any(io_limits.get(key) for key in DISK_IOTUNE_KEYS):
+            iotune = ET.SubElement(disk, 'iotune')
+            for key in DISK_IOTUNE_KEYS:
+                if io_limits.get(key):
+                    ET.SubElement(iotune, key).text = str(io_limits[key])
+        if profile['disk_bus'] == 'scsi':
+            ET.SubElement(disk, 'target', dev='sda', bus='scsi')
+            controller = ET.SubElement(devices, 'controller', type='scsi', index='0', model='virtio-scsi')
+            if profile['iothreads']:
+                ET.SubElement(controller, 'driver', iothread='1')
+        else:
+            ET.SubElement(disk, 'target', dev='vda', bus='virtio')
+            if profile['iothreads']:
+                driver.set('iothread', '1')
+        
+        # 网卡
+        interface = ET.SubElement(devices, 'interface', type='network')
+        ET.SubElement(interface, 'source', network='default')
+        ET.SubElement(interface, 'mac', address=mac_address)
+        ET.SubElement(interface, 'model', type='virtio')
+        queues = profile['net_queues'] or cpu_cores
+        if queues > 1:
+            ET.SubElement(interface, 'driver', name='vhost', queues=str(queues))
+        if io_limits and any(io_limits.get(key) for key in NET_BANDWIDTH_KEYS):
+            bandwidth = ET.SubElement(interface, 'bandwidth')
+            for direction in ('inbound', 'outbound'):
+                attrs = {attr: str(io_limits[f'{direction}_{attr}'])
+                         for attr in ('average', 'peak', 'burst') if io_limits.get(f'{direction}_{attr}')}
+                if attrs:
+                    ET.SubElement(bandwidth, direction, **attrs)
+        
+        # VNC图形
+        graphics = ET.SubElement(devices, 'graphics', type='vnc', port=str(vnc_port),
+                                 autoport='no', listen='0.0.0.0')
+        ET.SubElement(graphics, 'listen', type='address', address='0.0.0.0')
+        ET.SubElement(graphics, 'passwd').text = vnc_password
+        
+        video = ET.SubElement(devices, 'video')
+        ET.SubElement(video, 'model', type=profile['video'])
+        
+        console = ET.SubElement(devices, 'console', type='pty')
+        ET.SubElement(console, 'target', type='virtio', port='0')
+        serial = ET.SubElement(devices, 'serial', type='pty')
+        ET.SubElement(serial, 'target', port='0')
+        
+        # 内存气球，开启统计后 memoryStats() 才能返回来宾内存使用情况
+        memballoon = ET.SubElement(devices, 'memballoon', model='virtio')
+        if profile['memballoon_stats_period']:
+            ET.SubElement(memballoon, 'stats', period=str(profile['memballoon_stats_period']))
+        
+        ET.indent(domain)
+        return ET.tostring(domain, encoding='unicode')
+    
+    def _get_disk_target(self, domain) -> str:
+        """
+        读取系统盘的目标设备名（virtio-blk 为 vda，virtio-scsi 为 sda）
+        
+        Args:
+            domain: libvirt域对象
+            
+        Returns:
+            目标设备名
+        """
+        root = ET.fromstring(domain.XMLDesc())
+        target = root.find(".//disk[@type='file']/target")
+        if target is not None and target.get('dev'):
+            return target.get('dev')
+        return 'vda'
     
     def _generate_mac_address(self) -> str:
         """生成随机MAC地址"""
@@ -143,7 +233,9 @@ class LibvirtManager:
             return result != 0
     
     def create_vm(self, name: str, uuid: str, memory_mb: int, cpu_cores: int,
-                  template_path: str, storage_dir: str = "/var/lib/libvirt/images") -> Dict:
+                  template_path: str, profile: Optional[Dict] = None,
+                  disk_gb: Optional[int] = None, template_size: Optional[int] = None,
+                  cputune: Optional[Dict] = None, io_limits: Optional[Dict] = None) -> Dict:
         """
         创建虚拟机
         
@@ -153,7 +245,11 @@ class LibvirtManager:
             memory_mb: 内存大小 (MB)
             cpu_cores: CPU核心数
             template_path: 模板文件路径
-            storage_dir: 存储目录
+            profile: 硬件配置，为空时使用默认配置
+            disk_gb: 磁盘虚拟大小(GB)，小于模板时以模板大小为准
+            template_size: 模板虚拟大小（字节），由模板检查结果提供时不再读取模板文件
+            cputune: CPU调度策略，为空时不限制
+            io_limits: 磁盘与网络I/O限速，为空时不限制
 
         Returns:
             包含虚拟机信息的字典
@@ -175,9 +271,14 @@ class LibvirtManager:
             vnc_port = self._find_available_vnc_port()
             vnc_password = self._generate_vnc_password()
             
-            # 创建虚拟机磁盘
-            disk_path = f"{storage_dir}/{name}.qcow2"
-            self._create_vm_disk(template_path, disk_path)
+            # 在磁盘存储池中以模板为后备文件创建稀疏覆盖层，虚拟大小取申请的磁盘大小
+            if not os.path.exists(template_path):
+                raise Exception(f"模板文件不存在: {template_path}")
+            disk_path = self.storage.create_overlay(
+                'disks', f"{name}.qcow2", template_path,
+                capacity=disk_gb * 1024 ** 3 if disk_gb else None,
+                backing_capacity=template_size
+            )
             
             # 生成XML配置，包含VNC密码
             xml_config = self._generate_vm_xml(
@@ -188,7 +289,10 @@ class LibvirtManager:
                 disk_path=disk_path,
                 vnc_port=vnc_port,
                 mac_address=mac_address,
-                vnc_password=vnc_password
+                vnc_password=vnc_password,
+                profile=profile,
+                cputune=cputune,
+                io_limits=io_limits
             )
             
             # 定义并启动虚拟机
@@ -224,16 +328,386 @@ class LibvirtManager:
             template_path: 模板文件路径
             disk_path: 目标磁盘路径
         """
-        import shutil
-        import os
-        
         if not os.path.exists(template_path):
             raise Exception(f"模板文件不存在: {template_path}")
         
-        # 复制模板文件
-        shutil.copy2(template_path, disk_path)
+        # 复制模板文件：优先reflink，否则只复制已分配区段
+        copy_disk(template_path, disk_path)
         logger.info(f"从模板 {template_path} 创建磁盘 {disk_path}")
     
+    def _get_disk_path(self, domain) -> Optional[str]:
+        """
+        从域XML中读取系统盘路径
+        
+        Args:
+            domain: libvirt域对象
+            
+        Returns:
+            磁盘文件路径，未找到时返回None
+        """
+        root = ET.fromstring(domain.XMLDesc())
+        disk_elem = root.find(".//disk[@type='file']/source")
+        if disk_elem is not None:
+            return disk_elem.get('file')
+        return None
+    
+    def _get_disk_info(self, disk_path: str) -> Optional[Dict]:
+        """
+        读取磁盘镜像信息（qemu-img info）
+        
+        Args:
+            disk_path: 磁盘文件路径
+            
+        Returns:
+            qemu-img 输出的信息字典，读取失败时返回None
+        """
+        import json
+        import subprocess
+        
+        try:
+            output = subprocess.run(
+                ['qemu-img', 'info', '--force-share', '--output=json', disk_path],
+                check=True, capture_output=True, text=True
+            ).stdout
+        except (OSError, subprocess.CalledProcessError) as e:
+            logger.warning(f"读取磁盘信息失败 {disk_path}: {e}")
+            return None
+        return json.loads(output)
+    
+    def _get_backing_file(self, disk_path: str) -> Optional[str]:
+        """
+        读取qcow2磁盘的后备文件（链接克隆时为模板文件）
+        
+        Args:
+            disk_path: 磁盘文件路径
+            
+        Returns:
+            后备文件路径，磁盘为完整副本时返回None
+        """
+        info = self._get_disk_info(disk_path)
+        if info is None:
+            return None
+        return info.get('full-backing-filename') or info.get('backing-filename')
+    
+    def _create_overlay_disk(self, backing_path: str, disk_path: str,
+                             disk_gb: Optional[int] = None):
+        """
+        以后备文件为基础创建qcow2覆盖层磁盘
+        
+        Args:
+            backing_path: 后备文件路径
+            disk_path: 覆盖层磁盘路径
+            disk_gb: 覆盖层虚拟大小(GB)，为空时与后备文件一致；不会小于后备文件
+        """
+        import subprocess
+        
+        command = ['qemu-img', 'create', '-q', '-f', 'qcow2', '-F', 'qcow2',
+                   '-b', backing_path, disk_path]
+        if disk_gb:
+            # 覆盖层小于后备文件会截断模板中的数据
+            backing_info = self._get_disk_info(backing_path) or {}
+            size = max(disk_gb * 1024 ** 3, backing_info.get('virtual-size', 0))
+            command.append(str(size))
+        subprocess.run(command, check=True, capture_output=True, text=True)
+        logger.info(f"基于 {backing_path} 创建覆盖层磁盘 {disk_path}")
+    
+    def reset_vm(self, name: str, template_path: str, disk_path: Optional[str] = None,
+                 discard_paths: Optional[List[str]] = None, disk_gb: Optional[int] = None) -> bool:
+        """
+        将虚拟机重置为模板状态
+        
+        保留域定义（UUID、MAC、VNC端口与密码均不变），只丢弃可写层：
+        磁盘为链接克隆时重建覆盖层，否则重新复制模板文件。重置前处于运行状态的虚拟机
+        会被重新启动，暂停的虚拟机启动后重新暂停。
+        
+        Args:
+            name: 虚拟机名称
+            template_path: 模板文件路径
+            disk_path: 基础磁盘路径，存在外部快照链时由调用方传入
+            discard_paths: 需要丢弃的快照覆盖层路径
+            disk_gb: 重建覆盖层的虚拟大小(GB)
+            
+        Returns:
+            操作是否成功
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            raise Exception(f"虚拟机 {name} 不存在")
+        
+        started_at = time.monotonic()
+        was_active = domain.isActive() == 1
+        was_paused = was_active and domain.state()[0] == libvirt.VIR_DOMAIN_PAUSED
+        
+        current_disk_path = self._get_disk_path(domain)
+        disk_path = disk_path or current_disk_path
+        if not disk_path:
+            raise Exception(f"虚拟机 {name} 没有可重置的磁盘")
+        
+        if was_active:
+            domain.destroy()
+        # 休眠镜像属于旧磁盘状态，必须一并丢弃
+        if domain.hasManagedSaveImage(0):
+            domain.managedSaveRemove(0)
+        
+        # 丢弃整条快照链，域重新指向基础磁盘
+        self._remove_disk_files(discard_paths or [])
+        if current_disk_path != disk_path:
+            domain = self._set_disk_path(domain, disk_path)
+        
+        backing_path = self._get_backing_file(disk_path)
+        if backing_path:
+            # 链接克隆：丢弃覆盖层并基于同一后备文件重建
+            os.remove(disk_path)
+            self._create_overlay_disk(backing_path, disk_path, disk_gb=disk_gb)
+        else:
+            self._create_vm_disk(template_path, disk_path)
+        
+        if was_active:
+            result = domain.create()
+            if result != 0:
+                raise Exception(f"虚拟机 {name} 重置后启动失败, 返回码: {result}")
+            if was_paused:
+                domain.suspend()
+        
+        logger.info(f"虚拟机 {name} 重置成功, 耗时 {time.monotonic() - started_at:.3f}s")
+        return True
+    
+    def _set_disk_path(self, domain, disk_path: str):
+        """
+        修改域定义中的系统盘路径（仅适用于未运行的域）
+        
+        Args:
+            domain: libvirt域对象
+            disk_path: 新的磁盘文件路径
+            
+        Returns:
+            重新定义后的域对象
+        """
+        root = ET.fromstring(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+        disk_elem = root.find(".//disk[@type='file']/source")
+        if disk_elem is None:
+            raise Exception(f"虚拟机 {domain.name()} 没有文件磁盘")
+        disk_elem.set('file', disk_path)
+        # 后备链由qcow2头部描述，移除旧的 backingStore 让libvirt重新探测
+        disk = root.find(".//disk[@type='file']")
+        for backing in disk.findall('backingStore'):
+            disk.remove(backing)
+        return self.conn.defineXML(ET.tostring(root, encoding='unicode'))
+    
+    def _remove_disk_files(self, paths: List[str]):
+        """删除磁盘文件，忽略不存在的文件"""
+        for path in paths:
+            try:
+                os.remove(path)
+                logger.info(f"删除磁盘文件: {path}")
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"删除磁盘文件失败 {path}: {e}")
+    
+    def _disk_chain(self, domain) -> List[str]:
+        """
+        从域XML中读取系统盘后备链
+        
+        Returns:
+            活动层及各级 backingStore 的文件路径，自上而下
+        """
+        root = ET.fromstring(domain.XMLDesc())
+        node = root.find(".//disk[@type='file']")
+        chain = []
+        while node is not None:
+            source = node.find('source')
+            if source is not None and source.get('file'):
+                chain.append(source.get('file'))
+            node = node.find('backingStore')
+        return chain
+    
+    def _wait_block_job(self, domain, disk: str, pivot: bool, timeout: Optional[float] = None,
+                        interval: float = 0.5) -> bool:
+        """
+        等待块作业结束
+        
+        块作业消失只说明作业已结束，不说明成功（失败或被取消时同样消失），
+        调用方需再检查后备链确认结果。
+        
+        Args:
+            domain: libvirt域对象
+            disk: 磁盘目标名，如 vda
+            pivot: 是否为活动层提交，需要在数据同步后切换到base
+            timeout: 超时时间(秒)，默认 SNAPSHOT_MERGE_TIMEOUT
+            interval: 轮询间隔(秒)
+            
+        Returns:
+            作业是否在超时前结束，超时时作业被取消
+        """
+        if timeout is None:
+            timeout = settings.SNAPSHOT_MERGE_TIMEOUT
+        deadline = time.monotonic() + timeout
+        pivoted = False
+        while True:
+            info = domain.blockJobInfo(disk, 0)
+            if not info:
+                return True
+            if pivot and not pivoted and info['end'] > 0 and info['cur'] == info['end']:
+                domain.blockJobAbort(disk, libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT)
+                pivoted = True
+                continue
+            if time.monotonic() >= deadline:
+                logger.error(f"块作业 {disk} 超过 {timeout} 秒未完成，取消")
+                try:
+                    domain.blockJobAbort(disk, 0)
+                except libvirt.libvirtError as e:
+                    logger.warning(f"取消块作业 {disk} 失败: {e}")
+                return False
+            time.sleep(interval)
+    
+    def create_snapshot(self, name: str, tag: str) -> Dict:
+        """
+        创建外部磁盘快照
+        
+        当前磁盘层被冻结为只读，之后的写入进入新建的qcow2覆盖层，
+        因此创建耗时与磁盘大小无关。
+        
+        Args:
+            name: 虚拟机名称
+            tag: 快照标识，用于生成覆盖层文件名
+            
+        Returns:
+            包含 disk_path（新覆盖层）与 backing_path（冻结层）的字典
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            raise Exception(f"虚拟机 {name} 不存在")
+        
+        backing_path = self._get_disk_path(domain)
+        if not backing_path:
+            raise Exception(f"虚拟机 {name} 没有可快照的磁盘")
+        disk_path = os.path.join(os.path.dirname(backing_path), f"{name}-{tag}.qcow2")
+        disk_target = self._get_disk_target(domain)
+        
+        snapshot = ET.Element('domainsnapshot')
+        ET.SubElement(snapshot, 'name').text = tag
+        ET.SubElement(snapshot, 'memory', snapshot='no')
+        disks = ET.SubElement(snapshot, 'disks')
+        disk = ET.SubElement(disks, 'disk', name=disk_target, snapshot='external')
+        ET.SubElement(disk, 'driver', type='qcow2')
+        ET.SubElement(disk, 'source', file=disk_path)
+        snapshot_xml = ET.tostring(snapshot, encoding='unicode')
+        
+        # 快照元数据由数据库维护，libvirt只负责切换覆盖层
+        flags = (libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_DISK_ONLY |
+                 libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC |
+                 libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA)
+        try:
+            domain.snapshotCreateXML(snapshot_xml, flags)
+        except libvirt.libvirtError as e:
+            logger.error(f"创建快照失败: {e}")
+            raise Exception(f"创建快照失败: {e}")
+        
+        logger.info(f"虚拟机 {name} 创建快照 {tag}: {disk_path}")
+        return {'disk_path': disk_path, 'backing_path': backing_path}
+    
+    def revert_snapshot(self, name: str, disk_path: str, backing_path: str,
+                        discard_paths: List[str]) -> bool:
+        """
+        回滚到外部快照
+        
+        丢弃快照之后的全部覆盖层，并在冻结层上重建空的覆盖层，耗时与磁盘大小无关。
+        
+        Args:
+            name: 虚拟机名称
+            disk_path: 快照覆盖层路径
+            backing_path: 快照冻结层路径
+            discard_paths: 该快照之后创建的覆盖层路径
+            
+        Returns:
+            操作是否成功
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+            was_active = domain.isActive() == 1
+            if was_active:
+                domain.destroy()
+            if domain.hasManagedSaveImage(0):
+                domain.managedSaveRemove(0)
+            
+            self._remove_disk_files(discard_paths + [disk_path])
+            self._create_overlay_disk(backing_path, disk_path)
+            if self._get_disk_path(domain) != disk_path:
+                domain = self._set_disk_path(domain, disk_path)
+            
+            if was_active:
+                domain.create()
+            logger.info(f"虚拟机 {name} 回滚到快照层 {backing_path}")
+            return True
+        
+        except libvirt.libvirtError as e:
+            logger.error(f"回滚快照失败: {e}")
+            return False
+    
+    def merge_snapshot(self, name: str, disk_path: str, backing_path: str,
+                       child_path: Optional[str] = None) -> bool:
+        """
+        将快照覆盖层合并到其冻结层（blockcommit），缩短后备链
+        
+        Args:
+            name: 虚拟机名称
+            disk_path: 待合并的覆盖层路径
+            backing_path: 合并目标（冻结层）路径
+            child_path: 以 disk_path 为后备的上层覆盖层，为None时 disk_path 即为活动层
+            
+        Returns:
+            操作是否成功
+        """
+        import subprocess
+        
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+            
+            if domain.isActive():
+                # 在线提交，由QEMU负责改写上层覆盖层的后备指向
+                disk_target = self._get_disk_target(domain)
+                if child_path is None:
+                    domain.blockCommit(disk_target, backing_path, None, 0,
+                                       libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE)
+                    finished = self._wait_block_job(domain, disk_target, pivot=True)
+                else:
+                    domain.blockCommit(disk_target, backing_path, disk_path, 0, 0)
+                    finished = self._wait_block_job(domain, disk_target, pivot=False)
+                # 作业失败或被取消时覆盖层仍在后备链中（活动提交时还在被写入），不能删除
+                if not finished or disk_path in self._disk_chain(domain):
+                    logger.error(f"虚拟机 {name} 的快照层 {disk_path} 合并未完成，保留该层")
+                    return False
+            else:
+                subprocess.run(['qemu-img', 'commit', '-q', disk_path],
+                               check=True, capture_output=True, text=True)
+                if child_path is None:
+                    self._set_disk_path(domain, backing_path)
+                else:
+                    subprocess.run(['qemu-img', 'rebase', '-u', '-F', 'qcow2',
+                                    '-b', backing_path, child_path],
+                                   check=True, capture_output=True, text=True)
+            
+            self._remove_disk_files([disk_path])
+            logger.info(f"虚拟机 {name} 的快照层 {disk_path} 已合并到 {backing_path}")
+            return True
+        
+        except (libvirt.libvirtError, subprocess.CalledProcessError) as e:
+            logger.error(f"合并快照失败: {e}")
+            return False
+    
     def start_vm(self, name: str) -> bool:
         """
         启动虚拟机
@@ -255,10 +729,18 @@ class LibvirtManager:
             logger.error(f"虚拟机 {name} 不存在: {e}")
             raise Exception(f"虚拟机 {name} 不存在")
 
-        # 如果已经在运行，直接返回
+        # 如果已经在运行，直接返回；被暂停的虚拟机直接恢复
         if domain.isActive():
+            state, _ = domain.state()
+            if state == libvirt.VIR_DOMAIN_PAUSED:
+                logger.info(f"虚拟机 {name} 处于暂停状态，恢复运行")
+                return domain.resume() == 0
             logger.warning(f"虚拟机 {name} 已经在运行")
             return True
+        
+        # 存在休眠镜像时 create() 会从镜像恢复，而不是重新引导
+        if domain.hasManagedSaveImage(0):
+            logger.info(f"虚拟机 {name} 从休眠镜像恢复")
 
         # 启动虚拟机
         try:
@@ -390,13 +872,12 @@ class LibvirtManager:
             logger.error(f"恢复虚拟机失败: {e}")
             return False
     
-    def delete_vm(self, name: str, remove_disk: bool = True) -> bool:
+    def managed_save_vm(self, name: str) -> bool:
         """
-        删除虚拟机
+        将虚拟机内存状态休眠到磁盘并释放宿主机内存，下次启动时自动恢复
         
         Args:
             name: 虚拟机名称
-            remove_disk: 是否删除磁盘文件
             
         Returns:
             操作是否成功
@@ -405,106 +886,702 @@ class LibvirtManager:
         
         try:
             domain = self.conn.lookupByName(name)
+            if not domain.isActive():
+                logger.warning(f"虚拟机 {name} 未运行，无需休眠")
+                return True
             
-            # 获取磁盘路径
-            disk_path = None
-            if remove_disk:
-                xml_desc = domain.XMLDesc()
-                root = ET.fromstring(xml_desc)
-                disk_elem = root.find(".//disk[@type='file']/source")
-                if disk_elem is not None:
-                    disk_path = disk_elem.get('file')
-            
-            # 停止虚拟机（如果正在运行）
-            if domain.isActive():
-                domain.destroy()
-            
-            # 取消定义虚拟机
-            result = domain.undefine()
-            
-            # 删除磁盘文件
-            if remove_disk and disk_path:
-                import os
-                try:
-                    os.remove(disk_path)
-                    logger.info(f"删除磁盘文件: {disk_path}")
-                except OSError as e:
-                    logger.warning(f"删除磁盘文件失败: {e}")
+            result = domain.managedSave(0)
             
             if result == 0:
-                logger.info(f"虚拟机 {name} 删除成功")
+                logger.info(f"虚拟机 {name} 休眠成功")
                 return True
             else:
-                logger.error(f"虚拟机 {name} 删除失败")
+                logger.error(f"虚拟机 {name} 休眠失败")
                 return False
                 
         except libvirt.libvirtError as e:
-            logger.error(f"删除虚拟机失败: {e}")
+            logger.error(f"休眠虚拟机失败: {e}")
             return False
     
-    def get_vm_status(self, name: str) -> Optional[Dict]:
+    def resize_vm(self, name: str, cpu_cores: int, memory_mb: int) -> Dict:
         """
-        获取虚拟机状态
+        调整虚拟机的vCPU数量与内存大小
+        
+        配置始终写入持久化定义；虚拟机运行中且新值不超过当前上限时，
+        通过vCPU热插拔与内存气球在线生效，否则在下次冷启动时生效。
         
         Args:
             name: 虚拟机名称
+            cpu_cores: 新的CPU核心数
+            memory_mb: 新的内存大小(MB)
             
         Returns:
-            虚拟机状态信息字典
+            包含 vcpus_live、memory_live（是否已在线生效）的字典
         """
         self._ensure_connection()
         
         try:
             domain = self.conn.lookupByName(name)
-            state, reason = domain.state()
-            
-            # 状态映射
-            state_map = {
-                libvirt.VIR_DOMAIN_NOSTATE: 'nostate',
-                libvirt.VIR_DOMAIN_RUNNING: 'running',
-                libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
-                libvirt.VIR_DOMAIN_PAUSED: 'paused',
-                libvirt.VIR_DOMAIN_SHUTDOWN: 'shutdown',
-                libvirt.VIR_DOMAIN_SHUTOFF: 'stopped',
-                libvirt.VIR_DOMAIN_CRASHED: 'crashed',
-                libvirt.VIR_DOMAIN_PMSUSPENDED: 'suspended',
-            }
-            
-            # 获取VNC信息
-            vnc_port = None
-            xml_desc = domain.XMLDesc()
-            root = ET.fromstring(xml_desc)
-            graphics_elem = root.find(".//graphics[@type='vnc']")
-            if graphics_elem is not None:
-                vnc_port = graphics_elem.get('port')
-            
-            # 获取IP地址
-            ip_address = None
-            try:
-                ifaces = domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
-                for iface_name, iface_info in ifaces.items():
-                    for addr in iface_info['addrs']:
-                        if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
-                            ip_address = addr['addr']
-                            break
-            except:
-                pass
-            
-            return {
-                'name': name,
-                'state': state_map.get(state, 'unknown'),
-                'vnc_port': vnc_port,
-                'ip_address': ip_address,
-                'is_active': domain.isActive() == 1
-            }
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            raise Exception(f"虚拟机 {name} 不存在")
+        
+        config = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        live = libvirt.VIR_DOMAIN_AFFECT_LIVE
+        memory_kib = memory_mb * 1024
+        active = domain.isActive()
+        result = {'vcpus_live': False, 'memory_live': False}
+        
+        try:
+            # 持久化定义：超过上限时先提高上限
+            if cpu_cores > domain.vcpusFlags(config | libvirt.VIR_DOMAIN_VCPU_MAXIMUM):
+                domain.setVcpusFlags(cpu_cores, config | libvirt.VIR_DOMAIN_VCPU_MAXIMUM)
+            domain.setVcpusFlags(cpu_cores, config)
             
+            # libvirt 输出的域定义中内存单位统一为KiB
+            inactive_root = ET.fromstring(domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE))
+            if memory_kib > int(inactive_root.findtext('memory')):
+                domain.setMemoryFlags(memory_kib, config | libvirt.VIR_DOMAIN_MEM_MAXIMUM)
+            domain.setMemoryFlags(memory_kib, config)
         except libvirt.libvirtError as e:
-            logger.error(f"获取虚拟机状态失败: {e}")
-            return None
+            logger.error(f"修改虚拟机 {name} 配置失败: {e}")
+            raise Exception(f"修改虚拟机配置失败: {e}")
+        
+        if active:
+            # 在线生效：vCPU热插拔/拔出需要客户机配合，失败时保留到下次启动
+            if cpu_cores <= domain.vcpusFlags(live | libvirt.VIR_DOMAIN_VCPU_MAXIMUM):
+                try:
+                    domain.setVcpusFlags(cpu_cores, live)
+                    result['vcpus_live'] = True
+                except libvirt.libvirtError as e:
+                    logger.warning(f"虚拟机 {name} 在线调整vCPU失败，将在下次启动时生效: {e}")
+            if memory_kib <= domain.maxMemory():
+                try:
+                    domain.setMemoryFlags(memory_kib, live)
+                    result['memory_live'] = True
+                except libvirt.libvirtError as e:
+                    logger.warning(f"虚拟机 {name} 在线调整内存失败，将在下次启动时生效: {e}")
+        
+        logger.info(f"虚拟机 {name} 调整为 {cpu_cores} 核 / {memory_mb}MB: {result}")
+        return result
     
-    def get_vm_metrics(self, name: str) -> Optional[Dict]:
+    def get_cpu_tune(self, name: str) -> Optional[Dict]:
         """
-        获取虚拟机监控指标
+        获取虚拟机当前生效的CPU调度参数
+
+        Args:
+            name: 虚拟机名称
+
+        Returns:
+            {'shares', 'period', 'quota'}，quota 为负数表示不限制；失败时返回None
+        """
+        self._ensure_connection()
+
+        try:
+            domain = self.conn.lookupByName(name)
+            params = domain.schedulerParameters()
+            return {
+                'shares': params.get('cpu_shares'),
+                'period': params.get('vcpu_period'),
+                'quota': params.get('vcpu_quota'),
+            }
+        except libvirt.libvirtError as e:
+            logger.error(f"获取虚拟机 {name} CPU调度参数失败: {e}")
+            return None
+
+    def set_cpu_tune(self, name: str, shares: Optional[int] = None, period: Optional[int] = None,
+                     quota: Optional[int] = None, persistent: bool = True) -> bool:
+        """
+        调整虚拟机的CPU调度参数，运行中的虚拟机立即生效
+
+        Args:
+            name: 虚拟机名称
+            shares: 相对权重，为空时不修改
+            period: 配额周期（微秒），为空时不修改
+            quota: 每个vCPU每个周期的配额（微秒），0 或负数表示不限制，为空时不修改
+            persistent: 是否同时写入持久化定义；为False时只作用于运行中的域（临时限流）
+
+        Returns:
+            是否有参数生效（未运行且不写入持久化定义时为False）
+        """
+        self._ensure_connection()
+
+        try:
+            domain = self.conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            raise Exception(f"虚拟机 {name} 不存在")
+
+        params = {}
+        if shares:
+            params['cpu_shares'] = shares
+        if period:
+            params['vcpu_period'] = period
+        if quota is not None:
+            params['vcpu_quota'] = quota if quota > 0 else -1
+        flags = 0
+        if domain.isActive():
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+        if persistent:
+            flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        if not params or not flags:
+            return False
+
+        try:
+            domain.setSchedulerParametersFlags(params, flags)
+        except libvirt.libvirtError as e:
+            logger.error(f"调整虚拟机 {name} CPU调度参数失败: {e}")
+            raise Exception(f"调整CPU调度参数失败: {e}")
+        logger.info(f"虚拟机 {name} CPU调度参数调整为 {params}")
+        return True
+
+    def _get_io_limits(self, domain) -> Dict:
+        """
+        从域定义读取系统盘 iotune 与网卡 bandwidth 中生效的限速
+
+        Args:
+            domain: libvirt域对象
+
+        Returns:
+            DISK_IOTUNE_KEYS 与 NET_BANDWIDTH_KEYS 各项的值，未设置为0
+        """
+        root = ET.fromstring(domain.XMLDesc())
+        limits = {key: 0 for key in DISK_IOTUNE_KEYS + NET_BANDWIDTH_KEYS}
+        iotune = root.find(".//disk[@type='file']/iotune")
+        if iotune is not None:
+            for key in DISK_IOTUNE_KEYS:
+                if iotune.findtext(key):
+                    limits[key] = int(iotune.findtext(key))
+        bandwidth = root.find(".//interface[@type='network']/bandwidth")
+        if bandwidth is not None:
+            for direction in ('inbound', 'outbound'):
+                elem = bandwidth.find(direction)
+                if elem is None:
+                    continue
+                for attr in ('average', 'peak', 'burst'):
+                    if elem.get(attr):
+                        limits[f'{direction}_{attr}'] = int(elem.get(attr))
+        return limits
+
+    def get_io_tune(self, name: str) -> Optional[Dict]:
+        """
+        获取虚拟机当前生效的磁盘与网络I/O限速
+
+        Args:
+            name: 虚拟机名称
+
+        Returns:
+            各限速项的值，0 表示不限制；失败时返回None
+        """
+        self._ensure_connection()
+
+        try:
+            return self._get_io_limits(self.conn.lookupByName(name))
+        except libvirt.libvirtError as e:
+            logger.error(f"获取虚拟机 {name} I/O限速失败: {e}")
+            return None
+
+    def set_io_tune(self, name: str, limits: Dict, persistent: bool = True) -> bool:
+        """
+        调整虚拟机系统盘与网卡的I/O限速，运行中的虚拟机立即生效
+
+        Args:
+            name: 虚拟机名称
+            limits: DISK_IOTUNE_KEYS 与 NET_BANDWIDTH_KEYS 中要修改的项，0 表示不限制
+            persistent: 是否同时写入持久化定义
+
+        Returns:
+            是否有参数生效（未运行且不写入持久化定义时为False）
+        """
+        self._ensure_connection()
+
+        try:
+            domain = self.conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            raise Exception(f"虚拟机 {name} 不存在")
+
+        flags = 0
+        if domain.isActive():
+            flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+        if persistent:
+            flags |= libvirt.VIR_DOMAIN_AFFECT_CONFIG
+        disk_params = {key: int(limits[key]) for key in DISK_IOTUNE_KEYS if key in limits}
+        # 突发时长只能与突发上限一起设置
+        for key in ('total_bytes_sec', 'total_iops_sec'):
+            if not disk_params.get(f'{key}_max'):
+                disk_params.pop(f'{key}_max_length', None)
+        # libvirt 的网卡参数名为 inbound.average 形式
+        net_params = {key.replace('_', '.', 1): int(limits[key]) for key in NET_BANDWIDTH_KEYS if key in limits}
+        if not flags or not (disk_params or net_params):
+            return False
+
+        try:
+            if disk_params:
+                domain.setBlockIoTune(self._get_disk_target(domain), disk_params, flags)
+            if net_params:
+                mac = ET.fromstring(domain.XMLDesc()).find(".//interface[@type='network']/mac")
+                domain.setInterfaceParameters(mac.get('address'), net_params, flags)
+        except libvirt.libvirtError as e:
+            logger.error(f"调整虚拟机 {name} I/O限速失败: {e}")
+            raise Exception(f"调整I/O限速失败: {e}")
+        logger.info(f"虚拟机 {name} I/O限速调整为 {dict(disk_params, **net_params)}")
+        return True
+
+    def get_memory_stats(self, name: str) -> Optional[Dict]:
+        """
+        获取运行中虚拟机的内存气球统计
+
+        需要域定义开启气球统计周期，否则只有 actual 等少数几项。
+
+        Args:
+            name: 虚拟机名称
+
+        Returns:
+            memoryStats() 的结果，单位KiB（actual 为当前气球大小，usable 为来宾可回收后的可用内存）；
+            未运行或失败时返回None
+        """
+        self._ensure_connection()
+
+        try:
+            domain = self.conn.lookupByName(name)
+            if not domain.isActive():
+                return None
+            return domain.memoryStats()
+        except libvirt.libvirtError as e:
+            logger.error(f"获取虚拟机 {name} 内存统计失败: {e}")
+            return None
+
+    def enable_memory_stats(self, name: str, period: int) -> bool:
+        """
+        开启虚拟机的内存气球统计（运行中立即生效并写入持久化定义）
+
+        Args:
+            name: 虚拟机名称
+            period: 统计周期（秒）
+
+        Returns:
+            操作是否成功
+        """
+        self._ensure_connection()
+
+        try:
+            domain = self.conn.lookupByName(name)
+            flags = libvirt.VIR_DOMAIN_AFFECT_CONFIG
+            if domain.isActive():
+                flags |= libvirt.VIR_DOMAIN_AFFECT_LIVE
+            domain.setMemoryStatsPeriod(period, flags)
+            return True
+        except libvirt.libvirtError as e:
+            logger.error(f"开启虚拟机 {name} 内存统计失败: {e}")
+            return False
+
+    def set_balloon(self, name: str, memory_mb: int):
+        """
+        调整运行中虚拟机的气球大小（只作用于运行中的域，重启后恢复定义中的内存）
+
+        Args:
+            name: 虚拟机名称
+            memory_mb: 来宾可用内存(MB)，不超过域的内存上限
+        """
+        self._ensure_connection()
+
+        try:
+            domain = self.conn.lookupByName(name)
+            domain.setMemoryFlags(memory_mb * 1024, libvirt.VIR_DOMAIN_AFFECT_LIVE)
+        except libvirt.libvirtError as e:
+            logger.error(f"调整虚拟机 {name} 气球失败: {e}")
+            raise Exception(f"调整内存气球失败: {e}")
+        logger.info(f"虚拟机 {name} 气球调整为 {memory_mb}MB")
+
+    def get_ksm_stats(self) -> Optional[Dict]:
+        """
+        获取宿主机KSM（内存页合并）统计
+
+        Returns:
+            {'pages_shared', 'pages_sharing', 'pages_unshared', 'full_scans', 'saved_mb'}，
+            saved_mb 为合并节省的内存；宿主机不支持或失败时返回None
+        """
+        self._ensure_connection()
+
+        try:
+            params = self.conn.getMemoryParameters(0)
+        except libvirt.libvirtError as e:
+            logger.warning(f"获取宿主机KSM统计失败: {e}")
+            return None
+        if 'shm_pages_sharing' not in params:
+            return None
+        return {
+            'pages_shared': params.get('shm_pages_shared', 0),
+            'pages_sharing': params['shm_pages_sharing'],
+            'pages_unshared': params.get('shm_pages_unshared', 0),
+            'full_scans': params.get('shm_full_scans', 0),
+            'saved_mb': params['shm_pages_sharing'] * KSM_PAGE_SIZE // (1024 * 1024),
+        }
+
+    def get_ksm_merging_pages(self, name: str) -> Optional[int]:
+        """
+        获取虚拟机QEMU进程中被KSM合并的页数
+
+        读取本机 /proc/<pid>/ksm_merging_pages（Linux 5.17+），远程宿主机返回None。
+
+        Args:
+            name: 虚拟机名称
+
+        Returns:
+            合并页数，无法获取时返回None
+        """
+        if self.uri not in ('qemu:///system', 'qemu:///session'):
+            return None
+        try:
+            with open(os.path.join(QEMU_PID_DIR, f'{name}.pid')) as f:
+                pid = int(f.read().strip())
+            with open(f'/proc/{pid}/ksm_merging_pages') as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def resize_disk(self, name: str, disk_gb: int) -> bool:
+        """
+        扩大虚拟机系统盘的虚拟大小
+        
+        运行中的虚拟机通过 blockResize 在线生效，客户机内仍需自行扩展分区与文件系统；
+        未运行时直接修改当前活动层镜像。
+        
+        Args:
+            name: 虚拟机名称
+            disk_gb: 新的磁盘大小(GB)
+            
+        Returns:
+            操作是否成功
+        """
+        import subprocess
+        
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            raise Exception(f"虚拟机 {name} 不存在")
+        
+        disk_target = self._get_disk_target(domain)
+        size = disk_gb * 1024 ** 3
+        capacity = domain.blockInfo(disk_target)[0]
+        if size < capacity:
+            raise Exception(f"磁盘只能扩容，当前大小 {capacity // 1024 ** 3}GB")
+        if size == capacity:
+            return True
+        
+        try:
+            if domain.isActive():
+                domain.blockResize(disk_target, size, libvirt.VIR_DOMAIN_BLOCK_RESIZE_BYTES)
+            else:
+                subprocess.run(
+                    ['qemu-img', 'resize', '-q', self._get_disk_path(domain), str(size)],
+                    check=True, capture_output=True, text=True
+                )
+        except (libvirt.libvirtError, subprocess.CalledProcessError) as e:
+            logger.error(f"扩容虚拟机 {name} 磁盘失败: {e}")
+            raise Exception(f"扩容磁盘失败: {e}")
+        
+        logger.info(f"虚拟机 {name} 磁盘扩容到 {disk_gb}GB")
+        return True
+    
+    def get_disk_path(self, name: str) -> Optional[str]:
+        """
+        获取虚拟机当前活动磁盘层路径
+        
+        Args:
+            name: 虚拟机名称
+            
+        Returns:
+            磁盘文件路径，虚拟机不存在时返回None
+        """
+        self._ensure_connection()
+        
+        try:
+            return self._get_disk_path(self.conn.lookupByName(name))
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            return None
+    
+    def convert_disk(self, src: str, dst: str, compress: bool = False,
+                     progress: Optional[Callable[[float], None]] = None,
+                     backing: Optional[str] = None):
+        """
+        导出磁盘为独立的qcow2镜像（qemu-img convert）
+        
+        合并整条后备链，跳过全零簇以压实镜像，可选启用qcow2压缩。
+        
+        Args:
+            src: 源磁盘路径（后备链的顶层，调用方保证导出期间不被写入）
+            dst: 目标镜像路径
+            compress: 是否压缩
+            progress: 进度回调，参数为百分比
+            backing: 输出镜像的后备文件，须位于源磁盘的后备链中；指定时只导出该文件之上的差异
+        """
+        import re
+        import subprocess
+        
+        command = ['qemu-img', 'convert', '-p', '-O', 'qcow2']
+        if compress:
+            command.append('-c')
+        if backing:
+            command += ['-B', backing, '-F', 'qcow2']
+        command += [src, dst]
+        
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        pattern = re.compile(rb'\((\d+(?:\.\d+)?)/100%\)')
+        buffer = b''
+        while True:
+            chunk = process.stdout.read(256)
+            if not chunk:
+                break
+            # qemu-img 以回车刷新同一行进度
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\r')
+            for line in lines:
+                match = pattern.search(line)
+                if match and progress:
+                    progress(float(match.group(1)))
+        
+        stderr = process.stderr.read().decode(errors='replace')
+        if process.wait() != 0:
+            raise Exception(f"导出磁盘失败: {stderr.strip()}")
+        logger.info(f"导出磁盘 {src} -> {dst}{'（压缩）' if compress else ''}")
+    
+    def export_delta(self, top_path: str, base_path: str, dest: str,
+                     progress: Optional[Callable[[float], None]] = None):
+        """
+        导出后备链中 base_path 之上的差异层，输出以 base_path 为后备文件
+        
+        顶层直接以 base_path 为后备文件时复制该层（支持reflink时几乎不耗时），
+        否则通过 qemu-img convert -B 合并中间各层。
+        
+        Args:
+            top_path: 后备链顶层路径（调用方保证导出期间不被写入）
+            base_path: 差异的基准，须位于后备链中
+            dest: 目标镜像路径
+            progress: 进度回调，参数为百分比
+        """
+        import subprocess
+        
+        backing = self._get_backing_file(top_path)
+        if backing and os.path.realpath(backing) == os.path.realpath(base_path):
+            def report(copied: int, total: int):
+                if progress and total:
+                    progress(copied * 100 / total)
+            copy_disk(top_path, dest, progress=report)
+            # 统一写入基准的规范路径
+            subprocess.run(['qemu-img', 'rebase', '-u', '-F', 'qcow2', '-b', base_path, dest],
+                           check=True, capture_output=True, text=True)
+        else:
+            self.convert_disk(top_path, dest, progress=progress, backing=base_path)
+        logger.info(f"导出差异层 {top_path} (基于 {base_path}) -> {dest}")
+    
+    def get_disk_usage(self, name: str) -> Optional[Dict]:
+        """
+        获取虚拟机系统盘的容量与实际占用
+        
+        Args:
+            name: 虚拟机名称
+            
+        Returns:
+            包含 capacity（虚拟大小）、allocation（已分配）、physical（文件大小）的字典，单位字节
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+            capacity, allocation, physical = domain.blockInfo(self._get_disk_target(domain))
+            return {'capacity': capacity, 'allocation': allocation, 'physical': physical}
+        except libvirt.libvirtError as e:
+            logger.error(f"获取虚拟机 {name} 磁盘占用失败: {e}")
+            return None
+    
+    def delete_vm(self, name: str, remove_disk: bool = True) -> bool:
+        """
+        删除虚拟机
+        
+        Args:
+            name: 虚拟机名称
+            remove_disk: 是否删除磁盘文件
+            
+        Returns:
+            操作是否成功
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+            
+            # 获取磁盘路径
+            disk_path = self._get_disk_path(domain) if remove_disk else None
+            
+            # 停止虚拟机（如果正在运行）
+            if domain.isActive():
+                domain.destroy()
+            
+            # 取消定义虚拟机
+            result = domain.undefine()
+            
+            # 在存储池中异步删除磁盘卷
+            if remove_disk and disk_path:
+                self.storage.delete_volume(disk_path)
+            
+            if result == 0:
+                logger.info(f"虚拟机 {name} 删除成功")
+                return True
+            else:
+                logger.error(f"虚拟机 {name} 删除失败")
+                return False
+                
+        except libvirt.libvirtError as e:
+            logger.error(f"删除虚拟机失败: {e}")
+            return False
+
+    def migrate_offline(self, name: str, target: 'LibvirtManager'):
+        """
+        将已关机的虚拟机定义迁移到另一台宿主机
+
+        只迁移域定义与快照元数据，磁盘文件需位于两台宿主机共享的存储上。
+        在目标宿主机定义成功后才取消源宿主机上的定义。
+
+        Args:
+            name: 虚拟机名称
+            target: 目标宿主机的管理器
+        """
+        self._ensure_connection()
+        target._ensure_connection()
+
+        try:
+            domain = self.conn.lookupByName(name)
+        except libvirt.libvirtError as e:
+            logger.error(f"虚拟机 {name} 不存在: {e}")
+            raise Exception(f"虚拟机 {name} 不存在")
+        if domain.isActive():
+            raise Exception(f"虚拟机 {name} 正在运行，只能迁移已关机的虚拟机")
+
+        try:
+            xml = domain.XMLDesc(libvirt.VIR_DOMAIN_XML_INACTIVE | libvirt.VIR_DOMAIN_XML_SECURE)
+            # 父快照在前，保证重建时父快照已存在
+            snapshots = domain.listAllSnapshots(libvirt.VIR_DOMAIN_SNAPSHOT_LIST_TOPOLOGICAL)
+            current = domain.snapshotCurrent().getName() if domain.hasCurrentSnapshot() else None
+
+            new_domain = target.conn.defineXML(xml)
+            for snapshot in snapshots:
+                flags = libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_REDEFINE
+                if snapshot.getName() == current:
+                    flags |= libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_CURRENT
+                new_domain.snapshotCreateXML(snapshot.getXMLDesc(libvirt.VIR_DOMAIN_SNAPSHOT_XML_SECURE), flags)
+        except libvirt.libvirtError as e:
+            logger.error(f"迁移虚拟机 {name} 到 {target.uri} 失败: {e}")
+            raise Exception(f"迁移虚拟机失败: {e}")
+
+        try:
+            domain.undefineFlags(libvirt.VIR_DOMAIN_UNDEFINE_SNAPSHOTS_METADATA)
+        except libvirt.libvirtError as e:
+            # 目标宿主机已定义，源宿主机上的残留定义不影响使用
+            logger.warning(f"取消源宿主机上虚拟机 {name} 的定义失败: {e}")
+        logger.info(f"虚拟机 {name} 已从 {self.uri} 迁移到 {target.uri}")
+
+    def get_vm_status(self, name: str) -> Optional[Dict]:
+        """
+        获取虚拟机状态
+        
+        Args:
+            name: 虚拟机名称
+            
+        Returns:
+            虚拟机状态信息字典
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+            state, reason = domain.state()
+            
+            # 状态映射
+            state_map = {
+                libvirt.VIR_DOMAIN_NOSTATE: 'nostate',
+                libvirt.VIR_DOMAIN_RUNNING: 'running',
+                libvirt.VIR_DOMAIN_BLOCKED: 'blocked',
+                libvirt.VIR_DOMAIN_PAUSED: 'paused',
+                libvirt.VIR_DOMAIN_SHUTDOWN: 'shutdown',
+                libvirt.VIR_DOMAIN_SHUTOFF: 'stopped',
+                libvirt.VIR_DOMAIN_CRASHED: 'crashed',
+                libvirt.VIR_DOMAIN_PMSUSPENDED: 'suspended',
+            }
+            
+            # 获取VNC信息
+            vnc_port = None
+            xml_desc = domain.XMLDesc()
+            root = ET.fromstring(xml_desc)
+            graphics_elem = root.find(".//graphics[@type='vnc']")
+            if graphics_elem is not None:
+                vnc_port = graphics_elem.get('port')
+            
+            # 获取IP地址
+            ip_address = None
+            try:
+                ifaces = domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
+                for iface_name, iface_info in ifaces.items():
+                    for addr in iface_info['addrs']:
+                        if addr['type'] == libvirt.VIR_IP_ADDR_TYPE_IPV4:
+                            ip_address = addr['addr']
+                            break
+            except:
+                pass
+            
+            state_name = state_map.get(state, 'unknown')
+            if state == libvirt.VIR_DOMAIN_SHUTOFF and domain.hasManagedSaveImage(0):
+                state_name = 'saved'
+            
+            return {
+                'name': name,
+                'state': state_name,
+                'vnc_port': vnc_port,
+                'ip_address': ip_address,
+                'is_active': domain.isActive() == 1
+            }
+            
+        except libvirt.libvirtError as e:
+            logger.error(f"获取虚拟机状态失败: {e}")
+            return None
+    
+    def boot_completed(self, name: str) -> bool:
+        """
+        虚拟机是否已完成开机：DHCP租约中已有IP，或客户机代理响应 guest-ping
+        
+        Args:
+            name: 虚拟机名称
+            
+        Returns:
+            是否已完成开机
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+            if not domain.isActive():
+                return False
+            ifaces = domain.interfaceAddresses(libvirt.VIR_DOMAIN_INTERFACE_ADDRESSES_SRC_LEASE)
+            if any(iface.get('addrs') for iface in (ifaces or {}).values()):
+                return True
+        except libvirt.libvirtError:
+            return False
+        
+        try:
+            import libvirt_qemu
+            libvirt_qemu.qemuAgentCommand(domain, '{"execute": "guest-ping"}', 2, 0)
+            return True
+        except (ImportError, libvirt.libvirtError):
+            return False
+    
+    def get_vm_metrics(self, name: str) -> Optional[Dict]:
+        """
+        获取虚拟机监控指标
         
         Args:
             name: 虚拟机名称
@@ -523,7 +1600,8 @@ class LibvirtManager:
                     'memory_usage': 0,
                     'disk_usage': 0,
                     'network_rx': 0,
-                    'network_tx': 0
+                    'network_tx': 0,
+                    'io_limits': self._get_io_limits(domain)
                 }
             
             # 获取CPU统计
@@ -535,7 +1613,7 @@ class LibvirtManager:
             # 获取磁盘统计
             disk_stats = {}
             try:
-                disk_stats = domain.blockStats('vda')
+                disk_stats = domain.blockStats(self._get_disk_target(domain))
             except:
                 pass
             
@@ -560,12 +1638,102 @@ class LibvirtManager:
                 'disk_write': disk_stats[3] if disk_stats else 0,
                 'network_rx': network_stats[0] if network_stats else 0,
                 'network_tx': network_stats[4] if network_stats else 0,
+                'io_limits': self._get_io_limits(domain),
             }
             
         except libvirt.libvirtError as e:
             logger.error(f"获取虚拟机监控指标失败: {e}")
             return None
     
+    def get_activity_counters(self, name: str) -> Optional[Dict]:
+        """
+        获取用于空闲检测的累计计数器
+        
+        Args:
+            name: 虚拟机名称
+            
+        Returns:
+            包含 cpu_time（纳秒）、vcpus、net_bytes（收发总字节）、disk_allocation（磁盘已分配字节）
+            的字典，虚拟机未运行时返回None
+        """
+        self._ensure_connection()
+        
+        try:
+            domain = self.conn.lookupByName(name)
+            if not domain.isActive():
+                return None
+            
+            _, _, _, vcpus, cpu_time = domain.info()
+            
+            net_bytes = 0
+            root = ET.fromstring(domain.XMLDesc())
+            for target in root.findall(".//interface/target"):
+                dev_name = target.get('dev')
+                if dev_name:
+                    stats = domain.interfaceStats(dev_name)
+                    net_bytes += stats[0] + stats[4]
+            
+            disk_allocation = domain.blockInfo(self._get_disk_target(domain))[1]
+            
+            return {'cpu_time': cpu_time, 'vcpus': vcpus, 'net_bytes': net_bytes,
+                    'disk_allocation': disk_allocation}
+            
+        except libvirt.libvirtError as e:
+            logger.error(f"获取虚拟机活动计数失败: {e}")
+            return None
+    
+    def get_host_memory(self) -> Optional[Dict]:
+        """
+        获取宿主机内存
+        
+        Returns:
+            {'total_mb': 物理内存, 'free_mb': 空闲内存}，失败时返回None
+        """
+        self._ensure_connection()
+        
+        try:
+            info = self.conn.getInfo()
+            return {'total_mb': info[1], 'free_mb': self.conn.getFreeMemory() // (1024 * 1024)}
+        except libvirt.libvirtError as e:
+            logger.error(f"获取宿主机内存失败: {e}")
+            return None
+
+    def get_host_capacity(self) -> Optional[Dict]:
+        """
+        获取宿主机CPU、内存与磁盘存储池容量
+
+        available_mb 为空闲内存加上可回收的页缓存与缓冲区，内存统计不可用时等于 free_mb。
+
+        Returns:
+            {'cpus', 'memory_mb', 'free_mb', 'available_mb', 'disk_capacity_gb', 'disk_available_gb'}，
+            失败时返回None
+        """
+        self._ensure_connection()
+
+        try:
+            info = self.conn.getInfo()
+            free_mb = self.conn.getFreeMemory() // (1024 * 1024)
+            available_mb = free_mb
+            try:
+                # 单位KiB
+                stats = self.conn.getMemoryStats(libvirt.VIR_NODE_MEMORY_STATS_ALL_CELLS)
+                available_mb = (stats.get('free', 0) + stats.get('buffers', 0) + stats.get('cached', 0)) // 1024
+            except libvirt.libvirtError:
+                pass
+            # [state, capacity, allocation, available]，单位字节
+            pool_info = self.storage.get_pool('disks').info()
+            return {
+                'cpus': info[2],
+                'memory_mb': info[1],
+                'free_mb': free_mb,
+                'available_mb': available_mb,
+                'disk_capacity_gb': pool_info[1] // 1024 ** 3,
+                'disk_available_gb': pool_info[3] // 1024 ** 3,
+            }
+        except libvirt.libvirtError as e:
+            logger.error(f"获取宿主机容量失败: {e}")
+            return None
+
     def list_vms(self) -> List[Dict]:
         """
         列出所有虚拟机
@@ -607,3 +1775,30 @@ class LibvirtManager:
 
 # 全局管理器实例
 libvirt_manager = LibvirtManager()
+
+# 各宿主机的管理器，按宿主机记录缓存，每台宿主机一个连接
+_host_managers: Dict[int, LibvirtManager] = {}
+_host_managers_lock = threading.Lock()
+
+
+def get_manager(host) -> LibvirtManager:
+    """
+    获取宿主机的libvirt管理器，首次使用时建立连接
+
+    按宿主机记录而不是URI缓存，多台宿主机可以使用相同的URI（如测试驱动 test:///default，
+    每次打开都是独立的虚拟宿主机）。
+
+    Args:
+        host: 宿主机记录（apps.vms.models.Host）
+
+    Returns:
+        宿主机的管理器；URI变更后重新连接
+    """
+    with _host_managers_lock:
+        manager = _host_managers.get(host.pk)
+        if manager is None or manager.uri != host.uri:
+            if manager is not None:
+                manager.close()
+            manager = _host_managers[host.pk] = LibvirtManager(host.uri)
+        return manager
+
@@ -0,0 +1,39 @@
+"""
+空闲虚拟机回收守护进程
+"""
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.vms.balloon import MemoryManager
+from apps.vms.cputune import CpuThrottler
+from apps.vms.idle import IdleReaper
+
+
+class Command(BaseCommand):
+    help = '周期性采样虚拟机活动，按课程策略暂停、休眠或关闭空闲虚拟机，在宿主机CPU紧张时限流高负载虚拟机，在内存紧张时回收空闲虚拟机的内存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=settings.IDLE_SAMPLE_INTERVAL,
+                            help='采样间隔（秒）')
+        parser.add_argument('--once', action='store_true', help='只执行一轮后退出')
+
+    def handle(self, *args, **options):
+        reaper = IdleReaper()
+        throttler = CpuThrottler()
+        memory = MemoryManager()
+        # 第一轮只建立计数基线，至少需要两轮采样才能判断活动
+        while True:
+            result = reaper.run_once()
+            self.stdout.write(f"检查 {result['checked']} 台虚拟机，回收 {result['reclaimed']} 台")
+            # 限流依据本轮采样的CPU使用率
+            result = throttler.run_once()
+            if result['throttled'] or result['released']:
+                self.stdout.write(f"CPU限流 {result['throttled']} 台，解除 {result['released']} 台")
+            result = memory.run_once()
+            if result['shrunk'] or result['grown']:
+                self.stdout.write(f"内存回收 {result['shrunk']} 台（{result['reclaimed_mb']}MB），"
+                                  f"恢复 {result['grown']} 台")
+            if options['once']:
+                break
+            time.sleep(options['interval'])
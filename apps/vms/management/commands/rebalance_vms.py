@@ -0,0 +1,61 @@
+"""
+宿主机再平衡
+"""
+import json
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.vms.rebalance import plan_moves, rebalancer, synthetic_fleet
+
+
+class Command(BaseCommand):
+    help = '计算宿主机再平衡方案（默认只试运行），可迁移方案中已停止的虚拟机'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', type=float, default=None,
+                            help='目标利用率（0~1），默认 REBALANCE_TARGET_UTILIZATION')
+        parser.add_argument('--apply', action='store_true', help='迁移方案中已停止的虚拟机')
+        parser.add_argument('--json', action='store_true', help='以JSON输出报告')
+        parser.add_argument('--benchmark', type=int, nargs='+', metavar='VMS',
+                            help='在指定规模的合成集群上测试计算耗时，不读取数据库')
+
+    def handle(self, *args, **options):
+        if options['benchmark']:
+            self.benchmark(options['benchmark'], options['target'] or settings.REBALANCE_TARGET_UTILIZATION)
+            return
+
+        report = rebalancer.report(options['target'])
+        if options['apply']:
+            report['result'] = rebalancer.apply(report)
+        if options['json']:
+            self.stdout.write(json.dumps(report, ensure_ascii=False, indent=2))
+            return
+
+        for host in report['hosts']:
+            self.stdout.write(f"{host['name']}: {host['utilization_before']:.0%} -> "
+                              f"{host['utilization_after']:.0%}")
+        for move in report['moves']:
+            note = '' if move['ready'] else f"（{move['status']}，需先关机）"
+            self.stdout.write(f"迁移 {move['name']}: {move['from']} -> {move['to']}{note}")
+        if report['unresolved']:
+            self.stdout.write(f"无法放置: {', '.join(report['unresolved'])}")
+        self.stdout.write(f"共 {len(report['moves'])} 次迁移，计算耗时 {report['elapsed_ms']}ms")
+        if 'result' in report:
+            result = report['result']
+            self.stdout.write(f"已迁移 {len(result['applied'])} 台，跳过 {len(result['skipped'])} 台，"
+                              f"失败 {len(result['failed'])} 台")
+
+    def benchmark(self, sizes, target):
+        for size in sizes:
+            fleet = synthetic_fleet(size)
+            started = time.perf_counter()
+            plan = plan_moves(fleet['hosts'], fleet['vms'], target)
+            elapsed = (time.perf_counter() - started) * 1000
+            overloaded = sum(1 for u in plan['before'].values() if u > target)
+            self.stdout.write(
+                f"{size} 台虚拟机 / {len(fleet['hosts'])} 台宿主机: 过载 {overloaded} 台，"
+                f"迁移 {len(plan['moves'])} 台，无法放置 {len(plan['unresolved'])} 台，"
+                f"最高利用率 {max(plan['before'].values()):.0%} -> {max(plan['after'].values()):.0%}，"
+                f"耗时 {elapsed:.1f}ms"
+            )
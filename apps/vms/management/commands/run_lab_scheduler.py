@@ -0,0 +1,26 @@
+"""
+上机时段调度守护进程
+"""
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.vms.lab_scheduler import LabScheduler
+
+
+class Command(BaseCommand):
+    help = '按课程上机时段分批预启动学生虚拟机，并在时段结束后关机或休眠'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=int, default=settings.LAB_SCHEDULER_INTERVAL,
+                            help='检查间隔（秒）')
+        parser.add_argument('--once', action='store_true', help='只执行一轮后退出')
+
+    def handle(self, *args, **options):
+        scheduler = LabScheduler()
+        while True:
+            result = scheduler.run_once()
+            self.stdout.write(f"启动 {result['started']} 台虚拟机，结束处理 {result['stopped']} 台")
+            if options['once']:
+                break
+            time.sleep(options['interval'])
@@ -2,7 +2,26 @@ from django.db import models
 from django.conf import settings
 import uuid
 
-from apps.courses.models import Course, VirtualMachineTemplate
+from apps.courses.models import Course, TemplateVersion, VirtualMachineTemplate
+
+class Host(models.Model):
+    """
+    宿主机
+
+    每台宿主机通过各自的libvirt URI连接；没有宿主机记录时所有虚拟机运行在默认连接上。
+    """
+    name = models.CharField(max_length=255, unique=True, verbose_name="宿主机名称")
+    uri = models.CharField(max_length=255, verbose_name="Libvirt连接URI")
+    enabled = models.BooleanField(default=True, verbose_name="接受新虚拟机")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    def __str__(self):
+        return self.name
+
+    class Meta:
+        verbose_name = "宿主机"
+        verbose_name_plural = verbose_name
+        ordering = ['name']
 
 class VirtualMachine(models.Model):
     """
@@ -13,6 +32,7 @@ class VirtualMachine(models.Model):
         ('stopped', '已停止'),
         ('running', '运行中'),
         ('paused', '已暂停'),
+        ('saved', '已休眠'),
         ('error', '错误'),
         ('deleting', '删除中'),
     ]
@@ -22,21 +42,37 @@ class VirtualMachine(models.Model):
     uuid = models.CharField(max_length=255, unique=True, blank=True, null=True, verbose_name="Libvirt中的UUID")
     owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="虚拟机所有者")
     course = models.ForeignKey(Course, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="所属课程")
+    host = models.ForeignKey(Host, on_delete=models.PROTECT, null=True, blank=True, related_name="vms", verbose_name="所在宿主机")
+    anti_affinity_group = models.CharField(max_length=255, blank=True, default='', verbose_name="反亲和组")
     template = models.ForeignKey(VirtualMachineTemplate, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="创建时使用的模板")
+    template_version = models.ForeignKey(TemplateVersion, on_delete=models.SET_NULL, null=True, blank=True, related_name="vms", verbose_name="磁盘后备的模板版本")
     cpu_cores = models.IntegerField(verbose_name="CPU核心数")
     memory_mb = models.IntegerField(verbose_name="内存大小 (MB)")
     disk_gb = models.IntegerField(verbose_name="磁盘大小 (GB)")
+    disk_allocated_bytes = models.BigIntegerField(default=0, verbose_name="磁盘实际占用 (字节)")
     status = models.CharField(max_length=50, choices=STATUS_CHOICES, default="stopped", verbose_name="虚拟机状态")
     ip_address = models.GenericIPAddressField(blank=True, null=True, verbose_name="IP地址")
     mac_address = models.CharField(max_length=17, blank=True, null=True, verbose_name="MAC地址")
     vnc_port = models.IntegerField(blank=True, null=True, verbose_name="VNC端口")
     vnc_password = models.CharField(max_length=255, blank=True, null=True, verbose_name="VNC密码")
+    last_activity_at = models.DateTimeField(blank=True, null=True, verbose_name="最近活动时间")
+    cpu_usage_percent = models.FloatField(blank=True, null=True, verbose_name="最近采样CPU使用率")
+    cpu_throttled_until = models.DateTimeField(blank=True, null=True, verbose_name="CPU限流截止时间")
+    memory_current_mb = models.IntegerField(blank=True, null=True, verbose_name="气球回收后的内存 (MB)")
     created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
     updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
 
     def __str__(self):
         return self.name
     
+    @property
+    def admission(self):
+        """进行中的开机准入记录（排队、执行或开机中），没有时为None"""
+        # 列表查询由 apps.vms.admission.prefetch_admission 预取，避免逐行查询
+        if hasattr(self, 'active_admissions'):
+            return self.active_admissions[0] if self.active_admissions else None
+        return self.admission_tickets.filter(status__in=('queued', 'admitted', 'booting')).first()
+
     @property
     def is_running(self):
         """是否在运行"""
@@ -55,7 +91,7 @@ class VirtualMachine(models.Model):
     @property
     def can_start(self):
         """是否可以启动"""
-        return self.status in ['stopped', 'error']
+        return self.status in ['stopped', 'saved', 'error']
     
     @property
     def can_stop(self):
@@ -86,6 +122,7 @@ class VirtualMachine(models.Model):
             'stopped': 'gray',
             'running': 'green',
             'paused': 'yellow',
+            'saved': 'purple',
             'error': 'red',
             'deleting': 'orange',
         }
@@ -95,3 +132,182 @@ class VirtualMachine(models.Model):
         verbose_name = "虚拟机"
         verbose_name_plural = verbose_name
         ordering = ['-created_at']
+
+
+class VirtualMachineSnapshot(models.Model):
+    """
+    虚拟机外部快照模型
+
+    每个快照对应一个qcow2覆盖层：创建快照时当前磁盘层（backing_path）被冻结，
+    之后的写入进入新的覆盖层（disk_path）。快照时刻的磁盘状态即 backing_path 的内容。
+    """
+    STATUS_CHOICES = [
+        ('active', '可用'),
+        ('merging', '合并中'),
+        ('error', '错误'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    vm = models.ForeignKey(VirtualMachine, on_delete=models.CASCADE, related_name="snapshots", verbose_name="所属虚拟机")
+    name = models.CharField(max_length=255, verbose_name="快照名称")
+    description = models.TextField(blank=True, null=True, verbose_name="快照描述")
+    disk_path = models.CharField(max_length=1024, verbose_name="覆盖层文件路径")
+    backing_path = models.CharField(max_length=1024, verbose_name="冻结磁盘层路径")
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, default="active", verbose_name="快照状态")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+
+    def __str__(self):
+        return f"{self.vm.name}@{self.name}"
+
+    class Meta:
+        verbose_name = "虚拟机快照"
+        verbose_name_plural = verbose_name
+        ordering = ['created_at']
+        unique_together = ['vm', 'name']
+
+
+class TemplateConversionJob(models.Model):
+    """
+    虚拟机转换为模板的后台任务
+
+    运行中的虚拟机先创建临时外部快照，在冻结的磁盘层上导出一致的时间点副本，
+    导出时合并后备链、去除空簇并可选压缩，完成后合并临时快照。
+    """
+    STATUS_CHOICES = [
+        ('pending', '等待中'),
+        ('running', '转换中'),
+        ('succeeded', '已完成'),
+        ('failed', '失败'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    vm = models.ForeignKey(VirtualMachine, on_delete=models.SET_NULL, null=True, blank=True, related_name="conversion_jobs", verbose_name="源虚拟机")
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, verbose_name="发起者")
+    name = models.CharField(max_length=255, verbose_name="模板名称")
+    description = models.TextField(blank=True, null=True, verbose_name="模板描述")
+    course = models.ForeignKey(Course, on_delete=models.CASCADE, null=True, blank=True, verbose_name="模板所属课程")
+    is_public = models.BooleanField(default=False, verbose_name="是否公开")
+    compress = models.BooleanField(default=False, verbose_name="是否压缩")
+    status = models.CharField(max_length=50, choices=STATUS_CHOICES, default="pending", verbose_name="任务状态")
+    progress = models.FloatField(default=0, verbose_name="进度 (%)")
+    template = models.ForeignKey(VirtualMachineTemplate, on_delete=models.SET_NULL, null=True, blank=True, verbose_name="生成的模板")
+    target_template = models.ForeignKey(VirtualMachineTemplate, on_delete=models.CASCADE, null=True, blank=True, related_name="version_jobs", verbose_name="发布新版本的模板")
+    error = models.TextField(blank=True, null=True, verbose_name="错误信息")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="创建时间")
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name="完成时间")
+
+    def __str__(self):
+        return f"{self.name} ({self.get_status_display()})"
+
+    class Meta:
+        verbose_name = "模板转换任务"
+        verbose_name_plural = verbose_name
+        ordering = ['-created_at']
+
+
+class AdmissionTicket(models.Model):
+    """
+    开机准入记录
+
+    创建、启动、重启虚拟机前先排队，宿主机上同时开机的数量与每分钟开机次数受限；
+    开机后直到虚拟机获得IP或客户机代理响应前一直占用名额，以实际开机耗时作为反压。
+    放行顺序见 apps.vms.admission：交互操作优先于批量任务，同类请求按课程、用户加权公平排队。
+    """
+    OPERATION_CHOICES = [
+        ('create', '创建'),
+        ('start', '启动'),
+        ('restart', '重启'),
+    ]
+    PRIORITY_CHOICES = [
+        ('interactive', '交互'),
+        ('batch', '批量'),
+    ]
+    STATUS_CHOICES = [
+        ('queued', '排队中'),
+        ('admitted', '执行中'),
+        ('booting', '开机中'),
+        ('done', '已完成'),
+        ('failed', '失败'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    vm = models.ForeignKey(VirtualMachine, on_delete=models.CASCADE, related_name="admission_tickets", verbose_name="虚拟机")
+    operation = models.CharField(max_length=20, choices=OPERATION_CHOICES, verbose_name="操作")
+    priority = models.CharField(max_length=20, choices=PRIORITY_CHOICES, default='interactive', verbose_name="优先级")
+    host = models.CharField(max_length=255, verbose_name="宿主机")
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued', verbose_name="状态")
+    error = models.TextField(blank=True, default='', verbose_name="错误信息")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="排队时间")
+    admitted_at = models.DateTimeField(blank=True, null=True, verbose_name="准入时间")
+    booted_at = models.DateTimeField(blank=True, null=True, verbose_name="开机完成时间")
+    finished_at = models.DateTimeField(blank=True, null=True, verbose_name="结束时间")
+
+    def __str__(self):
+        return f"{self.vm.name} {self.get_operation_display()} ({self.get_status_display()})"
+
+    @property
+    def position(self) -> int:
+        """在宿主机队列中的位置（从1开始），不在排队时为0；批量计算见 AdmissionScheduler.positions"""
+        if self.status != 'queued':
+            return 0
+        from apps.vms.admission import admission
+        return admission.position(self)
+
+    @property
+    def boot_seconds(self):
+        """从准入到开机完成的耗时（秒）"""
+        if self.admitted_at and self.booted_at:
+            return (self.booted_at - self.admitted_at).total_seconds()
+        return None
+
+    class Meta:
+        verbose_name = "开机准入记录"
+        verbose_name_plural = verbose_name
+        ordering = ['created_at']
+
+
+class CapacityReservation(models.Model):
+    """
+    宿主机容量预留
+
+    虚拟机开机前按其vCPU与内存在宿主机上预留容量，关机、休眠或删除时释放；
+    已预留总量不超过宿主机容量乘以超分比例，见 apps.vms.capacity。
+    """
+    vm = models.OneToOneField(VirtualMachine, on_delete=models.CASCADE, related_name="capacity_reservation", verbose_name="虚拟机")
+    host = models.CharField(max_length=255, verbose_name="宿主机")
+    cpu_cores = models.IntegerField(verbose_name="CPU核心数")
+    memory_mb = models.IntegerField(verbose_name="内存大小(MB)")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="预留时间")
+    updated_at = models.DateTimeField(auto_now=True, verbose_name="更新时间")
+
+    def __str__(self):
+        return f"{self.vm.name} @ {self.host}: {self.cpu_cores} 核 / {self.memory_mb}MB"
+
+    class Meta:
+        verbose_name = "宿主机容量预留"
+        verbose_name_plural = verbose_name
+
+
+class Preemption(models.Model):
+    """
+    空闲虚拟机抢占记录
+
+    宿主机容量不足、开机请求将被拒绝时，长时间空闲且课程抢占优先级较低的运行中虚拟机被休眠到磁盘，
+    为开机请求腾出容量，见 apps.vms.preemption。被抢占的虚拟机下次启动时透明恢复。
+    """
+    vm = models.ForeignKey(VirtualMachine, on_delete=models.CASCADE, related_name="preemptions", verbose_name="被抢占的虚拟机")
+    preempted_for = models.ForeignKey(VirtualMachine, on_delete=models.SET_NULL, null=True, blank=True, related_name="+", verbose_name="开机的虚拟机")
+    host = models.CharField(max_length=255, verbose_name="宿主机")
+    idle_seconds = models.IntegerField(verbose_name="空闲时长(秒)")
+    cpu_cores = models.IntegerField(verbose_name="释放的CPU核心数")
+    memory_mb = models.IntegerField(verbose_name="释放的内存(MB)")
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name="抢占时间")
+    resumed_at = models.DateTimeField(blank=True, null=True, verbose_name="恢复时间")
+
+    def __str__(self):
+        return f"{self.vm.name} @ {self.host}: {self.cpu_cores} 核 / {self.memory_mb}MB"
+
+    class Meta:
+        verbose_name = "虚拟机抢占记录"
+        verbose_name_plural = verbose_name
+        ordering = ['-created_at']
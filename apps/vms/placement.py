@@ -0,0 +1,113 @@
+"""
+虚拟机放置调度
+
+创建虚拟机时在启用的宿主机中选择一台：先排除容量不足（见 apps.vms.capacity）或违反反亲和规则
+（同一反亲和组的虚拟机不放在同一宿主机）的宿主机，再按分配后剩余的内存与CPU比例打分，
+已有同一模板虚拟机的宿主机额外加分——后备镜像已在其页缓存中，开机读盘更少。
+模板文件需位于各宿主机都能访问的共享存储上。
+"""
+import logging
+from typing import Dict, List, Optional
+from django.conf import settings
+
+from apps.vms.capacity import CapacityExceeded, capacity
+from apps.vms.models import Host, VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+
+class PlacementError(Exception):
+    """没有可放置虚拟机的宿主机"""
+    pass
+
+
+class PlacementEngine:
+    """
+    宿主机放置调度器
+
+    没有宿主机记录时返回None，虚拟机运行在默认连接上（单宿主机部署）。
+    """
+
+    def candidates(self) -> List[Host]:
+        """可接受新虚拟机的宿主机"""
+        return list(Host.objects.filter(enabled=True))
+
+    def violates_anti_affinity(self, vm: VirtualMachine, host: Host) -> bool:
+        """宿主机上是否已有同一反亲和组的其他虚拟机"""
+        if not vm.anti_affinity_group:
+            return False
+        return VirtualMachine.objects.filter(
+            host=host, anti_affinity_group=vm.anti_affinity_group
+        ).exclude(id=vm.id).exclude(status='deleting').exists()
+
+    def has_template(self, vm: VirtualMachine, host: Host) -> bool:
+        """宿主机上是否已有使用同一模板的虚拟机"""
+        if vm.template_id is None:
+            return False
+        return VirtualMachine.objects.filter(host=host, template_id=vm.template_id).exclude(id=vm.id).exists()
+
+    def score(self, vm: VirtualMachine, host: Host, info: Dict) -> float:
+        """
+        宿主机得分，越高越优先
+
+        分配后剩余内存比例与剩余CPU比例按 PLACEMENT_MEMORY_WEIGHT、PLACEMENT_CPU_WEIGHT 加权，
+        有同一模板的虚拟机时加上 PLACEMENT_LOCALITY_WEIGHT。
+        """
+        limits = capacity.limits(info)
+        committed = capacity.committed(host, exclude_vm=vm)
+        memory_left = (limits['memory_mb'] - committed['memory_mb'] - vm.memory_mb) / max(limits['memory_mb'], 1)
+        cpu_left = (limits['cpu_cores'] - committed['cpu_cores'] - vm.cpu_cores) / max(limits['cpu_cores'], 1)
+        score = settings.PLACEMENT_MEMORY_WEIGHT * memory_left + settings.PLACEMENT_CPU_WEIGHT * cpu_left
+        if self.has_template(vm, host):
+            score += settings.PLACEMENT_LOCALITY_WEIGHT
+        return score
+
+    def rank(self, vm: VirtualMachine) -> List[Dict]:
+        """
+        所有候选宿主机的评估结果，可放置的按得分从高到低排在前面
+
+        Returns:
+            [{'host', 'score', 'reason'}]，reason 为不可放置的原因，可放置时为空
+        """
+        results = []
+        for host in self.candidates():
+            result = {'host': host, 'score': None, 'reason': ''}
+            info = capacity.host_info(host)
+            if info is None:
+                result['reason'] = '无法连接宿主机'
+            elif self.violates_anti_affinity(vm, host):
+                result['reason'] = f'反亲和组 {vm.anti_affinity_group} 已有虚拟机'
+            else:
+                try:
+                    capacity.check_fit(vm, host, info)
+                    result['score'] = round(self.score(vm, host, info), 4)
+                except CapacityExceeded as e:
+                    result['reason'] = str(e)
+            results.append(result)
+        results.sort(key=lambda r: (r['score'] is None, -(r['score'] or 0), r['host'].name))
+        return results
+
+    def place(self, vm: VirtualMachine) -> Optional[Host]:
+        """
+        为虚拟机选择宿主机
+
+        Returns:
+            得分最高的宿主机，没有宿主机记录时返回None
+
+        Raises:
+            PlacementError: 有宿主机但都不能放置
+        """
+        results = self.rank(vm)
+        if not results:
+            return None
+        best = results[0]
+        if best['score'] is None:
+            reasons = '；'.join(f"{r['host'].name}: {r['reason']}" for r in results)
+            raise PlacementError(f"没有可放置虚拟机的宿主机（{reasons}）")
+        logger.info(f"虚拟机 {vm.name} 放置评估: " +
+                    ', '.join(f"{r['host'].name}={r['score'] if r['score'] is not None else r['reason']}"
+                              for r in results))
+        return best['host']
+
+
+placement = PlacementEngine()
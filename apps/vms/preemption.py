@@ -0,0 +1,145 @@
+"""
+空闲虚拟机抢占
+
+开机请求因宿主机容量不足将被拒绝（或留在队列中）时，同一宿主机上长时间空闲的运行中虚拟机
+仍占着vCPU与内存预留。抢占器按课程抢占优先级（Course.preemption_priority）从低到高、
+同一优先级内空闲最久优先，选出足以腾出所需容量的虚拟机休眠到磁盘（managedSave），
+休眠完成后再放行开机请求（见 apps.vms.admission）。每次抢占记录在
+apps.vms.models.Preemption 中，被抢占的虚拟机下次启动时从休眠状态透明恢复。
+"""
+import logging
+from datetime import timedelta
+from typing import Dict, List, Tuple
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from apps.vms.capacity import capacity
+from apps.vms.models import CapacityReservation, Preemption, VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+
+def preemption_priority(vm: VirtualMachine) -> int:
+    """虚拟机的抢占优先级，未关联课程时为0"""
+    return vm.course.preemption_priority if vm.course_id else 0
+
+
+class Preemptor:
+    """
+    空闲虚拟机抢占器
+
+    空闲判定依赖 IdleReaper 写入的 last_activity_at。开机虚拟机只能抢占课程抢占优先级
+    不高于自身的虚拟机；空闲虚拟机全部休眠仍不够时不抢占任何虚拟机。
+    """
+
+    def candidates(self, vm: VirtualMachine, now) -> List[VirtualMachine]:
+        """
+        可被抢占的虚拟机，按抢占顺序排列
+
+        同一宿主机上运行中、超过 PREEMPTION_IDLE_MINUTES 未活动且课程抢占优先级不高于
+        开机虚拟机的虚拟机。
+        """
+        idle_before = now - timedelta(minutes=settings.PREEMPTION_IDLE_MINUTES)
+        priority = preemption_priority(vm)
+        vms = VirtualMachine.objects.filter(
+            host_id=vm.host_id, status='running', last_activity_at__lt=idle_before
+        ).filter(
+            Q(course__isnull=True) | Q(course__preemption_priority__lte=priority)
+        ).exclude(id=vm.id).select_related('course')
+        return sorted(vms, key=lambda v: (preemption_priority(v), v.last_activity_at))
+
+    @staticmethod
+    def shortfall(vm: VirtualMachine, info: Dict) -> Dict:
+        """开机虚拟机在宿主机上还缺少的vCPU与内存，不缺时为0或负数"""
+        host = vm.host if vm.host_id else None
+        limits = capacity.limits(info)
+        committed = capacity.committed(host, exclude_vm=vm)
+        memory_mb = committed['memory_mb'] + vm.memory_mb - limits['memory_mb']
+        if settings.HOST_MEMORY_OVERCOMMIT > 1:
+            available_mb = info['available_mb'] - settings.HOST_RESERVED_MEMORY_MB
+            memory_mb = max(memory_mb, vm.memory_mb - available_mb)
+        return {
+            'cpu_cores': committed['cpu_cores'] + vm.cpu_cores - limits['cpu_cores'],
+            'memory_mb': memory_mb,
+        }
+
+    def plan(self, vm: VirtualMachine, info: Dict, now) -> List[Tuple[VirtualMachine, int, int]]:
+        """
+        选出需要抢占的虚拟机
+
+        Returns:
+            [(虚拟机, 释放的CPU核心数, 释放的内存MB)]，容量本就足够（如磁盘不足）或
+            空闲虚拟机不足以腾出容量时为空
+        """
+        need = self.shortfall(vm, info)
+        if need['cpu_cores'] <= 0 and need['memory_mb'] <= 0:
+            return []
+        reserved = dict(CapacityReservation.objects.filter(
+            vm__host_id=vm.host_id, vm__status='running'
+        ).values_list('vm_id', 'memory_mb'))
+        victims = []
+        for candidate in self.candidates(vm, now):
+            if len(victims) >= settings.PREEMPTION_MAX_VMS:
+                break
+            # 气球回收中的虚拟机按调低后的预留释放
+            memory_mb = reserved.get(candidate.id, candidate.memory_mb)
+            victims.append((candidate, candidate.cpu_cores, memory_mb))
+            need['cpu_cores'] -= candidate.cpu_cores
+            need['memory_mb'] -= memory_mb
+            if need['cpu_cores'] <= 0 and need['memory_mb'] <= 0:
+                return victims
+        return []
+
+    def plan_room(self, vm: VirtualMachine, now=None) -> List[Tuple[VirtualMachine, int, int]]:
+        """
+        为 vm 规划需要抢占的虚拟机（只查询，不休眠）
+
+        Returns:
+            同 plan，未启用抢占或无法获取宿主机信息时为空
+        """
+        if not settings.PREEMPTION_IDLE_MINUTES:
+            return []
+        host = vm.host if vm.host_id else None
+        info = capacity.host_info(host)
+        if info is None:
+            return []
+        return self.plan(vm, info, now or timezone.now())
+
+    def preempt(self, vm: VirtualMachine, victims: List[Tuple[VirtualMachine, int, int]],
+                now=None) -> List[Preemption]:
+        """
+        休眠 plan_room 选出的虚拟机，为 vm 腾出宿主机容量
+
+        managedSave 需要数秒，不应在持有准入调度锁时调用。个别虚拟机休眠失败时继续休眠其余的，
+        已腾出的容量足够时开机请求照常放行。
+
+        Returns:
+            本次抢占记录
+        """
+        from apps.vms.services import vm_service
+
+        now = now or timezone.now()
+        host = vm.host if vm.host_id else None
+        records = []
+        for victim, cpu_cores, memory_mb in victims:
+            result = vm_service.hibernate_vm(str(victim.id))
+            if not result['success']:
+                logger.error(f"抢占虚拟机 {victim.name} 失败: {result['error']}")
+                continue
+            records.append(Preemption.objects.create(
+                vm=victim, preempted_for=vm, host=capacity.host_key(host),
+                idle_seconds=int((now - victim.last_activity_at).total_seconds()),
+                cpu_cores=cpu_cores, memory_mb=memory_mb,
+            ))
+            logger.info(f"虚拟机 {victim.name} 空闲 {records[-1].idle_seconds} 秒，"
+                        f"休眠以腾出 {cpu_cores} 核 / {memory_mb}MB 供 {vm.name} 开机")
+        return records
+
+    @staticmethod
+    def resumed(vm: VirtualMachine, now=None):
+        """被抢占的虚拟机重新启动后记录恢复时间"""
+        Preemption.objects.filter(vm=vm, resumed_at__isnull=True).update(resumed_at=now or timezone.now())
+
+
+preemptor = Preemptor()
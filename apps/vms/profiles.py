@@ -0,0 +1,94 @@
+"""
+虚拟机硬件性能配置
+"""
+import logging
+from typing import Dict, Optional
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# 所有配置项及其默认值，与历史上固定生成的最小域定义保持一致
+DEFAULT_PROFILE: Dict = {
+    # CPU模式：None 使用libvirt默认模型，可选 host-passthrough / host-model
+    'cpu_mode': None,
+    # 显卡模型
+    'video': 'cirrus',
+    # 磁盘总线：virtio（virtio-blk）或 scsi（virtio-scsi 控制器）
+    'disk_bus': 'virtio',
+    # 磁盘缓存模式：None / none / writeback / directsync
+    'disk_cache': None,
+    # 磁盘IO模式：None / native / threads / io_uring
+    'disk_io': None,
+    # 丢弃策略：None / unmap，需配合 virtio-scsi 或较新的 virtio-blk
+    'discard': None,
+    # 专用IO线程数量，0 表示不使用
+    'iothreads': 0,
+    # 网卡多队列数量，1 表示单队列，0 表示与vCPU数量一致
+    'net_queues': 1,
+    # 内存气球统计周期（秒），0 表示不开启
+    'memballoon_stats_period': 0,
+    # 是否使用大页内存
+    'hugepages': False,
+    # vCPU热插拔上限，0 表示与创建时的CPU核心数一致（不预留）
+    'max_vcpus': 0,
+    # 内存上限(MB)，超出当前内存的部分由气球回收，0 表示不预留
+    'max_memory_mb': 0,
+    # 磁盘与网络I/O限速策略（settings.VM_IO_POLICIES 中的名称）
+    'io_policy': 'default',
+}
+
+
+def resolve_profile(name: Optional[str] = None) -> Dict:
+    """
+    解析硬件配置
+
+    Args:
+        name: settings.VM_HARDWARE_PROFILES 中的配置名称，为空时使用 default
+
+    Returns:
+        合并默认值后的完整配置字典
+    """
+    profiles = getattr(settings, 'VM_HARDWARE_PROFILES', {})
+    name = name or 'default'
+    if name not in profiles and name != 'default':
+        logger.warning(f"硬件配置 {name} 不存在，使用默认配置")
+        name = 'default'
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(profiles.get(name, {}))
+    return profile
+
+
+def available_profiles() -> list:
+    """返回可用的硬件配置名称"""
+    return sorted(set(getattr(settings, 'VM_HARDWARE_PROFILES', {})) | {'default'})
+
+
+def merge_policies(defaults: Dict, policies: Dict, role_policies: Dict, owner,
+                   policy: Optional[str] = None, label: str = '策略') -> Dict:
+    """
+    依次合并 default、指定策略与所有者角色策略，后者覆盖前者设置的项
+
+    Args:
+        defaults: 所有策略项及其默认值
+        policies: 策略名称到策略项的映射，如 settings.VM_CPU_POLICIES
+        role_policies: 角色名称到策略名称的映射，如 settings.VM_CPU_ROLE_POLICIES
+        owner: 虚拟机所有者
+        policy: 课程或硬件配置指定的策略名称，为空时跳过
+        label: 日志中的策略类别
+
+    Returns:
+        合并后的策略项，不存在的策略名称记录警告后忽略
+    """
+    names = ['default']
+    if policy:
+        names.append(policy)
+    role = getattr(owner, 'role', None)
+    if role is not None and role.name in role_policies:
+        names.append(role_policies[role.name])
+    merged = dict(defaults)
+    for name in names:
+        if name not in policies and name != 'default':
+            logger.warning(f"{label} {name} 不存在，已忽略")
+            continue
+        merged.update(policies.get(name, {}))
+    return merged
@@ -0,0 +1,108 @@
+"""
+资源配额账本
+"""
+import logging
+from typing import Dict, Optional
+from django.db import models
+
+from apps.users.models import Quota
+from apps.vms.models import VirtualMachine, VirtualMachineSnapshot
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    """配额不足"""
+    pass
+
+
+class QuotaLedger:
+    """
+    用户资源配额账本
+
+    汇总用户已占用的CPU、内存、磁盘（虚拟大小与实际占用）、虚拟机数量与快照数量，
+    并在申请新资源前校验配额。
+    """
+
+    def __init__(self, user, quota: Optional[Quota] = None):
+        """
+        初始化配额账本
+
+        Args:
+            user: 配额所属用户
+            quota: 已加载的配额记录，为空时从数据库读取
+
+        Raises:
+            Quota.DoesNotExist: 用户没有配额记录
+        """
+        self.user = user
+        self.quota = quota or Quota.objects.get(user=user)
+
+    def usage(self, exclude_vm: Optional[VirtualMachine] = None) -> Dict:
+        """
+        统计已占用资源
+
+        Args:
+            exclude_vm: 不计入统计的虚拟机（修改配置时排除自身）
+
+        Returns:
+            资源占用字典
+        """
+        vms = VirtualMachine.objects.filter(owner=self.user)
+        if exclude_vm is not None:
+            vms = vms.exclude(id=exclude_vm.id)
+        totals = vms.aggregate(
+            cpu_cores=models.Sum('cpu_cores'),
+            memory_mb=models.Sum('memory_mb'),
+            disk_gb=models.Sum('disk_gb'),
+            disk_allocated_bytes=models.Sum('disk_allocated_bytes'),
+        )
+        snapshots = VirtualMachineSnapshot.objects.filter(
+            vm__owner=self.user
+        ).exclude(status='merging')
+        return {
+            'cpu_cores': totals['cpu_cores'] or 0,
+            'memory_mb': totals['memory_mb'] or 0,
+            'disk_gb': totals['disk_gb'] or 0,
+            # 磁盘配额按虚拟大小校验，实际占用仅用于容量规划
+            'disk_allocated_bytes': totals['disk_allocated_bytes'] or 0,
+            'vm_count': vms.count(),
+            'snapshot_count': snapshots.count(),
+        }
+
+    def check_vm(self, cpu_cores: int, memory_mb: int, disk_gb: int,
+                 exclude_vm: Optional[VirtualMachine] = None):
+        """
+        校验虚拟机资源申请
+
+        Args:
+            cpu_cores: 申请的CPU核心数
+            memory_mb: 申请的内存大小(MB)
+            disk_gb: 申请的磁盘大小(GB)
+            exclude_vm: 修改已有虚拟机时传入该虚拟机，其原有占用不重复计算
+
+        Raises:
+            QuotaExceeded: 任一资源超出配额
+        """
+        used = self.usage(exclude_vm=exclude_vm)
+        quota = self.quota
+
+        if used['cpu_cores'] + cpu_cores > quota.cpu_cores:
+            raise QuotaExceeded(f"CPU配额不足，当前已使用{used['cpu_cores']}核，配额{quota.cpu_cores}核")
+        if used['memory_mb'] + memory_mb > quota.memory_mb:
+            raise QuotaExceeded(f"内存配额不足，当前已使用{used['memory_mb']}MB，配额{quota.memory_mb}MB")
+        if used['disk_gb'] + disk_gb > quota.disk_gb:
+            raise QuotaExceeded(f"磁盘配额不足，当前已使用{used['disk_gb']}GB，配额{quota.disk_gb}GB")
+        if exclude_vm is None and used['vm_count'] >= quota.vm_limit:
+            raise QuotaExceeded(f"虚拟机数量已达上限，当前{used['vm_count']}台，上限{quota.vm_limit}台")
+
+    def check_snapshot(self):
+        """
+        校验快照数量配额
+
+        Raises:
+            QuotaExceeded: 快照数量已达上限
+        """
+        used = self.usage()['snapshot_count']
+        if used >= self.quota.snapshot_limit:
+            raise QuotaExceeded(f"快照数量已达上限，当前{used}个，上限{self.quota.snapshot_limit}个")
@@ -0,0 +1,267 @@
+"""
+宿主机负载再平衡
+
+离线计算虚拟机的重新放置方案：以虚拟机内存配置与空闲采样得到的实际CPU使用量为需求，
+使每台宿主机的利用率不超过目标值，并尽量减少迁移的虚拟机数量。
+
+算法分三步：
+1. 驱逐：对超过目标利用率（或已停用）的宿主机，能由一台虚拟机消除超出部分时只驱逐满足条件中最小的一台，
+   否则从大到小驱逐直到低于目标；
+2. 首次适应递减（FFD）：被驱逐的虚拟机从大到小，依次放到当前利用率最低且放得下的宿主机；
+3. 局部搜索：逐个检查已迁移的虚拟机（从小到大），能放回原宿主机的撤销迁移，去掉驱逐时多迁的部分。
+
+方案只在停止的虚拟机上执行（离线迁移域定义，磁盘需位于共享存储）。
+"""
+import logging
+import random
+import time
+from typing import Dict, List, Optional
+from django.conf import settings
+
+from apps.vms.capacity import capacity
+from apps.vms.libvirt_manager import get_manager
+from apps.vms.models import Host, VirtualMachine
+
+logger = logging.getLogger(__name__)
+
+# 可以离线迁移的虚拟机状态
+MOVABLE_STATUSES = ('stopped',)
+
+
+def _size(vm: Dict, host: Dict) -> float:
+    """虚拟机相对宿主机容量的大小，取CPU与内存占比的较大者"""
+    return max(vm['cpu'] / max(host['cpu'], 1e-9), vm['memory'] / max(host['memory'], 1e-9))
+
+
+def plan_moves(hosts: List[Dict], vms: List[Dict], target: float) -> Dict:
+    """
+    计算再平衡方案
+
+    Args:
+        hosts: [{'name', 'cpu', 'memory', 'enabled'}]，cpu 为可用CPU核数，memory 为可分配内存(MB)
+        vms: [{'id', 'host', 'cpu', 'memory'}]，cpu 为CPU需求（核），memory 为内存需求(MB)
+        target: 目标利用率（0~1）
+
+    Returns:
+        {'moves': [{'vm', 'from', 'to'}], 'unresolved': [未能放下的虚拟机ID],
+         'before': {宿主机: 利用率}, 'after': {宿主机: 利用率}}
+    """
+    host_map = {host['name']: host for host in hosts}
+    # 平均宿主机，用于比较虚拟机大小
+    reference = {
+        'cpu': sum(h['cpu'] for h in hosts) / max(len(hosts), 1),
+        'memory': sum(h['memory'] for h in hosts) / max(len(hosts), 1),
+    }
+    used = {name: [0.0, 0.0] for name in host_map}
+    members = {name: [] for name in host_map}
+    for vm in vms:
+        if vm['host'] not in host_map:
+            continue
+        used[vm['host']][0] += vm['cpu']
+        used[vm['host']][1] += vm['memory']
+        members[vm['host']].append(vm)
+
+    def utilization(name: str) -> float:
+        host = host_map[name]
+        return max(used[name][0] / max(host['cpu'], 1e-9), used[name][1] / max(host['memory'], 1e-9))
+
+    def fits(name: str, vm: Dict) -> bool:
+        host = host_map[name]
+        return host['enabled'] and \
+            used[name][0] + vm['cpu'] <= host['cpu'] * target and \
+            used[name][1] + vm['memory'] <= host['memory'] * target
+
+    def take(name: str, vm: Dict, sign: int):
+        used[name][0] += sign * vm['cpu']
+        used[name][1] += sign * vm['memory']
+
+    before = {name: round(utilization(name), 4) for name in host_map}
+
+    # 1. 驱逐
+    evicted = []
+    for name, host in host_map.items():
+        excess_cpu = used[name][0] - (host['cpu'] * target if host['enabled'] else 0)
+        excess_memory = used[name][1] - (host['memory'] * target if host['enabled'] else 0)
+        if excess_cpu <= 0 and excess_memory <= 0:
+            continue
+        candidates = sorted(members[name], key=lambda v: _size(v, reference), reverse=True)
+        single = [v for v in candidates if v['cpu'] >= excess_cpu and v['memory'] >= excess_memory]
+        if host['enabled'] and single:
+            chosen = [single[-1]]
+        else:
+            chosen = []
+            for vm in candidates:
+                if excess_cpu <= 0 and excess_memory <= 0:
+                    break
+                chosen.append(vm)
+                excess_cpu -= vm['cpu']
+                excess_memory -= vm['memory']
+        for vm in chosen:
+            take(name, vm, -1)
+            evicted.append(vm)
+
+    # 2. 首次适应递减，宿主机按当前利用率从低到高尝试
+    destination = {}
+    unresolved = []
+    for vm in sorted(evicted, key=lambda v: _size(v, reference), reverse=True):
+        for name in sorted(host_map, key=utilization):
+            if name != vm['host'] and fits(name, vm):
+                take(name, vm, 1)
+                destination[vm['id']] = name
+                break
+        else:
+            # 放不下时留在原宿主机
+            take(vm['host'], vm, 1)
+            unresolved.append(vm['id'])
+
+    # 3. 局部搜索：能放回原宿主机的撤销迁移
+    for vm in sorted(evicted, key=lambda v: _size(v, reference)):
+        if vm['id'] in destination and fits(vm['host'], vm):
+            take(destination.pop(vm['id']), vm, -1)
+            take(vm['host'], vm, 1)
+
+    moves = [
+        {'vm': vm['id'], 'from': vm['host'], 'to': destination[vm['id']]}
+        for vm in evicted if vm['id'] in destination
+    ]
+    return {
+        'moves': moves,
+        'unresolved': unresolved,
+        'before': before,
+        'after': {name: round(utilization(name), 4) for name in host_map},
+    }
+
+
+def synthetic_fleet(vm_count: int, host_count: Optional[int] = None, seed: int = 0) -> Dict:
+    """
+    生成用于基准测试的合成集群：宿主机容量相同，虚拟机规格随机且集中放在前一部分宿主机上
+
+    Returns:
+        {'hosts': [...], 'vms': [...]}，格式同 plan_moves 的参数
+    """
+    rng = random.Random(seed)
+    host_count = host_count or max(vm_count // 25, 4)
+    hosts = [{'name': f'host{i}', 'cpu': 64.0, 'memory': 256 * 1024.0, 'enabled': True}
+             for i in range(host_count)]
+    # 约五分之一的宿主机承载更多虚拟机，形成过载
+    hot = max(host_count // 5, 1)
+    vms = []
+    for i in range(vm_count):
+        cores = rng.choice((1, 2, 2, 4, 4, 8))
+        host = rng.randrange(hot) if rng.random() < 0.35 else rng.randrange(host_count)
+        vms.append({
+            'id': i,
+            'host': f'host{host}',
+            'cpu': cores * rng.uniform(0.05, 0.9),
+            'memory': float(rng.choice((1024, 2048, 4096, 8192))),
+        })
+    return {'hosts': hosts, 'vms': vms}
+
+
+class Rebalancer:
+    """
+    宿主机再平衡器
+
+    从数据库与宿主机读取当前放置，生成试运行报告，并可将方案中已停止的虚拟机离线迁移。
+    """
+
+    @staticmethod
+    def cpu_demand(vm: VirtualMachine) -> float:
+        """按最近采样的CPU使用率估算的CPU需求（核），没有采样时按全部vCPU计算"""
+        percent = vm.cpu_usage_percent if vm.cpu_usage_percent is not None else 100.0
+        return vm.cpu_cores * max(percent, settings.REBALANCE_CPU_FLOOR_PERCENT) / 100
+
+    def snapshot(self) -> Dict:
+        """
+        当前宿主机容量与虚拟机需求
+
+        CPU以宿主机物理核数衡量实际使用量，内存以超分上限衡量虚拟机配置；无法连接的宿主机不参与。
+        """
+        hosts = []
+        for host in Host.objects.all():
+            info = capacity.host_info(host)
+            if info is None:
+                logger.warning(f"无法获取宿主机 {host.name} 容量，不参与再平衡")
+                continue
+            hosts.append({
+                'name': host.name,
+                'cpu': float(info['cpus']),
+                'memory': float(capacity.limits(info)['memory_mb']),
+                'enabled': host.enabled,
+            })
+        names = {host['name'] for host in hosts}
+        vms = []
+        for vm in VirtualMachine.objects.filter(host__name__in=names).exclude(
+                status='deleting').select_related('host'):
+            vms.append({
+                'id': str(vm.id),
+                'name': vm.name,
+                'status': vm.status,
+                'host': vm.host.name,
+                'cpu': self.cpu_demand(vm),
+                'memory': float(vm.memory_mb),
+            })
+        return {'hosts': hosts, 'vms': vms}
+
+    def report(self, target: Optional[float] = None) -> Dict:
+        """
+        试运行：计算再平衡方案，不做任何修改
+
+        Returns:
+            {'target', 'hosts': [{'name', 'utilization_before', 'utilization_after'}],
+             'moves': [{'vm', 'name', 'status', 'from', 'to', 'ready'}], 'unresolved', 'elapsed_ms'}，
+            ready 表示虚拟机已停止、可以执行迁移
+        """
+        target = target or settings.REBALANCE_TARGET_UTILIZATION
+        fleet = self.snapshot()
+        started = time.perf_counter()
+        plan = plan_moves(fleet['hosts'], fleet['vms'], target)
+        elapsed = (time.perf_counter() - started) * 1000
+        vms = {vm['id']: vm for vm in fleet['vms']}
+        return {
+            'target': target,
+            'hosts': [
+                {'name': name, 'utilization_before': plan['before'][name],
+                 'utilization_after': plan['after'][name]}
+                for name in plan['before']
+            ],
+            'moves': [
+                {**move, 'name': vms[move['vm']]['name'], 'status': vms[move['vm']]['status'],
+                 'ready': vms[move['vm']]['status'] in MOVABLE_STATUSES}
+                for move in plan['moves']
+            ],
+            'unresolved': [vms[vm_id]['name'] for vm_id in plan['unresolved']],
+            'elapsed_ms': round(elapsed, 1),
+        }
+
+    def apply(self, report: Dict) -> Dict:
+        """
+        执行试运行报告中已停止虚拟机的迁移
+
+        迁移前重新确认虚拟机仍停止且仍在原宿主机上。
+
+        Returns:
+            {'applied': [虚拟机名称], 'skipped': [虚拟机名称], 'failed': [{'name', 'error'}]}
+        """
+        result = {'applied': [], 'skipped': [], 'failed': []}
+        hosts = {host.name: host for host in Host.objects.all()}
+        for move in report['moves']:
+            vm = VirtualMachine.objects.select_related('host').filter(id=move['vm']).first()
+            if vm is None or vm.status not in MOVABLE_STATUSES or vm.host is None \
+                    or vm.host.name != move['from']:
+                result['skipped'].append(move['name'])
+                continue
+            try:
+                get_manager(vm.host).migrate_offline(vm.name, get_manager(hosts[move['to']]))
+            except Exception as e:
+                logger.error(f"迁移虚拟机 {vm.name} 到 {move['to']} 失败: {e}")
+                result['failed'].append({'name': vm.name, 'error': str(e)})
+                continue
+            vm.host = hosts[move['to']]
+            vm.save(update_fields=['host'])
+            result['applied'].append(vm.name)
+            logger.info(f"虚拟机 {vm.name} 从 {move['from']} 迁移到 {move['to']}")
+        return result
+
+
+rebalancer = Rebalancer()
@@ -2,32 +2,95 @@
 虚拟机序列化器
 """
 from rest_framework import serializers
-from django.db import models
-from apps.vms.models import VirtualMachine
+from apps.vms.models import VirtualMachine, VirtualMachineSnapshot, TemplateConversionJob, AdmissionTicket, Host, Preemption
+from apps.vms.quota import QuotaLedger, QuotaExceeded
 from apps.courses.models import Course, VirtualMachineTemplate
 from apps.users.models import Quota
 
 
+class AdmissionTicketSerializer(serializers.ModelSerializer):
+    """
+    开机准入记录序列化器
+    """
+    queued = serializers.SerializerMethodField()
+    position = serializers.SerializerMethodField()
+    boot_seconds = serializers.FloatField(read_only=True)
+
+    class Meta:
+        model = AdmissionTicket
+        fields = [
+            'id', 'operation', 'priority', 'status', 'queued', 'position', 'error',
+            'created_at', 'admitted_at', 'booted_at', 'boot_seconds'
+        ]
+        read_only_fields = fields
+
+    def get_queued(self, obj):
+        return obj.status == 'queued'
+
+    def get_position(self, obj):
+        # 列表接口在上下文中给出按宿主机批量计算的排队位置
+        positions = self.context.get('admission_positions')
+        if positions is not None and obj.status == 'queued':
+            return positions.get(obj.id, 0)
+        return obj.position
+
+
+class PreemptionSerializer(serializers.ModelSerializer):
+    """
+    虚拟机抢占记录序列化器
+    """
+    preempted_for = serializers.CharField(source='preempted_for.name', read_only=True, default=None)
+
+    class Meta:
+        model = Preemption
+        fields = [
+            'id', 'host', 'preempted_for', 'idle_seconds', 'cpu_cores', 'memory_mb',
+            'created_at', 'resumed_at'
+        ]
+        read_only_fields = fields
+
+
+class HostSerializer(serializers.ModelSerializer):
+    """
+    宿主机序列化器
+    """
+    vm_count = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Host
+        fields = ['id', 'name', 'uri', 'enabled', 'vm_count', 'created_at']
+        read_only_fields = ['id', 'created_at']
+
+    def get_vm_count(self, obj):
+        return obj.vms.exclude(status='deleting').count()
+
+
 class VirtualMachineSerializer(serializers.ModelSerializer):
     """
     虚拟机序列化器
     """
     owner_username = serializers.CharField(source='owner.username', read_only=True)
     course_name = serializers.CharField(source='course.name', read_only=True)
+    host_name = serializers.CharField(source='host.name', read_only=True, default=None)
     template_name = serializers.CharField(source='template.name', read_only=True)
+    template_version_number = serializers.IntegerField(source='template_version.version', read_only=True, default=None)
     websockify_port = serializers.IntegerField(read_only=True)
+    admission = AdmissionTicketSerializer(read_only=True)
 
     class Meta:
         model = VirtualMachine
         fields = [
             'id', 'name', 'uuid', 'owner', 'owner_username',
-            'course', 'course_name', 'template', 'template_name',
-            'cpu_cores', 'memory_mb', 'disk_gb', 'status',
+            'course', 'course_name', 'host', 'host_name', 'anti_affinity_group',
+            'template', 'template_name', 'template_version_number',
+            'cpu_cores', 'memory_mb', 'disk_gb', 'disk_allocated_bytes', 'status',
             'ip_address', 'mac_address', 'vnc_port', 'vnc_password',
-            'created_at', 'updated_at', 'websockify_port'
+            'cpu_throttled_until', 'memory_current_mb',
+            'created_at', 'updated_at', 'websockify_port', 'admission'
         ]
-        read_only_fields = ['id', 'uuid', 'owner', 'status', 'ip_address', 'mac_address', 
-                           'vnc_port', 'vnc_password', 'created_at', 'updated_at']
+        read_only_fields = ['id', 'uuid', 'owner', 'host', 'status', 'ip_address', 'mac_address', 
+                           'vnc_port', 'vnc_password', 'disk_allocated_bytes', 'cpu_throttled_until',
+                           'memory_current_mb', 'created_at', 'updated_at']
 
 
 class VirtualMachineCreateSerializer(serializers.ModelSerializer):
@@ -40,7 +103,8 @@ class VirtualMachineCreateSerializer(serializers.ModelSerializer):
     class Meta:
         model = VirtualMachine
         fields = [
-            'name', 'template_id', 'course_id', 'cpu_cores', 'memory_mb', 'disk_gb'
+            'name', 'template_id', 'course_id', 'cpu_cores', 'memory_mb', 'disk_gb',
+            'anti_affinity_group'
         ]
     
     def validate(self, attrs):
@@ -55,6 +119,10 @@ class VirtualMachineCreateSerializer(serializers.ModelSerializer):
             attrs['template'] = template
         except VirtualMachineTemplate.DoesNotExist:
             raise serializers.ValidationError("指定的模板不存在")
+        if template.validation_status == 'invalid':
+            raise serializers.ValidationError(f"模板不可用: {template.validation_error}")
+        # 磁盘不能小于模板的虚拟大小，按实际创建的大小计入配额
+        attrs['disk_gb'] = max(attrs['disk_gb'], template.min_disk_gb)
         
         # 验证课程权限
         if course_id:
@@ -71,31 +139,9 @@ class VirtualMachineCreateSerializer(serializers.ModelSerializer):
         
         # 验证资源配额
         try:
-            quota = Quota.objects.get(user=user)
-            
-            # 检查CPU配额
-            used_cpu = VirtualMachine.objects.filter(owner=user).aggregate(
-                total=models.Sum('cpu_cores'))['total'] or 0
-            if used_cpu + attrs['cpu_cores'] > quota.cpu_cores:
-                raise serializers.ValidationError(f"CPU配额不足，当前已使用{used_cpu}核，配额{quota.cpu_cores}核")
-            
-            # 检查内存配额
-            used_memory = VirtualMachine.objects.filter(owner=user).aggregate(
-                total=models.Sum('memory_mb'))['total'] or 0
-            if used_memory + attrs['memory_mb'] > quota.memory_mb:
-                raise serializers.ValidationError(f"内存配额不足，当前已使用{used_memory}MB，配额{quota.memory_mb}MB")
-            
-            # 检查磁盘配额
-            used_disk = VirtualMachine.objects.filter(owner=user).aggregate(
-                total=models.Sum('disk_gb'))['total'] or 0
-            if used_disk + attrs['disk_gb'] > quota.disk_gb:
-                raise serializers.ValidationError(f"磁盘配额不足，当前已使用{used_disk}GB，配额{quota.disk_gb}GB")
-            
-            # 检查虚拟机数量限制
-            vm_count = VirtualMachine.objects.filter(owner=user).count()
-            if vm_count >= quota.vm_limit:
-                raise serializers.ValidationError(f"虚拟机数量已达上限，当前{vm_count}台，上限{quota.vm_limit}台")
-                
+            QuotaLedger(user).check_vm(attrs['cpu_cores'], attrs['memory_mb'], attrs['disk_gb'])
+        except QuotaExceeded as e:
+            raise serializers.ValidationError(str(e))
         except Quota.DoesNotExist:
             raise serializers.ValidationError("用户配额信息不存在，请联系管理员")
         
@@ -130,6 +176,7 @@ class VirtualMachineMetricsSerializer(serializers.Serializer):
     disk_write = serializers.IntegerField()
     network_rx = serializers.IntegerField()
     network_tx = serializers.IntegerField()
+    io_limits = serializers.DictField(child=serializers.IntegerField(), required=False)
 
 
 class VirtualMachineOperationSerializer(serializers.Serializer):
@@ -142,3 +189,29 @@ class VNCAccessSerializer(serializers.Serializer):
     """VNC访问信息序列化器"""
     websockify_port = serializers.IntegerField()
     vnc_password = serializers.CharField(allow_blank=True, allow_null=True)
+
+
+class VirtualMachineSnapshotSerializer(serializers.ModelSerializer):
+    """
+    虚拟机快照序列化器
+    """
+    class Meta:
+        model = VirtualMachineSnapshot
+        fields = ['id', 'name', 'description', 'status', 'created_at']
+        read_only_fields = ['id', 'status', 'created_at']
+
+
+class TemplateConversionJobSerializer(serializers.ModelSerializer):
+    """
+    模板转换任务序列化器
+    """
+    vm_name = serializers.CharField(source='vm.name', read_only=True, default=None)
+
+    class Meta:
+        model = TemplateConversionJob
+        fields = [
+            'id', 'vm', 'vm_name', 'name', 'description', 'course', 'is_public',
+            'compress', 'target_template', 'status', 'progress', 'template', 'error',
+            'created_at', 'finished_at'
+        ]
+        read_only_fields = fields
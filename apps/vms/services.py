@@ -9,8 +9,21 @@ import subprocess
 import shutil
 from typing import Dict, Optional
 from django.utils import timezone
-from apps.vms.models import VirtualMachine
-from apps.vms.libvirt_manager import libvirt_manager
+from apps.vms.models import VirtualMachine, VirtualMachineSnapshot, TemplateConversionJob
+from apps.courses.models import VirtualMachineTemplate
+from apps.courses import store as template_store
+from apps.courses.validation import check_template, copy_validation
+from apps.courses.versions import add_version, ensure_base_version, flatten_template_async, needs_flatten
+from apps.vms.libvirt_manager import LibvirtManager, get_manager, libvirt_manager
+from apps.vms.placement import PlacementError, placement
+from apps.vms.admission import admission
+from apps.vms.capacity import CapacityExceeded, capacity
+from apps.vms.preemption import preemptor
+from apps.vms.profiles import resolve_profile
+from apps.vms.cputune import resolve_cpu_policy
+from apps.vms.iotune import resolve_io_limits
+from apps.vms.quota import QuotaLedger, QuotaExceeded
+from apps.users.models import Quota
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +37,29 @@ class VirtualMachineService:
     虚拟机管理服务
     """
     
+    @staticmethod
+    def manager_for(vm: 'VirtualMachine') -> LibvirtManager:
+        """虚拟机所在宿主机的libvirt管理器，未分配宿主机的虚拟机使用默认连接"""
+        if vm.host_id is None:
+            return libvirt_manager
+        return get_manager(vm.host)
+    
+    @staticmethod
+    def place_vm(vm: 'VirtualMachine'):
+        """
+        为尚未分配宿主机的虚拟机选择宿主机
+
+        Raises:
+            PlacementError: 没有可用的宿主机
+        """
+        if vm.host_id is not None:
+            return
+        host = placement.place(vm)
+        if host is not None:
+            vm.host = host
+            vm.save(update_fields=['host'])
+            logger.info(f"虚拟机 {vm.name} 放置到宿主机 {host.name}")
+    
     @staticmethod
     def create_vm_sync(vm_id: str) -> Dict:
         """
@@ -46,17 +82,31 @@ class VirtualMachineService:
                 vm.status = 'error'
                 vm.save()
                 return {'success': False, 'error': '虚拟机没有关联的模板'}
+            if vm.template.validation_status == 'invalid':
+                logger.error(f"虚拟机 {vm.name} 的模板不可用: {vm.template.validation_error}")
+                vm.status = 'error'
+                vm.save()
+                return {'success': False, 'error': f"模板不可用: {vm.template.validation_error}"}
+            # 新虚拟机在模板最新版本上创建覆盖层
+            vm.template_version = ensure_base_version(vm.template)
+            vm.save()
+            VirtualMachineService.place_vm(vm)
             
             # 生成UUID
             vm_uuid = str(uuid.uuid4())
             
             # 调用libvirt管理器创建虚拟机
-            vm_info = libvirt_manager.create_vm(
+            vm_info = VirtualMachineService.manager_for(vm).create_vm(
                 name=vm.name,
                 uuid=vm_uuid,
                 memory_mb=vm.memory_mb,
                 cpu_cores=vm.cpu_cores,
-                template_path=vm.template.file_path
+                template_path=vm.template_version.file_path,
+                profile=resolve_profile(vm.template.hardware_profile),
+                disk_gb=vm.disk_gb,
+                template_size=vm.template.virtual_size or None,
+                cputune=resolve_cpu_policy(vm),
+                io_limits=resolve_io_limits(vm)
             )
             
             # 更新虚拟机信息
@@ -65,7 +115,9 @@ class VirtualMachineService:
             vm.vnc_port = vm_info['vnc_port']
             vm.vnc_password = vm_info['vnc_password']
             vm.status = 'running'
+            vm.last_activity_at = timezone.now()
             vm.save()
+            VirtualMachineService.refresh_disk_usage(vm)
             
             logger.info(f"虚拟机 {vm.name} 创建成功")
             return {'success': True, 'vm_id': vm_id}
@@ -84,25 +136,84 @@ class VirtualMachineService:
             return {'success': False, 'error': str(e)}
     
     @staticmethod
-    def create_vm_async(vm_id: str):
+    def create_vm_async(vm_id: str, priority: str = 'interactive') -> Dict:
         """
-        异步创建虚拟机（使用线程）
+        异步创建虚拟机（经开机准入排队，放行后在线程中执行）
         
         Args:
             vm_id: 虚拟机ID
+            priority: 开机准入优先级，批量任务传 batch
+            
+        Returns:
+            排队结果
         """
-        def _create():
-            VirtualMachineService.create_vm_sync(vm_id)
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        
+        # 先选定宿主机，再在该宿主机的准入队列中排队
+        try:
+            VirtualMachineService.place_vm(vm)
+        except PlacementError as e:
+            vm.status = 'error'
+            vm.save(update_fields=['status'])
+            return {'success': False, 'error': str(e)}
+        ticket = admission.submit(vm, 'create', priority)
+        if ticket.status == 'admitted':
+            thread = threading.Thread(target=admission.run, args=(ticket,))
+            thread.daemon = True
+            thread.start()
+        return VirtualMachineService._admission_result(vm_id, ticket)
+    
+    @staticmethod
+    def _admission_result(vm_id: str, ticket) -> Dict:
+        """排队中的操作返回排队位置"""
+        if ticket.status == 'failed':
+            return {'success': False, 'error': ticket.error}
+        if ticket.status != 'queued':
+            return {'success': True, 'vm_id': vm_id}
+        return {'success': True, 'vm_id': vm_id, 'queued': True,
+                'ticket_id': str(ticket.id), 'position': ticket.position}
+    
+    @staticmethod
+    def _admit(vm_id: str, operation: str, priority: str = 'interactive') -> Dict:
+        """开机类操作经准入调度：有名额时立即执行，否则返回排队位置"""
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
         
-        thread = threading.Thread(target=_create)
-        thread.daemon = True
-        thread.start()
+        ticket = admission.submit(vm, operation, priority)
+        if ticket.status == 'admitted':
+            return admission.run(ticket)
+        return VirtualMachineService._admission_result(vm_id, ticket)
     
     @staticmethod
-    def start_vm(vm_id: str) -> Dict:
+    def start_vm(vm_id: str, priority: str = 'interactive') -> Dict:
         """
         启动虚拟机
         
+        停止或休眠的虚拟机经开机准入排队；暂停的虚拟机直接恢复，不占用开机名额。
+        
+        Args:
+            vm_id: 虚拟机ID
+            priority: 开机准入优先级，批量任务传 batch
+            
+        Returns:
+            操作结果，排队时包含 queued、ticket_id 与 position
+        """
+        if VirtualMachine.objects.filter(id=vm_id, status__in=('running', 'paused')).exists():
+            return VirtualMachineService.start_vm_now(vm_id)
+        return VirtualMachineService._admit(vm_id, 'start', priority)
+    
+    @staticmethod
+    def start_vm_now(vm_id: str) -> Dict:
+        """
+        立即启动虚拟机（由开机准入放行后调用）
+        
         Args:
             vm_id: 虚拟机ID
             
@@ -112,12 +223,15 @@ class VirtualMachineService:
         try:
             vm = VirtualMachine.objects.get(id=vm_id)
             
-            # 调用libvirt管理器启动虚拟机
-            success = libvirt_manager.start_vm(vm.name)
+            # 调用libvirt管理器启动虚拟机（暂停或休眠的虚拟机会被透明恢复）
+            success = VirtualMachineService.manager_for(vm).start_vm(vm.name)
             
             if success:
                 vm.status = 'running'
+                # 重新开始计算空闲时长
+                vm.last_activity_at = timezone.now()
                 vm.save()
+                preemptor.resumed(vm, vm.last_activity_at)
                 logger.info(f"虚拟机 {vm.name} 启动成功")
                 return {'success': True, 'vm_id': vm_id}
             else:
@@ -152,10 +266,11 @@ class VirtualMachineService:
             if vm.websockify_port:
                 VirtualMachineService.stop_websockify(vm.websockify_port)
 
-            result = libvirt_manager.stop_vm(vm.name, force=force)
+            result = VirtualMachineService.manager_for(vm).stop_vm(vm.name, force=force)
             if result:
                 vm.status = 'stopped'
                 vm.save()
+                capacity.release(vm)
                 logger.info(f"虚拟机 {vm.name} 停止成功")
                 return {'success': True, 'vm_id': vm_id}
             else:
@@ -172,7 +287,20 @@ class VirtualMachineService:
     @staticmethod
     def restart_vm(vm_id: str) -> Dict:
         """
-        重启虚拟机
+        重启虚拟机（经开机准入排队）
+        
+        Args:
+            vm_id: 虚拟机ID
+            
+        Returns:
+            操作结果，排队时包含 queued、ticket_id 与 position
+        """
+        return VirtualMachineService._admit(vm_id, 'restart')
+    
+    @staticmethod
+    def restart_vm_now(vm_id: str) -> Dict:
+        """
+        立即重启虚拟机（由开机准入放行后调用）
         
         Args:
             vm_id: 虚拟机ID
@@ -184,7 +312,7 @@ class VirtualMachineService:
             vm = VirtualMachine.objects.get(id=vm_id)
             
             # 调用libvirt管理器重启虚拟机
-            success = libvirt_manager.restart_vm(vm.name)
+            success = VirtualMachineService.manager_for(vm).restart_vm(vm.name)
             
             if success:
                 logger.info(f"虚拟机 {vm.name} 重启成功")
@@ -215,7 +343,7 @@ class VirtualMachineService:
             vm = VirtualMachine.objects.get(id=vm_id)
             
             # 调用libvirt管理器暂停虚拟机
-            success = libvirt_manager.pause_vm(vm.name)
+            success = VirtualMachineService.manager_for(vm).pause_vm(vm.name)
             
             if success:
                 vm.status = 'paused'
@@ -248,7 +376,7 @@ class VirtualMachineService:
             vm = VirtualMachine.objects.get(id=vm_id)
             
             # 调用libvirt管理器恢复虚拟机
-            success = libvirt_manager.resume_vm(vm.name)
+            success = VirtualMachineService.manager_for(vm).resume_vm(vm.name)
             
             if success:
                 vm.status = 'running'
@@ -266,6 +394,256 @@ class VirtualMachineService:
             logger.error(f"恢复虚拟机失败: {e}")
             return {'success': False, 'error': str(e)}
     
+    @staticmethod
+    def hibernate_vm(vm_id: str) -> Dict:
+        """
+        休眠虚拟机（managedSave），释放宿主机内存
+
+        Args:
+            vm_id: 虚拟机ID
+
+        Returns:
+            操作结果
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+
+            # 停止 websockify
+            if vm.websockify_port:
+                VirtualMachineService.stop_websockify(vm.websockify_port)
+
+            success = VirtualMachineService.manager_for(vm).managed_save_vm(vm.name)
+
+            if success:
+                vm.status = 'saved'
+                vm.save()
+                capacity.release(vm)
+                logger.info(f"虚拟机 {vm.name} 休眠成功")
+                return {'success': True, 'vm_id': vm_id}
+            else:
+                logger.error(f"虚拟机 {vm.name} 休眠失败")
+                return {'success': False, 'error': '休眠失败'}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except Exception as e:
+            logger.error(f"休眠虚拟机失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def resize_vm(vm_id: str, cpu_cores: int, memory_mb: int,
+                  disk_gb: Optional[int] = None) -> Dict:
+        """
+        调整虚拟机的CPU、内存与磁盘，运行中的虚拟机尽量在线生效
+
+        Args:
+            vm_id: 虚拟机ID
+            cpu_cores: 新的CPU核心数
+            memory_mb: 新的内存大小(MB)
+            disk_gb: 新的磁盘大小(GB)，为空时不修改；磁盘只能扩容
+
+        Returns:
+            操作结果，restart_required 表示部分修改需重启后生效
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+            disk_gb = disk_gb or vm.disk_gb
+
+            if disk_gb < vm.disk_gb:
+                return {'success': False, 'error': f'磁盘只能扩容，当前大小{vm.disk_gb}GB'}
+
+            # 修改配置时排除自身原有占用
+            QuotaLedger(vm.owner).check_vm(cpu_cores, memory_mb, disk_gb, exclude_vm=vm)
+            # 运行中的虚拟机按新配置重新预留宿主机容量，未运行的在下次开机时预留
+            if disk_gb != vm.disk_gb:
+                capacity.check_disk(vm, disk_gb)
+            if vm.status in ('running', 'paused'):
+                capacity.reserve(vm, cpu_cores, memory_mb)
+
+            restart_required = False
+            # 创建中或创建失败的虚拟机尚未定义域，只需更新记录
+            if vm.status not in ('creating', 'error'):
+                if (cpu_cores, memory_mb) != (vm.cpu_cores, vm.memory_mb):
+                    applied = VirtualMachineService.manager_for(vm).resize_vm(vm.name, cpu_cores, memory_mb)
+                    if vm.status in ('running', 'paused'):
+                        restart_required = (
+                            (cpu_cores != vm.cpu_cores and not applied['vcpus_live']) or
+                            (memory_mb != vm.memory_mb and not applied['memory_live'])
+                        )
+                    elif vm.status == 'saved':
+                        # 休眠镜像按原配置恢复，新配置在下次冷启动时生效
+                        restart_required = True
+                if disk_gb != vm.disk_gb:
+                    VirtualMachineService.manager_for(vm).resize_disk(vm.name, disk_gb)
+                    VirtualMachineService.refresh_disk_usage(vm)
+
+            vm.cpu_cores = cpu_cores
+            vm.memory_mb = memory_mb
+            vm.disk_gb = disk_gb
+            vm.save(update_fields=['cpu_cores', 'memory_mb', 'disk_gb', 'updated_at'])
+
+            logger.info(f"虚拟机 {vm.name} 调整为 {cpu_cores} 核 / {memory_mb}MB / {disk_gb}GB")
+            return {'success': True, 'vm_id': vm_id, 'restart_required': restart_required}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except (QuotaExceeded, CapacityExceeded) as e:
+            return {'success': False, 'error': str(e)}
+        except Quota.DoesNotExist:
+            return {'success': False, 'error': '用户配额信息不存在，请联系管理员'}
+        except Exception as e:
+            logger.error(f"调整虚拟机配置失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def tune_cpu(vm_id: str, shares: Optional[int] = None, period: Optional[int] = None,
+                 quota: Optional[int] = None) -> Dict:
+        """
+        调整虚拟机的CPU调度参数，运行中的虚拟机立即生效并写入持久化定义
+
+        未指定任何参数时重新应用课程与角色的CPU调度策略（策略变更后使用）。
+        会解除限流器施加的临时限流。
+
+        Args:
+            vm_id: 虚拟机ID
+            shares: 相对权重
+            period: 配额周期（微秒）
+            quota: 每个vCPU每个周期的配额（微秒），0 表示不限制
+
+        Returns:
+            操作结果，cputune 为写入的参数
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+            if vm.status in ('creating', 'error'):
+                return {'success': False, 'error': '虚拟机尚未创建完成'}
+            if shares is None and period is None and quota is None:
+                tune = resolve_cpu_policy(vm)
+            else:
+                tune = {'shares': shares, 'period': period, 'quota': quota}
+            VirtualMachineService.manager_for(vm).set_cpu_tune(vm.name, **tune)
+            if vm.cpu_throttled_until is not None:
+                vm.cpu_throttled_until = None
+                vm.save(update_fields=['cpu_throttled_until'])
+            logger.info(f"虚拟机 {vm.name} CPU调度参数调整为 {tune}")
+            return {'success': True, 'vm_id': vm_id, 'cputune': tune}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except Exception as e:
+            logger.error(f"调整虚拟机CPU调度参数失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def tune_io(vm_id: str, limits: Optional[Dict] = None) -> Dict:
+        """
+        调整虚拟机的磁盘与网络I/O限速，运行中的虚拟机立即生效并写入持久化定义
+
+        Args:
+            vm_id: 虚拟机ID
+            limits: 要修改的限速项（见 apps.vms.iotune），为空时重新应用模板与角色的限速策略
+
+        Returns:
+            操作结果，io_limits 为写入的限速项
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+            if vm.status in ('creating', 'error'):
+                return {'success': False, 'error': '虚拟机尚未创建完成'}
+            limits = limits or resolve_io_limits(vm)
+            VirtualMachineService.manager_for(vm).set_io_tune(vm.name, limits)
+            logger.info(f"虚拟机 {vm.name} I/O限速调整为 {limits}")
+            return {'success': True, 'vm_id': vm_id, 'io_limits': limits}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except Exception as e:
+            logger.error(f"调整虚拟机I/O限速失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def refresh_disk_usage(vm: VirtualMachine):
+        """
+        从libvirt读取磁盘实际占用并写入虚拟机记录
+
+        Args:
+            vm: 虚拟机
+        """
+        usage = VirtualMachineService.manager_for(vm).get_disk_usage(vm.name)
+        if usage is None:
+            return
+        vm.disk_allocated_bytes = usage['allocation']
+        vm.save(update_fields=['disk_allocated_bytes'])
+
+    @staticmethod
+    def reset_vm(vm_id: str) -> Dict:
+        """
+        将虚拟机重置为模板状态（保留域、MAC、IP与VNC信息）
+
+        Args:
+            vm_id: 虚拟机ID
+
+        Returns:
+            操作结果
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+
+            if not vm.template:
+                logger.error(f"虚拟机 {vm.name} 没有关联的模板")
+                return {'success': False, 'error': '虚拟机没有关联的模板'}
+
+            previous_status = vm.status
+            if vm.snapshots.filter(status='merging').exists():
+                return {'success': False, 'error': '快照合并进行中，请稍后再试'}
+            if VirtualMachineService._conversion_in_progress(vm):
+                return {'success': False, 'error': '模板转换进行中，请稍后再试'}
+
+            # 重置会丢弃整条快照链，基础磁盘是第一个快照冻结的磁盘层
+            snapshots = list(vm.snapshots.all())
+            reset_kwargs = {}
+            if snapshots:
+                reset_kwargs = {
+                    'disk_path': snapshots[0].backing_path,
+                    'discard_paths': [snapshot.disk_path for snapshot in snapshots],
+                }
+
+            # 完整复制时使用虚拟机固定的模板版本，不随模板更新到最新版本
+            template_path = vm.template_version.file_path if vm.template_version_id else vm.template.file_path
+
+            # 调用libvirt管理器重置虚拟机
+            success = VirtualMachineService.manager_for(vm).reset_vm(
+                vm.name, template_path=template_path, disk_gb=vm.disk_gb, **reset_kwargs
+            )
+
+            if success:
+                vm.snapshots.all().delete()
+                # 运行或暂停的虚拟机重置后恢复原状态，休眠镜像随旧磁盘丢弃
+                vm.status = previous_status if previous_status in ('running', 'paused') else 'stopped'
+                vm.save()
+                logger.info(f"虚拟机 {vm.name} 重置成功")
+                return {'success': True, 'vm_id': vm_id}
+            else:
+                logger.error(f"虚拟机 {vm.name} 重置失败")
+                return {'success': False, 'error': '重置失败'}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except Exception as e:
+            logger.error(f"重置虚拟机失败: {e}")
+            try:
+                vm = VirtualMachine.objects.get(id=vm_id)
+                vm.status = 'error'
+                vm.save()
+            except:
+                pass
+            return {'success': False, 'error': str(e)}
+
     @staticmethod
     def delete_vm(vm_id: str, remove_disk: bool = True) -> Dict:
         """
@@ -285,8 +663,11 @@ class VirtualMachineService:
             if vm.websockify_port:
                 VirtualMachineService.stop_websockify(vm.websockify_port)
 
-            result = libvirt_manager.delete_vm(vm.name, remove_disk=remove_disk)
+            result = VirtualMachineService.manager_for(vm).delete_vm(vm.name, remove_disk=remove_disk)
             if result:
+                # 清理快照链中位于活动层之下的磁盘文件
+                if remove_disk:
+                    VirtualMachineService._remove_snapshot_files(vm)
                 # 从数据库中删除记录
                 vm.delete()
                 logger.info(f"虚拟机 {vm.name} 删除成功")
@@ -302,6 +683,414 @@ class VirtualMachineService:
             logger.error(f"删除虚拟机失败: {e}")
             return {'success': False, 'error': str(e)}
     
+    @staticmethod
+    def _remove_snapshot_files(vm: 'VirtualMachine'):
+        """删除虚拟机快照链涉及的磁盘卷"""
+        for snapshot in vm.snapshots.all():
+            for path in (snapshot.backing_path, snapshot.disk_path):
+                VirtualMachineService.manager_for(vm).storage.delete_volume(path)
+
+    @staticmethod
+    def create_snapshot(vm_id: str, name: str, description: str = '') -> Dict:
+        """
+        创建虚拟机外部快照
+
+        Args:
+            vm_id: 虚拟机ID
+            name: 快照名称
+            description: 快照描述
+
+        Returns:
+            操作结果
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+
+            if vm.snapshots.filter(name=name).exists():
+                return {'success': False, 'error': f'快照 {name} 已存在'}
+            if vm.snapshots.filter(status='merging').exists():
+                return {'success': False, 'error': '快照合并进行中，请稍后再试'}
+            if VirtualMachineService._conversion_in_progress(vm):
+                return {'success': False, 'error': '模板转换进行中，请稍后再试'}
+
+            # 快照数量计入配额
+            QuotaLedger(vm.owner).check_snapshot()
+
+            snapshot = VirtualMachineSnapshot(vm=vm, name=name, description=description)
+            snapshot_info = VirtualMachineService.manager_for(vm).create_snapshot(vm.name, tag=snapshot.id.hex[:12])
+            snapshot.disk_path = snapshot_info['disk_path']
+            snapshot.backing_path = snapshot_info['backing_path']
+            snapshot.save()
+
+            logger.info(f"虚拟机 {vm.name} 快照 {name} 创建成功")
+            return {'success': True, 'vm_id': vm_id, 'snapshot_id': str(snapshot.id)}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except QuotaExceeded as e:
+            return {'success': False, 'error': str(e)}
+        except Quota.DoesNotExist:
+            return {'success': False, 'error': '用户配额信息不存在，请联系管理员'}
+        except Exception as e:
+            logger.error(f"创建快照失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def revert_snapshot(vm_id: str, snapshot_id: str) -> Dict:
+        """
+        回滚到指定快照，该快照之后创建的快照将被丢弃
+
+        Args:
+            vm_id: 虚拟机ID
+            snapshot_id: 快照ID
+
+        Returns:
+            操作结果
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+            snapshot = vm.snapshots.get(id=snapshot_id)
+
+            if vm.snapshots.filter(status='merging').exists():
+                return {'success': False, 'error': '快照合并进行中，请稍后再试'}
+            if VirtualMachineService._conversion_in_progress(vm):
+                return {'success': False, 'error': '模板转换进行中，请稍后再试'}
+
+            later = vm.snapshots.filter(created_at__gt=snapshot.created_at)
+            success = VirtualMachineService.manager_for(vm).revert_snapshot(
+                vm.name,
+                disk_path=snapshot.disk_path,
+                backing_path=snapshot.backing_path,
+                discard_paths=[s.disk_path for s in later],
+            )
+
+            if success:
+                later.delete()
+                if vm.status == 'paused':
+                    vm.status = 'running'
+                    vm.save()
+                logger.info(f"虚拟机 {vm.name} 回滚到快照 {snapshot.name}")
+                return {'success': True, 'vm_id': vm_id}
+            else:
+                return {'success': False, 'error': '回滚快照失败'}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except VirtualMachineSnapshot.DoesNotExist:
+            return {'success': False, 'error': '快照不存在'}
+        except Exception as e:
+            logger.error(f"回滚快照失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def delete_snapshot(vm_id: str, snapshot_id: str) -> Dict:
+        """
+        删除快照：立即释放配额，覆盖层在后台通过 blockcommit 合并以缩短后备链
+
+        Args:
+            vm_id: 虚拟机ID
+            snapshot_id: 快照ID
+
+        Returns:
+            操作结果
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+            snapshot = vm.snapshots.get(id=snapshot_id)
+
+            # 同一虚拟机的合并任务串行执行，避免并发改写后备链
+            if vm.snapshots.filter(status='merging').exists():
+                return {'success': False, 'error': '快照合并进行中，请稍后再试'}
+            if VirtualMachineService._conversion_in_progress(vm):
+                return {'success': False, 'error': '模板转换进行中，请稍后再试'}
+
+            snapshot.status = 'merging'
+            snapshot.save()
+
+            thread = threading.Thread(
+                target=VirtualMachineService.merge_snapshot, args=(str(snapshot.id),)
+            )
+            thread.daemon = True
+            thread.start()
+
+            return {'success': True, 'vm_id': vm_id, 'snapshot_id': snapshot_id}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except VirtualMachineSnapshot.DoesNotExist:
+            return {'success': False, 'error': '快照不存在'}
+        except Exception as e:
+            logger.error(f"删除快照失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def merge_snapshot(snapshot_id: str) -> Dict:
+        """
+        合并快照覆盖层（在后台线程中执行）
+
+        Args:
+            snapshot_id: 快照ID
+
+        Returns:
+            操作结果
+        """
+        try:
+            snapshot = VirtualMachineSnapshot.objects.select_related('vm').get(id=snapshot_id)
+            vm = snapshot.vm
+            child = vm.snapshots.filter(created_at__gt=snapshot.created_at).first()
+
+            success = VirtualMachineService.manager_for(vm).merge_snapshot(
+                vm.name,
+                disk_path=snapshot.disk_path,
+                backing_path=snapshot.backing_path,
+                child_path=child.disk_path if child else None,
+            )
+
+            if success:
+                # 上层快照的冻结层已由合并后的磁盘取代
+                if child:
+                    child.backing_path = snapshot.backing_path
+                    child.save()
+                snapshot.delete()
+                logger.info(f"虚拟机 {vm.name} 快照 {snapshot.name} 合并完成")
+                return {'success': True, 'snapshot_id': snapshot_id}
+            else:
+                snapshot.status = 'error'
+                snapshot.save()
+                return {'success': False, 'error': '合并快照失败'}
+
+        except VirtualMachineSnapshot.DoesNotExist:
+            return {'success': False, 'error': '快照不存在'}
+        except Exception as e:
+            logger.error(f"合并快照失败: {e}")
+            VirtualMachineSnapshot.objects.filter(id=snapshot_id).update(status='error')
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def _conversion_in_progress(vm: VirtualMachine) -> bool:
+        """虚拟机是否有进行中的模板转换（转换期间后备链上有临时快照层）"""
+        return vm.conversion_jobs.filter(status__in=['pending', 'running']).exists()
+
+    @staticmethod
+    def convert_to_template(vm_id: str, user, name: str, description: str = '',
+                            course=None, is_public: bool = False,
+                            compress: bool = False) -> Dict:
+        """
+        创建虚拟机转换为模板的后台任务
+
+        Args:
+            vm_id: 虚拟机ID
+            user: 发起转换的用户，成为模板所有者
+            name: 模板名称
+            description: 模板描述
+            course: 模板所属课程，为空时使用虚拟机所属课程
+            is_public: 是否公开
+            compress: 是否压缩导出的镜像
+
+        Returns:
+            操作结果，包含 job_id
+        """
+        try:
+            vm = VirtualMachine.objects.get(id=vm_id)
+
+            if vm.status in ('creating', 'error', 'deleting'):
+                return {'success': False, 'error': f'虚拟机当前状态（{vm.get_status_display()}）无法转换'}
+            if vm.snapshots.filter(status='merging').exists():
+                return {'success': False, 'error': '快照合并进行中，请稍后再试'}
+            if VirtualMachineService._conversion_in_progress(vm):
+                return {'success': False, 'error': '模板转换进行中，请稍后再试'}
+            course = course or vm.course
+            if course is None:
+                return {'success': False, 'error': '模板必须属于某个课程'}
+
+            job = TemplateConversionJob.objects.create(
+                vm=vm,
+                requested_by=user,
+                name=name,
+                description=description,
+                course=course,
+                is_public=is_public,
+                compress=compress,
+            )
+
+            thread = threading.Thread(
+                target=VirtualMachineService.run_template_conversion, args=(str(job.id),)
+            )
+            thread.daemon = True
+            thread.start()
+
+            return {'success': True, 'vm_id': vm_id, 'job_id': str(job.id)}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except Exception as e:
+            logger.error(f"创建模板转换任务失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def publish_version(vm_id: str, user, description: str = '') -> Dict:
+        """
+        创建以虚拟机磁盘差异发布模板新版本的后台任务
+
+        只导出虚拟机磁盘相对其后备模板版本的差异，作为新版本叠加在该版本之上。
+
+        Args:
+            vm_id: 虚拟机ID
+            user: 发布者
+            description: 版本说明
+
+        Returns:
+            操作结果，包含 job_id
+        """
+        try:
+            vm = VirtualMachine.objects.select_related('template').get(id=vm_id)
+
+            if vm.template is None:
+                return {'success': False, 'error': '虚拟机没有关联的模板'}
+            if vm.status in ('creating', 'error', 'deleting'):
+                return {'success': False, 'error': f'虚拟机当前状态（{vm.get_status_display()}）无法发布'}
+            if vm.snapshots.filter(status='merging').exists():
+                return {'success': False, 'error': '快照合并进行中，请稍后再试'}
+            if VirtualMachineService._conversion_in_progress(vm):
+                return {'success': False, 'error': '模板转换进行中，请稍后再试'}
+
+            template = vm.template
+            job = TemplateConversionJob.objects.create(
+                vm=vm,
+                requested_by=user,
+                name=template.name,
+                description=description,
+                course=template.course,
+                is_public=template.is_public,
+                target_template=template,
+            )
+
+            thread = threading.Thread(
+                target=VirtualMachineService.run_template_conversion, args=(str(job.id),)
+            )
+            thread.daemon = True
+            thread.start()
+
+            return {'success': True, 'vm_id': vm_id, 'job_id': str(job.id)}
+
+        except VirtualMachine.DoesNotExist:
+            logger.error(f"虚拟机不存在: {vm_id}")
+            return {'success': False, 'error': '虚拟机不存在'}
+        except Exception as e:
+            logger.error(f"创建模板版本发布任务失败: {e}")
+            return {'success': False, 'error': str(e)}
+
+    @staticmethod
+    def run_template_conversion(job_id: str) -> Dict:
+        """
+        执行模板转换（在后台线程中执行）
+
+        运行中的虚拟机先创建临时外部快照，导出冻结的磁盘层后再合并回去，
+        虚拟机全程不停机；未运行的虚拟机直接导出当前磁盘。
+        任务指定了 target_template 时只导出相对虚拟机后备版本的差异，发布为该模板的新版本。
+
+        Args:
+            job_id: 转换任务ID
+
+        Returns:
+            操作结果
+        """
+        import os
+
+        job = TemplateConversionJob.objects.select_related('vm', 'target_template').get(id=job_id)
+        vm = job.vm
+        job.status = 'running'
+        job.save(update_fields=['status'])
+
+        def report(percent: float):
+            # 限制写库频率，每推进1%更新一次
+            if percent - job.progress >= 1 or percent >= 100:
+                job.progress = round(percent, 1)
+                job.save(update_fields=['progress'])
+
+        temporary = None
+        dest = None
+        try:
+            # 磁盘在虚拟机所在宿主机上，转换由该宿主机的管理器执行
+            manager = VirtualMachineService.manager_for(vm)
+            source = manager.get_disk_path(vm.name)
+            if not source:
+                raise Exception(f"虚拟机 {vm.name} 没有可转换的磁盘")
+
+            state = manager.get_vm_status(vm.name)
+            if state and state['is_active']:
+                # 时间点一致的副本：冻结当前磁盘层，转换期间的写入进入临时覆盖层
+                temporary = manager.create_snapshot(vm.name, tag=f"convert-{job.id.hex[:12]}")
+                source = temporary['backing_path']
+
+            dest = template_store.temp_path()
+            if job.target_template is not None:
+                return VirtualMachineService._publish_delta(job, source, dest, report)
+            manager.convert_disk(source, dest, compress=job.compress, progress=report)
+            # 按内容存入模板存储，与已有模板相同时复用已有文件
+            blob = template_store.ingest_file(dest)
+
+            template = VirtualMachineTemplate.objects.create(
+                name=job.name,
+                description=job.description,
+                blob=blob,
+                owner=job.requested_by,
+                course=job.course,
+                is_public=job.is_public,
+                hardware_profile=vm.template.hardware_profile if vm.template else 'default',
+            )
+            # 已在后台线程中，直接完成镜像检查
+            if not copy_validation(template):
+                check_template(template.id)
+            job.template = template
+            job.status = 'succeeded'
+            job.progress = 100
+            logger.info(f"虚拟机 {vm.name} 转换为模板 {template.name} 完成")
+            return {'success': True, 'job_id': job_id, 'template_id': template.id}
+
+        except Exception as e:
+            logger.error(f"虚拟机转换为模板失败: {e}")
+            job.status = 'failed'
+            job.error = str(e)
+            if dest and os.path.exists(dest):
+                os.remove(dest)
+            return {'success': False, 'error': str(e)}
+
+        finally:
+            if temporary is not None:
+                # 合并临时覆盖层，恢复转换前的后备链
+                if not VirtualMachineService.manager_for(vm).merge_snapshot(
+                        vm.name, temporary['disk_path'], temporary['backing_path']):
+                    logger.error(f"虚拟机 {vm.name} 临时快照层合并失败: {temporary['disk_path']}")
+            job.finished_at = timezone.now()
+            job.save()
+
+    @staticmethod
+    def _publish_delta(job: TemplateConversionJob, source: str, dest: str, report) -> Dict:
+        """导出虚拟机磁盘相对其后备版本的差异层，发布为模板新版本"""
+        vm = job.vm
+        template = job.target_template
+        base = vm.template_version or ensure_base_version(template)
+        VirtualMachineService.manager_for(vm).export_delta(source, base.file_path, dest, progress=report)
+        blob = template_store.ingest_file(dest)
+
+        version = add_version(template, blob, parent=base, user=job.requested_by,
+                              description=job.description or '')
+        check_template(template.id)
+        if needs_flatten(version):
+            flatten_template_async(template)
+        job.template = template
+        job.status = 'succeeded'
+        job.progress = 100
+        logger.info(f"虚拟机 {vm.name} 发布为模板 {template.name} 版本 {version.version}，"
+                    f"差异层 {version.size} 字节")
+        return {'success': True, 'job_id': str(job.id), 'template_id': template.id,
+                'version': version.version}
+
     @staticmethod
     def sync_vm_status() -> Dict:
         """
@@ -311,17 +1100,18 @@ class VirtualMachineService:
             操作结果
         """
         try:
-            # 获取libvirt中的所有虚拟机状态
-            libvirt_vms = libvirt_manager.list_vms()
-            libvirt_vm_names = {vm['name'] for vm in libvirt_vms}
-            
             # 获取数据库中的所有虚拟机
-            db_vms = VirtualMachine.objects.all()
+            db_vms = VirtualMachine.objects.select_related('host')
+            # 各宿主机libvirt中的虚拟机名称
+            libvirt_vm_names = {}
             
             for vm in db_vms:
-                if vm.name in libvirt_vm_names:
+                manager = VirtualMachineService.manager_for(vm)
+                if id(manager) not in libvirt_vm_names:
+                    libvirt_vm_names[id(manager)] = {info['name'] for info in manager.list_vms()}
+                if vm.name in libvirt_vm_names[id(manager)]:
                     # 虚拟机存在于libvirt中，同步状态
-                    vm_status = libvirt_manager.get_vm_status(vm.name)
+                    vm_status = manager.get_vm_status(vm.name)
                     if vm_status:
                         vm.status = vm_status['state']
                         vm.ip_address = vm_status['ip_address']
@@ -0,0 +1,223 @@
+"""
+基于libvirt存储池的磁盘卷管理
+"""
+import libvirt
+import xml.etree.ElementTree as ET
+import logging
+import threading
+from typing import Dict, Optional
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class StorageManager:
+    """
+    存储卷管理器
+
+    按用途（disks: 虚拟机磁盘，templates: 模板）映射到 settings.LIBVIRT_STORAGE_POOLS
+    中的存储池。克隆、清除、删除等磁盘IO由libvirtd在存储所在主机上完成，不经过Django进程。
+    """
+
+    def __init__(self, manager):
+        """
+        初始化存储卷管理器
+
+        Args:
+            manager: 提供libvirt连接的 LibvirtManager
+        """
+        self.manager = manager
+
+    @property
+    def conn(self):
+        self.manager._ensure_connection()
+        return self.manager.conn
+
+    def get_pool(self, role: str):
+        """
+        获取指定用途的存储池
+
+        Args:
+            role: 存储池用途，对应 settings.LIBVIRT_STORAGE_POOLS 的键
+
+        Returns:
+            libvirt存储池对象
+        """
+        pools = getattr(settings, 'LIBVIRT_STORAGE_POOLS', {})
+        if role not in pools:
+            raise Exception(f"未配置存储池用途: {role}")
+        try:
+            pool = self.conn.storagePoolLookupByName(pools[role])
+        except libvirt.libvirtError as e:
+            logger.error(f"存储池 {pools[role]} 不存在: {e}")
+            raise Exception(f"存储池 {pools[role]} 不存在")
+        if not pool.isActive():
+            pool.create(0)
+        return pool
+
+    def get_pool_path(self, role: str) -> str:
+        """
+        获取目录型存储池的目标目录
+
+        Args:
+            role: 存储池用途
+
+        Returns:
+            存储池目录路径
+        """
+        root = ET.fromstring(self.get_pool(role).XMLDesc(0))
+        return root.findtext('target/path')
+
+    def lookup_volume(self, path: str):
+        """
+        按路径查找存储卷
+
+        快照覆盖层等由libvirt域操作或qemu-img创建的文件不会自动登记到存储池，
+        首次查找失败时刷新所有活动存储池后重试。
+
+        Args:
+            path: 卷文件路径
+
+        Returns:
+            libvirt存储卷对象
+        """
+        try:
+            return self.conn.storageVolLookupByPath(path)
+        except libvirt.libvirtError:
+            pass
+        for pool in self.conn.listAllStoragePools(libvirt.VIR_CONNECT_LIST_STORAGE_POOLS_ACTIVE):
+            try:
+                pool.refresh(0)
+            except libvirt.libvirtError as e:
+                logger.warning(f"刷新存储池 {pool.name()} 失败: {e}")
+        return self.conn.storageVolLookupByPath(path)
+
+    def volume_info(self, path: str) -> Optional[Dict]:
+        """
+        获取存储卷容量信息
+
+        Args:
+            path: 卷文件路径
+
+        Returns:
+            包含 pool、capacity（虚拟大小）、allocation（实际占用）的字典，单位字节；卷不存在时返回None
+        """
+        try:
+            volume = self.lookup_volume(path)
+            _, capacity, allocation = volume.info()
+            return {
+                'pool': volume.storagePoolLookupByVolume().name(),
+                'capacity': capacity,
+                'allocation': allocation,
+            }
+        except libvirt.libvirtError as e:
+            logger.warning(f"获取存储卷信息失败 {path}: {e}")
+            return None
+
+    def _volume_xml(self, name: str, capacity: int, backing_path: Optional[str] = None) -> str:
+        """生成qcow2存储卷XML"""
+        volume = ET.Element('volume')
+        ET.SubElement(volume, 'name').text = name
+        ET.SubElement(volume, 'capacity', unit='bytes').text = str(capacity)
+        # 稀疏分配，实际占用随写入增长
+        ET.SubElement(volume, 'allocation', unit='bytes').text = '0'
+        target = ET.SubElement(volume, 'target')
+        ET.SubElement(target, 'format', type='qcow2')
+        if backing_path:
+            backing = ET.SubElement(volume, 'backingStore')
+            ET.SubElement(backing, 'path').text = backing_path
+            ET.SubElement(backing, 'format', type='qcow2')
+        return ET.tostring(volume, encoding='unicode')
+
+    def _get_capacity(self, path: str) -> int:
+        """读取镜像虚拟大小，不在存储池中的文件（如上传的模板）通过qemu-img读取"""
+        try:
+            return self.lookup_volume(path).info()[1]
+        except libvirt.libvirtError:
+            info = self.manager._get_disk_info(path)
+            if info is None:
+                raise Exception(f"无法读取镜像信息: {path}")
+            return info['virtual-size']
+
+    def create_overlay(self, role: str, name: str, backing_path: str,
+                       capacity: Optional[int] = None,
+                       backing_capacity: Optional[int] = None) -> str:
+        """
+        在存储池中以后备文件为基础创建qcow2覆盖层卷
+
+        Args:
+            role: 存储池用途
+            name: 卷名称
+            backing_path: 后备文件路径
+            capacity: 虚拟大小（字节），为空或小于后备文件时与后备文件一致
+            backing_capacity: 后备文件虚拟大小（字节），为空时从存储池或镜像读取
+
+        Returns:
+            新卷的文件路径
+        """
+        pool = self.get_pool(role)
+        capacity = max(capacity or 0, backing_capacity or self._get_capacity(backing_path))
+        try:
+            volume = pool.createXML(self._volume_xml(name, capacity, backing_path), 0)
+        except libvirt.libvirtError as e:
+            logger.error(f"创建存储卷 {name} 失败: {e}")
+            raise Exception(f"创建存储卷失败: {e}")
+        logger.info(f"基于 {backing_path} 在存储池 {pool.name()} 创建覆盖层卷 {volume.path()}")
+        return volume.path()
+
+    def clone_volume(self, source_path: str, role: str, name: str) -> str:
+        """
+        将卷克隆为目标存储池中的独立qcow2卷（createXMLFrom，在libvirtd侧完成复制）
+
+        源卷的后备链会被合并，克隆结果不依赖源卷。
+
+        Args:
+            source_path: 源卷文件路径
+            role: 目标存储池用途
+            name: 新卷名称
+
+        Returns:
+            新卷的文件路径
+        """
+        try:
+            source = self.lookup_volume(source_path)
+        except libvirt.libvirtError as e:
+            logger.error(f"源卷不存在 {source_path}: {e}")
+            raise Exception(f"源卷不存在: {source_path}")
+        pool = self.get_pool(role)
+        capacity = source.info()[1]
+        try:
+            volume = pool.createXMLFrom(self._volume_xml(name, capacity), source, 0)
+        except libvirt.libvirtError as e:
+            logger.error(f"克隆存储卷 {source_path} 失败: {e}")
+            raise Exception(f"克隆存储卷失败: {e}")
+        logger.info(f"克隆存储卷 {source_path} -> {volume.path()}")
+        return volume.path()
+
+    def delete_volume(self, path: str, wipe: bool = False, wait: bool = False):
+        """
+        删除存储卷
+
+        Args:
+            path: 卷文件路径
+            wipe: 删除前是否清除卷内容
+            wait: 是否等待删除完成，默认在后台线程中执行
+        """
+        def _delete():
+            try:
+                volume = self.lookup_volume(path)
+            except libvirt.libvirtError:
+                logger.warning(f"存储卷不存在，跳过删除: {path}")
+                return
+            try:
+                if wipe:
+                    volume.wipe(0)
+                volume.delete(0)
+                logger.info(f"删除存储卷: {path}")
+            except libvirt.libvirtError as e:
+                logger.error(f"删除存储卷失败 {path}: {e}")
+
+        if wait:
+            _delete()
+        else:
+            threading.Thread(target=_delete, daemon=True).start()
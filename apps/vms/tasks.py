@@ -5,8 +5,12 @@ from celery import shared_task
 import logging
 import uuid
 from django.utils import timezone
+from apps.courses.versions import ensure_base_version
 from apps.vms.models import VirtualMachine
-from apps.vms.libvirt_manager import libvirt_manager
+from apps.vms.services import vm_service
+from apps.vms.profiles import resolve_profile
+from apps.vms.cputune import resolve_cpu_policy
+from apps.vms.iotune import resolve_io_limits
 
 logger = logging.getLogger(__name__)
 
@@ -33,14 +37,28 @@ def create_vm_task(self, vm_id: str):
             vm.status = 'error'
             vm.save()
             return {'success': False, 'error': '虚拟机没有关联的模板'}
+        if vm.template.validation_status == 'invalid':
+            logger.error(f"虚拟机 {vm.name} 的模板不可用: {vm.template.validation_error}")
+            vm.status = 'error'
+            vm.save()
+            return {'success': False, 'error': f"模板不可用: {vm.template.validation_error}"}
+        # 新虚拟机在模板最新版本上创建覆盖层
+        vm.template_version = ensure_base_version(vm.template)
+        vm.save()
+        vm_service.place_vm(vm)
         
         # 调用libvirt管理器创建虚拟机
-        vm_info = libvirt_manager.create_vm(
+        vm_info = vm_service.manager_for(vm).create_vm(
             name=vm.name,
             uuid=vm_uuid,
             memory_mb=vm.memory_mb,
             cpu_cores=vm.cpu_cores,
-            template_path=vm.template.file_path
+            template_path=vm.template_version.file_path,
+            profile=resolve_profile(vm.template.hardware_profile),
+            disk_gb=vm.disk_gb,
+            template_size=vm.template.virtual_size or None,
+            cputune=resolve_cpu_policy(vm),
+            io_limits=resolve_io_limits(vm)
         )
         
         # 更新虚拟机信息
@@ -82,7 +100,7 @@ def start_vm_task(self, vm_id: str):
         vm = VirtualMachine.objects.get(id=vm_id)
         
         # 调用libvirt管理器启动虚拟机
-        success = libvirt_manager.start_vm(vm.name)
+        success = vm_service.manager_for(vm).start_vm(vm.name)
         
         if success:
             vm.status = 'running'
@@ -116,7 +134,7 @@ def stop_vm_task(self, vm_id: str, force: bool = False):
         vm = VirtualMachine.objects.get(id=vm_id)
         
         # 调用libvirt管理器停止虚拟机
-        success = libvirt_manager.stop_vm(vm.name, force=force)
+        success = vm_service.manager_for(vm).stop_vm(vm.name, force=force)
         
         if success:
             vm.status = 'stopped'
@@ -147,7 +165,7 @@ def restart_vm_task(self, vm_id: str):
         vm = VirtualMachine.objects.get(id=vm_id)
         
         # 调用libvirt管理器重启虚拟机
-        success = libvirt_manager.restart_vm(vm.name)
+        success = vm_service.manager_for(vm).restart_vm(vm.name)
         
         if success:
             logger.info(f"虚拟机 {vm.name} 重启成功")
@@ -176,7 +194,7 @@ def pause_vm_task(self, vm_id: str):
         vm = VirtualMachine.objects.get(id=vm_id)
         
         # 调用libvirt管理器暂停虚拟机
-        success = libvirt_manager.pause_vm(vm.name)
+        success = vm_service.manager_for(vm).pause_vm(vm.name)
         
         if success:
             vm.status = 'paused'
@@ -207,7 +225,7 @@ def resume_vm_task(self, vm_id: str):
         vm = VirtualMachine.objects.get(id=vm_id)
         
         # 调用libvirt管理器恢复虚拟机
-        success = libvirt_manager.resume_vm(vm.name)
+        success = vm_service.manager_for(vm).resume_vm(vm.name)
         
         if success:
             vm.status = 'running'
@@ -240,7 +258,7 @@ def delete_vm_task(self, vm_id: str, remove_disk: bool = True):
         vm_name = vm.name
         
         # 调用libvirt管理器删除虚拟机
-        success = libvirt_manager.delete_vm(vm_name, remove_disk=remove_disk)
+        success = vm_service.manager_for(vm).delete_vm(vm_name, remove_disk=remove_disk)
         
         if success:
             # 从数据库中删除记录
@@ -264,30 +282,4 @@ def sync_vm_status_task(self):
     """
     同步虚拟机状态任务
     """
-    try:
-        # 获取libvirt中的所有虚拟机状态
-        libvirt_vms = libvirt_manager.list_vms()
-        libvirt_vm_names = {vm['name'] for vm in libvirt_vms}
-        
-        # 获取数据库中的所有虚拟机
-        db_vms = VirtualMachine.objects.all()
-        
-        for vm in db_vms:
-            if vm.name in libvirt_vm_names:
-                # 虚拟机存在于libvirt中，同步状态
-                vm_status = libvirt_manager.get_vm_status(vm.name)
-                if vm_status:
-                    vm.status = vm_status['state']
-                    vm.ip_address = vm_status['ip_address']
-                    vm.save()
-            else:
-                # 虚拟机不存在于libvirt中，标记为错误状态
-                vm.status = 'error'
-                vm.save()
-        
-        logger.info("虚拟机状态同步完成")
-        return {'success': True, 'synced_count': len(db_vms)}
-        
-    except Exception as e:
-        logger.error(f"同步虚拟机状态失败: {e}")
-        return {'success': False, 'error': str(e)}
+    return vm_service.sync_vm_status()
@@ -9,6 +9,8 @@ app_name = 'vms'
 
 router = DefaultRouter()
 router.register(r'vms', views.VirtualMachineViewSet, basename='vm')
+router.register(r'template-jobs', views.TemplateConversionJobViewSet, basename='template-job')
+router.register(r'hosts', views.HostViewSet, basename='host')
 
 urlpatterns = [
     path('', include(router.urls)),
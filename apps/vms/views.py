@@ -2,29 +2,40 @@
 虚拟机管理视图
 """
 import logging
+import os
+from django.conf import settings
 from django.shortcuts import get_object_or_404
 from django.http import JsonResponse
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from django.db.models import Q
+from django.utils import timezone
+from django.urls import reverse
 
-from apps.vms.models import VirtualMachine
+from apps.vms.models import VirtualMachine, TemplateConversionJob, Host, AdmissionTicket
 from apps.vms.serializers import (
     VirtualMachineSerializer, 
     VirtualMachineCreateSerializer,
     VirtualMachineStatusSerializer,
     VirtualMachineMetricsSerializer,
     VirtualMachineOperationSerializer,
+    VirtualMachineSnapshotSerializer,
+    TemplateConversionJobSerializer,
+    AdmissionTicketSerializer,
+    PreemptionSerializer,
+    HostSerializer,
     VNCAccessSerializer
 )
 from apps.vms.services import vm_service
-from apps.vms.libvirt_manager import libvirt_manager
-import os, shutil
-from django.conf import settings
-from apps.courses.models import VirtualMachineTemplate
-from apps.courses.serializers import VirtualMachineTemplateSerializer
+from apps.vms.admission import admission, prefetch_admission
+from apps.vms.capacity import capacity
+from apps.vms.rebalance import rebalancer
+from apps.vms.balloon import memory_manager
+from apps.vms.cputune import resolve_cpu_policy
+from apps.vms.iotune import DISK_IOTUNE_KEYS, NET_BANDWIDTH_KEYS, resolve_io_limits
+from apps.core.transfer import file_download_response
 
 logger = logging.getLogger(__name__)
 
@@ -46,15 +57,28 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
         
         if user.is_staff or role_name == 'admin':
             # 管理员可以看到所有虚拟机
-            return VirtualMachine.objects.all().order_by('-created_at')
+            queryset = VirtualMachine.objects.all().order_by('-created_at')
         elif role_name == 'teacher':
             # 教师可以看到自己的虚拟机和自己课程中学生的虚拟机
-            return VirtualMachine.objects.filter(
+            queryset = VirtualMachine.objects.filter(
                 Q(owner=user) | Q(course__teachers=user)
             ).distinct().order_by('-created_at')
         else:
             # 学生只能看到自己的虚拟机
-            return VirtualMachine.objects.filter(owner=user).order_by('-created_at')
+            queryset = VirtualMachine.objects.filter(owner=user).order_by('-created_at')
+        if self.action == 'list':
+            queryset = prefetch_admission(queryset)
+        return queryset
+    
+    def get_serializer_context(self):
+        """列表接口的排队位置按宿主机批量计算，而不是每行重新排序队列"""
+        context = super().get_serializer_context()
+        if self.action == 'list':
+            queued = AdmissionTicket.objects.filter(
+                vm__in=self.filter_queryset(self.get_queryset()), status='queued'
+            ).only('host', 'status')
+            context['admission_positions'] = admission.positions(queued)
+        return context
     
     def get_serializer_class(self):
         """根据动作选择序列化器"""
@@ -72,15 +96,60 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
         # 保存虚拟机记录
         vm = serializer.save()
         
-        # 异步创建虚拟机
+        # 异步创建虚拟机，宿主机繁忙时排队
         vm_service.create_vm_async(str(vm.id))
         
-        return Response({
+        data = {
             'id': vm.id,
             'name': vm.name,
             'status': vm.status,
             'message': '虚拟机创建任务已启动'
-        }, status=status.HTTP_201_CREATED)
+        }
+        ticket = vm.admission
+        if ticket is not None and ticket.status == 'queued':
+            data['admission'] = AdmissionTicketSerializer(ticket).data
+            data['message'] = f"虚拟机创建已排队，前面还有 {ticket.position - 1} 个开机请求"
+        return Response(data, status=status.HTTP_201_CREATED)
+    
+    @staticmethod
+    def _queued_response(result):
+        """开机请求排队时返回排队位置"""
+        return Response({
+            'queued': True,
+            'ticket_id': result['ticket_id'],
+            'position': result['position'],
+            'message': f"已进入开机队列，前面还有 {result['position'] - 1} 个开机请求"
+        }, status=status.HTTP_202_ACCEPTED)
+    
+    def update(self, request, *args, **kwargs):
+        """
+        修改虚拟机，CPU、内存与磁盘的变更会应用到虚拟机
+        """
+        partial = kwargs.pop('partial', False)
+        vm = self.get_object()
+        
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限修改此虚拟机'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        serializer = self.get_serializer(vm, data=request.data, partial=partial)
+        serializer.is_valid(raise_exception=True)
+        
+        cpu_cores = serializer.validated_data.pop('cpu_cores', vm.cpu_cores)
+        memory_mb = serializer.validated_data.pop('memory_mb', vm.memory_mb)
+        disk_gb = serializer.validated_data.pop('disk_gb', vm.disk_gb)
+        restart_required = False
+        if (cpu_cores, memory_mb, disk_gb) != (vm.cpu_cores, vm.memory_mb, vm.disk_gb):
+            result = vm_service.resize_vm(str(vm.id), cpu_cores, memory_mb, disk_gb)
+            if not result['success']:
+                return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
+            restart_required = result['restart_required']
+            vm.refresh_from_db()
+        
+        serializer.save()
+        return Response({**serializer.data, 'restart_required': restart_required})
     
     def destroy(self, request, *args, **kwargs):
         """
@@ -120,6 +189,13 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
             return True
         return False
     
+    def _check_tune_permission(self, vm, user):
+        """检查用户是否有权限调整虚拟机的资源限制（管理员与课程教师）"""
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+        is_teacher = (role_name == 'teacher' and vm.course and vm.course.teachers.filter(id=user.id).exists())
+        return user.is_staff or role_name == 'admin' or is_teacher
+    
     @action(detail=True, methods=['post'])
     def start(self, request, pk=None):
         """启动虚拟机"""
@@ -137,6 +213,8 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
         # 启动虚拟机
         result = vm_service.start_vm(str(vm.id))
         
+        if result.get('queued'):
+            return self._queued_response(result)
         if result['success']:
             # 启动 websockify
             vm.refresh_from_db() # 确保获取到最新的 vnc_port
@@ -199,6 +277,8 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
         # 重启虚拟机
         result = vm_service.restart_vm(str(vm.id))
         
+        if result.get('queued'):
+            return self._queued_response(result)
         if result['success']:
             return Response({
                 'message': '虚拟机重启成功'
@@ -266,6 +346,117 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
                 'error': result['error']
             }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
+    @action(detail=True, methods=['post'])
+    def reset(self, request, pk=None):
+        """重置虚拟机到模板状态"""
+        vm = self.get_object()
+
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限操作此虚拟机'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        if vm.status in ['creating', 'deleting']:
+            return Response(
+                {'error': '虚拟机正在创建或删除中，无法重置'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        # 重置虚拟机
+        result = vm_service.reset_vm(str(vm.id))
+
+        if result['success']:
+            return Response({
+                'message': '虚拟机重置成功'
+            })
+        else:
+            return Response({
+                'error': result['error']
+            }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    @action(detail=True, methods=['get', 'post'])
+    def snapshots(self, request, pk=None):
+        """获取快照列表或创建快照"""
+        vm = self.get_object()
+
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限操作此虚拟机'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        if request.method == 'GET':
+            serializer = VirtualMachineSnapshotSerializer(vm.snapshots.all(), many=True)
+            return Response(serializer.data)
+
+        serializer = VirtualMachineSnapshotSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+
+        # 创建快照
+        result = vm_service.create_snapshot(
+            str(vm.id),
+            name=serializer.validated_data['name'],
+            description=serializer.validated_data.get('description') or ''
+        )
+
+        if result['success']:
+            snapshot = vm.snapshots.get(id=result['snapshot_id'])
+            return Response(
+                VirtualMachineSnapshotSerializer(snapshot).data,
+                status=status.HTTP_201_CREATED
+            )
+        else:
+            return Response({
+                'error': result['error']
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=['post'], url_path='snapshots/(?P<snapshot_id>[^/.]+)/revert')
+    def revert_snapshot(self, request, pk=None, snapshot_id=None):
+        """回滚到指定快照"""
+        vm = self.get_object()
+
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限操作此虚拟机'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        # 回滚快照
+        result = vm_service.revert_snapshot(str(vm.id), snapshot_id)
+
+        if result['success']:
+            return Response({
+                'message': '快照回滚成功'
+            })
+        else:
+            return Response({
+                'error': result['error']
+            }, status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=['delete'], url_path='snapshots/(?P<snapshot_id>[^/.]+)')
+    def delete_snapshot(self, request, pk=None, snapshot_id=None):
+        """删除快照（后台合并覆盖层）"""
+        vm = self.get_object()
+
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限操作此虚拟机'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+
+        # 删除快照
+        result = vm_service.delete_snapshot(str(vm.id), snapshot_id)
+
+        if result['success']:
+            return Response({
+                'message': '快照合并任务已启动'
+            }, status=status.HTTP_202_ACCEPTED)
+        else:
+            return Response({
+                'error': result['error']
+            }, status=status.HTTP_400_BAD_REQUEST)
+
     @action(detail=True, methods=['get'])
     def status(self, request, pk=None):
         """获取虚拟机状态"""
@@ -279,7 +470,7 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
         
         try:
             # 从libvirt获取实时状态
-            vm_status = libvirt_manager.get_vm_status(vm.name)
+            vm_status = vm_service.manager_for(vm).get_vm_status(vm.name)
             if vm_status:
                 # 更新数据库中的状态
                 vm.status = vm_status['state']
@@ -300,6 +491,143 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
+    @action(detail=True, methods=['get'])
+    def admission(self, request, pk=None):
+        """获取虚拟机进行中的开机准入记录与排队位置"""
+        vm = self.get_object()
+        
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限查看此虚拟机'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        ticket = vm.admission
+        if ticket is None:
+            return Response({'queued': False})
+        return Response(AdmissionTicketSerializer(ticket).data)
+    
+    @action(detail=True, methods=['get'])
+    def preemptions(self, request, pk=None):
+        """获取虚拟机因空闲被休眠、为其他虚拟机腾出容量的记录"""
+        vm = self.get_object()
+        
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限查看此虚拟机'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        return Response(PreemptionSerializer(vm.preemptions.select_related('preempted_for'), many=True).data)
+    
+    @action(detail=False, methods=['get'])
+    def admission_metrics(self, request):
+        """按课程、用户统计开机准入队列深度与等待时间"""
+        user = request.user
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+        
+        tenants = admission.tenant_metrics()
+        if not (user.is_staff or role_name == 'admin'):
+            # 教师可以查看所授课程的全部用户，其他用户只能查看自己
+            taught = set(user.teaching_courses.values_list('id', flat=True)) if role_name == 'teacher' else set()
+            tenants = [t for t in tenants if t['user'] == user.id or t['course'] in taught]
+        return Response({
+            'host': admission.host,
+            'window_seconds': settings.ADMISSION_FAIR_SHARE_WINDOW,
+            'tenants': tenants,
+        })
+    
+    @action(detail=False, methods=['get'])
+    def host_capacity(self, request):
+        """获取宿主机容量、超分上限与已分配情况，仅限管理员与教师"""
+        user = request.user
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+        if not (user.is_staff or role_name in ('admin', 'teacher')):
+            return Response({'error': '您没有权限查看宿主机容量'}, status=status.HTTP_403_FORBIDDEN)
+        return Response(capacity.usage())
+    
+    @action(detail=False, methods=['get'])
+    def host_memory(self, request):
+        """获取宿主机内存气球回收与按模板汇总的KSM合并情况，仅限管理员与教师"""
+        user = request.user
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+        if not (user.is_staff or role_name in ('admin', 'teacher')):
+            return Response({'error': '您没有权限查看宿主机内存'}, status=status.HTTP_403_FORBIDDEN)
+        return Response(memory_manager.report())
+    
+    @action(detail=True, methods=['get', 'post'])
+    def cpu_tune(self, request, pk=None):
+        """
+        获取或调整虚拟机CPU调度参数
+
+        GET 返回策略与当前生效的参数；POST 调整 shares、period、quota（仅限管理员与课程教师），
+        不带参数时重新应用策略
+        """
+        vm = self.get_object()
+        if not self._check_vm_permission(vm, request.user):
+            return Response({'error': '您没有权限查看此虚拟机'}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.method == 'POST':
+            if not self._check_tune_permission(vm, request.user):
+                return Response({'error': '您没有权限调整此虚拟机的CPU调度参数'}, status=status.HTTP_403_FORBIDDEN)
+            values = {}
+            for key in ('shares', 'period', 'quota'):
+                if request.data.get(key) is None:
+                    continue
+                try:
+                    values[key] = int(request.data[key])
+                except (TypeError, ValueError):
+                    return Response({'error': f'{key} 必须是整数'}, status=status.HTTP_400_BAD_REQUEST)
+                if values[key] < 0:
+                    return Response({'error': f'{key} 不能为负数'}, status=status.HTTP_400_BAD_REQUEST)
+            result = vm_service.tune_cpu(str(vm.id), **values)
+            if not result['success']:
+                return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
+            vm.refresh_from_db()
+
+        return Response({
+            'policy': resolve_cpu_policy(vm),
+            'live': vm_service.manager_for(vm).get_cpu_tune(vm.name) if vm.status == 'running' else None,
+            'throttled_until': vm.cpu_throttled_until,
+        })
+    
+    @action(detail=True, methods=['get', 'post'])
+    def io_tune(self, request, pk=None):
+        """
+        获取或调整虚拟机磁盘与网络I/O限速
+
+        GET 返回策略与当前生效的限速；POST 调整 DISK_IOTUNE_KEYS、NET_BANDWIDTH_KEYS 中的项
+        （仅限管理员与课程教师），不带参数时重新应用策略
+        """
+        vm = self.get_object()
+        if not self._check_vm_permission(vm, request.user):
+            return Response({'error': '您没有权限查看此虚拟机'}, status=status.HTTP_403_FORBIDDEN)
+
+        if request.method == 'POST':
+            if not self._check_tune_permission(vm, request.user):
+                return Response({'error': '您没有权限调整此虚拟机的I/O限速'}, status=status.HTTP_403_FORBIDDEN)
+            limits = {}
+            for key in DISK_IOTUNE_KEYS + NET_BANDWIDTH_KEYS:
+                if request.data.get(key) is None:
+                    continue
+                try:
+                    limits[key] = int(request.data[key])
+                except (TypeError, ValueError):
+                    return Response({'error': f'{key} 必须是整数'}, status=status.HTTP_400_BAD_REQUEST)
+                if limits[key] < 0:
+                    return Response({'error': f'{key} 不能为负数'}, status=status.HTTP_400_BAD_REQUEST)
+            result = vm_service.tune_io(str(vm.id), limits or None)
+            if not result['success']:
+                return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
+
+        live = None
+        if vm.status not in ('creating', 'error'):
+            live = vm_service.manager_for(vm).get_io_tune(vm.name)
+        return Response({'policy': resolve_io_limits(vm), 'live': live})
+    
     @action(detail=True, methods=['get'])
     def metrics(self, request, pk=None):
         """获取虚拟机监控指标"""
@@ -313,7 +641,7 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
         
         try:
             # 从libvirt获取监控指标
-            metrics = libvirt_manager.get_vm_metrics(vm.name)
+            metrics = vm_service.manager_for(vm).get_vm_metrics(vm.name)
             if metrics:
                 serializer = VirtualMachineMetricsSerializer(metrics)
                 return Response(serializer.data)
@@ -329,6 +657,36 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR
             )
     
+    @action(detail=True, methods=['get'], url_path='disk')
+    def export_disk(self, request, pk=None):
+        """
+        导出虚拟机磁盘，鉴权后由nginx发送（X-Accel-Redirect），支持Range断点续传
+
+        磁盘为以模板为后备文件的qcow2覆盖层，只包含相对模板的改动；
+        响应头 X-Backing-Template 给出模板ID。
+        """
+        vm = self.get_object()
+
+        if not self._check_vm_permission(vm, request.user):
+            return Response(
+                {'error': '您没有权限导出此虚拟机磁盘'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        # 运行中的磁盘内容不一致，只允许导出已停止或已休眠的虚拟机
+        if vm.status not in ('stopped', 'saved'):
+            return Response(
+                {'error': '请先停止虚拟机再导出磁盘'},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        disk_path = vm_service.manager_for(vm).get_disk_path(vm.name)
+        if not disk_path or not os.path.exists(disk_path):
+            return Response({'error': '虚拟机磁盘不存在'}, status=status.HTTP_404_NOT_FOUND)
+        response = file_download_response(request, disk_path, f"{vm.name}.qcow2")
+        if vm.template_id:
+            response['X-Backing-Template'] = str(vm.template_id)
+        return response
+
     @action(detail=True, methods=['get'])
     def console_vnc(self, request, pk=None):
         """获取VNC控制台访问信息"""
@@ -346,6 +704,10 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        # 打开控制台视为用户活动，避免被空闲回收
+        vm.last_activity_at = timezone.now()
+        vm.save(update_fields=['last_activity_at'])
+
         # 确保 websockify 正在运行
         websockify_port = vm_service.start_websockify(vm)
         if not websockify_port:
@@ -427,22 +789,108 @@ class VirtualMachineViewSet(viewsets.ModelViewSet):
         # 获取模板名称与描述
         name = request.data.get('name', vm.name)
         description = request.data.get('description', '')
-        # 复制磁盘文件
-        src = os.path.join(settings.LIBVIRT_STORAGE_DIR, f"{vm.name}.qcow2")
-        dest_dir = os.path.join(settings.LIBVIRT_STORAGE_DIR, 'templates')
-        os.makedirs(dest_dir, exist_ok=True)
-        dest = os.path.join(dest_dir, f"{name}_{vm.name}.qcow2")
+        compress = str(request.data.get('compress', '')).lower() in ('1', 'true', 'yes')
+        # 转换在后台执行，通过任务接口查询进度
+        result = vm_service.convert_to_template(
+            str(vm.id), request.user, name, description, compress=compress
+        )
+        if not result['success']:
+            return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'job_id': result['job_id'],
+            'progress_url': reverse('vms:template-job-detail', kwargs={'pk': result['job_id']}),
+            'message': '模板转换任务已启动'
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+    @action(detail=True, methods=['post'])
+    def publish_version(self, request, pk=None):
+        """将虚拟机磁盘相对模板的差异发布为模板新版本，仅限模板所属课程教师"""
+        vm = self.get_object()
+        template = vm.template
+        if template is None:
+            return Response({'error': '虚拟机没有关联的模板'}, status=status.HTTP_400_BAD_REQUEST)
+        # 权限校验：模板所有者、模板所属课程教师或管理员
+        user = request.user
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+        is_teacher = (role_name == 'teacher' and (
+            template.owner_id == user.id or
+            (template.course and template.course.teachers.filter(id=user.id).exists())
+        ))
+        if not (user.is_staff or role_name == 'admin' or is_teacher):
+            return Response({'error': '您没有权限发布此模板的新版本'}, status=status.HTTP_403_FORBIDDEN)
+        result = vm_service.publish_version(
+            str(vm.id), request.user, request.data.get('description', '')
+        )
+        if not result['success']:
+            return Response({'error': result['error']}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({
+            'job_id': result['job_id'],
+            'progress_url': reverse('vms:template-job-detail', kwargs={'pk': result['job_id']}),
+            'message': '模板版本发布任务已启动'
+        }, status=status.HTTP_202_ACCEPTED)
+
+
+class TemplateConversionJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    模板转换任务视图集（查询进度）
+    """
+    serializer_class = TemplateConversionJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        """管理员可以看到所有任务，其他用户只能看到自己发起的任务"""
+        user = self.request.user
+        user_role = getattr(user, 'role', None)
+        role_name = getattr(user_role, 'name', None) if user_role else None
+        jobs = TemplateConversionJob.objects.select_related('vm')
+        if user.is_staff or role_name == 'admin':
+            return jobs
+        return jobs.filter(requested_by=user)
+
+
+class HostViewSet(viewsets.ModelViewSet):
+    """
+    宿主机视图集，仅限管理员
+    """
+    queryset = Host.objects.all()
+    serializer_class = HostSerializer
+    permission_classes = [IsAdminUser]
+
+    def destroy(self, request, *args, **kwargs):
+        """仍有虚拟机的宿主机不能删除，可先停用"""
+        host = self.get_object()
+        if host.vms.exists():
+            return Response({'error': '宿主机上仍有虚拟机，请先迁移或删除，或将其停用'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return super().destroy(request, *args, **kwargs)
+
+    @action(detail=True, methods=['get'])
+    def capacity(self, request, pk=None):
+        """宿主机容量、超分上限与已分配情况"""
+        return Response(capacity.usage(self.get_object()))
+
+    @action(detail=True, methods=['get'])
+    def memory(self, request, pk=None):
+        """宿主机内存气球回收与按模板汇总的KSM合并情况"""
+        return Response(memory_manager.report(self.get_object()))
+
+    @action(detail=False, methods=['get', 'post'])
+    def rebalance(self, request):
+        """
+        宿主机再平衡：GET 返回试运行报告，POST 计算方案并迁移其中已停止的虚拟机
+
+        可选参数 target 指定目标利用率（0~1）
+        """
+        target = request.query_params.get('target') or request.data.get('target')
         try:
-            shutil.copyfile(src, dest)
-            template = VirtualMachineTemplate.objects.create(
-                name=name,
-                description=description,
-                file_path=dest,
-                owner=request.user,
-                course=vm.course
-            )
-            serializer = VirtualMachineTemplateSerializer(template)
-            return Response(serializer.data, status=status.HTTP_201_CREATED)
-        except Exception as e:
-            logger.error(f"VM转换为模板失败: {e}")
-            return Response({'error': '转换失败'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            target = float(target) if target else None
+        except (TypeError, ValueError):
+            return Response({'error': 'target 必须是数字'}, status=status.HTTP_400_BAD_REQUEST)
+        if target is not None and not 0 < target <= 1:
+            return Response({'error': 'target 必须在 0 到 1 之间'}, status=status.HTTP_400_BAD_REQUEST)
+        report = rebalancer.report(target)
+        if request.method == 'POST':
+            report['result'] = rebalancer.apply(report)
+        return Response(report)
@@ -4,6 +4,7 @@ from django import forms
 from apps.courses.models import Course
 from apps.vms.models import VirtualMachine
 from apps.users.models import Quota
+from apps.vms.quota import QuotaLedger
 from apps.courses.models import VirtualMachineTemplate
 
 class CustomUserCreationForm(UserCreationForm):
@@ -28,6 +29,13 @@ class VMForm(forms.ModelForm):
 
     def clean(self):
         cleaned = super().clean()
+        template = cleaned.get('template')
+        if template:
+            if template.validation_status == 'invalid':
+                self.add_error('template', f"模板不可用: {template.validation_error}")
+            # 磁盘不能小于模板的虚拟大小
+            if cleaned.get('disk_gb') and cleaned['disk_gb'] < template.min_disk_gb:
+                cleaned['disk_gb'] = template.min_disk_gb
         # 获取表单提交用户：优先使用 initial 中传入的 owner
         user = self.initial.get('owner')
         # 如果是已有实例且 initial 中无 owner，则使用实例 owner
@@ -44,17 +52,20 @@ class VMForm(forms.ModelForm):
                 return cleaned
         else:
             return cleaned
-        # 校验资源
+        # 校验资源：累计用户已有虚拟机的占用，编辑时排除自身
+        adding = self.instance._state.adding
+        used = QuotaLedger(user).usage(exclude_vm=None if adding else self.instance)
         cpu = cleaned.get('cpu_cores')
         mem = cleaned.get('memory_mb')
         disk = cleaned.get('disk_gb')
-        if cpu and cpu > quota.cpu_cores:
+        if cpu and used['cpu_cores'] + cpu > quota.cpu_cores:
             self.add_error('cpu_cores', '超出CPU配额')
-        if mem and mem > quota.memory_mb:
+        if mem and used['memory_mb'] + mem > quota.memory_mb:
             self.add_error('memory_mb', '超出内存配额')
-        if disk and disk > quota.disk_gb:
+        if disk and used['disk_gb'] + disk > quota.disk_gb:
             self.add_error('disk_gb', '超出磁盘配额')
-        # TODO: VM 数量限制校验
+        if adding and used['vm_count'] >= quota.vm_limit:
+            self.add_error(None, '虚拟机数量已达上限')
         return cleaned
  
 # 用户管理表单
@@ -121,6 +132,8 @@ class VMTemplateForm(forms.ModelForm):
 
 # 虚拟机转换为模板表单
 class VMConvertForm(forms.ModelForm):
+    compress = forms.BooleanField(label='压缩镜像', required=False)
+
     class Meta:
         model = VirtualMachineTemplate
         fields = ['name', 'description', 'course', 'is_public']
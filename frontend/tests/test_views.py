@@ -3,7 +3,7 @@ from django.urls import reverse
 from django.contrib.auth import get_user_model
 from django.test import Client
 from apps.courses.models import Course
-from apps.vms.models import VirtualMachine
+from apps.vms.models import VirtualMachine, TemplateConversionJob, AdmissionTicket
 import uuid
 
 pytestmark = pytest.mark.django_db
@@ -73,6 +73,19 @@ def test_vm_list_requires_login(client):
     assert response.status_code == 302
     assert reverse('frontend:login') in response.url
 
+def test_vm_list_rows_show_queue_position(client):
+    user = User.objects.create_user(username='queueuser', password='pass12345')
+    client.login(username='queueuser', password='pass12345')
+    for i in range(2):
+        vm = VirtualMachine.objects.create(
+            name=f'QueuedVM{i}', owner=user, cpu_cores=1, memory_mb=1024, disk_gb=10
+        )
+        AdmissionTicket.objects.create(vm=vm, operation='start', host='qemu:///system')
+    response = client.get(reverse('frontend:vm_list_partial'))
+    assert response.status_code == 200
+    assert '排队第 1 位'.encode('utf-8') in response.content
+    assert '排队第 2 位'.encode('utf-8') in response.content
+
 def test_course_detail_requires_login(client):
     url = reverse('frontend:course_detail', args=[1])
     response = client.get(url)
@@ -114,3 +127,17 @@ def test_vm_detail_shows_info(client):
     assert b'2 cores' in response.content
     assert b'1024 MB' in response.content
     assert b'20 GB' in response.content
+
+def test_template_job_only_visible_to_requester(client):
+    owner = User.objects.create_user(username='jobowner', password='pass12345')
+    User.objects.create_user(username='otheruser', password='pass12345')
+    job = TemplateConversionJob.objects.create(requested_by=owner, name='ConvertedTemplate')
+    url = reverse('frontend:template_job', args=[job.pk])
+
+    client.login(username='otheruser', password='pass12345')
+    assert client.get(url).status_code == 404
+
+    client.login(username='jobowner', password='pass12345')
+    response = client.get(url)
+    assert response.status_code == 200
+    assert b'ConvertedTemplate' in response.content
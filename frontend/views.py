@@ -1,19 +1,21 @@
 from django.shortcuts import render, redirect, get_object_or_404
 from django.conf import settings
-import os, shutil
+import os
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.forms import AuthenticationForm
 from .forms import CustomUserCreationForm, CourseForm, VMForm, VMConvertForm
 from django.contrib.auth.decorators import login_required
 from apps.courses.models import Course, VirtualMachineTemplate
-from apps.vms.models import VirtualMachine
+from apps.courses.store import TemplateInUse, delete_template, ingest_chunks
+from apps.courses.validation import validate_template_async
+from apps.vms.models import VirtualMachine, TemplateConversionJob
 from django.contrib.auth import get_user_model
 from .forms import UserForm, CourseStudentForm, VMTemplateForm
 from django.db.models import Q
-from django.core.files.storage import FileSystemStorage
 from django.conf import settings
 import os
 from apps.vms.services import vm_service
+from apps.vms.admission import admission, prefetch_admission
 
 
 def index(request):
@@ -120,16 +122,24 @@ def course_detail(request, course_id):
         'add_student_form': add_student_form,
     })
 
+def _vm_rows(vms):
+    """虚拟机列表行 (虚拟机, 进行中的开机准入记录, 排队位置)，排队位置每台宿主机只计算一次"""
+    vms = list(prefetch_admission(vms))
+    tickets = [vm.admission for vm in vms]
+    positions = admission.positions([ticket for ticket in tickets if ticket is not None])
+    return [(vm, ticket, positions.get(ticket.id, 0) if ticket else 0)
+            for vm, ticket in zip(vms, tickets)]
+
 @login_required
 def vm_list(request):
     vms = VirtualMachine.objects.filter(owner=request.user)
-    return render(request, 'frontend/vm_list.html', {'vms': vms})
+    return render(request, 'frontend/vm_list.html', {'rows': _vm_rows(vms)})
 
 @login_required
 def vm_list_partial(request):
     """HTMX 局部刷新虚拟机列表行"""
     vms = VirtualMachine.objects.filter(owner=request.user)
-    return render(request, 'frontend/partials/vm_list_rows.html', {'vms': vms})
+    return render(request, 'frontend/partials/vm_list_rows.html', {'rows': _vm_rows(vms)})
 
 @login_required
 def vm_create(request):
@@ -150,8 +160,15 @@ def vm_create(request):
 def vm_update(request, vm_id):
     vm = get_object_or_404(VirtualMachine, id=vm_id)
     if request.method == 'POST':
-        form = VMForm(request.POST, instance=vm, initial={'owner': request.user})
+        resources = (vm.cpu_cores, vm.memory_mb, vm.disk_gb)
+        form = VMForm(request.POST, instance=vm, initial={'owner': vm.owner})
         if form.is_valid():
+            # 资源变更同步到虚拟机，运行中时在线生效
+            if (vm.cpu_cores, vm.memory_mb, vm.disk_gb) != resources:
+                result = vm_service.resize_vm(str(vm.id), vm.cpu_cores, vm.memory_mb, vm.disk_gb)
+                if not result['success']:
+                    form.add_error(None, result['error'])
+                    return render(request, 'frontend/vm_form.html', {'form': form, 'title': '编辑虚拟机'})
             form.save()
             return redirect('frontend:vm_detail', vm_id=vm.pk)
     else:
@@ -178,22 +195,32 @@ def vm_convert(request, vm_id):
     if request.method == 'POST':
         form = VMConvertForm(request.POST)
         if form.is_valid():
-            template = form.save(commit=False)
-            # 复制虚拟机磁盘为模板文件
-            src = os.path.join(settings.LIBVIRT_STORAGE_DIR, f"{vm.name}.qcow2")
-            dest_dir = os.path.join(settings.LIBVIRT_STORAGE_DIR, 'templates')
-            os.makedirs(dest_dir, exist_ok=True)
-            dest = os.path.join(dest_dir, f"{template.name}_{vm.name}.qcow2")
-            shutil.copyfile(src, dest)
-            template.file_path = dest
-            template.owner = request.user
-            template.save()
-            return redirect('frontend:template_detail', template_id=template.id)
+            # 转换在后台执行，跳转到任务进度页
+            data = form.cleaned_data
+            result = vm_service.convert_to_template(
+                str(vm.id), request.user, data['name'], data['description'] or '',
+                course=data['course'], is_public=data['is_public'],
+                compress=data.get('compress', False)
+            )
+            if result['success']:
+                return redirect('frontend:template_job', job_id=result['job_id'])
+            form.add_error(None, result['error'])
     else:
         initial = {'name': vm.name, 'course': vm.course.pk if vm.course else None}
         form = VMConvertForm(initial=initial)
     return render(request, 'frontend/vm_convert.html', {'form': form, 'vm': vm})
 
+@login_required
+def template_job(request, job_id):
+    """模板转换任务进度，管理员可以查看所有任务，其他用户只能查看自己发起的任务"""
+    jobs = TemplateConversionJob.objects.all()
+    user_role = getattr(request.user, 'role', None)
+    role_name = getattr(user_role, 'name', None) if user_role else None
+    if not (request.user.is_staff or role_name == 'admin'):
+        jobs = jobs.filter(requested_by=request.user)
+    job = get_object_or_404(jobs, id=job_id)
+    return render(request, 'frontend/template_job.html', {'job': job})
+
 # 用户管理视图
 User = get_user_model()
 
@@ -270,12 +297,11 @@ def template_create(request):
         if form.is_valid():
             template = form.save(commit=False)
             template.owner = request.user
-            # 保存上传文件
+            # 上传文件按内容存入模板存储，与已有模板相同时复用已有文件
             file = request.FILES.get('file')
-            fs = FileSystemStorage(location=str(settings.MEDIA_ROOT) + '/templates')
-            filename = fs.save(file.name, file)
-            template.file_path = fs.path(filename)
+            template.blob = ingest_chunks(file.chunks())
             template.save()
+            validate_template_async(template)
             return redirect('frontend:template_list')
     else:
         form = VMTemplateForm()
@@ -291,11 +317,10 @@ def template_detail(request, template_id):
 def template_delete(request, template_id):
     """删除虚拟机模板"""
     template = get_object_or_404(VirtualMachineTemplate, id=template_id)
-    # 删除文件
+    # 镜像文件在最后一个引用释放时删除
     try:
-        os.remove(template.file_path)
-    except Exception:
-        pass
-    template.delete()
+        delete_template(template)
+    except TemplateInUse as e:
+        return render(request, 'frontend/template_detail.html', {'template': template, 'error': str(e)})
     return redirect('frontend:template_list')
 
@@ -1,10 +1,15 @@
+import hashlib
+import os
+import tempfile
 import pytest
+from unittest.mock import patch
 from django.urls import reverse
+from django.conf import settings
 from rest_framework import status
 from rest_framework.test import APITestCase
 from django.contrib.auth import get_user_model
 from apps.users.models import Role
-from apps.courses.models import Course, VirtualMachineTemplate
+from apps.courses.models import Course, VirtualMachineTemplate, TemplateUpload, TemplateBlob, TemplateVersion
 
 User = get_user_model()
 
@@ -145,6 +150,32 @@ class CourseAPITests(APITestCase):
         self.assertIn('total_students', response.data)
         self.assertIn('total_teachers', response.data)
 
+    def test_teacher_schedules_lab_session(self):
+        """
+        测试教师为课程安排上机时段，学生只能查看
+        """
+        url = reverse('courses:lab-session-list')
+        data = {
+            'course': self.course.id, 'title': '实验一',
+            'starts_at': '2030-03-01T08:00:00Z', 'ends_at': '2030-03-01T09:40:00Z',
+        }
+        self.client.force_authenticate(user=self.student_user)
+        self.assertEqual(self.client.post(url, data, format='json').status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.teacher_user)
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['status'], 'scheduled')
+        self.assertEqual(response.data['end_action'], 'managed_save')
+
+        response = self.client.post(url, {**data, 'ends_at': '2030-03-01T07:00:00Z'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        self.client.force_authenticate(user=self.student_user)
+        response = self.client.get(url, {'course': self.course.id})
+        self.assertEqual(len(response.data['results']), 1)
+
+
 class VirtualMachineTemplateAPITests(APITestCase):
     """
     虚拟机模板API测试
@@ -236,3 +267,430 @@ class VirtualMachineTemplateAPITests(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         # 学生应该能看到公开模板和课程模板
         self.assertGreaterEqual(len(response.data['results']), 1)
+
+
+class TemplateUploadAPITests(APITestCase):
+    """
+    模板分块上传API测试
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        """
+        设置测试数据
+        """
+        cls.teacher_role, _ = Role.objects.get_or_create(name='teacher', defaults={'description': '教师'})
+        cls.teacher_user = User.objects.create_user(
+            username='upload_teacher', password='password', role=cls.teacher_role
+        )
+        cls.course = Course.objects.create(name='上传测试课程')
+        cls.course.teachers.add(cls.teacher_user)
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        for target in ('apps.courses.uploads.get_upload_dir', 'apps.courses.store.get_store_dir'):
+            patcher = patch(target, return_value=self.tmpdir.name)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+        self.client.force_authenticate(user=self.teacher_user)
+
+    def _put_chunk(self, upload_id, offset, data):
+        url = reverse('courses:template-upload-chunk', kwargs={'pk': upload_id})
+        return self.client.put(f"{url}?offset={offset}", data=data,
+                               content_type='application/octet-stream')
+
+    def test_chunked_upload_resume_and_commit(self):
+        """
+        测试分块上传、断点续传与提交
+        """
+        content = b'QFI\xfb' + b'x' * 60
+        response = self.client.post(reverse('courses:template-upload-list'), {
+            'name': 'Uploaded', 'course': self.course.id, 'size': len(content)
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['chunk_size'], settings.TEMPLATE_UPLOAD_CHUNK_SIZE)
+        upload_id = response.data['id']
+
+        # 超过分块上限的请求体被拒绝
+        with self.settings(TEMPLATE_UPLOAD_CHUNK_SIZE=32):
+            response = self._put_chunk(upload_id, 0, content[:40])
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+
+        response = self._put_chunk(upload_id, 0, content[:40])
+        self.assertEqual(response.data['offset'], 40)
+
+        # 偏移不一致时返回服务端已接收的字节数
+        response = self._put_chunk(upload_id, 20, content[20:])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response.data['offset'], 40)
+
+        response = self.client.get(reverse('courses:template-upload-detail', kwargs={'pk': upload_id}))
+        self.assertEqual(response.data['offset'], 40)
+
+        response = self._put_chunk(upload_id, 40, content[40:])
+        self.assertEqual(response.data['offset'], len(content))
+
+        url = reverse('courses:template-upload-commit', kwargs={'pk': upload_id})
+        response = self.client.post(url, {'sha256': hashlib.sha256(content).hexdigest()}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+        template = VirtualMachineTemplate.objects.get(id=response.data['id'])
+        self.assertEqual(template.sha256, hashlib.sha256(content).hexdigest())
+        self.assertTrue(template.file_path.startswith(self.tmpdir.name))
+        with open(template.file_path, 'rb') as f:
+            self.assertEqual(f.read(), content)
+
+    def _upload(self, name, content):
+        response = self.client.post(reverse('courses:template-upload-list'), {
+            'name': name, 'course': self.course.id, 'size': len(content)
+        }, format='json')
+        upload_id = response.data['id']
+        self._put_chunk(upload_id, 0, content)
+        url = reverse('courses:template-upload-commit', kwargs={'pk': upload_id})
+        return VirtualMachineTemplate.objects.get(id=self.client.post(url, format='json').data['id'])
+
+    def test_duplicate_uploads_share_blob(self):
+        """
+        测试内容相同的上传合并为一个镜像文件，最后一个模板删除时才删除文件
+        """
+        content = b'QFI\xfb' + b'z' * 60
+        first = self._upload('First', content)
+        second = self._upload('Second', content)
+
+        self.assertEqual(first.blob_id, second.blob_id)
+        self.assertEqual(first.blob.ref_count, 2)
+        self.assertEqual(first.file_path, second.file_path)
+        self.assertEqual(os.path.basename(first.file_path),
+                         f"sha256-{hashlib.sha256(content).hexdigest()}.qcow2")
+        self.assertEqual([n for n in os.listdir(self.tmpdir.name) if not n.startswith('.')],
+                         [os.path.basename(first.file_path)])
+
+        url = reverse('courses:template-detail', kwargs={'pk': first.id})
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertTrue(os.path.exists(second.file_path))
+        url = reverse('courses:template-detail', kwargs={'pk': second.id})
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(os.path.exists(second.file_path))
+        self.assertFalse(TemplateBlob.objects.exists())
+
+    def test_delete_template_in_use(self):
+        """
+        测试仍有虚拟机基于模板时拒绝删除
+        """
+        from apps.vms.models import VirtualMachine
+        template = self._upload('Used', b'QFI\xfb' + b'u' * 60)
+        VirtualMachine.objects.create(name='vm', owner=self.teacher_user, template=template,
+                                      cpu_cores=1, memory_mb=512, disk_gb=1)
+        url = reverse('courses:template-detail', kwargs={'pk': template.id})
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_409_CONFLICT)
+        self.assertTrue(os.path.exists(template.file_path))
+
+    def test_template_versions_share_store(self):
+        """
+        测试版本层存入存储，合并后释放不再引用的旧版本，删除模板时释放全部文件
+        """
+        from apps.courses import store
+        from apps.courses.versions import add_version, ensure_base_version, prune_versions
+        template = self._upload('Layered', b'QFI\xfb' + b'v' * 60)
+        base = ensure_base_version(template)
+        self.assertEqual(base.version, 1)
+
+        delta_path = os.path.join(self.tmpdir.name, 'delta')
+        with open(delta_path, 'wb') as f:
+            f.write(b'QFI\xfb' + b'd' * 12)
+        delta = add_version(template, store.ingest_file(delta_path), parent=base, description='v2')
+        template.refresh_from_db()
+        self.assertEqual(template.file_path, delta.file_path)
+        self.assertEqual(delta.depth, 1)
+        self.assertEqual(delta.size, 16)
+
+        response = self.client.get(reverse('courses:template-versions', kwargs={'pk': template.id}))
+        self.assertEqual([v['version'] for v in response.data], [2, 1])
+        self.assertEqual(response.data[0]['parent_version'], 1)
+
+        # 合并后的独立版本成为最新版本，没有虚拟机引用的旧版本被释放
+        flat_path = os.path.join(self.tmpdir.name, 'flat')
+        with open(flat_path, 'wb') as f:
+            f.write(b'QFI\xfb' + b'f' * 60)
+        add_version(template, store.ingest_file(flat_path), parent=None)
+        self.assertEqual(prune_versions(template), 2)
+        self.assertFalse(os.path.exists(base.file_path))
+        self.assertFalse(os.path.exists(delta.file_path))
+
+        template.refresh_from_db()
+        url = reverse('courses:template-detail', kwargs={'pk': template.id})
+        self.assertEqual(self.client.delete(url).status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(TemplateBlob.objects.exists())
+
+    def test_commit_rejects_checksum_mismatch(self):
+        """
+        测试校验和不一致时拒绝提交
+        """
+        upload = TemplateUpload.objects.create(
+            owner=self.teacher_user, name='Bad', course=self.course, size=4,
+            file_path=os.path.join(self.tmpdir.name, 'bad.part')
+        )
+        open(upload.file_path, 'wb').close()
+        self._put_chunk(upload.id, 0, b'abcd')
+
+        url = reverse('courses:template-upload-commit', kwargs={'pk': upload.id})
+        response = self.client.post(url, {'sha256': '0' * 64}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(VirtualMachineTemplate.objects.filter(name='Bad').exists())
+
+    def test_body_upload_from_nginx_temp_file(self):
+        """
+        测试nginx请求体落盘后只转发临时文件路径
+        """
+        content = b'QFI\xfb' + b'y' * 28
+        upload = TemplateUpload.objects.create(
+            owner=self.teacher_user, name='Body', course=self.course, size=len(content),
+            file_path=os.path.join(self.tmpdir.name, 'body.part')
+        )
+        open(upload.file_path, 'wb').close()
+        body_dir = os.path.join(self.tmpdir.name, '.upload')
+        os.mkdir(body_dir)
+        body_path = os.path.join(body_dir, '0000000001')
+        with open(body_path, 'wb') as f:
+            f.write(content)
+
+        url = reverse('courses:template-upload-body', kwargs={'pk': upload.id})
+        with self.settings(NGINX_UPLOAD_DIR=body_dir):
+            response = self.client.put(url, HTTP_X_UPLOAD_FILE=body_path)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['offset'], len(content))
+        self.assertFalse(os.path.exists(body_path))
+
+        url = reverse('courses:template-upload-commit', kwargs={'pk': upload.id})
+        response = self.client.post(url, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(response.data['sha256'], hashlib.sha256(content).hexdigest())
+
+    def test_body_upload_ignores_path_outside_upload_dir(self):
+        """
+        测试上传目录之外的 X-Upload-File 不被信任
+        """
+        upload = TemplateUpload.objects.create(
+            owner=self.teacher_user, name='Spoof', course=self.course, size=4,
+            file_path=os.path.join(self.tmpdir.name, 'spoof.part')
+        )
+        open(upload.file_path, 'wb').close()
+        url = reverse('courses:template-upload-body', kwargs={'pk': upload.id})
+        with self.settings(NGINX_UPLOAD_DIR=os.path.join(self.tmpdir.name, '.upload')):
+            response = self.client.put(url, data=b'abcd', content_type='application/octet-stream',
+                                       HTTP_X_UPLOAD_FILE='/etc/passwd')
+        self.assertEqual(response.data['offset'], 4)
+        with open(upload.file_path, 'rb') as f:
+            self.assertEqual(f.read(), b'abcd')
+
+
+class TemplateDownloadAPITests(APITestCase):
+    """
+    模板下载API测试
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.teacher_role, _ = Role.objects.get_or_create(name='teacher', defaults={'description': '教师'})
+        cls.teacher_user = User.objects.create_user(
+            username='download_teacher', password='password', role=cls.teacher_role
+        )
+        cls.course = Course.objects.create(name='下载测试课程')
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        file_path = os.path.join(self.tmpdir.name, 'base.qcow2')
+        with open(file_path, 'wb') as f:
+            f.write(b'0123456789')
+        self.template = VirtualMachineTemplate.objects.create(
+            name='Base', file_path=file_path, owner=self.teacher_user, course=self.course
+        )
+        self.url = reverse('courses:template-download', kwargs={'pk': self.template.id})
+        self.client.force_authenticate(user=self.teacher_user)
+
+    def test_download_uses_x_accel_redirect(self):
+        """
+        测试启用nginx时只返回 X-Accel-Redirect
+        """
+        with self.settings(NGINX_ACCEL_REDIRECT=True,
+                           NGINX_ACCEL_LOCATIONS={self.tmpdir.name: '/protected/images/'}):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/images/base.qcow2')
+        self.assertEqual(response.content, b'')
+
+    def test_download_range_without_nginx(self):
+        """
+        测试未启用nginx时由Django处理Range请求
+        """
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+
+
+    def test_prewarm_reports_residency(self):
+        """
+        测试预热模板整条后备链并报告页缓存驻留
+        """
+        from apps.courses.pagecache import prewarm_template
+        from apps.courses.qcow2 import Qcow2Error
+        top = os.path.join(self.tmpdir.name, 'top.qcow2')
+        with open(top, 'wb') as f:
+            f.write(b'abcdef')
+        self.template.file_path = top
+        self.template.save()
+        headers = {top: {'backing_file': 'base.qcow2'}}
+
+        def read_header(path):
+            if path not in headers:
+                raise Qcow2Error('不是qcow2镜像')
+            return headers[path]
+
+        url = reverse('courses:template-prewarm', kwargs={'pk': self.template.id})
+        with patch('apps.courses.pagecache.read_header', side_effect=read_header):
+            result = prewarm_template(self.template, method='read')
+            self.assertEqual([f['bytes'] for f in result['files']], [6, 10])
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['size'], 16)
+        self.assertEqual(response.data['resident_bytes'], 16)
+        self.assertEqual(response.data['percent'], 100.0)
+
+        with patch('apps.courses.views.prewarm_template_async') as mock_prewarm:
+            response = self.client.post(url, {'method': 'read'}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        mock_prewarm.assert_called_once_with(self.template, 'read')
+
+
+def build_qcow2(path, virtual_size=1024 * 1024, data=b'hello', refcount_data=1, cluster_bits=9,
+                backing_file=''):
+    """
+    生成最小的qcow2 v3镜像，依次为头、引用计数表、引用计数块、L1表、L2表、数据簇
+    """
+    import struct
+    cluster = 1 << cluster_bits
+    l1_size = -(-virtual_size // (cluster * cluster // 8))
+    backing = backing_file.encode()
+    # 后备文件名紧跟在头扩展结束标记之后
+    backing_offset = 112 if backing else 0
+    header = b'QFI\xfb' + struct.pack(
+        '>IQIIQIIQQIIQQQQII',
+        3, backing_offset, len(backing), cluster_bits, virtual_size, 0, l1_size, 3 * cluster,
+        1 * cluster, 1, 0, 0, 0, 0, 0, 4, 104
+    )
+    header = header.ljust(112, b'\0') + backing
+    clusters = [header.ljust(cluster, b'\0')]
+    clusters.append(struct.pack('>Q', 2 * cluster).ljust(cluster, b'\0'))
+    clusters.append(struct.pack('>6H', 1, 1, 1, 1, 1, refcount_data).ljust(cluster, b'\0'))
+    clusters.append(struct.pack('>Q', (1 << 63) | 4 * cluster).ljust(cluster, b'\0'))
+    clusters.append(struct.pack('>Q', (1 << 63) | 5 * cluster).ljust(cluster, b'\0'))
+    clusters.append(data.ljust(cluster, b'\0'))
+    with open(path, 'wb') as f:
+        f.write(b''.join(clusters))
+
+
+class Qcow2InspectionTests(APITestCase):
+    """
+    qcow2镜像头解析与模板检查测试
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.teacher_role, _ = Role.objects.get_or_create(name='teacher', defaults={'description': '教师'})
+        cls.teacher_user = User.objects.create_user(
+            username='qcow2_teacher', password='password', role=cls.teacher_role
+        )
+        cls.course = Course.objects.create(name='镜像测试课程')
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.path = os.path.join(self.tmpdir.name, 'base.qcow2')
+
+    def _template(self):
+        return VirtualMachineTemplate.objects.create(
+            name='Base', file_path=self.path, owner=self.teacher_user, course=self.course
+        )
+
+    def test_read_header_and_check(self):
+        """
+        测试读取镜像头与一致性检查
+        """
+        from apps.courses.qcow2 import read_header, check_image
+        build_qcow2(self.path, virtual_size=3 * 1024 ** 3)
+        header = read_header(self.path)
+        self.assertEqual(header['version'], 3)
+        self.assertEqual(header['virtual_size'], 3 * 1024 ** 3)
+        self.assertEqual(header['cluster_size'], 512)
+        self.assertFalse(header['encrypted'])
+
+        build_qcow2(self.path)
+        result = check_image(self.path)
+        self.assertEqual(result['errors'], [])
+        self.assertEqual(result['allocated_clusters'], 1)
+        self.assertEqual(result['leaked_clusters'], 0)
+        self.assertFalse(result['compressed'])
+
+    def test_check_detects_refcount_mismatch(self):
+        """
+        测试引用计数为0的已引用簇被视为损坏
+        """
+        from apps.courses.qcow2 import check_image
+        build_qcow2(self.path, refcount_data=0)
+        result = check_image(self.path)
+        self.assertEqual(result['error_count'], 1)
+        self.assertIn('簇 5', result['errors'][0])
+
+    def test_check_template_stores_result(self):
+        """
+        测试检查结果保存到模板，虚拟大小用于磁盘最小值
+        """
+        from apps.courses.validation import check_template
+        build_qcow2(self.path, virtual_size=int(2.5 * 1024 ** 3), cluster_bits=16)
+        template = self._template()
+        self.assertTrue(check_template(template.id))
+        template.refresh_from_db()
+        self.assertEqual(template.validation_status, 'valid')
+        self.assertEqual(template.format_version, 3)
+        self.assertEqual(template.min_disk_gb, 3)
+
+    def test_check_rejects_backing_file(self):
+        """
+        测试依赖宿主机上任意文件的镜像不可用，差异层版本可以以本模板的版本为后备文件
+        """
+        from apps.courses.validation import check_template
+        build_qcow2(self.path, backing_file='/etc/passwd')
+        template = self._template()
+        self.assertFalse(check_template(template.id))
+        template.refresh_from_db()
+        self.assertEqual(template.validation_status, 'invalid')
+        self.assertEqual(template.backing_file, '/etc/passwd')
+        self.assertIn('/etc/passwd', template.validation_error)
+
+        # 以同一模板的基础版本为后备文件的差异层
+        base_path = os.path.join(self.tmpdir.name, 'v1.qcow2')
+        build_qcow2(base_path)
+        TemplateVersion.objects.create(template=template, version=1, file_path=base_path)
+        build_qcow2(self.path, backing_file='v1.qcow2')
+        self.assertTrue(check_template(template.id))
+
+    def test_validate_rejects_non_qcow2(self):
+        """
+        测试非qcow2文件立即标记为不可用
+        """
+        with open(self.path, 'wb') as f:
+            f.write(b'not an image' * 10)
+        template = self._template()
+        self.client.force_authenticate(user=self.teacher_user)
+        url = reverse('courses:template-validate', kwargs={'pk': template.id})
+        response = self.client.post(url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['valid'])
+        template.refresh_from_db()
+        self.assertEqual(template.validation_status, 'invalid')
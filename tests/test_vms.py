@@ -2,19 +2,36 @@
 虚拟机管理模块测试
 """
 import pytest
+import os
+import tempfile
 import uuid
+import xml.etree.ElementTree as ET
+from datetime import timedelta
 from unittest.mock import patch, MagicMock
 from django.test import TestCase
 from django.contrib.auth import get_user_model
 from rest_framework.test import APITestCase, APIClient
 from rest_framework import status
 from django.urls import reverse
+from django.utils import timezone
 
 from apps.users.models import Role, Quota
-from apps.courses.models import Course, VirtualMachineTemplate
-from apps.vms.models import VirtualMachine
+from apps.courses.models import Course, VirtualMachineTemplate, TemplateBlob, TemplateVersion, LabSession
+from apps.vms.models import VirtualMachine, VirtualMachineSnapshot, TemplateConversionJob, AdmissionTicket, Host, Preemption
 from apps.vms.services import vm_service
-from apps.vms.libvirt_manager import LibvirtManager
+from apps.vms.libvirt_manager import LibvirtManager, get_manager
+from apps.vms.idle import IdleReaper
+from apps.vms.cputune import CpuThrottler, resolve_cpu_policy
+from apps.vms.iotune import resolve_io_limits
+from apps.vms.balloon import MemoryManager
+from apps.vms.lab_scheduler import LabScheduler
+from apps.vms.admission import admission
+from apps.vms.placement import PlacementError, placement
+from apps.vms.rebalance import plan_moves, rebalancer
+from apps.vms.profiles import resolve_profile
+from apps.vms.quota import QuotaLedger
+from apps.vms.storage import StorageManager
+from apps.vms.diskcopy import DiskCopier
 
 User = get_user_model()
 
@@ -194,7 +211,20 @@ class VirtualMachineServiceTest(TestCase):
             memory_mb=2048,
             disk_gb=20
         )
-    
+
+        # 开机准入与容量账本不访问本机libvirtd
+        for target, kwargs in (
+            ('apps.vms.capacity.capacity.host_info', {'return_value': {
+                'cpus': 64, 'memory_mb': 262144, 'free_mb': 262144, 'available_mb': 262144,
+                'disk_capacity_gb': 10000, 'disk_available_gb': 10000,
+            }}),
+            ('apps.vms.capacity.libvirt_manager', {'uri': 'qemu:///system'}),
+            ('apps.vms.admission.libvirt_manager', {'uri': 'qemu:///system'}),
+        ):
+            patcher = patch(target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
     @patch('apps.vms.services.libvirt_manager')
     def test_start_vm_success(self, mock_libvirt):
         """测试启动虚拟机成功"""
@@ -316,6 +346,305 @@ class VirtualMachineServiceTest(TestCase):
         
         mock_libvirt.delete_vm.assert_called_once_with(vm_name, remove_disk=True)
     
+    @patch('apps.vms.services.libvirt_manager')
+    def test_reset_vm_success(self, mock_libvirt):
+        """测试重置虚拟机保持运行状态"""
+        self.vm.status = 'running'
+        self.vm.save()
+        
+        mock_libvirt.reset_vm.return_value = True
+        
+        result = vm_service.reset_vm(str(self.vm.id))
+        
+        self.assertTrue(result['success'])
+        
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.status, 'running')
+        
+        mock_libvirt.reset_vm.assert_called_once_with(
+            self.vm.name, template_path=self.template.file_path, disk_gb=self.vm.disk_gb
+        )
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_reset_vm_keeps_pinned_version_and_paused_state(self, mock_libvirt):
+        """测试重置使用虚拟机固定的模板版本，暂停的虚拟机重置后仍为暂停"""
+        version = TemplateVersion.objects.create(
+            template=self.template, version=1, file_path='/templates/test-template-v1.qcow2'
+        )
+        self.vm.template_version = version
+        self.vm.status = 'paused'
+        self.vm.save()
+        mock_libvirt.reset_vm.return_value = True
+        
+        self.assertTrue(vm_service.reset_vm(str(self.vm.id))['success'])
+        
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.status, 'paused')
+        mock_libvirt.reset_vm.assert_called_once_with(
+            self.vm.name, template_path='/templates/test-template-v1.qcow2', disk_gb=self.vm.disk_gb
+        )
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_reset_vm_without_template(self, mock_libvirt):
+        """测试重置没有模板的虚拟机"""
+        self.vm.template = None
+        self.vm.save()
+        
+        result = vm_service.reset_vm(str(self.vm.id))
+        
+        self.assertFalse(result['success'])
+        mock_libvirt.reset_vm.assert_not_called()
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_create_snapshot_success(self, mock_libvirt):
+        """测试创建外部快照"""
+        Quota.objects.create(user=self.student, snapshot_limit=2)
+        mock_libvirt.create_snapshot.return_value = {
+            'disk_path': '/var/lib/libvirt/images/test-vm-snap.qcow2',
+            'backing_path': '/var/lib/libvirt/images/test-vm.qcow2',
+        }
+        
+        result = vm_service.create_snapshot(str(self.vm.id), name='before-lab')
+        
+        self.assertTrue(result['success'])
+        snapshot = VirtualMachineSnapshot.objects.get(id=result['snapshot_id'])
+        self.assertEqual(snapshot.vm, self.vm)
+        self.assertEqual(snapshot.backing_path, '/var/lib/libvirt/images/test-vm.qcow2')
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_create_snapshot_quota_exceeded(self, mock_libvirt):
+        """测试快照数量超出配额"""
+        Quota.objects.create(user=self.student, snapshot_limit=1)
+        VirtualMachineSnapshot.objects.create(
+            vm=self.vm, name='s1', disk_path='/tmp/s1.qcow2', backing_path='/tmp/base.qcow2'
+        )
+        
+        result = vm_service.create_snapshot(str(self.vm.id), name='s2')
+        
+        self.assertFalse(result['success'])
+        self.assertIn('快照数量已达上限', result['error'])
+        mock_libvirt.create_snapshot.assert_not_called()
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_revert_snapshot_discards_later(self, mock_libvirt):
+        """测试回滚快照会丢弃之后的快照"""
+        first = VirtualMachineSnapshot.objects.create(
+            vm=self.vm, name='s1', disk_path='/tmp/s1.qcow2', backing_path='/tmp/base.qcow2'
+        )
+        VirtualMachineSnapshot.objects.create(
+            vm=self.vm, name='s2', disk_path='/tmp/s2.qcow2', backing_path='/tmp/s1.qcow2'
+        )
+        mock_libvirt.revert_snapshot.return_value = True
+        
+        result = vm_service.revert_snapshot(str(self.vm.id), str(first.id))
+        
+        self.assertTrue(result['success'])
+        self.assertEqual(list(self.vm.snapshots.values_list('name', flat=True)), ['s1'])
+        mock_libvirt.revert_snapshot.assert_called_once_with(
+            self.vm.name,
+            disk_path='/tmp/s1.qcow2',
+            backing_path='/tmp/base.qcow2',
+            discard_paths=['/tmp/s2.qcow2'],
+        )
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_merge_snapshot_rebases_child(self, mock_libvirt):
+        """测试合并快照后上层快照指向合并后的磁盘"""
+        first = VirtualMachineSnapshot.objects.create(
+            vm=self.vm, name='s1', disk_path='/tmp/s1.qcow2', backing_path='/tmp/base.qcow2',
+            status='merging'
+        )
+        second = VirtualMachineSnapshot.objects.create(
+            vm=self.vm, name='s2', disk_path='/tmp/s2.qcow2', backing_path='/tmp/s1.qcow2'
+        )
+        mock_libvirt.merge_snapshot.return_value = True
+        
+        result = vm_service.merge_snapshot(str(first.id))
+        
+        self.assertTrue(result['success'])
+        self.assertFalse(VirtualMachineSnapshot.objects.filter(id=first.id).exists())
+        second.refresh_from_db()
+        self.assertEqual(second.backing_path, '/tmp/base.qcow2')
+        mock_libvirt.merge_snapshot.assert_called_once_with(
+            self.vm.name,
+            disk_path='/tmp/s1.qcow2',
+            backing_path='/tmp/base.qcow2',
+            child_path='/tmp/s2.qcow2',
+        )
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_hibernate_vm_success(self, mock_libvirt):
+        """测试休眠虚拟机"""
+        self.vm.status = 'running'
+        self.vm.save()
+        
+        mock_libvirt.managed_save_vm.return_value = True
+        
+        result = vm_service.hibernate_vm(str(self.vm.id))
+        
+        self.assertTrue(result['success'])
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.status, 'saved')
+        self.assertTrue(self.vm.can_start)
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_resize_vm_live(self, mock_libvirt):
+        """测试运行中虚拟机在线调整CPU与内存"""
+        Quota.objects.create(user=self.student, cpu_cores=8, memory_mb=8192, disk_gb=100, vm_limit=5)
+        self.vm.status = 'running'
+        self.vm.save()
+        
+        mock_libvirt.resize_vm.return_value = {'vcpus_live': True, 'memory_live': True}
+        
+        result = vm_service.resize_vm(str(self.vm.id), 4, 4096)
+        
+        self.assertTrue(result['success'])
+        self.assertFalse(result['restart_required'])
+        mock_libvirt.resize_vm.assert_called_once_with(self.vm.name, 4, 4096)
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.cpu_cores, 4)
+        self.assertEqual(self.vm.memory_mb, 4096)
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_resize_vm_quota_exceeded(self, mock_libvirt):
+        """测试调整配置超出配额"""
+        Quota.objects.create(user=self.student, cpu_cores=4, memory_mb=4096, disk_gb=100, vm_limit=5)
+        
+        result = vm_service.resize_vm(str(self.vm.id), 6, 2048)
+        
+        self.assertFalse(result['success'])
+        mock_libvirt.resize_vm.assert_not_called()
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.cpu_cores, 2)
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_resize_disk_online(self, mock_libvirt):
+        """测试在线扩容磁盘并刷新实际占用"""
+        Quota.objects.create(user=self.student, cpu_cores=8, memory_mb=8192, disk_gb=100, vm_limit=5)
+        self.vm.status = 'running'
+        self.vm.save()
+        
+        mock_libvirt.get_disk_usage.return_value = {
+            'capacity': 40 * 1024 ** 3, 'allocation': 3 * 1024 ** 3, 'physical': 3 * 1024 ** 3
+        }
+        
+        result = vm_service.resize_vm(str(self.vm.id), 2, 2048, disk_gb=40)
+        
+        self.assertTrue(result['success'])
+        mock_libvirt.resize_disk.assert_called_once_with(self.vm.name, 40)
+        mock_libvirt.resize_vm.assert_not_called()
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.disk_gb, 40)
+        
+        usage = QuotaLedger(self.student).usage()
+        self.assertEqual(usage['disk_gb'], 40)
+        self.assertEqual(usage['disk_allocated_bytes'], 3 * 1024 ** 3)
+    
+    @patch('apps.vms.services.libvirt_manager')
+    def test_resize_disk_shrink_rejected(self, mock_libvirt):
+        """测试磁盘不允许缩容"""
+        result = vm_service.resize_vm(str(self.vm.id), 2, 2048, disk_gb=10)
+        
+        self.assertFalse(result['success'])
+        mock_libvirt.resize_disk.assert_not_called()
+    
+    @patch('apps.courses.store.get_store_dir', return_value='/templates')
+    @patch('apps.vms.services.template_store.ingest_file')
+    @patch('apps.vms.services.libvirt_manager')
+    def test_run_template_conversion_running_vm(self, mock_libvirt, mock_ingest, mock_store_dir):
+        """测试运行中虚拟机通过临时快照导出时间点副本"""
+        self.vm.status = 'running'
+        self.vm.save()
+        job = TemplateConversionJob.objects.create(
+            vm=self.vm, requested_by=self.teacher, name='tpl', course=self.course
+        )
+        
+        mock_libvirt.get_disk_path.return_value = '/pool/test-vm.qcow2'
+        mock_libvirt.get_vm_status.return_value = {'is_active': True}
+        mock_libvirt.create_snapshot.return_value = {
+            'disk_path': '/pool/test-vm-convert.qcow2', 'backing_path': '/pool/test-vm.qcow2'
+        }
+        mock_libvirt.merge_snapshot.return_value = True
+        mock_ingest.return_value = TemplateBlob.objects.create(
+            sha256='a' * 64, file_path=f"/templates/sha256-{'a' * 64}.qcow2", size=1024
+        )
+        
+        result = vm_service.run_template_conversion(str(job.id))
+        
+        self.assertTrue(result['success'])
+        src, dest = mock_libvirt.convert_disk.call_args[0]
+        self.assertEqual(src, '/pool/test-vm.qcow2')
+        self.assertTrue(dest.startswith('/templates/'))
+        # 转换结果按内容存入模板存储
+        mock_ingest.assert_called_once_with(dest)
+        mock_libvirt.merge_snapshot.assert_called_once_with(
+            self.vm.name, '/pool/test-vm-convert.qcow2', '/pool/test-vm.qcow2'
+        )
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual(job.template.file_path, mock_ingest.return_value.file_path)
+        self.assertEqual(job.template.sha256, 'a' * 64)
+        
+        # 转换结束后可以再创建快照
+        self.assertFalse(vm_service._conversion_in_progress(self.vm))
+    
+    @patch('apps.courses.store.get_store_dir', return_value='/templates')
+    @patch('apps.vms.services.flatten_template_async')
+    @patch('apps.vms.services.check_template')
+    @patch('apps.vms.services.template_store.ingest_file')
+    @patch('apps.vms.services.libvirt_manager')
+    def test_publish_version_exports_delta(self, mock_libvirt, mock_ingest, mock_check,
+                                           mock_flatten, mock_store_dir):
+        """测试从虚拟机差异发布模板新版本，后备链过深时触发合并"""
+        mock_libvirt.get_disk_path.return_value = '/pool/test-vm.qcow2'
+        mock_libvirt.get_vm_status.return_value = {'is_active': False}
+
+        for depth, digest in ((1, 'b'), (2, 'c')):
+            mock_ingest.return_value = TemplateBlob.objects.create(
+                sha256=digest * 64, file_path=f"/templates/sha256-{digest * 64}.qcow2", size=4096
+            )
+            job = TemplateConversionJob.objects.create(
+                vm=self.vm, requested_by=self.teacher, name=self.template.name,
+                course=self.course, target_template=self.template
+            )
+            with self.settings(TEMPLATE_MAX_CHAIN_DEPTH=1):
+                result = vm_service.run_template_conversion(str(job.id))
+            self.assertTrue(result['success'])
+            self.assertEqual(result['version'], depth + 1)
+
+        # 每次只导出虚拟机相对其后备版本的差异，新版本叠加在该版本之上
+        top, base, dest = mock_libvirt.export_delta.call_args[0]
+        self.assertEqual(top, '/pool/test-vm.qcow2')
+        self.assertEqual(base, '/var/lib/libvirt/images/ubuntu20.04.qcow2')
+        mock_libvirt.convert_disk.assert_not_called()
+
+        self.template.refresh_from_db()
+        self.assertEqual(self.template.sha256, 'c' * 64)
+        latest = self.template.versions.first()
+        self.assertEqual(latest.version, 3)
+        self.assertEqual(latest.parent.version, 1)
+        self.assertEqual(latest.depth, 1)
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.template_version.version, 1)
+        mock_flatten.assert_not_called()
+
+        # 基于最新版本创建的虚拟机再发布时链深度超过上限
+        vm2 = VirtualMachine.objects.create(
+            name='test-vm-2', owner=self.student, course=self.course, template=self.template,
+            template_version=latest, cpu_cores=1, memory_mb=1024, disk_gb=20
+        )
+        mock_ingest.return_value = TemplateBlob.objects.create(
+            sha256='d' * 64, file_path=f"/templates/sha256-{'d' * 64}.qcow2", size=4096
+        )
+        job = TemplateConversionJob.objects.create(
+            vm=vm2, requested_by=self.teacher, name=self.template.name,
+            course=self.course, target_template=self.template
+        )
+        with self.settings(TEMPLATE_MAX_CHAIN_DEPTH=1):
+            vm_service.run_template_conversion(str(job.id))
+        self.assertEqual(self.template.versions.first().depth, 2)
+        mock_flatten.assert_called_once()
+
     def test_vm_not_found(self):
         """测试虚拟机不存在"""
         fake_id = str(uuid.uuid4())
@@ -422,6 +751,28 @@ class VirtualMachineAPITest(APITestCase):
             if isinstance(vm_data, dict):
                 self.assertEqual(vm_data['owner'], self.student.id)
     
+    def test_vm_list_queue_positions(self):
+        """测试列表中的排队位置按宿主机只排序一次队列"""
+        tickets = []
+        for i in range(3):
+            vm = VirtualMachine.objects.create(
+                name=f'queued-vm-{i}', owner=self.student, template=self.template,
+                cpu_cores=1, memory_mb=1024, disk_gb=10, status='stopped'
+            )
+            tickets.append(AdmissionTicket.objects.create(vm=vm, operation='start', host='qemu:///system'))
+        self.client.force_authenticate(user=self.student)
+
+        with patch.object(admission, 'ordered_queue', wraps=admission.ordered_queue) as ordered_queue:
+            response = self.client.get(reverse('vms:vm-list'))
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(ordered_queue.call_count, 1)
+        positions = {
+            vm_data['admission']['id']: vm_data['admission']['position']
+            for vm_data in response.data['results'] if vm_data['admission']
+        }
+        self.assertEqual(positions, {str(ticket.id): i + 1 for i, ticket in enumerate(tickets)})
+
     def test_vm_list_as_teacher(self):
         """测试教师获取虚拟机列表"""
         self.client.force_authenticate(user=self.teacher)
@@ -478,6 +829,34 @@ class VirtualMachineAPITest(APITestCase):
         # 验证异步创建任务被调用
         mock_create.assert_called_once()
     
+    @patch('apps.vms.services.vm_service.create_vm_async')
+    def test_create_vm_uses_template_inspection(self, mock_create):
+        """测试创建虚拟机时拒绝不可用模板，磁盘不小于模板虚拟大小"""
+        self.client.force_authenticate(user=self.student)
+        url = reverse('vms:vm-list')
+        data = {
+            'name': 'sized-vm',
+            'template_id': self.template.id,
+            'cpu_cores': 1,
+            'memory_mb': 1024,
+            'disk_gb': 10,
+            'course_id': self.course.id
+        }
+        
+        self.template.validation_status = 'invalid'
+        self.template.validation_error = '文件不是qcow2格式'
+        self.template.save()
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        mock_create.assert_not_called()
+        
+        self.template.validation_status = 'valid'
+        self.template.virtual_size = 40 * 1024 ** 3
+        self.template.save()
+        response = self.client.post(url, data, format='json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(VirtualMachine.objects.get(name='sized-vm').disk_gb, 40)
+    
     def test_create_vm_without_template(self):
         """测试创建虚拟机时缺少模板"""
         self.client.force_authenticate(user=self.student)
@@ -606,6 +985,135 @@ class VirtualMachineAPITest(APITestCase):
         
         mock_delete.assert_called_once_with(str(self.vm.id), remove_disk=True)
     
+    @patch('apps.vms.services.vm_service.start_vm')
+    def test_start_vm_queued(self, mock_start):
+        """测试开机请求排队时返回202与排队位置"""
+        mock_start.return_value = {
+            'success': True, 'vm_id': str(self.vm.id), 'queued': True,
+            'ticket_id': str(uuid.uuid4()), 'position': 3
+        }
+        self.client.force_authenticate(user=self.student)
+
+        response = self.client.post(reverse('vms:vm-start', kwargs={'pk': self.vm.id}))
+
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(response.data['position'], 3)
+
+    @patch('apps.vms.services.vm_service.reset_vm')
+    def test_reset_vm(self, mock_reset):
+        """测试重置虚拟机"""
+        mock_reset.return_value = {'success': True, 'vm_id': str(self.vm.id)}
+        
+        self.client.force_authenticate(user=self.student)
+        
+        url = reverse('vms:vm-reset', kwargs={'pk': self.vm.id})
+        response = self.client.post(url)
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('message', response.data)
+        
+        mock_reset.assert_called_once_with(str(self.vm.id))
+    
+    @patch('apps.vms.services.vm_service.resize_vm')
+    def test_update_vm_resources(self, mock_resize):
+        """测试修改虚拟机CPU与内存"""
+        mock_resize.return_value = {'success': True, 'vm_id': str(self.vm.id), 'restart_required': False}
+        
+        self.client.force_authenticate(user=self.student)
+        
+        url = reverse('vms:vm-detail', kwargs={'pk': self.vm.id})
+        response = self.client.patch(url, {'cpu_cores': 4, 'memory_mb': 4096})
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['restart_required'])
+        mock_resize.assert_called_once_with(str(self.vm.id), 4, 4096, self.vm.disk_gb)
+    
+    @patch('apps.vms.services.threading.Thread')
+    def test_convert_to_template(self, mock_thread):
+        """测试教师将虚拟机转换为模板（后台任务）"""
+        self.client.force_authenticate(user=self.teacher)
+        
+        url = reverse('vms:vm-convert-to-template', kwargs={'pk': self.vm.id})
+        response = self.client.post(url, {'name': 'tpl'})
+        
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = TemplateConversionJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.status, 'pending')
+        mock_thread.return_value.start.assert_called_once()
+        
+        # 发起者可以查询任务进度
+        response = self.client.get(response.data['progress_url'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['name'], 'tpl')
+    
+    @patch('apps.vms.services.threading.Thread')
+    def test_publish_version(self, mock_thread):
+        """测试教师发布模板新版本，学生无权发布"""
+        url = reverse('vms:vm-publish-version', kwargs={'pk': self.vm.id})
+
+        self.client.force_authenticate(user=self.student)
+        response = self.client.post(url, {'description': 'v2'})
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+
+        self.client.force_authenticate(user=self.teacher)
+        response = self.client.post(url, {'description': 'v2'})
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        job = TemplateConversionJob.objects.get(id=response.data['job_id'])
+        self.assertEqual(job.target_template, self.template)
+        mock_thread.return_value.start.assert_called_once()
+
+    @patch('apps.vms.services.libvirt_manager')
+    def test_export_disk(self, mock_libvirt):
+        """测试导出已停止虚拟机的磁盘由nginx发送"""
+        with tempfile.NamedTemporaryFile(suffix='.qcow2') as disk:
+            mock_libvirt.get_disk_path.return_value = disk.name
+            self.client.force_authenticate(user=self.student)
+            url = reverse('vms:vm-export-disk', kwargs={'pk': self.vm.id})
+
+            with self.settings(NGINX_ACCEL_REDIRECT=True,
+                               NGINX_ACCEL_LOCATIONS={os.path.dirname(disk.name): '/protected/images/'}):
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['X-Accel-Redirect'],
+                             '/protected/images/' + os.path.basename(disk.name))
+            self.assertEqual(response['X-Backing-Template'], str(self.template.id))
+
+            # 运行中的虚拟机不能导出
+            self.vm.status = 'running'
+            self.vm.save()
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+    
+    def test_list_snapshots(self):
+        """测试获取快照列表"""
+        VirtualMachineSnapshot.objects.create(
+            vm=self.vm, name='s1', disk_path='/tmp/s1.qcow2', backing_path='/tmp/base.qcow2'
+        )
+        
+        self.client.force_authenticate(user=self.student)
+        
+        url = reverse('vms:vm-snapshots', kwargs={'pk': self.vm.id})
+        response = self.client.get(url)
+        
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data), 1)
+        self.assertEqual(response.data[0]['name'], 's1')
+        self.assertNotIn('disk_path', response.data[0])
+    
+    @patch('apps.vms.services.vm_service.delete_snapshot')
+    def test_delete_snapshot(self, mock_delete):
+        """测试删除快照返回202"""
+        mock_delete.return_value = {'success': True, 'vm_id': str(self.vm.id)}
+        snapshot_id = str(uuid.uuid4())
+        
+        self.client.force_authenticate(user=self.student)
+        
+        url = reverse('vms:vm-delete-snapshot', kwargs={'pk': self.vm.id, 'snapshot_id': snapshot_id})
+        response = self.client.delete(url)
+        
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        mock_delete.assert_called_once_with(str(self.vm.id), snapshot_id)
+    
     @patch('apps.vms.libvirt_manager.libvirt_manager.get_vm_status')
     def test_vm_status(self, mock_status):
         """测试获取虚拟机状态"""
@@ -724,6 +1232,648 @@ class VirtualMachineAPITest(APITestCase):
         self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
 
 
+class IdleReaperTest(TestCase):
+    """空闲虚拟机回收测试"""
+    
+    def setUp(self):
+        """设置测试数据"""
+        self.student = User.objects.create_user(username='student1', password='test123')
+        self.teacher = User.objects.create_user(username='teacher1', password='test123')
+        self.course = Course.objects.create(
+            name='测试课程', idle_policy='managed_save', idle_timeout_minutes=30
+        )
+        self.vm = VirtualMachine.objects.create(
+            name='idle-vm',
+            owner=self.student,
+            course=self.course,
+            cpu_cores=1,
+            memory_mb=1024,
+            disk_gb=10,
+            status='running'
+        )
+        self.sampler = MagicMock()
+        self.sampler.is_active.return_value = False
+        self.reaper = IdleReaper(sampler=self.sampler)
+    
+    @patch('apps.vms.services.vm_service.hibernate_vm')
+    def test_idle_vm_is_hibernated(self, mock_hibernate):
+        """测试超时空闲的虚拟机按课程策略休眠"""
+        mock_hibernate.return_value = {'success': True}
+        self.sampler.sample.return_value = {'cpu_percent': 0.1, 'net_rate': 0, 'console': False}
+        self.vm.last_activity_at = timezone.now() - timedelta(minutes=45)
+        self.vm.save()
+        
+        result = self.reaper.run_once()
+        
+        self.assertEqual(result['reclaimed'], 1)
+        mock_hibernate.assert_called_once_with(str(self.vm.id))
+    
+    @patch('apps.vms.services.vm_service.hibernate_vm')
+    def test_active_vm_is_kept(self, mock_hibernate):
+        """测试活跃虚拟机刷新活动时间且不被回收"""
+        self.sampler.is_active.return_value = True
+        self.sampler.sample.return_value = {'cpu_percent': 80, 'net_rate': 0, 'console': False}
+        self.vm.last_activity_at = timezone.now() - timedelta(minutes=45)
+        self.vm.save()
+        
+        result = self.reaper.run_once()
+        
+        self.assertEqual(result['reclaimed'], 0)
+        mock_hibernate.assert_not_called()
+        self.vm.refresh_from_db()
+        self.assertEqual(self.vm.cpu_usage_percent, 80)
+    
+    @patch('apps.vms.services.vm_service.hibernate_vm')
+    def test_policy_none_is_ignored(self, mock_hibernate):
+        """测试未启用空闲策略的课程不回收"""
+        self.course.idle_policy = 'none'
+        self.course.save()
+        self.sampler.sample.return_value = None
+        self.vm.last_activity_at = timezone.now() - timedelta(days=2)
+        self.vm.save()
+        
+        self.reaper.run_once()
+        
+        mock_hibernate.assert_not_called()
+
+
+@patch('apps.vms.cputune.capacity.host_info', return_value={'cpus': 4})
+@patch('apps.vms.services.libvirt_manager')
+class CpuThrottlerTest(TestCase):
+    """CPU调度策略与限流测试"""
+
+    def setUp(self):
+        """设置测试数据：4核宿主机上两台满负载的2核虚拟机"""
+        self.course = Course.objects.create(name='测试课程', cpu_policy='limited')
+        self.student = User.objects.create_user(username='student1', password='test123')
+        self.teacher = User.objects.create_user(
+            username='teacher1', password='test123', role=Role.objects.get_or_create(name='teacher')[0]
+        )
+        self.vms = [
+            VirtualMachine.objects.create(
+                name=f'busy-vm-{i}', owner=owner, course=self.course, cpu_cores=2,
+                memory_mb=1024, disk_gb=10, status='running', cpu_usage_percent=95
+            )
+            for i, owner in enumerate((self.student, self.teacher))
+        ]
+        self.throttler = CpuThrottler()
+
+    def test_resolve_policy(self, mock_manager, mock_host_info):
+        """测试课程策略之上叠加角色策略"""
+        self.assertEqual(resolve_cpu_policy(self.vms[0]), {'shares': 512, 'period': 100000, 'quota': 50000})
+        self.assertEqual(resolve_cpu_policy(self.vms[1]), {'shares': 2048, 'period': 100000, 'quota': 50000})
+
+    def test_throttle_sustained_vm_when_contended(self, mock_manager, mock_host_info):
+        """测试宿主机紧张且持续高负载时限流，到期后恢复策略配额"""
+        now = timezone.now()
+        self.assertEqual(self.throttler.run_once(now)['throttled'], 0)
+        result = self.throttler.run_once(now + timedelta(seconds=301))
+        self.assertEqual(result['throttled'], 2)
+        mock_manager.set_cpu_tune.assert_any_call('busy-vm-0', period=100000, quota=50000, persistent=False)
+
+        mock_manager.reset_mock()
+        result = self.throttler.run_once(now + timedelta(seconds=1000))
+        self.assertEqual(result['released'], 2)
+        mock_manager.set_cpu_tune.assert_any_call('busy-vm-1', period=100000, quota=50000, persistent=False)
+        self.vms[0].refresh_from_db()
+        self.assertIsNone(self.vms[0].cpu_throttled_until)
+
+    def test_no_throttle_without_contention(self, mock_manager, mock_host_info):
+        """测试宿主机CPU充足时不限流"""
+        mock_host_info.return_value = {'cpus': 16}
+        now = timezone.now()
+        self.throttler.run_once(now)
+        self.assertEqual(self.throttler.run_once(now + timedelta(seconds=301))['throttled'], 0)
+        mock_manager.set_cpu_tune.assert_not_called()
+
+
+@patch('apps.vms.admission.AdmissionScheduler._ensure_dispatcher')
+@patch('apps.vms.admission.libvirt_manager')
+@patch('apps.vms.services.libvirt_manager')
+class AdmissionSchedulerTest(TestCase):
+    """开机准入调度测试"""
+
+    def setUp(self):
+        """设置测试数据"""
+        self.student = User.objects.create_user(username='student1', password='test123')
+        self.vms = [
+            VirtualMachine.objects.create(
+                name=f'boot-vm-{i}', owner=self.student, cpu_cores=1,
+                memory_mb=1024, disk_gb=10, status='stopped'
+            )
+            for i in range(3)
+        ]
+        # 宿主机容量充足，只测试开机名额
+        host_info = patch('apps.vms.capacity.HostCapacity.host_info', return_value={
+            'cpus': 64, 'memory_mb': 262144, 'free_mb': 262144, 'available_mb': 262144,
+            'disk_capacity_gb': 10000, 'disk_available_gb': 10000,
+        })
+        host_info.start()
+        self.addCleanup(host_info.stop)
+
+    def test_concurrency_cap_and_boot_backpressure(self, mock_libvirt, mock_admission_libvirt, mock_dispatcher):
+        """测试超过并发上限的启动请求排队，开机完成后按顺序放行"""
+        mock_libvirt.start_vm.return_value = True
+        mock_admission_libvirt.uri = 'qemu:///system'
+        mock_libvirt.boot_completed.return_value = False
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=2, ADMISSION_BOOTS_PER_MINUTE=0):
+            results = [vm_service.start_vm(str(vm.id)) for vm in self.vms]
+            self.assertNotIn('queued', results[0])
+            self.assertNotIn('queued', results[1])
+            self.assertTrue(results[2]['queued'])
+            self.assertEqual(results[2]['position'], 1)
+            self.assertEqual(mock_libvirt.start_vm.call_count, 2)
+            mock_dispatcher.assert_called_once()
+
+            # 开机未完成时不放行
+            self.assertEqual(admission.admit(), [])
+
+            mock_libvirt.boot_completed.side_effect = lambda name: name == 'boot-vm-0'
+            admitted = admission.admit()
+            self.assertEqual([t.vm_id for t in admitted], [self.vms[2].id])
+            admission.run(admitted[0])
+
+        first = self.vms[0].admission_tickets.get()
+        self.assertEqual(first.status, 'done')
+        self.assertIsNotNone(first.boot_seconds)
+        self.assertEqual(self.vms[2].admission.status, 'booting')
+        self.vms[2].refresh_from_db()
+        self.assertEqual(self.vms[2].status, 'running')
+
+    def test_rate_limit_per_host(self, mock_libvirt, mock_admission_libvirt, mock_dispatcher):
+        """测试每分钟开机次数限制"""
+        mock_libvirt.start_vm.return_value = True
+        mock_admission_libvirt.uri = 'qemu:///system'
+        mock_libvirt.boot_completed.return_value = True
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=0, ADMISSION_BOOTS_PER_MINUTE=1):
+            self.assertNotIn('queued', vm_service.start_vm(str(self.vms[0].id)))
+            self.assertTrue(vm_service.start_vm(str(self.vms[1].id))['queued'])
+            # 再次请求返回原有排队记录
+            self.assertEqual(vm_service.start_vm(str(self.vms[1].id))['position'], 1)
+            self.assertEqual(self.vms[1].admission_tickets.count(), 1)
+
+            self.assertEqual(admission.admit(timezone.now() + timedelta(seconds=61))[0].vm_id, self.vms[1].id)
+
+
+    def test_fair_share_across_courses_and_priority(self, mock_libvirt, mock_admission_libvirt, mock_dispatcher):
+        """测试交互请求优先，批量请求按课程公平交替放行"""
+        mock_admission_libvirt.uri = 'qemu:///system'
+        teacher = User.objects.create_user(username='teacher1', password='test123')
+        other = User.objects.create_user(username='student2', password='test123')
+        bulk_course = Course.objects.create(name='批量课程')
+        small_course = Course.objects.create(name='小课程')
+
+        def enqueue(owner, course, priority, count=1):
+            tickets = []
+            for i in range(count):
+                vm = VirtualMachine.objects.create(
+                    name=f'{owner.username}-{priority}-{i}', owner=owner, course=course,
+                    cpu_cores=1, memory_mb=1024, disk_gb=10, status='stopped'
+                )
+                tickets.append(AdmissionTicket.objects.create(
+                    vm=vm, operation='start', priority=priority, host='qemu:///system'
+                ))
+            return tickets
+
+        bulk = enqueue(teacher, bulk_course, 'batch', 4)
+        small_batch = enqueue(other, small_course, 'batch')[0]
+        single = enqueue(self.student, small_course, 'interactive')[0]
+
+        order = [t.id for t in admission.ordered_queue()]
+        self.assertEqual(order, [single.id, bulk[0].id, bulk[1].id, small_batch.id, bulk[2].id, bulk[3].id])
+        self.assertEqual(AdmissionTicket.objects.get(id=single.id).position, 1)
+
+        # 提高批量课程权重后其请求占更大份额
+        bulk_course.admission_weight = 3
+        bulk_course.save()
+        order = [t.id for t in admission.ordered_queue()]
+        self.assertEqual(order[1:4], [t.id for t in bulk[:3]])
+
+        metrics = {t['username']: t for t in admission.tenant_metrics()}
+        self.assertEqual(metrics['teacher1']['queued'], 4)
+        self.assertEqual(metrics['teacher1']['batch'], 4)
+        self.assertEqual(metrics['student1']['interactive'], 1)
+        self.assertEqual(metrics['student1']['course_name'], '小课程')
+
+
+
+@patch('apps.vms.admission.AdmissionScheduler._ensure_dispatcher')
+@patch('apps.vms.capacity.libvirt_manager')
+@patch('apps.vms.admission.libvirt_manager')
+@patch('apps.vms.services.libvirt_manager')
+class HostCapacityTest(TestCase):
+    """宿主机容量账本测试"""
+
+    def setUp(self):
+        """设置测试数据：4核 / 10GB内存 / 100GB磁盘的宿主机"""
+        self.student = User.objects.create_user(username='student1', password='test123')
+        Quota.objects.create(user=self.student, cpu_cores=32, memory_mb=65536, disk_gb=1000, vm_limit=10)
+        self.vms = [
+            VirtualMachine.objects.create(
+                name=f'cap-vm-{i}', owner=self.student, cpu_cores=2,
+                memory_mb=3072, disk_gb=20, status='stopped'
+            )
+            for i in range(4)
+        ]
+        self.host_info = {
+            'cpus': 4, 'memory_mb': 10240, 'free_mb': 8192, 'available_mb': 9216,
+            'disk_capacity_gb': 100, 'disk_available_gb': 90,
+        }
+
+    def _setup(self, mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt):
+        mock_libvirt.start_vm.return_value = True
+        mock_libvirt.stop_vm.return_value = True
+        mock_admission_libvirt.uri = mock_capacity_libvirt.uri = 'qemu:///system'
+        mock_capacity_libvirt.get_host_capacity.return_value = self.host_info
+
+    def test_start_rejected_when_memory_exhausted(self, mock_libvirt, mock_admission_libvirt,
+                                                  mock_capacity_libvirt, mock_dispatcher):
+        """测试内存预留用尽后拒绝启动，关机释放后可再次启动"""
+        self._setup(mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt)
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=0, ADMISSION_BOOTS_PER_MINUTE=0,
+                           HOST_MEMORY_OVERCOMMIT=1.0, HOST_RESERVED_MEMORY_MB=2048,
+                           HOST_CAPACITY_EXCEEDED_ACTION='reject'):
+            self.assertTrue(vm_service.start_vm(str(self.vms[0].id))['success'])
+            self.assertTrue(vm_service.start_vm(str(self.vms[1].id))['success'])
+            # (10240 - 2048) MB 只能容纳两台 3072MB 的虚拟机
+            result = vm_service.start_vm(str(self.vms[2].id))
+            self.assertFalse(result['success'])
+            self.assertIn('内存容量不足', result['error'])
+            self.assertEqual(mock_libvirt.start_vm.call_count, 2)
+
+            self.assertTrue(vm_service.stop_vm(str(self.vms[0].id))['success'])
+            self.assertTrue(vm_service.start_vm(str(self.vms[2].id))['success'])
+
+    def test_unreadable_host_capacity_fails_closed(self, mock_libvirt, mock_admission_libvirt,
+                                                   mock_capacity_libvirt, mock_dispatcher):
+        """测试无法读取宿主机容量时，宿主机上有运行中的虚拟机则拒绝预留"""
+        self._setup(mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt)
+        mock_capacity_libvirt.get_host_capacity.return_value = None
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=0, ADMISSION_BOOTS_PER_MINUTE=0,
+                           HOST_CAPACITY_EXCEEDED_ACTION='reject'):
+            # 空宿主机不限制
+            self.assertTrue(vm_service.start_vm(str(self.vms[0].id))['success'])
+            result = vm_service.start_vm(str(self.vms[1].id))
+            self.assertFalse(result['success'])
+            self.assertIn('无法获取宿主机', result['error'])
+            self.assertEqual(mock_libvirt.start_vm.call_count, 1)
+
+    def test_idle_vm_preempted_to_admit_start(self, mock_libvirt, mock_admission_libvirt,
+                                              mock_capacity_libvirt, mock_dispatcher):
+        """测试容量不足时休眠低优先级的空闲虚拟机后放行，被抢占的虚拟机下次启动时恢复"""
+        self._setup(mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt)
+        # 休眠在锁外的后台线程中执行，测试中同步执行
+        preempt = patch.object(admission, '_preempt_in_thread', side_effect=admission._preempt)
+        preempt.start()
+        self.addCleanup(preempt.stop)
+        mock_libvirt.managed_save_vm.return_value = True
+        course = Course.objects.create(name='高优先级课程', preemption_priority=5)
+        for vm in self.vms[1:3]:
+            vm.course = course
+            vm.save()
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=0, ADMISSION_BOOTS_PER_MINUTE=0,
+                           HOST_MEMORY_OVERCOMMIT=1.0, HOST_RESERVED_MEMORY_MB=2048,
+                           HOST_CAPACITY_EXCEEDED_ACTION='reject',
+                           PREEMPTION_IDLE_MINUTES=60, PREEMPTION_MAX_VMS=4):
+            vm_service.start_vm(str(self.vms[0].id))
+            vm_service.start_vm(str(self.vms[1].id))
+            now = timezone.now()
+            VirtualMachine.objects.filter(id=self.vms[0].id).update(last_activity_at=now - timedelta(hours=2))
+            VirtualMachine.objects.filter(id=self.vms[1].id).update(last_activity_at=now - timedelta(hours=3))
+
+            # 空闲更久但课程优先级更高的 cap-vm-1 不先被抢占；休眠期间请求保持排队
+            self.assertTrue(vm_service.start_vm(str(self.vms[2].id))['queued'])
+            mock_libvirt.managed_save_vm.assert_called_once_with('cap-vm-0')
+            mock_dispatcher.assert_called()
+            tickets = admission.admit()
+            self.assertEqual([t.vm_id for t in tickets], [self.vms[2].id])
+            self.assertTrue(admission.run(tickets[0])['success'])
+            self.assertEqual(VirtualMachine.objects.get(id=self.vms[0].id).status, 'saved')
+            preemption = Preemption.objects.get()
+            self.assertEqual(preemption.vm_id, self.vms[0].id)
+            self.assertEqual(preemption.preempted_for_id, self.vms[2].id)
+            self.assertEqual(preemption.memory_mb, 3072)
+            self.assertGreaterEqual(preemption.idle_seconds, 7200)
+            self.assertIsNone(preemption.resumed_at)
+
+            # 被抢占的虚拟机再次启动时从休眠中恢复
+            vm_service.stop_vm(str(self.vms[2].id))
+            self.assertTrue(vm_service.start_vm(str(self.vms[0].id))['success'])
+            mock_libvirt.start_vm.assert_called_with('cap-vm-0')
+            preemption.refresh_from_db()
+            self.assertIsNotNone(preemption.resumed_at)
+
+            # 优先级为0的虚拟机不能抢占高优先级课程的虚拟机
+            result = vm_service.start_vm(str(self.vms[3].id))
+            self.assertFalse(result['success'])
+            self.assertIn('内存容量不足', result['error'])
+            self.assertEqual(Preemption.objects.count(), 1)
+
+    def test_failed_preemption_not_retried(self, mock_libvirt, mock_admission_libvirt,
+                                           mock_capacity_libvirt, mock_dispatcher):
+        """测试部分休眠失败时保留已腾出的容量，腾出的容量不够时按原策略拒绝且不再抢占"""
+        self._setup(mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt)
+        mock_libvirt.managed_save_vm.side_effect = lambda name: name != 'cap-vm-0'
+        preempt = patch.object(admission, '_preempt_in_thread', side_effect=admission._preempt)
+        preempt.start()
+        self.addCleanup(preempt.stop)
+        big = self.vms[3]
+        big.memory_mb = 6144
+        big.save()
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=0, ADMISSION_BOOTS_PER_MINUTE=0,
+                           HOST_MEMORY_OVERCOMMIT=1.0, HOST_RESERVED_MEMORY_MB=2048,
+                           HOST_CAPACITY_EXCEEDED_ACTION='reject',
+                           PREEMPTION_IDLE_MINUTES=60, PREEMPTION_MAX_VMS=4):
+            vm_service.start_vm(str(self.vms[0].id))
+            vm_service.start_vm(str(self.vms[1].id))
+            VirtualMachine.objects.filter(id__in=[self.vms[0].id, self.vms[1].id]).update(
+                last_activity_at=timezone.now() - timedelta(hours=2))
+
+            # 需要休眠两台，cap-vm-0 休眠失败
+            self.assertTrue(vm_service.start_vm(str(big.id))['queued'])
+            self.assertEqual(mock_libvirt.managed_save_vm.call_count, 2)
+            self.assertEqual(VirtualMachine.objects.get(id=self.vms[1].id).status, 'saved')
+            self.assertEqual(list(Preemption.objects.values_list('vm_id', flat=True)), [self.vms[1].id])
+
+            self.assertEqual(admission.admit(), [])
+            self.assertEqual(big.admission_tickets.get().status, 'failed')
+            self.assertEqual(mock_libvirt.managed_save_vm.call_count, 2)
+
+    def test_start_queued_until_capacity_released(self, mock_libvirt, mock_admission_libvirt,
+                                                  mock_capacity_libvirt, mock_dispatcher):
+        """测试容量不足时排队，释放后由调度放行"""
+        self._setup(mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt)
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=0, ADMISSION_BOOTS_PER_MINUTE=0,
+                           HOST_CPU_OVERCOMMIT=1.0, HOST_CAPACITY_EXCEEDED_ACTION='queue'):
+            vm_service.start_vm(str(self.vms[0].id))
+            vm_service.start_vm(str(self.vms[1].id))
+            # 4核全部预留后排队
+            self.assertTrue(vm_service.start_vm(str(self.vms[2].id))['queued'])
+            self.assertEqual(admission.admit(), [])
+
+            vm_service.stop_vm(str(self.vms[1].id))
+            self.assertEqual([t.vm_id for t in admission.admit()], [self.vms[2].id])
+
+    def test_resize_checks_host_capacity(self, mock_libvirt, mock_admission_libvirt,
+                                         mock_capacity_libvirt, mock_dispatcher):
+        """测试在线调整配置与磁盘扩容受宿主机容量限制"""
+        self._setup(mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt)
+        mock_libvirt.resize_vm.return_value = {'vcpus_live': True, 'memory_live': True}
+        vm = self.vms[0]
+        vm.status = 'running'
+        vm.save()
+
+        with self.settings(HOST_MEMORY_OVERCOMMIT=1.0, HOST_DISK_OVERCOMMIT=1.0):
+            self.assertTrue(vm_service.resize_vm(str(vm.id), 2, 8192)['success'])
+            self.assertEqual(vm.capacity_reservation.memory_mb, 8192)
+
+            result = vm_service.resize_vm(str(vm.id), 2, 9216)
+            self.assertFalse(result['success'])
+            self.assertIn('内存容量不足', result['error'])
+
+            # 其余虚拟机共 60GB，磁盘池 100GB
+            result = vm_service.resize_vm(str(vm.id), 2, 8192, disk_gb=50)
+            self.assertFalse(result['success'])
+            self.assertIn('磁盘容量不足', result['error'])
+            mock_libvirt.resize_disk.assert_not_called()
+
+    def test_balloon_shrink_frees_capacity(self, mock_libvirt, mock_admission_libvirt,
+                                           mock_capacity_libvirt, mock_dispatcher):
+        """测试内存紧张时回收空闲虚拟机的内存并释放预留，活动后在容量允许时恢复"""
+        self._setup(mock_libvirt, mock_admission_libvirt, mock_capacity_libvirt)
+        # 来宾使用 512MB
+        mock_libvirt.get_memory_stats.return_value = {
+            'actual': 3072 * 1024, 'available': 3072 * 1024, 'usable': 2560 * 1024,
+        }
+        manager = MemoryManager()
+
+        with self.settings(ADMISSION_MAX_CONCURRENT_BOOTS=0, ADMISSION_BOOTS_PER_MINUTE=0,
+                           HOST_MEMORY_OVERCOMMIT=1.0, HOST_RESERVED_MEMORY_MB=2048,
+                           HOST_CAPACITY_EXCEEDED_ACTION='reject'):
+            vm_service.start_vm(str(self.vms[0].id))
+            vm_service.start_vm(str(self.vms[1].id))
+            self.assertFalse(vm_service.start_vm(str(self.vms[2].id))['success'])
+            VirtualMachine.objects.filter(id__in=[self.vms[0].id, self.vms[1].id]).update(
+                status='running', last_activity_at=timezone.now() - timedelta(hours=1)
+            )
+
+            # 宿主机可用内存充足时不回收
+            self.assertEqual(manager.run_once()['shrunk'], 0)
+            self.host_info['available_mb'] = 1024
+            result = manager.run_once()
+            self.assertEqual((result['shrunk'], result['reclaimed_mb']), (2, 2 * (3072 - 768)))
+            mock_libvirt.set_balloon.assert_any_call('cap-vm-0', 768)
+            self.vms[0].refresh_from_db()
+            self.assertEqual(self.vms[0].memory_current_mb, 768)
+            self.assertEqual(self.vms[0].capacity_reservation.memory_mb, 768)
+            self.assertTrue(vm_service.start_vm(str(self.vms[2].id))['success'])
+
+            # 重新活动后恢复；恢复第二台会超出宿主机容量，保持回收状态
+            VirtualMachine.objects.filter(id__in=[self.vms[0].id, self.vms[1].id]).update(
+                last_activity_at=timezone.now()
+            )
+            full = mock_libvirt.get_memory_stats.return_value
+            shrunk = {'actual': 768 * 1024, 'available': 768 * 1024, 'usable': 256 * 1024}
+            mock_libvirt.get_memory_stats.side_effect = \
+                lambda name: full if name == 'cap-vm-2' else shrunk
+            self.assertEqual(manager.run_once()['grown'], 1)
+            reservations = sorted(
+                (vm.memory_current_mb or 0, vm.capacity_reservation.memory_mb)
+                for vm in VirtualMachine.objects.filter(id__in=[self.vms[0].id, self.vms[1].id])
+            )
+            self.assertEqual(reservations, [(0, 3072), (768, 768)])
+
+
+class PlacementTest(TestCase):
+    """多宿主机放置调度测试，各宿主机使用独立的 test:///default 连接"""
+
+    def setUp(self):
+        """设置测试数据：三台宿主机，空闲内存各不相同"""
+        self.student = User.objects.create_user(username='student1', password='test123')
+        self.course = Course.objects.create(name='测试课程')
+        self.template = VirtualMachineTemplate.objects.create(
+            name='Ubuntu', file_path='/var/lib/libvirt/images/ubuntu.qcow2', owner=self.student,
+            course=self.course
+        )
+        self.hosts = [Host.objects.create(name=f'node{i}', uri='test:///default') for i in range(3)]
+        self.memory = {'node0': 16384, 'node1': 32768, 'node2': 24576}
+        self.managers = {}
+        for host in self.hosts:
+            manager = MagicMock(uri=host.uri)
+            manager.get_host_capacity.return_value = {
+                'cpus': 16, 'memory_mb': self.memory[host.name], 'free_mb': self.memory[host.name],
+                'available_mb': self.memory[host.name], 'disk_capacity_gb': 500, 'disk_available_gb': 500,
+            }
+            self.managers[host.pk] = manager
+        patcher = patch('apps.vms.capacity.get_manager', side_effect=lambda host: self.managers[host.pk])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _vm(self, name, memory_mb=4096, host=None, group=''):
+        return VirtualMachine.objects.create(
+            name=name, owner=self.student, template=self.template, host=host,
+            anti_affinity_group=group, cpu_cores=2, memory_mb=memory_mb, disk_gb=20, status='stopped'
+        )
+
+    def test_get_manager_per_host(self):
+        """测试相同URI的宿主机各有独立连接"""
+        first, second = get_manager(self.hosts[0]), get_manager(self.hosts[1])
+        self.assertIsNot(first, second)
+        self.assertIs(get_manager(self.hosts[0]), first)
+        self.assertEqual(first.uri, 'test:///default')
+
+    def test_place_on_most_free_host(self):
+        """测试优先放到剩余容量最多的宿主机，停用的宿主机不参与"""
+        self.assertEqual(placement.place(self._vm('vm-a')).name, 'node1')
+        self.hosts[1].enabled = False
+        self.hosts[1].save()
+        self.assertEqual(placement.place(self._vm('vm-b')).name, 'node2')
+
+    def test_template_locality_and_anti_affinity(self):
+        """测试已有同一模板的宿主机加分，同一反亲和组的虚拟机分散放置"""
+        self._vm('existing', host=self.hosts[2], memory_mb=1024)
+        self.assertEqual(placement.place(self._vm('vm-a')).name, 'node2')
+
+        self._vm('web-1', host=self.hosts[2], group='web')
+        self._vm('web-2', host=self.hosts[1], group='web')
+        self.assertEqual(placement.place(self._vm('web-3', group='web')).name, 'node0')
+        self._vm('web-4', host=self.hosts[0], group='web')
+        with self.assertRaises(PlacementError):
+            placement.place(self._vm('web-5', group='web'))
+
+    @patch('apps.vms.admission.AdmissionScheduler._ensure_dispatcher')
+    @patch('apps.vms.services.get_manager')
+    def test_create_routes_to_placed_host(self, mock_get_manager, mock_dispatcher):
+        """测试创建时选定宿主机，准入与生命周期调用路由到该宿主机"""
+        mock_get_manager.side_effect = lambda host: self.managers[host.pk]
+        node1 = self.managers[self.hosts[1].pk]
+        node1.create_vm.return_value = {'mac_address': '52:54:00:00:00:01', 'vnc_port': 5901, 'vnc_password': 'x'}
+        node1.stop_vm.return_value = True
+        node1.get_disk_usage.return_value = None
+        vm = self._vm('vm-a')
+
+        with patch('apps.vms.services.threading.Thread') as mock_thread:
+            self.assertTrue(vm_service.create_vm_async(str(vm.id))['success'])
+        vm.refresh_from_db()
+        self.assertEqual(vm.host, self.hosts[1])
+        ticket = vm.admission_tickets.get()
+        self.assertEqual(ticket.host, 'node1')
+        self.assertEqual(vm.capacity_reservation.host, 'node1')
+        mock_thread.assert_called_once()
+
+        admission.run(ticket)
+        node1.create_vm.assert_called_once()
+        self.assertTrue(vm_service.stop_vm(str(vm.id))['success'])
+        node1.stop_vm.assert_called_once_with('vm-a', force=False)
+        self.managers[self.hosts[0].pk].stop_vm.assert_not_called()
+
+    def test_rebalance_plan_minimal_moves(self):
+        """测试再平衡只迁移能消除过载的最小虚拟机，停用的宿主机全部迁出"""
+        hosts = [{'name': 'a', 'cpu': 10, 'memory': 100, 'enabled': True},
+                 {'name': 'b', 'cpu': 10, 'memory': 100, 'enabled': True}]
+        vms = [{'id': f'a{cpu}', 'host': 'a', 'cpu': cpu, 'memory': 10} for cpu in (2, 3, 4)]
+        plan = plan_moves(hosts, vms, 0.85)
+        self.assertEqual(plan['moves'], [{'vm': 'a2', 'from': 'a', 'to': 'b'}])
+        self.assertEqual(plan['before'], {'a': 0.9, 'b': 0.0})
+        self.assertEqual(plan['after'], {'a': 0.7, 'b': 0.2})
+
+        hosts[0]['enabled'] = False
+        plan = plan_moves(hosts, vms, 0.85)
+        self.assertEqual(len(plan['moves']), 2)
+        self.assertEqual(plan['unresolved'], ['a2'])
+
+    def test_rebalance_report_and_apply(self):
+        """测试试运行报告，只迁移已停止的虚拟机并更新所在宿主机"""
+        vms = [self._vm(f'vm-{i}', host=self.hosts[0]) for i in range(3)]
+        small = self._vm('vm-small', memory_mb=2048, host=self.hosts[0])
+        with patch('apps.vms.rebalance.get_manager', side_effect=lambda host: self.managers[host.pk]):
+            report = rebalancer.report()
+            self.assertEqual(len(report['moves']), 1)
+            move = report['moves'][0]
+            self.assertEqual((move['from'], move['to'], move['ready']), ('node0', 'node1', True))
+            self.assertIn(move['name'], [vm.name for vm in vms])
+            self.assertEqual(VirtualMachine.objects.filter(host=self.hosts[0]).count(), 4)
+
+            result = rebalancer.apply(report)
+        self.assertEqual(result['applied'], [move['name']])
+        self.managers[self.hosts[0].pk].migrate_offline.assert_called_once_with(
+            move['name'], self.managers[self.hosts[1].pk])
+        self.assertEqual(VirtualMachine.objects.get(name=move['name']).host, self.hosts[1])
+        small.refresh_from_db()
+        self.assertEqual(small.host, self.hosts[0])
+
+
+class LabSchedulerTest(TestCase):
+    """上机时段调度测试"""
+
+    def setUp(self):
+        """设置测试数据"""
+        self.course = Course.objects.create(name='测试课程')
+        self.vms = []
+        for i in range(5):
+            student = User.objects.create_user(username=f'student{i}', password='test123')
+            self.course.students.add(student)
+            self.vms.append(VirtualMachine.objects.create(
+                name=f'lab-vm-{i}', owner=student, course=self.course,
+                cpu_cores=1, memory_mb=1024, disk_gb=10, status='stopped'
+            ))
+        self.now = timezone.now()
+        self.session = LabSession.objects.create(
+            course=self.course, starts_at=self.now + timedelta(minutes=5),
+            ends_at=self.now + timedelta(minutes=95), prestart_minutes=10, grace_minutes=15
+        )
+        self.scheduler = LabScheduler()
+
+    @patch('apps.vms.lab_scheduler.prewarm_template_async')
+    @patch('apps.vms.lab_scheduler.libvirt_manager')
+    @patch('apps.vms.services.vm_service.start_vm')
+    def test_prestart_in_waves_within_capacity(self, mock_start, mock_libvirt, mock_prewarm):
+        """测试预启动按批次间隔启动，每批不超过批量与宿主机空闲内存"""
+        mock_start.return_value = {'success': True}
+        mock_libvirt.get_host_memory.return_value = {'total_mb': 65536, 'free_mb': 5120}
+
+        with self.settings(LAB_SESSION_WAVE_SIZE=3, LAB_SESSION_WAVE_INTERVAL=60,
+                           LAB_SESSION_HOST_RESERVE_MB=2048):
+            result = self.scheduler.run_once(self.now)
+            # 空闲内存只够3台
+            self.assertEqual(result['started'], 3)
+            VirtualMachine.objects.filter(id__in=[c[0][0] for c in mock_start.call_args_list]) \
+                .update(status='running')
+
+            # 未到批次间隔不启动
+            self.assertEqual(self.scheduler.run_once(self.now + timedelta(seconds=30))['started'], 0)
+
+            mock_libvirt.get_host_memory.return_value = {'total_mb': 65536, 'free_mb': 3072}
+            result = self.scheduler.run_once(self.now + timedelta(seconds=61))
+            self.assertEqual(result['started'], 1)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, 'starting')
+        self.assertEqual(self.session.started_count, 4)
+
+    @patch('apps.vms.services.vm_service.hibernate_vm')
+    def test_finish_after_grace_period(self, mock_hibernate):
+        """测试结束并超过保留时间后休眠学生虚拟机"""
+        mock_hibernate.return_value = {'success': True}
+        VirtualMachine.objects.filter(id__in=[vm.id for vm in self.vms[:2]]).update(status='running')
+        self.session.status = 'running'
+        self.session.save()
+
+        self.assertEqual(self.scheduler.run_once(self.now + timedelta(minutes=100))['stopped'], 0)
+        result = self.scheduler.run_once(self.now + timedelta(minutes=111))
+
+        self.assertEqual(result['stopped'], 2)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.status, 'finished')
+
+
 class LibvirtManagerTest(TestCase):
     """Libvirt管理器测试"""
     
@@ -748,15 +1898,201 @@ class LibvirtManagerTest(TestCase):
             cpu_cores=2,
             disk_path='/path/to/disk.qcow2',
             vnc_port=5900,
-            mac_address='52:54:00:12:34:56'
+            mac_address='52:54:00:12:34:56',
+            vnc_password='secret'
+        )
+        root = ET.fromstring(xml)
+        
+        self.assertEqual(root.findtext('name'), 'test-vm')
+        self.assertEqual(root.find('memory').get('unit'), 'MiB')
+        self.assertEqual(root.findtext('memory'), '2048')
+        self.assertEqual(root.findtext('vcpu'), '2')
+        self.assertEqual(root.find('devices/disk/source').get('file'), '/path/to/disk.qcow2')
+        self.assertEqual(root.find('devices/graphics').get('port'), '5900')
+        self.assertEqual(root.findtext('devices/graphics/passwd'), 'secret')
+        self.assertEqual(root.find('devices/interface/mac').get('address'), '52:54:00:12:34:56')
+        # 默认配置保持原有的最小域定义
+        self.assertIsNone(root.find('cpu'))
+        self.assertEqual(root.find('devices/disk/target').get('bus'), 'virtio')
+        self.assertIsNone(root.find('devices/interface/driver'))
+        self.assertIsNone(root.find('cputune'))
+    
+    def test_generate_vm_xml_with_profile(self):
+        """测试按硬件配置生成虚拟机XML"""
+        profile = resolve_profile('performance')
+        xml = self.manager._generate_vm_xml(
+            name='test-vm',
+            uuid='12345678-1234-1234-1234-123456789abc',
+            memory_mb=2048,
+            cpu_cores=4,
+            disk_path='/path/to/disk.qcow2',
+            vnc_port=5900,
+            mac_address='52:54:00:12:34:56',
+            vnc_password='secret',
+            profile=profile
         )
+        root = ET.fromstring(xml)
+        
+        self.assertEqual(root.find('cpu').get('mode'), 'host-passthrough')
+        driver = root.find('devices/disk/driver')
+        self.assertEqual(driver.get('cache'), 'none')
+        self.assertEqual(driver.get('io'), profile['disk_io'])
+        self.assertEqual(driver.get('discard'), 'unmap')
+        self.assertEqual(root.find('devices/disk/target').get('bus'), 'scsi')
+        self.assertIsNotNone(root.find("devices/controller[@model='virtio-scsi']"))
+        self.assertEqual(root.find('devices/interface/driver').get('queues'), '4')
+        self.assertEqual(root.find('devices/memballoon/stats').get('period'),
+                         str(profile['memballoon_stats_period']))
+    
+    def test_generate_vm_xml_with_cputune(self):
+        """测试CPU调度策略写入 cputune，未设置的项不写入"""
+        xml = self.manager._generate_vm_xml(
+            name='test-vm',
+            uuid='12345678-1234-1234-1234-123456789abc',
+            memory_mb=2048,
+            cpu_cores=2,
+            disk_path='/path/to/disk.qcow2',
+            vnc_port=5900,
+            mac_address='52:54:00:12:34:56',
+            vnc_password='secret',
+            cputune={'shares': 512, 'period': 100000, 'quota': 0}
+        )
+        root = ET.fromstring(xml)
         
-        self.assertIn('<name>test-vm</name>', xml)
-        self.assertIn('<memory unit=\'MiB\'>2048</memory>', xml)
-        self.assertIn('<vcpu>2</vcpu>', xml)
-        self.assertIn('/path/to/disk.qcow2', xml)
-        self.assertIn('port=\'5900\'', xml)
-        self.assertIn('52:54:00:12:34:56', xml)
+        self.assertEqual(root.findtext('cputune/shares'), '512')
+        self.assertEqual(root.findtext('cputune/period'), '100000')
+        self.assertIsNone(root.find('cputune/quota'))
+    
+    @patch('apps.vms.libvirt_manager.libvirt.VIR_DOMAIN_PAUSED', 3, create=True)
+    def test_reset_vm_restores_paused_state(self):
+        """测试重置链接克隆时重建覆盖层，暂停的虚拟机重新启动后再次暂停"""
+        domain = MagicMock()
+        domain.isActive.return_value = 1
+        domain.state.return_value = (3, 0)
+        domain.create.return_value = 0
+        domain.hasManagedSaveImage.return_value = 0
+        self.manager.conn = MagicMock()
+        self.manager.conn.lookupByName.return_value = domain
+        
+        with patch.object(self.manager, '_get_disk_path', return_value='/pool/test-vm.qcow2'), \
+                patch.object(self.manager, '_get_backing_file', return_value='/tpl/base.qcow2'), \
+                patch.object(self.manager, '_create_overlay_disk') as create_overlay, \
+                patch('apps.vms.libvirt_manager.os.remove') as remove:
+            self.assertTrue(self.manager.reset_vm('test-vm', template_path='/tpl/latest.qcow2', disk_gb=20))
+        
+        remove.assert_called_once_with('/pool/test-vm.qcow2')
+        create_overlay.assert_called_once_with('/tpl/base.qcow2', '/pool/test-vm.qcow2', disk_gb=20)
+        domain.destroy.assert_called_once()
+        domain.create.assert_called_once()
+        domain.suspend.assert_called_once()
+    
+    def test_create_vm_defines_io_limits(self):
+        """测试创建虚拟机时I/O限速写入定义的域XML"""
+        conn = MagicMock()
+        conn.lookupByName.return_value = None
+        conn.defineXML.return_value.create.return_value = 0
+        self.manager.conn = conn
+        self.manager.storage = MagicMock()
+        self.manager.storage.create_overlay.return_value = '/var/lib/vmlab/disks/test-vm.qcow2'
+        limits = {'total_iops_sec': 500, 'inbound_average': 1024}
+        
+        with tempfile.NamedTemporaryFile(suffix='.qcow2') as template, \
+                patch.object(self.manager, '_find_available_vnc_port', return_value=5900):
+            info = self.manager.create_vm(
+                name='test-vm', uuid='12345678-1234-1234-1234-123456789abc',
+                memory_mb=2048, cpu_cores=2, template_path=template.name,
+                cputune={'shares': 2048}, io_limits=limits
+            )
+        
+        self.assertEqual(info['disk_path'], '/var/lib/vmlab/disks/test-vm.qcow2')
+        root = ET.fromstring(conn.defineXML.call_args[0][0])
+        self.assertEqual(root.findtext('devices/disk/iotune/total_iops_sec'), '500')
+        self.assertEqual(root.find('devices/interface/bandwidth/inbound').get('average'), '1024')
+        self.assertEqual(root.findtext('cputune/shares'), '2048')
+    
+    @patch('apps.vms.libvirt_manager.libvirt.VIR_DOMAIN_BLOCK_JOB_ABORT_PIVOT', 2, create=True)
+    @patch('apps.vms.libvirt_manager.libvirt.VIR_DOMAIN_BLOCK_COMMIT_ACTIVE', 4, create=True)
+    def test_merge_snapshot_checks_chain(self):
+        """测试在线合并后覆盖层仍在后备链中时保留该层，切换成功后才删除"""
+        disk_xml = """<domain><devices><disk type='file' device='disk'>
+  <source file='{}'/><target dev='vda' bus='virtio'/>{}
+</disk></devices></domain>"""
+        backing = "<backingStore type='file'><source file='/disks/base.qcow2'/></backingStore>"
+        domain = MagicMock()
+        domain.isActive.return_value = True
+        self.manager.conn = MagicMock()
+        self.manager.conn.lookupByName.return_value = domain
+        
+        # 提交作业失败消失，域仍在写覆盖层
+        domain.blockJobInfo.return_value = {}
+        domain.XMLDesc.return_value = disk_xml.format('/disks/vm-snap1.qcow2', backing)
+        with patch.object(self.manager, '_remove_disk_files') as remove:
+            self.assertFalse(self.manager.merge_snapshot(
+                'test-vm', '/disks/vm-snap1.qcow2', '/disks/base.qcow2'))
+        remove.assert_not_called()
+        domain.blockJobAbort.assert_not_called()
+        
+        # 数据同步后切换到base
+        domain.blockJobInfo.side_effect = [{'cur': 10, 'end': 10}, {}]
+        domain.XMLDesc.return_value = disk_xml.format('/disks/base.qcow2', '')
+        with patch.object(self.manager, '_remove_disk_files') as remove:
+            self.assertTrue(self.manager.merge_snapshot(
+                'test-vm', '/disks/vm-snap1.qcow2', '/disks/base.qcow2'))
+        domain.blockJobAbort.assert_called_once_with('vda', 2)
+        remove.assert_called_once_with(['/disks/vm-snap1.qcow2'])
+    
+    def test_wait_block_job_timeout(self):
+        """测试块作业超时后被取消"""
+        domain = MagicMock()
+        domain.blockJobInfo.return_value = {'cur': 1, 'end': 10}
+        self.assertFalse(self.manager._wait_block_job(domain, 'vda', pivot=True, timeout=0))
+        domain.blockJobAbort.assert_called_once_with('vda', 0)
+    
+    @patch('apps.vms.libvirt_manager.libvirt.VIR_DOMAIN_AFFECT_CONFIG', 2, create=True)
+    @patch('apps.vms.libvirt_manager.libvirt.VIR_DOMAIN_AFFECT_LIVE', 1, create=True)
+    def test_io_limits(self):
+        """测试I/O限速写入域定义、从域定义读回，并在线调整"""
+        limits = {'total_bytes_sec': 1048576, 'total_iops_sec': 500,
+                  'inbound_average': 1024, 'outbound_average': 512, 'outbound_burst': 2048}
+        xml = self.manager._generate_vm_xml(
+            name='test-vm',
+            uuid='12345678-1234-1234-1234-123456789abc',
+            memory_mb=2048,
+            cpu_cores=2,
+            disk_path='/path/to/disk.qcow2',
+            vnc_port=5900,
+            mac_address='52:54:00:12:34:56',
+            vnc_password='secret',
+            io_limits=limits
+        )
+        root = ET.fromstring(xml)
+        self.assertEqual(root.findtext('devices/disk/iotune/total_iops_sec'), '500')
+        self.assertIsNone(root.find('devices/disk/iotune/read_bytes_sec'))
+        self.assertEqual(root.find('devices/interface/bandwidth/outbound').attrib,
+                         {'average': '512', 'burst': '2048'})
+        
+        domain = MagicMock()
+        domain.XMLDesc.return_value = xml
+        domain.isActive.return_value = True
+        applied = self.manager._get_io_limits(domain)
+        self.assertEqual({key: value for key, value in applied.items() if value}, limits)
+        
+        self.manager.conn = MagicMock()
+        self.manager.conn.lookupByName.return_value = domain
+        self.assertTrue(self.manager.set_io_tune('test-vm', {'total_iops_sec': 0, 'inbound_peak': 4096}))
+        domain.setBlockIoTune.assert_called_once_with('vda', {'total_iops_sec': 0}, 3)
+        domain.setInterfaceParameters.assert_called_once_with('52:54:00:12:34:56', {'inbound.peak': 4096}, 3)
+    
+    def test_resolve_io_limits(self):
+        """测试学生角色使用课堂限速策略，其他用户不限速"""
+        student = User.objects.create_user(
+            username='student1', password='test123', role=Role.objects.get_or_create(name='student')[0]
+        )
+        teacher = User.objects.create_user(username='teacher1', password='test123')
+        vm = VirtualMachine(name='io-vm', owner=student, cpu_cores=1, memory_mb=1024, disk_gb=10)
+        self.assertEqual(resolve_io_limits(vm)['total_iops_sec'], 2000)
+        vm.owner = teacher
+        self.assertFalse(any(resolve_io_limits(vm).values()))
     
     @patch('socket.socket')
     def test_is_port_available(self, mock_socket):
@@ -775,3 +2111,87 @@ class LibvirtManagerTest(TestCase):
 
 if __name__ == '__main__':
     pytest.main([__file__])
+
+
+class StorageManagerTest(TestCase):
+    """存储卷管理测试"""
+    
+    def setUp(self):
+        """设置测试数据"""
+        self.manager = MagicMock()
+        self.storage = StorageManager(self.manager)
+        self.pool = self.manager.conn.storagePoolLookupByName.return_value
+        self.pool.isActive.return_value = True
+    
+    def test_create_overlay(self):
+        """测试在存储池中创建覆盖层卷"""
+        self.manager.conn.storageVolLookupByPath.return_value.info.return_value = [0, 10 * 1024 ** 3, 0]
+        self.pool.createXML.return_value.path.return_value = '/pool/test-vm.qcow2'
+        
+        path = self.storage.create_overlay('disks', 'test-vm.qcow2', '/tpl/base.qcow2', 40 * 1024 ** 3)
+        
+        self.assertEqual(path, '/pool/test-vm.qcow2')
+        volume = ET.fromstring(self.pool.createXML.call_args[0][0])
+        self.assertEqual(volume.findtext('name'), 'test-vm.qcow2')
+        self.assertEqual(volume.findtext('capacity'), str(40 * 1024 ** 3))
+        self.assertEqual(volume.findtext('backingStore/path'), '/tpl/base.qcow2')
+    
+    def test_create_overlay_not_smaller_than_backing(self):
+        """测试覆盖层不小于后备文件"""
+        self.manager.conn.storageVolLookupByPath.return_value.info.return_value = [0, 10 * 1024 ** 3, 0]
+        
+        self.storage.create_overlay('disks', 'test-vm.qcow2', '/tpl/base.qcow2', 1024 ** 3)
+        
+        volume = ET.fromstring(self.pool.createXML.call_args[0][0])
+        self.assertEqual(volume.findtext('capacity'), str(10 * 1024 ** 3))
+    
+    def test_delete_volume(self):
+        """测试清除并删除卷"""
+        volume = self.manager.conn.storageVolLookupByPath.return_value
+        
+        self.storage.delete_volume('/pool/test-vm.qcow2', wipe=True, wait=True)
+        
+        volume.wipe.assert_called_once_with(0)
+        volume.delete.assert_called_once_with(0)
+
+
+class DiskCopierTest(TestCase):
+    """磁盘复制引擎测试"""
+    
+    def setUp(self):
+        """创建带空洞的源文件"""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmpdir.name, 'src.qcow2')
+        self.dst = os.path.join(self.tmpdir.name, 'dst.qcow2')
+        with open(self.src, 'wb') as f:
+            f.write(b'head' * 1024)
+            f.seek(64 * 1024 * 1024)
+            f.write(b'tail' * 1024)
+    
+    def tearDown(self):
+        self.tmpdir.cleanup()
+    
+    def _assert_same(self):
+        with open(self.src, 'rb') as a, open(self.dst, 'rb') as b:
+            self.assertEqual(a.read(), b.read())
+    
+    def test_copy_with_progress(self):
+        """测试复制内容一致并报告进度"""
+        progress = MagicMock()
+        
+        result = DiskCopier(bytes_per_sec=0, progress=progress).copy(self.src, self.dst)
+        
+        self._assert_same()
+        self.assertTrue(progress.called)
+        copied, total = progress.call_args[0]
+        self.assertEqual(copied, total)
+        self.assertEqual(result['bytes_copied'], copied)
+    
+    @patch.object(DiskCopier, '_reflink', return_value=False)
+    def test_sparse_copy_skips_holes(self, mock_reflink):
+        """测试不支持reflink时只复制已分配区段"""
+        result = DiskCopier(bytes_per_sec=0).copy(self.src, self.dst)
+        
+        self._assert_same()
+        self.assertIn(result['method'], ('copy_file_range', 'pread'))
+        self.assertLess(result['bytes_copied'], os.path.getsize(self.src))
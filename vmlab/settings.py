@@ -149,6 +149,238 @@ AUTH_USER_MODEL = 'users.User'
 # Directory where libvirt stores VM images
 LIBVIRT_STORAGE_DIR = '/var/lib/libvirt/images'
 
+# libvirt storage pools by purpose: 'disks' holds VM disks (and their snapshot
+# overlays), 'templates' holds converted templates. Pools must already be
+# defined on the host, e.g. an SSD-backed pool for disks and an HDD-backed one
+# for templates.
+LIBVIRT_STORAGE_POOLS = {
+    'disks': 'default',
+    'templates': 'default',
+}
+
+# Online snapshot merges (blockcommit) that have not finished after
+# SNAPSHOT_MERGE_TIMEOUT seconds are cancelled; the overlay is kept.
+SNAPSHOT_MERGE_TIMEOUT = 1800
+
+# Large file transfers behind nginx (docker/nginx/default.conf).
+# With NGINX_ACCEL_REDIRECT enabled, template and VM disk downloads under a
+# directory listed in NGINX_ACCEL_LOCATIONS are authorized by Django and then
+# served by nginx from the mapped `internal` location via X-Accel-Redirect
+# (nginx handles Range requests); otherwise Django streams the file itself.
+NGINX_ACCEL_REDIRECT = False
+NGINX_ACCEL_LOCATIONS = {
+    '/var/lib/libvirt/images': '/protected/images/',
+}
+
+# Directory where nginx writes request bodies of whole-file template uploads
+# (client_body_in_file_only); only X-Upload-File paths inside it are trusted.
+# Keep it on the same filesystem as the templates pool so the file can be
+# renamed into place. Empty disables body-to-file uploads.
+NGINX_UPLOAD_DIR = ''
+
+# Size (bytes) of each chunk the template upload form sends; returned to
+# clients with the upload session. Larger chunk PUTs are rejected with 413.
+# The nginx client_max_body_size of the chunk location must be at least this.
+TEMPLATE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Throughput cap (bytes/second) for full disk image copies made by
+# apps.vms.diskcopy when a reflink clone is not possible; 0 disables it.
+DISK_COPY_BYTES_PER_SEC = 0
+
+# Template versions are qcow2 layers over their parent version; once the
+# newest version sits on more than this many backing layers it is flattened
+# into a standalone image in the background.
+TEMPLATE_MAX_CHAIN_DEPTH = 4
+
+# Hardware profiles for generated domain XML, selected per template via
+# VirtualMachineTemplate.hardware_profile. Keys not listed fall back to
+# apps.vms.profiles.DEFAULT_PROFILE.
+VM_HARDWARE_PROFILES = {
+    # Balloon statistics let apps.vms.balloon see guest memory use.
+    'default': {'memballoon_stats_period': 10},
+    'performance': {
+        'cpu_mode': 'host-passthrough',
+        'video': 'virtio',
+        'disk_bus': 'scsi',
+        'disk_cache': 'none',
+        'disk_io': 'native',
+        'discard': 'unmap',
+        'iothreads': 1,
+        'net_queues': 0,
+        'memballoon_stats_period': 10,
+        'max_vcpus': 8,
+        'max_memory_mb': 16384,
+    },
+    'performance-hugepages': {
+        'cpu_mode': 'host-passthrough',
+        'video': 'virtio',
+        'disk_bus': 'scsi',
+        'disk_cache': 'none',
+        'disk_io': 'io_uring',
+        'discard': 'unmap',
+        'iothreads': 1,
+        'net_queues': 0,
+        'memballoon_stats_period': 10,
+        'hugepages': True,
+        'max_vcpus': 8,
+    },
+}
+
+# CPU scheduling policies (apps.vms.cputune), written to <cputune> when a
+# domain is defined. 'shares' is the relative weight against other VMs on
+# the host, 'quota' the microseconds each vCPU may run per 'period'; 0
+# leaves a value at the hypervisor default (quota 0 = unlimited). A VM gets
+# 'default', then the policy named by its course (Course.cpu_policy), then
+# the policy mapped to its owner's role in VM_CPU_ROLE_POLICIES; later
+# policies override the keys they set.
+VM_CPU_POLICIES = {
+    'default': {},
+    'limited': {'shares': 512, 'period': 100000, 'quota': 50000},
+    'priority': {'shares': 2048},
+}
+VM_CPU_ROLE_POLICIES = {
+    'teacher': 'priority',
+}
+
+# Disk and network I/O limits (apps.vms.iotune), written to the system
+# disk's <iotune> and the interface's <bandwidth> when a domain is defined.
+# Disk keys use libvirt's iotune names (bytes/s, IOPS, *_max bursts held
+# for *_max_length seconds); network keys are inbound_/outbound_ average
+# and peak in KiB/s and burst in KiB. 0 means unlimited. A VM gets
+# 'default', then the policy named by its template's hardware profile
+# ('io_policy'), then the policy mapped to its owner's role.
+VM_IO_POLICIES = {
+    'default': {},
+    'classroom': {
+        'total_bytes_sec': 100 * 1024 ** 2,
+        'total_iops_sec': 2000,
+        'total_bytes_sec_max': 300 * 1024 ** 2,
+        'total_iops_sec_max': 6000,
+        'total_bytes_sec_max_length': 30,
+        'total_iops_sec_max_length': 30,
+        'inbound_average': 25600,
+        'inbound_peak': 51200,
+        'inbound_burst': 51200,
+        'outbound_average': 12800,
+        'outbound_peak': 25600,
+        'outbound_burst': 25600,
+    },
+}
+VM_IO_ROLE_POLICIES = {
+    'student': 'classroom',
+}
+
+# CPU throttling (apps.vms.cputune.CpuThrottler, run by reap_idle_vms): when
+# the sampled CPU use of a host's running VMs adds up to at least
+# CPU_THROTTLE_HOST_PERCENT of its physical CPUs, a VM that has used at least
+# CPU_THROTTLE_VM_PERCENT of its vCPUs for CPU_THROTTLE_SUSTAIN_SECONDS is
+# capped to CPU_THROTTLE_QUOTA_PERCENT of a CPU per vCPU for
+# CPU_THROTTLE_DURATION seconds (live only, a restart lifts it).
+# CPU_THROTTLE_VM_PERCENT = 0 disables throttling.
+CPU_THROTTLE_VM_PERCENT = 90
+CPU_THROTTLE_SUSTAIN_SECONDS = 300
+CPU_THROTTLE_HOST_PERCENT = 90
+CPU_THROTTLE_QUOTA_PERCENT = 50
+CPU_THROTTLE_DURATION = 600
+
+# Boot admission (apps.vms.admission): create/start/restart requests queue
+# per host. At most ADMISSION_MAX_CONCURRENT_BOOTS VMs may be booting at
+# once and at most ADMISSION_BOOTS_PER_MINUTE boots are admitted per
+# rolling minute (0 disables either limit). A VM holds its slot until it
+# gets a DHCP lease or answers a guest-agent ping, or for at most
+# ADMISSION_BOOT_TIMEOUT seconds; the queue is polled every
+# ADMISSION_POLL_INTERVAL seconds while non-empty.
+ADMISSION_MAX_CONCURRENT_BOOTS = 8
+ADMISSION_BOOTS_PER_MINUTE = 20
+ADMISSION_BOOT_TIMEOUT = 300
+ADMISSION_POLL_INTERVAL = 2
+# Fair share: interactive requests (a user acting on one VM) are admitted
+# before batch work (lab-session pre-start). Within a priority class the
+# next slot goes to the course with the fewest admissions in the last
+# ADMISSION_FAIR_SHARE_WINDOW seconds relative to Course.admission_weight,
+# then to the least-served user in that course.
+ADMISSION_FAIR_SHARE_WINDOW = 600
+
+# Host capacity (apps.vms.capacity): before a VM is created, started or
+# resized while running, its vCPUs and memory are reserved against the host.
+# Reserved vCPUs may not exceed host CPUs * HOST_CPU_OVERCOMMIT and reserved
+# memory may not exceed (host memory - HOST_RESERVED_MEMORY_MB) *
+# HOST_MEMORY_OVERCOMMIT; with memory overcommit above 1.0 the host must also
+# have the requested memory actually available. The sum of VM disk sizes may
+# not exceed the 'disks' pool capacity * HOST_DISK_OVERCOMMIT (thin disks).
+# HOST_CAPACITY_EXCEEDED_ACTION: 'reject' fails the request immediately,
+# 'queue' keeps it in the admission queue until capacity is released.
+# When a host's capacity cannot be read (e.g. no 'disks' pool) while VMs are
+# running on it, reservations are refused instead of being unlimited.
+HOST_CPU_OVERCOMMIT = 4.0
+HOST_MEMORY_OVERCOMMIT = 1.0
+HOST_DISK_OVERCOMMIT = 2.0
+HOST_RESERVED_MEMORY_MB = 2048
+HOST_CAPACITY_EXCEEDED_ACTION = 'reject'
+
+# Preemption (apps.vms.preemption): before a create or start is rejected or
+# left queued for lack of host capacity, running VMs on the same host that
+# have been idle for PREEMPTION_IDLE_MINUTES are managed-saved to make room,
+# lowest Course.preemption_priority first and longest idle first within a
+# priority, at most PREEMPTION_MAX_VMS per request. A VM only preempts VMs
+# whose course priority is not higher than its own; nothing is preempted
+# unless the idle VMs free enough. Preempted VMs resume on their next start.
+# PREEMPTION_IDLE_MINUTES = 0 disables preemption.
+PREEMPTION_IDLE_MINUTES = 60
+PREEMPTION_MAX_VMS = 4
+
+# Placement (apps.vms.placement): with Host rows defined, a new VM goes to
+# the enabled host with the best score among those with enough capacity and
+# no VM of the same anti-affinity group. The score is the weighted fraction
+# of memory and CPU left after placement, plus PLACEMENT_LOCALITY_WEIGHT when
+# the host already runs VMs of the same template. Without Host rows every VM
+# runs on the default libvirt connection.
+PLACEMENT_MEMORY_WEIGHT = 1.0
+PLACEMENT_CPU_WEIGHT = 0.5
+PLACEMENT_LOCALITY_WEIGHT = 0.3
+
+# Rebalancing (apps.vms.rebalance, manage.py rebalance_vms): an offline plan
+# that moves as few VMs as possible so that no host exceeds
+# REBALANCE_TARGET_UTILIZATION of its physical CPUs (by sampled VM CPU usage,
+# at least REBALANCE_CPU_FLOOR_PERCENT of each VM's vCPUs) or of its
+# allocatable memory. Disabled hosts are drained. Only stopped VMs are moved.
+REBALANCE_TARGET_UTILIZATION = 0.85
+REBALANCE_CPU_FLOOR_PERCENT = 10
+
+# Memory ballooning (apps.vms.balloon.MemoryManager, run by reap_idle_vms):
+# when a host's available memory drops below BALLOON_HOST_FREE_PERCENT of
+# its physical memory, running VMs idle for BALLOON_IDLE_MINUTES have their
+# balloon inflated down to what the guest uses plus BALLOON_HEADROOM_MB, but
+# not below BALLOON_MIN_PERCENT of their configured memory. The reclaimed
+# memory is released from the host capacity ledger. A ballooned VM grows
+# back to its configured memory once it is active again or its free memory
+# falls below BALLOON_HEADROOM_MB. VMs defined without balloon statistics
+# get them enabled with BALLOON_STATS_PERIOD seconds.
+# BALLOON_HOST_FREE_PERCENT = 0 disables shrinking.
+BALLOON_HOST_FREE_PERCENT = 15
+BALLOON_IDLE_MINUTES = 10
+BALLOON_HEADROOM_MB = 256
+BALLOON_MIN_PERCENT = 25
+BALLOON_STATS_PERIOD = 10
+
+# Idle VM reaper: sampling interval (seconds) and activity thresholds.
+# A VM counts as active when any sample exceeds a threshold or a VNC
+# console session is connected; the per-course policy decides what
+# happens after Course.idle_timeout_minutes without activity.
+IDLE_SAMPLE_INTERVAL = 60
+IDLE_CPU_PERCENT = 5.0
+IDLE_NET_BYTES_PER_SEC = 2048
+
+# Lab session scheduler (manage.py run_lab_scheduler): check interval
+# (seconds), VMs started per wave, seconds between waves, and host memory
+# (MB) kept free when sizing a wave. Sessions start pre-starting
+# LabSession.prestart_minutes before the bell and are stopped or suspended
+# LabSession.grace_minutes after they end.
+LAB_SCHEDULER_INTERVAL = 30
+LAB_SESSION_WAVE_SIZE = 10
+LAB_SESSION_WAVE_INTERVAL = 60
+LAB_SESSION_HOST_RESERVE_MB = 2048
+
 STATICFILES_DIRS = [
     BASE_DIR / 'frontend' / 'static'
 ]